@@ -0,0 +1,266 @@
+# benchmarks/bench_admission.py
+# 受け入れ制御のベンチマーク
+#
+# 1. 1 万ユーザー分の状態を持つストアで、1 リクエストあたりの判定 + 解放にかかる時間 (メモリ / SQLite)
+# 2. 推論サーバーが飽和している状況で、1 人の重いユーザーと多数の軽いユーザーに枠がどう配分されるかのシミュレーション
+#    (受け入れ制御なし: 空いていれば先着順に受け入れ、満杯なら拒否 / あり: AdmissionPolicy で判定し、取り分内なら待つ)
+# 3. --dynamodb を指定した場合、DynamoDB のストアに多数のスレッドから同時に acquire / release したときのレイテンシ、
+#    ストアのエラー (fail-open) の数、全体の容量を超えて受け入れていないか
+#    (--dynamodb-endpoint で DynamoDB Local などを指定、省略時は moto のモック)
+#
+# 使い方: python benchmarks/bench_admission.py [--users 10000] [--requests 20000] [--seconds 60]
+#         pip install boto3 "moto[dynamodb]" && python benchmarks/bench_admission.py --dynamodb [--threads 32]
+import argparse
+import os
+import random
+import sys
+import tempfile
+import threading
+import time
+from concurrent.futures import ThreadPoolExecutor
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), '..', 'lambda'))
+
+from admission import (SATURATED, AdmissionController, AdmissionPolicy, AdmissionRejected,  # noqa: E402
+                       DynamoDBAdmissionStore, MemoryAdmissionStore, SQLiteAdmissionStore)
+from bench_logging import percentile  # noqa: E402
+
+
+def measure_overhead(store, policy, users, requests, seed=0):
+    """全ユーザーの状態を作ってから、ランダムなユーザーで acquire + release した時間 (マイクロ秒) を返します。"""
+    now = time.time()
+    for i in range(users):
+        lease_id = f"warm{i}"
+        if store.acquire(f"user{i}", lease_id, policy, now).admitted:
+            store.release(f"user{i}", lease_id)
+    rng = random.Random(seed)
+    latencies = []
+    for i in range(requests):
+        user = f"user{rng.randrange(users)}"
+        lease_id = f"req{i}"
+        start = time.perf_counter()
+        if store.acquire(user, lease_id, policy, time.time()).admitted:
+            store.release(user, lease_id)
+        latencies.append((time.perf_counter() - start) * 1e6)
+    return latencies
+
+
+class SerializedClient:
+    """
+    クライアントの呼び出しを 1 つずつ実行します。
+
+    moto はスレッドから同時に呼び出すと 1 回の書き込み (条件付きの ADD など) がアトミックにならないので、
+    DynamoDB と同じく 1 回の呼び出しがアトミックになるようにします (呼び出しの間には他のスレッドが割り込める)。
+    """
+
+    def __init__(self, client):
+        self._client = client
+        self._lock = threading.Lock()
+
+    def __getattr__(self, name):
+        attr = getattr(self._client, name)
+        if not callable(attr):
+            return attr
+
+        def call(*args, **kwargs):
+            with self._lock:
+                return attr(*args, **kwargs)
+        return call
+
+
+def open_dynamodb(endpoint_url=None):
+    """DynamoDB Local など (endpoint_url) か moto のモックにテーブルを作り、(ストア, 後片付けの関数) を返します。"""
+    import boto3  # 使う場合のみ読み込む
+    for key, value in (("AWS_ACCESS_KEY_ID", "bench"), ("AWS_SECRET_ACCESS_KEY", "bench"),
+                       ("AWS_DEFAULT_REGION", "us-east-1")):
+        os.environ.setdefault(key, value)
+    stop = None
+    if not endpoint_url:
+        from moto import mock_aws
+        mock = mock_aws()
+        mock.start()
+        stop = mock.stop
+    client = boto3.client("dynamodb", endpoint_url=endpoint_url)
+    if not endpoint_url:
+        client = SerializedClient(client)
+    table = f"bench-admission-{os.getpid()}"
+    client.create_table(TableName=table, KeySchema=[{"AttributeName": "pk", "KeyType": "HASH"}],
+                        AttributeDefinitions=[{"AttributeName": "pk", "AttributeType": "S"}],
+                        BillingMode="PAY_PER_REQUEST")
+    client.get_waiter("table_exists").wait(TableName=table)
+
+    def close():
+        client.delete_table(TableName=table)
+        if stop:
+            stop()
+    return DynamoDBAdmissionStore(table, client=client), close
+
+
+def measure_concurrent(store, policy, threads, requests, users, hold_seconds=0.005):
+    """
+    threads 並列で AdmissionController.acquire → hold_seconds 待つ → release を繰り返し、集計を返します。
+
+    Returns:
+        dict: acquire / release のレイテンシ (ミリ秒)、受け入れ・拒否・ストアのエラーの数、観測した最大同時実行数。
+    """
+    controller = AdmissionController(store, policy, queue_timeout=0)
+    lock = threading.Lock()
+    state = {"inflight": 0, "max_inflight": 0, "admitted": 0, "rejected": 0}
+    acquire_ms, release_ms = [], []
+
+    def one(i):
+        user = f"user{i % users}"
+        started = time.perf_counter()
+        try:
+            lease_id = controller.acquire(user)
+        except AdmissionRejected:
+            with lock:
+                state["rejected"] += 1
+            return
+        finally:
+            acquire_ms.append((time.perf_counter() - started) * 1000)
+        if lease_id is None:
+            return  # ストアの障害で fail-open した
+        with lock:
+            state["admitted"] += 1
+            state["inflight"] += 1
+            state["max_inflight"] = max(state["max_inflight"], state["inflight"])
+        time.sleep(hold_seconds)
+        with lock:
+            state["inflight"] -= 1
+        started = time.perf_counter()
+        controller.release(user, lease_id)
+        release_ms.append((time.perf_counter() - started) * 1000)
+
+    with ThreadPoolExecutor(max_workers=threads) as executor:
+        list(executor.map(one, range(requests)))
+    return {**state, "acquire_ms": acquire_ms, "release_ms": release_ms, "store_errors": controller.store_errors}
+
+
+def simulate(policy, seconds, capacity, service_seconds, heavy_rate, light_users, light_rate, queue_timeout,
+             tick=0.01, seed=0):
+    """
+    仮想時刻で到着・処理を進め、ユーザー種別ごとの集計を返します。
+
+    policy が None の場合は受け入れ制御なし (全体の同時実行数が capacity 未満なら受け入れ、満杯なら拒否) として扱います。
+    """
+    rng = random.Random(seed)
+    store = MemoryAdmissionStore()
+    running = []  # (終了時刻, ユーザー, リース ID)
+    waiting = []  # (到着時刻, ユーザー)
+    inflight = {}
+    stats = {kind: {"sent": 0, "admitted": 0, "rejected": 0, "wait": 0.0} for kind in ("heavy", "light")}
+    kind_of = lambda user: "heavy" if user == "heavy" else "light"  # noqa: E731
+    seq = 0
+
+    def try_admit(user, arrived, now):
+        nonlocal seq
+        seq += 1
+        lease_id = str(seq)
+        if policy is None:
+            admitted = sum(inflight.values()) < capacity
+            reason = None if admitted else "full"
+        else:
+            decision = store.acquire(user, lease_id, policy, now)
+            admitted, reason = decision.admitted, decision.reason
+        if admitted:
+            inflight[user] = inflight.get(user, 0) + 1
+            running.append((now + service_seconds, user, lease_id))
+            stats[kind_of(user)]["admitted"] += 1
+            stats[kind_of(user)]["wait"] += now - arrived
+        return admitted, reason
+
+    steps = int(seconds / tick)
+    for step in range(steps):
+        now = step * tick
+        for item in [item for item in running if item[0] <= now]:
+            running.remove(item)
+            _, user, lease_id = item
+            inflight[user] -= 1
+            if policy is not None:
+                store.release(user, lease_id)
+
+        arrivals = []
+        if rng.random() < heavy_rate * tick:
+            arrivals.append("heavy")
+        for i in range(light_users):
+            if rng.random() < light_rate * tick:
+                arrivals.append(f"light{i}")
+        for user in arrivals:
+            stats[kind_of(user)]["sent"] += 1
+            waiting.append((now, user))
+
+        # 同時実行数が少ないユーザーから再判定する (AdmissionController の再判定間隔の差に相当)
+        waiting.sort(key=lambda item: (inflight.get(item[1], 0), item[0]))
+        still_waiting = []
+        for arrived, user in waiting:
+            admitted, reason = try_admit(user, arrived, now)
+            if admitted:
+                continue
+            if reason == SATURATED and now - arrived < queue_timeout:
+                still_waiting.append((arrived, user))
+            else:
+                stats[kind_of(user)]["rejected"] += 1
+        waiting = still_waiting
+    return stats
+
+
+def main():
+    parser = argparse.ArgumentParser(description="受け入れ制御のベンチマーク")
+    parser.add_argument("--users", type=int, default=10000, help="状態を持つユーザー数")
+    parser.add_argument("--requests", type=int, default=20000, help="オーバーヘッドを計測するリクエスト数")
+    parser.add_argument("--seconds", type=float, default=60, help="シミュレーションの長さ (仮想時刻の秒数)")
+    parser.add_argument("--dynamodb", action="store_true", help="DynamoDB のストアに並列に送るベンチマークも実行する")
+    parser.add_argument("--dynamodb-endpoint", help="DynamoDB のエンドポイント (省略時は moto のモック)")
+    parser.add_argument("--threads", type=int, default=32, help="DynamoDB のベンチマークの並列数")
+    parser.add_argument("--dynamodb-requests", type=int, default=2000, help="DynamoDB のベンチマークのリクエスト数")
+    args = parser.parse_args()
+
+    policy = AdmissionPolicy(rate_per_second=1, burst=5, max_concurrency=2, global_capacity=64)
+    print(f"admission overhead ({args.users} users, {args.requests} requests, acquire + release)")
+    print(f"{'store':<8} {'p50 us':>9} {'p99 us':>9} {'mean us':>9}")
+    with tempfile.TemporaryDirectory() as tmp:
+        stores = [("memory", MemoryAdmissionStore()), ("sqlite", SQLiteAdmissionStore(os.path.join(tmp, "a.db")))]
+        for label, store in stores:
+            latencies = measure_overhead(store, policy, args.users, args.requests)
+            print(f"{label:<8} {percentile(latencies, 0.5):>9.1f} {percentile(latencies, 0.99):>9.1f} "
+                  f"{sum(latencies) / len(latencies):>9.1f}")
+
+    # 容量 8 (1 件 1 秒) に対し、重いユーザー 1 人が 20 件/秒、軽いユーザー 20 人が合計 4 件/秒を送る
+    capacity = 8
+    scenario = dict(seconds=args.seconds, capacity=capacity, service_seconds=1.0, heavy_rate=20,
+                    light_users=20, light_rate=0.2, queue_timeout=2.0)
+    print()
+    print(f"saturated backend (capacity {capacity}, heavy user 20 req/s, 20 light users 0.2 req/s each)")
+    print(f"{'admission':<10} {'user':<6} {'sent':>6} {'admitted':>9} {'rejected %':>11} {'mean wait ms':>13}")
+    for label, sim_policy in (("off", None),
+                              ("on", AdmissionPolicy(rate_per_second=5, burst=10, max_concurrency=4,
+                                                     global_capacity=capacity))):
+        stats = simulate(sim_policy, **scenario)
+        for kind in ("heavy", "light"):
+            s = stats[kind]
+            wait = s["wait"] / s["admitted"] * 1000 if s["admitted"] else 0.0
+            print(f"{label:<10} {kind:<6} {s['sent']:>6} {s['admitted']:>9} "
+                  f"{s['rejected'] / max(1, s['sent']) * 100:>10.1f}% {wait:>13.0f}")
+
+    if args.dynamodb:
+        # 多数のユーザーが同時に送り、全体の容量 (threads の半分) で拒否が起きる状況
+        capacity = max(1, args.threads // 2)
+        dynamodb_policy = AdmissionPolicy(rate_per_second=0, max_concurrency=2, global_capacity=capacity)
+        store, close = open_dynamodb(args.dynamodb_endpoint)
+        try:
+            print()
+            print(f"dynamodb store ({args.threads} threads, {args.dynamodb_requests} requests, 100 users, "
+                  f"global capacity {capacity})")
+            print(f"{'acquire p50 ms':>15} {'p99 ms':>8} {'release p50 ms':>15} {'admitted':>9} {'rejected':>9} "
+                  f"{'store errors':>13} {'max inflight':>13}")
+            r = measure_concurrent(store, dynamodb_policy, args.threads, args.dynamodb_requests, 100)
+            print(f"{percentile(r['acquire_ms'], 0.5):>15.1f} {percentile(r['acquire_ms'], 0.99):>8.1f} "
+                  f"{percentile(r['release_ms'], 0.5):>15.1f} {r['admitted']:>9} {r['rejected']:>9} "
+                  f"{r['store_errors']:>13} {r['max_inflight']:>13}")
+        finally:
+            close()
+
+
+if __name__ == "__main__":
+    main()
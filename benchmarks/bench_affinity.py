@@ -0,0 +1,133 @@
+# benchmarks/bench_affinity.py
+# 会話のアフィニティルーティングで、推論サーバーのプレフィックス (KV) キャッシュがどれだけ再利用され、
+# レイテンシがどれだけ下がるかを比較するベンチマーク
+#
+# 使い方: python benchmarks/bench_affinity.py [--backends 4] [--conversations 32] [--turns 6] [--concurrency 16]
+#
+# スタブの推論サーバーを --backends 台起動し (stub_backend.PrefixCache でキャッシュに載っていない部分の prefill
+# 時間を加える)、会話履歴を含むプロンプトを UpstreamEngine 経由で送ります。ターンごとにプロンプトは伸びていき、
+# 前のターンのプロンプトが次のターンのプレフィックスになります。
+#
+# least_outstanding: 従来どおり未完了数が最少のバックエンドに送る
+# affinity:          会話 ID ごとにコンシステントハッシュで決めたバックエンドに送る
+# affinity +dead:    停止したバックエンドを 1 台加えた場合 (ブレーカーが開くまでの失敗と、リング上の次への割り当て)
+import argparse
+import asyncio
+import collections
+import json
+import os
+import socket
+import sys
+import time
+
+sys.path.insert(0, os.path.dirname(os.path.abspath(__file__)))
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), '..', 'lambda'))
+
+import stub_backend  # noqa: E402
+from bench_logging import percentile  # noqa: E402
+from upstream import UpstreamEngine  # noqa: E402
+
+SYSTEM_PROMPT = "System: あなたは社内ヘルプデスクのアシスタントです。丁寧に、簡潔に答えてください。\n" * 20
+HEADERS = {"Content-Type": "application/json", "Accept": "application/json"}
+
+
+def dead_url():
+    """接続を拒否するアドレス (一度確保して閉じたポート) を返します。"""
+    sock = socket.socket()
+    sock.bind(("127.0.0.1", 0))
+    port = sock.getsockname()[1]
+    sock.close()
+    return f"http://127.0.0.1:{port}"
+
+
+async def conversation(engine, index, args, semaphore, latencies, served, failures):
+    history = SYSTEM_PROMPT
+    for turn in range(args.turns):
+        message = f"User: 会話{index} の {turn} 番目の質問です。" + "詳しい状況の説明。" * (args.message_chars // 9) + "\n"
+        prompt = history + message + "Assistant:"
+        body = json.dumps({"prompt": prompt, "max_new_tokens": 64, "do_sample": False}).encode('utf-8')
+        async with semaphore:
+            started = time.perf_counter()
+            try:
+                status, data, backend_url, _ = await engine.post('/generate', body, HEADERS, timeout=30.0,
+                                                                 affinity_key=f"conversation{index}")
+            except Exception:
+                failures.append(index)
+                continue
+            latencies.append((time.perf_counter() - started) * 1000)
+        served[backend_url] += 1
+        answer = json.loads(data).get("generated_text", "") if status == 200 else ""
+        history = prompt + answer + "\n"
+
+
+def run(policy, args, dead=False):
+    caches, servers, urls = [], [], []
+    model = stub_backend.GenerationModel(args.ttft_ms, 0, args.tokens_per_second, args.output_tokens, seed=0)
+    for _ in range(args.backends):
+        cache = stub_backend.PrefixCache(args.prefill_ms_per_token, args.cache_tokens)
+        server, _, url = stub_backend.start(model=model, prefix_cache=cache)
+        caches.append(cache)
+        servers.append(server)
+        urls.append(url)
+    if dead:
+        urls.append(dead_url())
+    engine = UpstreamEngine(urls, policy=policy, breaker_options={"min_requests": 5, "open_seconds": 60})
+
+    latencies, failures = [], []
+    served = collections.Counter()
+
+    async def main():
+        semaphore = asyncio.Semaphore(args.concurrency)
+        await asyncio.gather(*(conversation(engine, i, args, semaphore, latencies, served, failures)
+                               for i in range(args.conversations)))
+
+    started = time.perf_counter()
+    asyncio.run(main())
+    elapsed = time.perf_counter() - started
+    for server in servers:
+        server.shutdown()
+        server.server_close()
+    prompt_tokens = sum(c.prompt_tokens for c in caches)
+    cached_tokens = sum(c.cached_tokens for c in caches)
+    loads = [served[url] for url in urls[:args.backends]]
+    return {
+        "latencies": latencies,
+        "failures": len(failures),
+        "hit_pct": cached_tokens / prompt_tokens * 100 if prompt_tokens else 0.0,
+        "max_load": max(loads) / (sum(loads) / len(loads)) if sum(loads) else 0.0,
+        "elapsed": elapsed,
+        "spills": engine.affinity_spills,
+    }
+
+
+def main():
+    parser = argparse.ArgumentParser(description="会話のアフィニティルーティングのベンチマーク")
+    parser.add_argument("--backends", type=int, default=4, help="スタブの推論サーバーの台数")
+    parser.add_argument("--conversations", type=int, default=32, help="会話の数")
+    parser.add_argument("--turns", type=int, default=6, help="1 会話のターン数")
+    parser.add_argument("--concurrency", type=int, default=16, help="同時に送るリクエスト数")
+    parser.add_argument("--message-chars", type=int, default=300, help="1 ターンのユーザーメッセージの文字数")
+    parser.add_argument("--prefill-ms-per-token", type=float, default=0.2, help="キャッシュミスした 1 トークンの prefill 時間")
+    parser.add_argument("--cache-tokens", type=int, default=8000, help="1 台のプレフィックスキャッシュの容量 (トークン数)")
+    parser.add_argument("--ttft-ms", type=float, default=20.0, help="prefill 以外の最初のトークンまでの時間")
+    parser.add_argument("--tokens-per-second", type=float, default=400.0, help="トークンの生成速度")
+    parser.add_argument("--output-tokens", type=int, default=16, help="出力トークン数の平均")
+    args = parser.parse_args()
+
+    print(f"{args.backends} backends, {args.conversations} conversations x {args.turns} turns, "
+          f"concurrency {args.concurrency}, prefill {args.prefill_ms_per_token:g} ms/token, "
+          f"cache {args.cache_tokens} tokens/backend")
+    print(f"{'policy':<18} {'requests':>8} {'failed':>7} {'prefix hit %':>13} {'mean ms':>8} {'p50 ms':>8} "
+          f"{'p95 ms':>8} {'max/avg load':>13} {'spills':>7} {'wall s':>7}")
+    variants = [("least_outstanding", "least_outstanding", False), ("affinity", "affinity", False),
+                ("affinity +dead", "affinity", True)]
+    for label, policy, dead in variants:
+        r = run(policy, args, dead)
+        latencies = r["latencies"]
+        print(f"{label:<18} {len(latencies):>8} {r['failures']:>7} {r['hit_pct']:>13.1f} "
+              f"{sum(latencies) / len(latencies):>8.1f} {percentile(latencies, 0.5):>8.1f} "
+              f"{percentile(latencies, 0.95):>8.1f} {r['max_load']:>13.2f} {r['spills']:>7} {r['elapsed']:>7.1f}")
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,76 @@
+# benchmarks/bench_batching.py
+# マイクロバッチングのバッチサイズごとのスループットとレイテンシ (p50 / p99) を計測するベンチマーク
+#
+# 使い方: python benchmarks/bench_batching.py [--concurrency 32] [--requests 256] [--max-wait-ms 10]
+import argparse
+import asyncio
+import os
+import sys
+import time
+
+sys.path.insert(0, os.path.dirname(os.path.abspath(__file__)))
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), '..', 'lambda'))
+
+import stub_backend  # noqa: E402
+from batching import HttpBatchSender, MicroBatcher  # noqa: E402
+
+
+def percentile(values, q):
+    ordered = sorted(values)
+    return ordered[min(len(ordered) - 1, int(q * len(ordered)))]
+
+
+async def run(url, max_batch_size, args):
+    """concurrency 個のクライアントが合計 requests 件を送り、スループットとレイテンシを返します。"""
+    batcher = MicroBatcher(HttpBatchSender(url), max_batch_size=max_batch_size, max_wait_ms=args.max_wait_ms,
+                           flush_when_idle=args.flush_when_idle, max_in_flight=args.max_in_flight)
+    latencies = []
+    remaining = iter(range(args.requests))
+
+    async def client():
+        for i in remaining:
+            payload = {"prompt": f"質問 {i}: バッチ推論の利点は?", "max_new_tokens": 128, "temperature": 0.7,
+                       "top_p": 0.9, "do_sample": True}
+            start = time.perf_counter()
+            await batcher.submit(payload)
+            latencies.append((time.perf_counter() - start) * 1000)
+
+    start = time.perf_counter()
+    await asyncio.gather(*(client() for _ in range(args.concurrency)))
+    elapsed = time.perf_counter() - start
+    stats = batcher.stats()
+    return {
+        "throughput_rps": args.requests / elapsed,
+        "p50_ms": percentile(latencies, 0.5),
+        "p99_ms": percentile(latencies, 0.99),
+        "mean_batch_size": stats["mean_batch_size"],
+        "batches": stats["batches"],
+    }
+
+
+def main():
+    parser = argparse.ArgumentParser(description="マイクロバッチングのベンチマーク")
+    parser.add_argument("--concurrency", type=int, default=32, help="同時に送るクライアント数")
+    parser.add_argument("--requests", type=int, default=256, help="送信するリクエストの総数")
+    parser.add_argument("--max-wait-ms", type=float, default=10.0, help="バッチを待つ最大時間 (ミリ秒)")
+    parser.add_argument("--flush-when-idle", action="store_true", help="送信中のバッチがなければ待たずに送る")
+    parser.add_argument("--max-in-flight", type=int, default=None, help="同時に送信するバッチ数の上限")
+    parser.add_argument("--base-ms", type=float, default=20.0, help="スタブの forward 固定コスト (ミリ秒)")
+    parser.add_argument("--per-item-ms", type=float, default=2.0, help="スタブのバッチ 1 件あたりのコスト (ミリ秒)")
+    args = parser.parse_args()
+
+    server, _, url = stub_backend.start(base_ms=args.base_ms, per_item_ms=args.per_item_ms)
+    print(f"stub: base={args.base_ms}ms per_item={args.per_item_ms}ms concurrency={args.concurrency} "
+          f"requests={args.requests} max_wait={args.max_wait_ms}ms")
+    print(f"{'batch':>6} {'rps':>9} {'p50 ms':>9} {'p99 ms':>9} {'mean size':>10} {'batches':>8}")
+    try:
+        for size in (1, 2, 4, 8, 16, 32):
+            r = asyncio.run(run(url, size, args))
+            print(f"{size:>6} {r['throughput_rps']:>9.1f} {r['p50_ms']:>9.1f} {r['p99_ms']:>9.1f} "
+                  f"{r['mean_batch_size']:>10} {r['batches']:>8}")
+    finally:
+        server.shutdown()
+
+
+if __name__ == "__main__":
+    main()
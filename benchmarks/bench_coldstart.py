@@ -0,0 +1,140 @@
+# benchmarks/bench_coldstart.py
+# Lambda ハンドラのコールドスタート (モジュール初期化) 時間と import コストの内訳を計測する
+#
+# 使い方: python benchmarks/bench_coldstart.py [--repeat 10] [--top 12] [--ref HEAD~1]
+#
+# 毎回新しいインタプリタで `import index` を実行し、-X importtime の出力から
+# index が直接 import しているモジュールごとの累積コストを集計します。
+# --ref を指定すると、その git リビジョンの lambda/ も同じ条件で計測して比較します。
+import argparse
+import os
+import re
+import statistics
+import subprocess
+import sys
+import tarfile
+import tempfile
+import time
+
+ROOT = os.path.join(os.path.dirname(os.path.abspath(__file__)), '..')
+
+# 計測対象の import だけを測る (json なども index の初期化コストに含めたいので、ここでは何も import しない)
+SNIPPET = (
+    "import time\n"
+    "t = time.perf_counter()\n"
+    "import index\n"
+    "import sys\n"
+    "sys.stdout.write(f'\\ninit_ms {(time.perf_counter() - t) * 1000}\\n')\n"
+)
+
+# 推論サーバーには接続しない (接続の事前確立を有効にしている場合もすぐに失敗させる)
+DEFAULT_ENV = {
+    "NGROK_URL": "http://127.0.0.1:9",
+    "PYTHONDONTWRITEBYTECODE": "",
+}
+
+
+def parse_importtime(stderr):
+    """-X importtime の出力を (モジュール名, 深さ, self_us, cumulative_us) のリストにします。"""
+    rows = []
+    for line in stderr.splitlines():
+        if not line.startswith("import time:") or "self [us]" in line:
+            continue
+        self_us, cumulative_us, name = line.split(":", 1)[1].split("|")
+        # モジュール名の前の空白 1 段 (2 文字) が import のネストの深さを表す
+        name = name[1:]
+        depth = (len(name) - len(name.lstrip(" "))) // 2
+        rows.append((name.strip(), depth, int(self_us), int(cumulative_us)))
+    return rows
+
+
+def index_breakdown(rows):
+    """index が直接 import したモジュールごとの累積コスト (マイクロ秒) を返します。"""
+    for i, (name, depth, _, cumulative) in enumerate(rows):
+        if name == "index":
+            break
+    else:
+        raise RuntimeError("index was not imported")
+    breakdown = {}
+    # importtime は後行順で出力されるので、index の行の直前に子孫が並ぶ
+    for child, child_depth, _, child_cumulative in reversed(rows[:i]):
+        if child_depth <= depth:
+            break
+        if child_depth == depth + 1:
+            breakdown[child] = child_cumulative
+    return cumulative, breakdown
+
+
+def run_once(lambda_dir, env):
+    started = time.perf_counter()
+    result = subprocess.run(
+        [sys.executable, "-X", "importtime", "-c", SNIPPET],
+        cwd=lambda_dir, env=env, capture_output=True, text=True, check=True,
+    )
+    process_ms = (time.perf_counter() - started) * 1000
+    # index の初期化中のログ (バックグラウンドスレッドから出力される) と混ざっても読めるよう、目印を付けて出力する
+    init_ms = float(re.search(r"^init_ms ([0-9.]+)$", result.stdout, re.M).group(1))
+    import_us, breakdown = index_breakdown(parse_importtime(result.stderr))
+    return process_ms, init_ms, import_us, breakdown
+
+
+def measure(lambda_dir, repeat, env):
+    run_once(lambda_dir, env)  # .pyc の生成とページキャッシュの影響を除く
+    runs = [run_once(lambda_dir, env) for _ in range(repeat)]
+    modules = {}
+    for _, _, _, breakdown in runs:
+        for name, us in breakdown.items():
+            modules.setdefault(name, []).append(us)
+    return {
+        "process_ms": statistics.median(r[0] for r in runs),
+        "init_ms": statistics.median(r[1] for r in runs),
+        "import_index_ms": statistics.median(r[2] for r in runs) / 1000,
+        "modules_ms": {name: statistics.median(v) / 1000 for name, v in modules.items()},
+    }
+
+
+def checkout_lambda(ref, dest):
+    """git リビジョン ref の lambda/ を dest に展開し、そのパスを返します。"""
+    archive = os.path.join(dest, "lambda.tar")
+    with open(archive, "wb") as f:
+        subprocess.run(["git", "-C", ROOT, "archive", ref, "lambda"], stdout=f, check=True)
+    with tarfile.open(archive) as tar:
+        tar.extractall(dest)
+    return os.path.join(dest, "lambda")
+
+
+def report(label, result, top):
+    print(f"[{label}] process={result['process_ms']:.1f}ms init(import index)={result['init_ms']:.1f}ms "
+          f"importtime(index)={result['import_index_ms']:.1f}ms")
+    ranked = sorted(result["modules_ms"].items(), key=lambda kv: kv[1], reverse=True)[:top]
+    for name, ms in ranked:
+        print(f"    {name:<24} {ms:>8.2f}ms")
+
+
+def main():
+    parser = argparse.ArgumentParser(description="コールドスタートのベンチマーク")
+    parser.add_argument("--repeat", type=int, default=10, help="計測回数 (中央値を表示)")
+    parser.add_argument("--top", type=int, default=12, help="表示するモジュール数")
+    parser.add_argument("--ref", help="比較する git リビジョン (例: HEAD~1)")
+    parser.add_argument("--env", action="append", default=[], metavar="KEY=VALUE", help="追加の環境変数")
+    args = parser.parse_args()
+
+    env = {**os.environ, **DEFAULT_ENV}
+    env.update(item.split("=", 1) for item in args.env)
+
+    results = []
+    if args.ref:
+        with tempfile.TemporaryDirectory() as tmp:
+            results.append((args.ref, measure(checkout_lambda(args.ref, tmp), args.repeat, env)))
+    results.append(("working tree", measure(os.path.join(ROOT, "lambda"), args.repeat, env)))
+
+    for label, result in results:
+        report(label, result, args.top)
+    if len(results) == 2:
+        before, after = results[0][1], results[1][1]
+        print(f"init: {before['init_ms']:.1f}ms -> {after['init_ms']:.1f}ms "
+              f"({after['init_ms'] - before['init_ms']:+.1f}ms)")
+
+
+if __name__ == "__main__":
+    main()
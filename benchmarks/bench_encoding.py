@@ -0,0 +1,94 @@
+# benchmarks/bench_encoding.py
+# 応答ボディの圧縮のベンチマーク: 会話履歴の長さごとに、応答の大きさと lambda_handler の所要時間を比較する
+#
+# identity:      圧縮なし (従来どおり)
+# gzip / br:     Accept-Encoding に応じて圧縮し base64 で返す (br は brotli パッケージがある場合のみ)
+# response only: includeHistory=false で会話履歴を返さない
+#
+# "lambda KB" は Lambda が返すボディ (base64 を含む) の大きさで、Lambda の応答ペイロード上限 (6MB) と比べる値、
+# "wire KB" は API Gateway がクライアントに送るボディの大きさです。
+#
+# 使い方: python benchmarks/bench_encoding.py [--turns 10 50 200] [--requests 50]
+import argparse
+import os
+import random
+import sys
+import time
+
+sys.path.insert(0, os.path.dirname(os.path.abspath(__file__)))
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), '..', 'lambda'))
+
+import stub_backend  # noqa: E402
+from bench_logging import percentile  # noqa: E402
+from loadtest import FakeContext, make_event  # noqa: E402
+
+SENTENCES = [
+    "Lambda のコールドスタートを短くするには、依存パッケージを減らすのが効果的です。",
+    "初期化処理はモジュールレベルに移し、ウォームスタートで使い回します。",
+    "API Gateway のタイムアウトは 29 秒なので、長い生成は非同期にします。",
+    "DynamoDB のオンデマンドモードでは、キャパシティの設定は不要です。",
+    "CloudWatch Logs Insights で p99 のレイテンシを確認できます。",
+    "The request failed because the upstream model returned a 503 status.",
+    "You can enable provisioned concurrency to keep instances warm.",
+    "Consider batching small writes to reduce the number of round trips.",
+    "プロンプトが長くなるほど、最初のトークンまでの時間も長くなります。",
+    "会話履歴は要約してトークン予算内に収めると、コストも下がります。",
+]
+
+
+def make_history(turns, rng):
+    """文の組み合わせと数値を変えた、圧縮しすぎない会話履歴を作ります。"""
+    history = []
+    for i in range(turns):
+        history.append({"role": "user", "content": f"質問 {i} ({rng.randrange(10 ** 6)}): "
+                        + " ".join(rng.sample(SENTENCES, 2))})
+        history.append({"role": "assistant", "content": f"回答 {i}: "
+                        + " ".join(rng.choice(SENTENCES) + f" [{rng.randrange(10 ** 4)}]" for _ in range(4))})
+    return history
+
+
+def main():
+    parser = argparse.ArgumentParser(description="応答ボディの圧縮のベンチマーク")
+    parser.add_argument("--turns", type=int, nargs="+", default=[10, 50, 200, 1000], help="会話履歴のターン数")
+    parser.add_argument("--requests", type=int, default=50, help="各条件で計測するリクエスト数")
+    args = parser.parse_args()
+
+    _, _, url = stub_backend.start(base_ms=0, per_item_ms=0)
+    os.environ.update({"NGROK_URL": url, "PREWARM_CONNECTION": "false", "METRICS_SINK": "none",
+                       "CONVERSATION_STORE": "none", "RESPONSE_CACHE_ENABLED": "false",
+                       "SINGLEFLIGHT_ENABLED": "false"})
+    os.environ.setdefault("LOG_LEVEL", "CRITICAL")
+    import index
+
+    variants = [("identity", None, True), ("gzip", "gzip", True)]
+    if "br" in index.response_encoder.codings:
+        variants.append(("br", "br", True))
+    else:
+        print("(brotli is not installed; br is skipped: pip install brotli)")
+    variants.append(("response only", "gzip, br", False))
+
+    rng = random.Random(0)
+    print(f"{'turns':>6} {'variant':<14} {'lambda KB':>10} {'wire KB':>9} {'p50 ms':>8} {'p99 ms':>8}")
+    for turns in args.turns:
+        history = make_history(turns, rng)
+        for label, accept_encoding, include_history in variants:
+            event = make_event({"message": "続きを教えて", "conversationHistory": history,
+                                "includeHistory": include_history}, 0)
+            if accept_encoding:
+                # axios と同じく Accept の最初を application/json にする (API Gateway がバイナリとして返す条件)
+                event["headers"] = {**event["headers"], "Accept": "application/json, text/plain, */*",
+                                    "Accept-Encoding": accept_encoding}
+            latencies = []
+            for i in range(args.requests):
+                started = time.perf_counter()
+                response = index.lambda_handler(event, FakeContext(f"req-{i}", 30000))
+                latencies.append((time.perf_counter() - started) * 1000)
+            assert response["statusCode"] == 200, response
+            payload = len(response["body"].encode('utf-8'))
+            wire = payload * 3 // 4 if response.get("isBase64Encoded") else payload
+            print(f"{turns:>6} {label:<14} {payload / 1024:>10.1f} {wire / 1024:>9.1f} "
+                  f"{percentile(latencies, 0.5):>8.2f} {percentile(latencies, 0.99):>8.2f}")
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,65 @@
+# benchmarks/bench_history.py
+# 会話履歴のコンパクションによるペイロードサイズと処理時間を計測するベンチマーク
+#
+# 使い方: python benchmarks/bench_history.py [--budget 1024] [--repeat 20]
+import argparse
+import json
+import os
+import sys
+import time
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), '..', 'lambda'))
+
+from history import HistoryBuilder  # noqa: E402
+
+
+def make_history(turns):
+    """user/assistant のペアを turns 回分含む会話履歴を作ります。"""
+    history = []
+    for i in range(turns):
+        history.append({"role": "user", "content": f"質問 {i}: Lambda のコールドスタートを短くするには? 具体的な手順も教えてください。"})
+        history.append({"role": "assistant", "content": f"回答 {i}: " + "依存パッケージを減らし、初期化処理をモジュールレベルに移します。" * 4})
+    return history
+
+
+def measure(history, message, builder, repeat):
+    """1 ターン分の処理 (リクエストの JSON デコード → プロンプト構築 → ペイロードのエンコード) を計測します。"""
+    request_body = json.dumps({"message": message, "conversationHistory": history})
+
+    def one_turn(build):
+        body = json.loads(request_body)
+        if build:
+            prompt, _ = builder.build(body["conversationHistory"], body["message"])
+        else:
+            prompt = "\n".join(f"{m['role']}: {m['content']}" for m in body["conversationHistory"])
+            prompt += f"\nuser: {body['message']}"
+        return json.dumps({"prompt": prompt, "max_new_tokens": 512}).encode('utf-8')
+
+    results = {}
+    for name, build in (("full_history", False), ("compacted", True)):
+        start = time.perf_counter()
+        for _ in range(repeat):
+            payload = one_turn(build)
+        elapsed_ms = (time.perf_counter() - start) * 1000 / repeat
+        results[name] = {"payload_bytes": len(payload), "latency_ms": round(elapsed_ms, 3)}
+    results["request_bytes"] = len(request_body.encode('utf-8'))
+    return results
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__)
+    parser.add_argument("--budget", type=int, default=1024, help="プロンプトのトークン予算")
+    parser.add_argument("--repeat", type=int, default=20, help="各条件の繰り返し回数")
+    args = parser.parse_args()
+
+    builder = HistoryBuilder(args.budget)
+    print(f"{'turns':>6} {'request':>10} {'full bytes':>11} {'full ms':>9} {'compact bytes':>14} {'compact ms':>11}")
+    for turns in (10, 100, 1000):
+        r = measure(make_history(turns), "次はどうすればいいですか?", builder, args.repeat)
+        print(f"{turns:>6} {r['request_bytes']:>10} "
+              f"{r['full_history']['payload_bytes']:>11} {r['full_history']['latency_ms']:>9.3f} "
+              f"{r['compacted']['payload_bytes']:>14} {r['compacted']['latency_ms']:>11.3f}")
+
+
+if __name__ == "__main__":
+    main()
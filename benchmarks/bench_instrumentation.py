@@ -0,0 +1,95 @@
+# benchmarks/bench_instrumentation.py
+# フェーズ計測のオーバーヘッド (有効 / 無効) と、1 ターンのフェーズごとの内訳を計測するベンチマーク
+#
+# 使い方: python benchmarks/bench_instrumentation.py [--requests 300] [--history 40] [--backend-ms 0]
+import argparse
+import os
+import statistics
+import sys
+import time
+
+sys.path.insert(0, os.path.dirname(os.path.abspath(__file__)))
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), '..', 'lambda'))
+
+import stub_backend  # noqa: E402
+from bench_logging import FakeContext, make_event, percentile  # noqa: E402
+from metrics import Instrumentation, MemorySink  # noqa: E402
+
+
+def span_cost_ns(enabled, repeat=200000):
+    """with metrics.span(...) 1 回あたりのコスト (ナノ秒、空ループとの差) を返します。"""
+    metrics = Instrumentation(sink=MemorySink(), enabled=enabled, flush_seconds=3600)
+    start = time.perf_counter_ns()
+    for _ in range(repeat):
+        pass
+    empty = time.perf_counter_ns() - start
+    start = time.perf_counter_ns()
+    for _ in range(repeat):
+        with metrics.span("body_parse"):
+            pass
+    return (time.perf_counter_ns() - start - empty) / repeat
+
+
+def run_handler(index, events, context, warmup):
+    latencies = []
+    for i, event in enumerate(events):
+        start = time.perf_counter()
+        index.lambda_handler(event, context)
+        if i >= warmup:
+            latencies.append((time.perf_counter() - start) * 1000)
+    return latencies
+
+
+def main():
+    parser = argparse.ArgumentParser(description="フェーズ計測のベンチマーク")
+    parser.add_argument("--requests", type=int, default=300, help="計測するリクエスト数")
+    parser.add_argument("--warmup", type=int, default=20, help="計測前に捨てるリクエスト数")
+    parser.add_argument("--history", type=int, default=40, help="会話履歴のターン数")
+    parser.add_argument("--backend-ms", type=float, default=0.0, help="スタブの推論サーバーの 1 回の forward のコスト (ミリ秒)")
+    args = parser.parse_args()
+
+    _, _, url = stub_backend.start(base_ms=args.backend_ms, per_item_ms=0)
+    os.environ["NGROK_URL"] = url
+    os.environ.setdefault("LOG_LEVEL", "CRITICAL")
+    os.environ["PREWARM_CONNECTION"] = "false"
+    import index
+
+    print(f"{'span':<10} {'ns/op':>8}")
+    for enabled in (False, True):
+        print(f"{'on' if enabled else 'off':<10} {span_cost_ns(enabled):>8.0f}")
+
+    context = FakeContext()
+    events = [make_event(args.history, i) for i in range(args.requests + args.warmup)]
+    # 既定の設定と同じく、ヒストグラムはリクエストごとではなくまとめて出力する
+    index.metrics = Instrumentation(sink=MemorySink(), flush_seconds=10)
+    # 有効 / 無効を交互に計測して、時間による揺らぎを両方に均等に乗せる
+    results = {"off": [], "on": []}
+    for _ in range(3):
+        for label in ("off", "on"):
+            index.metrics.enabled = label == "on"
+            results[label] += run_handler(index, events, context, args.warmup)
+
+    # 内訳はリクエストごとに出力して、各レコードの Sum をそのリクエストの所要時間として集計する
+    sink = MemorySink()
+    index.metrics = Instrumentation(sink=sink, flush_seconds=0)
+    run_handler(index, events, context, args.warmup)
+
+    print()
+    print(f"{'metrics':<10} {'mean ms':>8} {'p50 ms':>8} {'p99 ms':>8}")
+    for label, latencies in results.items():
+        print(f"{label:<10} {statistics.fmean(latencies):>8.3f} {percentile(latencies, 0.5):>8.3f} "
+              f"{percentile(latencies, 0.99):>8.3f}")
+
+    phases = {}
+    for record in sink.records:
+        for key, value in record.items():
+            if key.endswith("_ms"):
+                phases.setdefault(key[:-3], []).append(value["Sum"])
+    print()
+    print(f"{'phase':<18} {'p50 ms':>8} {'p99 ms':>8}")
+    for name, values in phases.items():
+        print(f"{name:<18} {percentile(values, 0.5):>8.3f} {percentile(values, 0.99):>8.3f}")
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,112 @@
+# benchmarks/bench_jobs.py
+# 非同期ジョブモードのベンチマーク
+#
+# 1. "async": true のリクエストを lambda_handler が 202 で返すまでの時間 (キュー / ジョブストアが memory・sqlite の場合)
+# 2. SQLite のキューに溜めたジョブをワーカースレッドで処理したときのスループットと、受け付けから完了までの時間
+#    (スタブの推論サーバーは GenerationModel でトークンをストリーミングし、ワーカーは途中経過をジョブストアに書き込む)
+#
+# 使い方: python benchmarks/bench_jobs.py [--enqueue 2000] [--jobs 100] [--workers 1 4 16]
+import argparse
+import json
+import os
+import sys
+import tempfile
+import threading
+import time
+
+sys.path.insert(0, os.path.dirname(os.path.abspath(__file__)))
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), '..', 'lambda'))
+
+import stub_backend  # noqa: E402
+from bench_logging import percentile  # noqa: E402
+from jobs import FINISHED, SQLiteJobQueue, create_job_queue, create_job_store, run_worker  # noqa: E402
+from loadtest import FakeContext, make_event  # noqa: E402
+
+
+def enqueue_latency(index, kind, tmp, requests):
+    """kind のキューとジョブストアで、非同期リクエストを受け付ける lambda_handler の所要時間 (ミリ秒) を返します。"""
+    path = os.path.join(tmp, f"enqueue-{kind}.db")
+    index.job_queue = create_job_queue(kind, path=path)
+    index.job_store = create_job_store(kind, path=path)
+    latencies = []
+    for i in range(requests):
+        event = make_event({"message": f"長い記事を書いて {i}", "async": True}, i % 50)
+        started = time.perf_counter()
+        response = index.lambda_handler(event, FakeContext(f"req-{i}", 30000))
+        latencies.append((time.perf_counter() - started) * 1000)
+        assert response["statusCode"] == 202, response
+    return latencies
+
+
+def worker_throughput(index, tmp, jobs, workers):
+    """jobs 件のジョブを workers 本のワーカースレッドで処理し、(経過秒, 各ジョブの受け付けから完了までの秒) を返します。"""
+    path = os.path.join(tmp, f"workers-{workers}.db")
+    index.job_queue = SQLiteJobQueue(path)
+    index.job_store = create_job_store("sqlite", path=path)
+    enqueued_at = {}
+    for i in range(jobs):
+        response = index.lambda_handler(make_event({"message": f"長い記事を書いて {i}", "async": True}, i % 50),
+                                        FakeContext(f"req-{i}", 30000))
+        enqueued_at[json.loads(response["body"])["jobId"]] = time.monotonic()
+
+    finished_at = {}
+    stop = threading.Event()
+
+    def process(message):
+        index.run_job(message, FakeContext(message["jobId"], 300000))
+        finished_at[message["jobId"]] = time.monotonic()
+
+    started = time.monotonic()
+    threads = [threading.Thread(target=run_worker, args=(index.job_queue, process, stop), kwargs={"wait_seconds": 0.1})
+               for _ in range(workers)]
+    for thread in threads:
+        thread.start()
+    while len(finished_at) < jobs:
+        time.sleep(0.05)
+    elapsed = time.monotonic() - started
+    stop.set()
+    for thread in threads:
+        thread.join()
+    assert all(index.job_store.get(job_id)["status"] in FINISHED for job_id in enqueued_at)
+    return elapsed, [finished_at[job_id] - enqueued_at[job_id] for job_id in enqueued_at]
+
+
+def main():
+    parser = argparse.ArgumentParser(description="非同期ジョブモードのベンチマーク")
+    parser.add_argument("--enqueue", type=int, default=2000, help="受け付けの所要時間を計測するリクエスト数")
+    parser.add_argument("--jobs", type=int, default=100, help="ワーカーで処理するジョブ数")
+    parser.add_argument("--workers", type=int, nargs="+", default=[1, 4, 16], help="ワーカースレッド数")
+    parser.add_argument("--partial-interval", type=float, default=0.5, help="途中経過をジョブストアに書き込む間隔 (秒)")
+    stub_backend.add_model_arguments(parser)
+    parser.set_defaults(ttft_ms=200.0, ttft_sigma=0.3, tokens_per_second=50.0, output_tokens=50, seed=0)
+    args = parser.parse_args()
+
+    _, _, url = stub_backend.start(model=stub_backend.model_from_args(args))
+    os.environ.update({
+        "NGROK_URL": url, "PREWARM_CONNECTION": "false", "METRICS_SINK": "none", "JOB_QUEUE": "memory",
+        "JOB_LOCAL_WORKERS": "0", "JOB_PARTIAL_INTERVAL": str(args.partial_interval), "CONVERSATION_STORE": "none",
+        "RESPONSE_CACHE_ENABLED": "false", "SINGLEFLIGHT_ENABLED": "false",
+    })
+    os.environ.setdefault("LOG_LEVEL", "CRITICAL")
+    import index
+
+    with tempfile.TemporaryDirectory() as tmp:
+        print(f"enqueue latency ({args.enqueue} async requests, lambda_handler until 202)")
+        print(f"{'backend':<8} {'p50 ms':>8} {'p99 ms':>8} {'mean ms':>8}")
+        for kind in ("memory", "sqlite"):
+            latencies = enqueue_latency(index, kind, tmp, args.enqueue)
+            print(f"{kind:<8} {percentile(latencies, 0.5):>8.3f} {percentile(latencies, 0.99):>8.3f} "
+                  f"{sum(latencies) / len(latencies):>8.3f}")
+
+        print()
+        print(f"worker throughput ({args.jobs} jobs, sqlite queue/store, TTFT {args.ttft_ms:g} ms, "
+              f"{args.output_tokens} tokens at {args.tokens_per_second:g} tokens/s)")
+        print(f"{'workers':>7} {'jobs/s':>8} {'p50 s':>7} {'p95 s':>7} {'max s':>7}")
+        for workers in args.workers:
+            elapsed, completion = worker_throughput(index, tmp, args.jobs, workers)
+            print(f"{workers:>7} {args.jobs / elapsed:>8.1f} {percentile(completion, 0.5):>7.2f} "
+                  f"{percentile(completion, 0.95):>7.2f} {max(completion):>7.2f}")
+
+
+if __name__ == "__main__":
+    main()
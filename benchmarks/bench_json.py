@@ -0,0 +1,98 @@
+# benchmarks/bench_json.py
+# 1 ターン分の JSON 処理 (リクエストのデコード → ペイロードのエンコード → 応答のデコード → レスポンスのエンコード) を
+# 会話履歴の長さごとに比較するマイクロベンチマーク
+#
+# 使い方: python benchmarks/bench_json.py [--repeat 50]
+#
+# baseline: 変更前の index.py と同じ手順 (ペイロードをログ用・送信用・single-flight 用に 3 回エンコードし、
+#           履歴はデコードしたリストをコピーして再エンコードする)
+# json / orjson: fastjson を使う手順 (ペイロードは 1 回だけエンコードし、履歴は受け取ったテキストを埋め込む)
+import argparse
+import importlib
+import json
+import os
+import sys
+import time
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), '..', 'lambda'))
+
+import fastjson  # noqa: E402
+from bench_history import make_history  # noqa: E402
+
+GENERATED = json.dumps({"generated_text": "依存パッケージを減らし、初期化処理をモジュールレベルに移します。" * 8})
+
+
+def baseline_turn(request_body, response_bytes):
+    body = json.loads(request_body)
+    messages = body["conversationHistory"].copy()
+    messages.append({"role": "user", "content": body["message"]})
+    payload = {"prompt": body["message"], "max_new_tokens": 512, "temperature": 0.7, "top_p": 0.9, "do_sample": True}
+    json.dumps(payload)  # ログ
+    json.dumps(payload, sort_keys=True).encode('utf-8')  # single-flight のキー
+    json.dumps(payload).encode('utf-8')  # 送信
+    response_data = json.loads(response_bytes.decode('utf-8'))
+    json.dumps(response_data)  # ログ
+    messages.append({"role": "assistant", "content": response_data["generated_text"]})
+    return json.dumps({"success": True, "response": response_data["generated_text"], "conversationHistory": messages})
+
+
+def fastjson_turn(request_body, response_bytes):
+    body, raw = fastjson.loads_with_raw(request_body, ("conversationHistory",))
+    user_message = {"role": "user", "content": body["message"]}
+    raw_history = raw.get("conversationHistory")
+    if raw_history is None:
+        messages = body["conversationHistory"].copy()
+        messages.append(user_message)
+    payload = {"prompt": body["message"], "max_new_tokens": 512, "temperature": 0.7, "top_p": 0.9, "do_sample": True}
+    fastjson.dumpb(payload)  # 送信・single-flight のキー・ログで共有
+    response_data = fastjson.loads(response_bytes)
+    assistant_message = {"role": "assistant", "content": response_data["generated_text"]}
+    if raw_history is not None:
+        history = fastjson.extend_array(raw_history, [user_message, assistant_message])
+    else:
+        messages.append(assistant_message)
+        history = messages
+    return fastjson.dumps({"success": True, "response": response_data["generated_text"], "conversationHistory": history})
+
+
+def measure(turn, request_body, response_bytes, repeat):
+    turn(request_body, response_bytes)
+    start = time.perf_counter()
+    for _ in range(repeat):
+        result = turn(request_body, response_bytes)
+    return (time.perf_counter() - start) * 1000 / repeat, len(result.encode('utf-8'))
+
+
+def load_backend(name):
+    """JSON_BACKEND を切り替えて fastjson を読み込み直し、その実装が使えるかを返します。"""
+    os.environ["JSON_BACKEND"] = name
+    importlib.reload(fastjson)
+    return fastjson.BACKEND == name
+
+
+def main():
+    parser = argparse.ArgumentParser(description="JSON 処理のベンチマーク")
+    parser.add_argument("--repeat", type=int, default=50, help="各条件の繰り返し回数")
+    args = parser.parse_args()
+
+    response_bytes = GENERATED.encode('utf-8')
+    print(f"{'turns':>6} {'request KB':>11} {'variant':<9} {'ms/turn':>9} {'response KB':>12}")
+    for turns in (10, 100, 1000):
+        # ブラウザの JSON.stringify と同じく、非 ASCII 文字はエスケープしない
+        request_body = json.dumps({"message": "次はどうすればいいですか?", "conversationHistory": make_history(turns)},
+                                  ensure_ascii=False)
+        rows = [("baseline", *measure(baseline_turn, request_body, response_bytes, args.repeat))]
+        for backend in ("json", "orjson"):
+            if load_backend(backend):
+                rows.append((backend, *measure(fastjson_turn, request_body, response_bytes, args.repeat)))
+            else:
+                rows.append((backend, None, None))
+        for label, ms, size in rows:
+            if ms is None:
+                print(f"{turns:>6} {len(request_body) / 1024:>11.1f} {label:<9} {'(not installed)':>22}")
+            else:
+                print(f"{turns:>6} {len(request_body) / 1024:>11.1f} {label:<9} {ms:>9.3f} {size / 1024:>12.1f}")
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,130 @@
+# benchmarks/bench_logging.py
+# ログ出力による Lambda ハンドラーのオーバーヘッドを、ログの設定ごとに計測するベンチマーク
+#
+# 使い方: python benchmarks/bench_logging.py [--requests 300] [--history 40] [--ref HEAD~1]
+#
+# 設定ごとに新しいインタプリタでスタブの推論サーバー (固定コスト 0ms) に対して lambda_handler を呼び出し、
+# 1 リクエストあたりの処理時間を比較します。標準出力は Lambda と同じくパイプ (ここではファイル) に書き出します。
+# --ref を指定すると、その git リビジョンの lambda/ (print による旧ログ) も同じ条件で計測します。
+import argparse
+import json
+import os
+import statistics
+import subprocess
+import sys
+import tempfile
+import time
+
+BENCH_DIR = os.path.dirname(os.path.abspath(__file__))
+LAMBDA_DIR = os.path.join(BENCH_DIR, '..', 'lambda')
+
+# (ラベル, 環境変数)
+MODES = (
+    ("off", {"LOG_LEVEL": "CRITICAL"}),
+    ("sampled 1%", {"LOG_ASYNC": "true", "LOG_BODY_SAMPLE_RATE": "0.01"}),
+    ("async, all bodies", {"LOG_ASYNC": "true", "LOG_BODY_SAMPLE_RATE": "1"}),
+    ("sync, all bodies", {"LOG_ASYNC": "false", "LOG_BODY_SAMPLE_RATE": "1"}),
+)
+
+
+class FakeContext:
+    aws_request_id = "bench"
+
+    def get_remaining_time_in_millis(self):
+        return 30000
+
+
+def make_event(history_turns, i):
+    history = []
+    for t in range(history_turns):
+        history.append({"role": "user", "content": f"質問 {t}: ログのコストを下げるには? " * 4})
+        history.append({"role": "assistant", "content": f"回答 {t}: " + "本体はサンプリングし、書き出しは別スレッドで行います。" * 6})
+    return {
+        "path": "/chat",
+        "httpMethod": "POST",
+        "headers": {"Authorization": "Bearer " + "x" * 900, "Content-Type": "application/json"},
+        "requestContext": {"authorizer": {"claims": {"sub": "0000-bench", "email": "bench@example.com",
+                                                     "cognito:username": "bench"}}},
+        "body": json.dumps({"message": f"質問 {i}: 次はどうすればいいですか?", "conversationHistory": history},
+                           ensure_ascii=False),
+    }
+
+
+def child(args):
+    """計測用の子プロセス。lambda_handler を requests 回呼び出し、処理時間 (ミリ秒) を out に書き出します。"""
+    sys.path.insert(0, BENCH_DIR)
+    import stub_backend
+    _, _, url = stub_backend.start(base_ms=0, per_item_ms=0)
+    os.environ["NGROK_URL"] = url
+    sys.path.insert(0, args.lambda_dir)
+    import index
+
+    context = FakeContext()
+    # 会話履歴の作成はハンドラーの外で済ませておく
+    events = [make_event(args.history, i) for i in range(args.requests + args.warmup)]
+    latencies = []
+    for i, event in enumerate(events):
+        start = time.perf_counter()
+        response = index.lambda_handler(event, context)
+        elapsed = (time.perf_counter() - start) * 1000
+        if response["statusCode"] != 200:
+            raise RuntimeError(f"Unexpected response: {response}")
+        if i >= args.warmup:
+            latencies.append(elapsed)
+    with open(args.child, "w") as f:
+        json.dump(latencies, f)
+
+
+def percentile(values, q):
+    ordered = sorted(values)
+    return ordered[min(len(ordered) - 1, int(q * len(ordered)))]
+
+
+def measure(lambda_dir, env, args, tmp):
+    out = os.path.join(tmp, "latencies.json")
+    log_path = os.path.join(tmp, "stdout.log")
+    with open(log_path, "wb") as stdout:
+        subprocess.run(
+            [sys.executable, os.path.abspath(__file__), "--child", out, "--lambda-dir", lambda_dir,
+             "--requests", str(args.requests), "--warmup", str(args.warmup), "--history", str(args.history)],
+            env={**os.environ, "PREWARM_CONNECTION": "false", **env}, stdout=stdout, check=True,
+        )
+    with open(out) as f:
+        latencies = json.load(f)
+    return {
+        "mean": statistics.fmean(latencies),
+        "p50": percentile(latencies, 0.5),
+        "p99": percentile(latencies, 0.99),
+        "log_bytes": os.path.getsize(log_path) / args.requests,
+    }
+
+
+def main():
+    parser = argparse.ArgumentParser(description="ログのオーバーヘッドのベンチマーク")
+    parser.add_argument("--requests", type=int, default=300, help="計測するリクエスト数")
+    parser.add_argument("--warmup", type=int, default=20, help="計測前に捨てるリクエスト数")
+    parser.add_argument("--history", type=int, default=40, help="会話履歴のターン数")
+    parser.add_argument("--ref", help="比較する git リビジョン (例: HEAD~1)")
+    parser.add_argument("--child", help=argparse.SUPPRESS)
+    parser.add_argument("--lambda-dir", default=LAMBDA_DIR, help=argparse.SUPPRESS)
+    args = parser.parse_args()
+
+    if args.child:
+        child(args)
+        return
+
+    rows = []
+    with tempfile.TemporaryDirectory() as tmp:
+        if args.ref:
+            from bench_coldstart import checkout_lambda
+            rows.append((f"{args.ref} (print)", measure(checkout_lambda(args.ref, tmp), {}, args, tmp)))
+        for label, env in MODES:
+            rows.append((label, measure(os.path.abspath(LAMBDA_DIR), env, args, tmp)))
+
+    print(f"{'mode':<22} {'mean ms':>8} {'p50 ms':>8} {'p99 ms':>8} {'log bytes/req':>14}")
+    for label, r in rows:
+        print(f"{label:<22} {r['mean']:>8.3f} {r['p50']:>8.3f} {r['p99']:>8.3f} {r['log_bytes']:>14.0f}")
+
+
+if __name__ == "__main__":
+    main()
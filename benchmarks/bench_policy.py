@@ -0,0 +1,129 @@
+# benchmarks/bench_policy.py
+# 生成パラメータのポリシーで、1 ターンあたりの生成トークン数と GPU 時間がどれだけ減るかをリプレイで比較するベンチマーク
+#
+# 使い方: python benchmarks/bench_policy.py [--corpus replay.jsonl] [--turns 5000] [--tokens-per-second 40]
+#
+# コーパスは 1 行 1 JSON で "message" と、あれば実際の応答 "response" を含みます。応答があればその長さを
+# モデルが本来生成する長さとして使い、なければメッセージの種類ごとの分布から決めます (--corpus を省略すると合成のコーパス)。
+# 一定の割合 (--runaway) の応答は終端トークンを出さずに、次の "User:" のターンを作り続けて max_new_tokens まで生成するものとします。
+#
+# fixed:  従来どおり常に max_new_tokens=512
+# policy: GenerationPolicy の既定のルール
+# +stop:  ルールに加えて停止シーケンス "\nUser:" を付ける (暴走した応答を本来の長さで止める)
+import argparse
+import json
+import math
+import os
+import random
+import sys
+
+sys.path.insert(0, os.path.dirname(os.path.abspath(__file__)))
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), '..', 'lambda'))
+
+from bench_logging import percentile  # noqa: E402
+from generation_policy import GenerationPolicy  # noqa: E402
+from history import estimate_tokens  # noqa: E402
+
+# (種類, 割合, メッセージの例, 本来の応答の長さの中央値)
+CLASSES = [
+    ("greeting", 0.2, ["こんにちは", "ありがとう!", "hi", "thanks!", "おはようございます", "了解です"], 25),
+    ("short_question", 0.35, ["東京の天気は?", "今日は何曜日?", "What time is it in London?", "円周率は?",
+                              "ログインできない", "返品の手続きは?"], 110),
+    ("code", 0.15, ["Pythonでリストをソートするコードを書いて", "Write a SQL query that counts orders per day",
+                    "JavaScript で配列の重複を取り除く関数を実装して"], 320),
+    ("long_form", 0.1, ["この記事を要約してください。" + "本文" * 200, "Explain how TCP congestion control works",
+                        "新しい製品の紹介文を詳しく書いて"], 420),
+    ("other", 0.2, ["来週の会議の議題を考えているのですが、参加者が多いので進め方に悩んでいます。何か良い方法はありますか?",
+                    "I am planning a trip to Kyoto next spring with my family and want to avoid the crowds, any advice?"], 220),
+]
+
+
+def synthetic_corpus(turns, rng):
+    weights = [weight for _, weight, _, _ in CLASSES]
+    corpus = []
+    for _ in range(turns):
+        _, _, messages, median = rng.choices(CLASSES, weights)[0]
+        natural = max(1, round(median * math.exp(rng.gauss(0, 0.6))))
+        corpus.append((rng.choice(messages), natural))
+    return corpus
+
+
+def load_replay(path, turns, rng):
+    rows = []
+    with open(path, encoding='utf-8') as f:
+        for line in f:
+            if line.strip():
+                row = json.loads(line)
+                message = row.get("message") or row.get("body") or row.get("title") or ""
+                response = row.get("response")
+                rows.append((message, estimate_tokens(response) if response else None))
+    corpus = []
+    fallback = {name: median for name, _, _, median in CLASSES}
+    policy = GenerationPolicy()
+    for i in range(turns):
+        message, natural = rows[i % len(rows)]
+        if natural is None:
+            rule = policy.classify(message, estimate_tokens(message))["name"]
+            natural = max(1, round(fallback.get(rule, 220) * math.exp(rng.gauss(0, 0.6))))
+        corpus.append((message, natural))
+    return corpus
+
+
+def replay(corpus, build, args, seed):
+    """各ターンの (予算, 生成トークン数, GPU 秒, 予算で切られたか) を集計します。"""
+    rng = random.Random(seed)
+    budgets, produced, gpu_seconds, cut = [], [], [], 0
+    for message, natural in corpus:
+        params = build(message)
+        budget = params["max_new_tokens"]
+        runaway = rng.random() < args.runaway
+        # 暴走した応答は停止シーケンスがあれば本来の長さで止まり、なければ予算まで生成する
+        length = natural if not runaway or params.get("stop") else budget
+        tokens = min(length, budget)
+        cut += natural > budget
+        budgets.append(budget)
+        produced.append(tokens)
+        gpu_seconds.append(args.prefill_ms / 1000 + tokens / args.tokens_per_second)
+    n = len(corpus)
+    return {
+        "budget": sum(budgets) / n,
+        "produced": sum(produced) / n,
+        "gpu_seconds": sum(gpu_seconds) / n,
+        "p95_seconds": percentile(gpu_seconds, 0.95),
+        "cut_pct": cut / n * 100,
+    }
+
+
+def main():
+    parser = argparse.ArgumentParser(description="生成パラメータのポリシーのベンチマーク")
+    parser.add_argument("--corpus", help="リプレイする JSONL (省略すると合成のコーパス)")
+    parser.add_argument("--turns", type=int, default=5000, help="リプレイするターン数")
+    parser.add_argument("--tokens-per-second", type=float, default=40.0, help="1 リクエストのトークン生成速度")
+    parser.add_argument("--prefill-ms", type=float, default=150.0, help="プロンプトの処理 (最初のトークンまで) の時間")
+    parser.add_argument("--runaway", type=float, default=0.15, help="終端せずに予算まで生成する応答の割合")
+    parser.add_argument("--seed", type=int, default=0)
+    args = parser.parse_args()
+
+    rng = random.Random(args.seed)
+    corpus = load_replay(args.corpus, args.turns, rng) if args.corpus else synthetic_corpus(args.turns, rng)
+    policy = GenerationPolicy()
+    policy_stop = GenerationPolicy(stop=["\nUser:"])
+    variants = [
+        ("fixed", lambda message: {"max_new_tokens": 512}),
+        ("policy", lambda message: policy.build(message)[0]),
+        ("+stop", lambda message: policy_stop.build(message)[0]),
+    ]
+
+    print(f"{len(corpus)} turns, {args.tokens_per_second:g} tokens/s, runaway {args.runaway:.0%}")
+    print(f"{'variant':<8} {'budget':>7} {'produced':>9} {'GPU s/turn':>11} {'p95 s':>7} {'saving':>7} {'cut short %':>12}")
+    baseline = None
+    for label, build in variants:
+        result = replay(corpus, build, args, args.seed)
+        baseline = baseline or result["gpu_seconds"]
+        saving = (1 - result["gpu_seconds"] / baseline) * 100
+        print(f"{label:<8} {result['budget']:>7.0f} {result['produced']:>9.1f} {result['gpu_seconds']:>11.2f} "
+              f"{result['p95_seconds']:>7.2f} {saving:>6.1f}% {result['cut_pct']:>12.1f}")
+
+
+if __name__ == "__main__":
+    main()
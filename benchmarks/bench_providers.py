@@ -0,0 +1,131 @@
+# benchmarks/bench_providers.py
+# モデルプロバイダーのベンチマーク: 同じ負荷を HTTP の推論サーバー (/generate) と Bedrock (Converse / InvokeModel) に
+# lambda_handler 経由で送り、スループットとレイテンシを比較する
+#
+# 使い方: pip install boto3 && python benchmarks/bench_providers.py [--requests 200] [--concurrency 1 8]
+#
+# どちらのプロバイダーも stub_backend の同じ GenerationModel で応答します (Bedrock は boto3 の endpoint_url を
+# スタブの Bedrock Runtime 互換エンドポイントに向けるので、署名・接続プール・イベントストリームのパースは実物です)。
+# "bedrock new client" はリクエストごとに boto3 のクライアントを作る実装 (ハンドラー内で boto3.client() を呼ぶ場合) を
+# 再現し、モジュールレベルのクライアントを使い回す場合と比べます。
+import argparse
+import importlib
+import os
+import sys
+import time
+from concurrent.futures import ThreadPoolExecutor
+
+sys.path.insert(0, os.path.dirname(os.path.abspath(__file__)))
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), '..', 'lambda'))
+
+import stub_backend  # noqa: E402
+from bench_logging import percentile  # noqa: E402
+from loadtest import FakeContext, make_event  # noqa: E402
+
+MODEL_ID = "us.amazon.nova-lite-v1:0"
+
+
+def new_client(url):
+    """キャッシュせずに bedrock-runtime クライアントを作ります (新しいセッションから)。"""
+    import boto3
+    return boto3.session.Session().client('bedrock-runtime', endpoint_url=url)
+
+
+def client_costs(url, repeat):
+    """(boto3 の import ミリ秒, クライアント作成の平均ミリ秒, 保持したクライアントの取得の平均マイクロ秒) を返します。"""
+    started = time.perf_counter()
+    importlib.import_module("boto3")
+    import_ms = (time.perf_counter() - started) * 1000
+    started = time.perf_counter()
+    for _ in range(repeat):
+        new_client(url)
+    create_ms = (time.perf_counter() - started) * 1000 / repeat
+    from providers import bedrock_client
+    bedrock_client(endpoint_url=url)
+    started = time.perf_counter()
+    for _ in range(repeat):
+        bedrock_client(endpoint_url=url)
+    cached_us = (time.perf_counter() - started) * 1e6 / repeat
+    return import_ms, create_ms, cached_us
+
+
+def run(index, requests, concurrency, stream):
+    """requests 件のリクエストを concurrency 並列で送り、(経過秒, 各リクエストのミリ秒, エラー数) を返します。"""
+    def one(i):
+        event = make_event({"message": f"Lambda のコールドスタートについて教えて ({i})", "stream": stream}, i % 50)
+        started = time.perf_counter()
+        response = index.lambda_handler(event, FakeContext(f"req-{i}", 30000))
+        elapsed = (time.perf_counter() - started) * 1000
+        # 上流のエラーは 200 の応答テキストとして返る
+        ok = response["statusCode"] == 200 and "Error:" not in response["body"]
+        return elapsed, ok
+
+    started = time.perf_counter()
+    with ThreadPoolExecutor(max_workers=concurrency) as executor:
+        results = list(executor.map(one, range(requests)))
+    elapsed = time.perf_counter() - started
+    return elapsed, [ms for ms, _ in results], sum(1 for _, ok in results if not ok)
+
+
+def main():
+    parser = argparse.ArgumentParser(description="モデルプロバイダーのベンチマーク")
+    parser.add_argument("--requests", type=int, default=200, help="各条件で送るリクエスト数")
+    parser.add_argument("--concurrency", type=int, nargs="+", default=[1, 8], help="同時に送るリクエスト数")
+    parser.add_argument("--client-repeat", type=int, default=20, help="クライアント作成時間の計測回数")
+    stub_backend.add_model_arguments(parser)
+    parser.set_defaults(ttft_ms=50.0, ttft_sigma=0.3, tokens_per_second=400.0, output_tokens=32, seed=0)
+    args = parser.parse_args()
+
+    _, _, url = stub_backend.start(model=stub_backend.model_from_args(args))
+    os.environ.update({
+        "NGROK_URL": url, "PREWARM_CONNECTION": "false", "METRICS_SINK": "none", "CONVERSATION_STORE": "none",
+        "RESPONSE_CACHE_ENABLED": "false", "SINGLEFLIGHT_ENABLED": "false", "RESPONSE_COMPRESSION_ENABLED": "false",
+        "HTTP_POOL_MAXSIZE": str(max(args.concurrency)), "HTTP_POOL_MAX_CONNECTIONS": str(max(args.concurrency)),
+        # スタブは署名を検証しないが、botocore は認証情報とリージョンがないと送信しない
+        "AWS_ACCESS_KEY_ID": "stub", "AWS_SECRET_ACCESS_KEY": "stub", "AWS_DEFAULT_REGION": "us-east-1",
+    })
+    os.environ.setdefault("LOG_LEVEL", "CRITICAL")
+    import index
+
+    variants = [("http", None)]
+    try:
+        from providers import BedrockProvider, bedrock_client
+
+        class NewClientProvider(BedrockProvider):
+            # リクエストごとにクライアントを作ってから呼び出す
+            def generate(self, payload):
+                return BedrockProvider(self.model_id, self.api, new_client(url)).generate(payload)
+
+            def stream(self, payload):
+                return BedrockProvider(self.model_id, self.api, new_client(url)).stream(payload)
+
+        # boto3 の import 時間も測るので、最初のクライアントを作る前に計測する
+        import_ms, create_ms, cached_us = client_costs(url, args.client_repeat)
+        client = bedrock_client(endpoint_url=url, max_pool_connections=max(args.concurrency))
+        variants += [
+            ("bedrock converse", BedrockProvider(MODEL_ID, "converse", client)),
+            ("bedrock invoke", BedrockProvider(MODEL_ID, "invoke", client)),
+            ("bedrock new client", NewClientProvider(MODEL_ID, "converse", client)),
+        ]
+        print(f"boto3 import {import_ms:.1f} ms, new bedrock-runtime client {create_ms:.1f} ms, "
+              f"module-level client {cached_us:.2f} us")
+        print()
+    except ImportError:
+        print("(boto3 is not installed; Bedrock is skipped: pip install boto3)")
+
+    print(f"{args.requests} requests per row, stub TTFT {args.ttft_ms:g} ms, {args.output_tokens} tokens "
+          f"at {args.tokens_per_second:g} tokens/s")
+    print(f"{'provider':<20} {'mode':<7} {'conc':>4} {'req/s':>7} {'p50 ms':>8} {'p95 ms':>8} {'p99 ms':>8} {'errors':>6}")
+    for label, provider in variants:
+        index.bedrock_provider = provider
+        for stream in (False, True):
+            for concurrency in args.concurrency:
+                elapsed, latencies, errors = run(index, args.requests, concurrency, stream)
+                print(f"{label:<20} {'stream' if stream else 'sync':<7} {concurrency:>4} "
+                      f"{args.requests / elapsed:>7.1f} {percentile(latencies, 0.5):>8.1f} "
+                      f"{percentile(latencies, 0.95):>8.1f} {percentile(latencies, 0.99):>8.1f} {errors:>6}")
+    index.bedrock_provider = None
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,159 @@
+# benchmarks/bench_semantic_cache.py
+# 意味キャッシュのベンチマーク
+#
+# 1. 言い換えのヒット率と、別の質問に誤ってヒットする割合、1 語だけ違う質問に誤ってヒットする割合
+#    (しきい値ごと、HashingEmbedder)
+# 2. エントリ数ごとの 1 回あたりの埋め込み + 検索と、追加にかかる時間
+# 3. 保存したインデックスの読み込み時間 (メモリマップ / 同じ内容を JSON から読み込んで行列を作る場合)
+#
+# 使い方: python benchmarks/bench_semantic_cache.py [--entries 1000 10000] [--queries 2000]
+# (NumPy が必要です: pip install numpy)
+import argparse
+import json
+import os
+import random
+import sys
+import tempfile
+import time
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), '..', 'lambda'))
+
+from semantic_cache import HashingEmbedder, SemanticCache  # noqa: E402
+
+# 同じ行の質問は同じ答えになる言い換え
+PARAPHRASES = [
+    ["How do I reset my password?", "password reset how?", "How can I reset the password?",
+     "I forgot my password, how do I reset it?"],
+    ["How do I change my email address?", "change email address how?", "How can I update my email address?"],
+    ["What are your opening hours?", "opening hours?", "What are the opening hours?"],
+    ["How do I cancel my subscription?", "cancel subscription how?", "How can I cancel the subscription?"],
+    ["パスワードをリセットする方法を教えてください", "パスワードのリセット方法は?", "パスワードをリセットするには?"],
+    ["メールアドレスを変更する方法を教えてください", "メールアドレスの変更方法は?", "メールアドレスを変更するには?"],
+    ["東京の天気は?", "東京の天気を教えて", "東京の天気はどうですか"],
+    ["大阪の天気は?", "大阪の天気を教えて", "大阪の天気はどうですか"],
+    ["Pythonでリストをソートする方法", "Pythonのリストのソート方法を教えてください", "Pythonでリストをソートするには?"],
+    ["Pythonで辞書をソートする方法", "Pythonの辞書のソート方法を教えてください", "Pythonで辞書をソートするには?"],
+    ["返品の手続きを教えてください", "返品の手続きは?", "返品手続きの方法"],
+    ["領収書を発行する方法", "領収書の発行方法を教えてください", "領収書を発行するには?"],
+]
+
+# 1 語 (否定・反対語・語順) だけ違い、答えが変わる質問の組 (ヒットしてはいけない)
+NEAR_MISSES = [
+    ("How do I sort a list in Python so it sorts ascending?", "How do I sort a list in Python so it sorts descending?"),
+    ("Is it safe to run rm -rf on the build directory?", "Is it not safe to run rm -rf on the build directory?"),
+    ("Is TCP faster than UDP?", "Is UDP faster than TCP?"),
+    ("How do I migrate from MySQL to PostgreSQL?", "How do I migrate from PostgreSQL to MySQL?"),
+    ("Should I use Python 2 or Python 3?", "Should I use Python 3 or Python 2?"),
+    ("Why does my test pass?", "Why doesn't my test pass?"),
+    ("東京から大阪への行き方", "大阪から東京への行き方"),
+    ("この薬は妊娠中に飲めますか", "この薬は妊娠中に飲めませんか"),
+]
+
+
+def paraphrase_quality(threshold):
+    """
+    各グループの最初の質問をキャッシュし、残りの質問で検索したときの (ヒット率, 誤ヒット率, 近い質問の誤ヒット率) を返します。
+    """
+    cache = SemanticCache(HashingEmbedder(256), threshold=threshold, max_bytes=1024 * 1024)
+    namespace = cache.namespace([], {})
+    for i, group in enumerate(PARAPHRASES):
+        cache.set(cache.vectorize(group[0]), namespace, str(i))
+    correct = wrong = total = 0
+    for i, group in enumerate(PARAPHRASES):
+        for question in group[1:]:
+            total += 1
+            answer, _ = cache.get(cache.vectorize(question), namespace)
+            if answer == str(i):
+                correct += 1
+            elif answer is not None:
+                wrong += 1
+    near_hits = 0
+    for cached, question in NEAR_MISSES:
+        near = SemanticCache(HashingEmbedder(256), threshold=threshold, max_bytes=64 * 1024)
+        near.set(near.vectorize(cached), namespace, "cached")
+        near_hits += near.get(near.vectorize(question), namespace)[0] is not None
+    return correct / total, wrong / total, near_hits / len(NEAR_MISSES)
+
+
+def random_question(rng):
+    words = ["password", "email", "invoice", "refund", "account", "login", "order", "shipping", "price", "plan",
+             "パスワード", "請求書", "返金", "アカウント", "ログイン", "注文", "配送", "料金", "プラン", "設定"]
+    return " ".join(rng.choice(words) for _ in range(rng.randint(3, 8))) + f" {rng.randrange(10 ** 6)}"
+
+
+def fill(cache, namespace, entries, rng):
+    for _ in range(entries):
+        cache.set(cache.vectorize(random_question(rng)), namespace, "回答" * 100)
+
+
+def lookup_cost(entries, queries, path):
+    """entries 件を入れたキャッシュの (埋め込み + 検索の平均 us, 追加の平均 us, 容量) を返します。"""
+    embed = HashingEmbedder(256)
+    row_bytes = 256 * 4 + 8192 + 36
+    cache = SemanticCache(embed, max_bytes=row_bytes * entries, path=path)
+    rng = random.Random(0)
+    namespace = cache.namespace([], {})
+    fill(cache, namespace, entries, rng)
+    questions = [random_question(rng) for _ in range(queries)]
+    start = time.perf_counter()
+    for question in questions:
+        cache.get(cache.vectorize(question), namespace)
+    get_us = (time.perf_counter() - start) * 1e6 / queries
+    start = time.perf_counter()
+    for question in questions:
+        cache.set(cache.vectorize(question), namespace, "回答" * 100)
+    set_us = (time.perf_counter() - start) * 1e6 / queries
+    cache.index.flush()
+    return get_us, set_us, cache
+
+
+def load_cost(cache, entries, path, tmp):
+    """保存済みのインデックスを開く時間と、同じ内容を JSON から読み込んで行列を作る時間 (ミリ秒) を返します。"""
+    import numpy as np
+    index = cache.index
+    rows = [{"vector": index.vectors[i].tolist(), "answer": index.answer(i, 0), "meta": index.meta[i].tolist()}
+            for i in range(index.capacity)]
+    json_path = os.path.join(tmp, f"index{entries}.json")
+    with open(json_path, "w") as f:
+        json.dump(rows, f, ensure_ascii=False)
+
+    start = time.perf_counter()
+    reopened = SemanticCache(cache.embed, max_bytes=index.capacity * (256 * 4 + 8192 + 36), path=path)
+    mmap_ms = (time.perf_counter() - start) * 1000
+    assert reopened.index.loaded
+
+    start = time.perf_counter()
+    with open(json_path) as f:
+        rows = json.load(f)
+    np.array([row["vector"] for row in rows], dtype="<f4")
+    [row["answer"].encode('utf-8') for row in rows]
+    np.array([tuple(row["meta"]) for row in rows], dtype=index.meta_dtype)
+    json_ms = (time.perf_counter() - start) * 1000
+    return mmap_ms, json_ms, os.path.getsize(json_path)
+
+
+def main():
+    parser = argparse.ArgumentParser(description="意味キャッシュのベンチマーク")
+    parser.add_argument("--entries", type=int, nargs="+", default=[1000, 10000], help="キャッシュのエントリ数")
+    parser.add_argument("--queries", type=int, default=2000, help="検索・追加の回数")
+    args = parser.parse_args()
+
+    print("paraphrase quality (HashingEmbedder, dim 256)")
+    print(f"{'threshold':>9} {'hit %':>7} {'wrong %':>8} {'near-miss hit %':>16}")
+    for threshold in (0.8, 0.85, 0.9, 0.95):
+        hit, wrong, near = paraphrase_quality(threshold)
+        print(f"{threshold:>9.2f} {hit * 100:>7.1f} {wrong * 100:>8.1f} {near * 100:>16.1f}")
+
+    print()
+    print(f"{'entries':>8} {'get us':>8} {'set us':>8} {'index MB':>9} {'mmap open ms':>13} {'json load ms':>13}")
+    with tempfile.TemporaryDirectory() as tmp:
+        for entries in args.entries:
+            path = os.path.join(tmp, f"cache{entries}")
+            get_us, set_us, cache = lookup_cost(entries, args.queries, path)
+            mmap_ms, json_ms, _ = load_cost(cache, entries, path, tmp)
+            size = sum(os.path.getsize(os.path.join(path, name)) for name in os.listdir(path))
+            print(f"{entries:>8} {get_us:>8.1f} {set_us:>8.1f} {size / 1024 / 1024:>9.1f} {mmap_ms:>13.2f} {json_ms:>13.1f}")
+
+
+if __name__ == "__main__":
+    main()
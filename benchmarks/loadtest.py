@@ -0,0 +1,350 @@
+# benchmarks/loadtest.py
+# JSONL のチャットリクエストを lambda_handler に流し込む負荷試験
+#
+# 使い方: python benchmarks/loadtest.py [--corpus requests.jsonl] [--requests 200] [--concurrency 4] [--rate 20]
+#                                       [--ttft-ms 300 --tokens-per-second 40 --error-rate 0.01]
+#                                       [--env KEY=VALUE] [--output results.json] [--baseline previous.json] [--ref HEAD~1]
+#
+# --concurrency 個のワーカープロセス (= Lambda のコンテナ) がそれぞれ index を読み込み、
+# 届いたリクエストを 1 件ずつ処理します。--rate を指定すると毎秒その件数を (--arrival に従って) 投入する
+# オープンループ、指定しなければ空いたワーカーがすぐ次を処理するクローズドループになります。
+# オープンループのレイテンシは投入予定時刻から数えるので、ワーカー待ちの時間も含みます。
+#
+# コーパスは 1 行 1 JSON で、"message" (なければ "body" / "title") をメッセージとして使い、
+# "conversationHistory" / "conversationId" / "stream" があればそのままリクエストボディに含めます。
+# 結果は --output に JSON で書き出し、--baseline に以前の結果を渡すと差分を表示します。
+import argparse
+import json
+import multiprocessing
+import os
+import queue
+import random
+import resource
+import statistics
+import subprocess
+import sys
+import tempfile
+import threading
+import time
+
+BENCH_DIR = os.path.dirname(os.path.abspath(__file__))
+ROOT = os.path.join(BENCH_DIR, '..')
+LAMBDA_DIR = os.path.join(ROOT, 'lambda')
+sys.path.insert(0, BENCH_DIR)
+
+import stub_backend  # noqa: E402
+from bench_history import make_history  # noqa: E402
+
+
+class FakeContext:
+    """Lambda の context の代わり。残り時間は timeout_ms から経過時間を引いて返します。"""
+
+    function_name = "loadtest"
+    memory_limit_in_mb = 128
+
+    def __init__(self, request_id, timeout_ms):
+        self.aws_request_id = request_id
+        self._deadline = time.monotonic() + timeout_ms / 1000
+
+    def get_remaining_time_in_millis(self):
+        return max(0, int((self._deadline - time.monotonic()) * 1000))
+
+
+def load_corpus(path, history_turns=0):
+    """
+    JSONL のコーパスを読み込み、lambda_handler に渡すリクエストボディ (dict) のリストを返します。
+
+    Args:
+        path (str): JSONL ファイルのパス。
+        history_turns (int): conversationHistory を含まない行に付ける合成の会話履歴のターン数。
+    """
+    bodies = []
+    with open(path, encoding='utf-8') as f:
+        for line in f:
+            line = line.strip()
+            if not line:
+                continue
+            item = json.loads(line)
+            body = {"message": item.get("message") or item.get("body") or item.get("title") or ""}
+            for key in ("conversationHistory", "conversationId", "stream"):
+                if key in item:
+                    body[key] = item[key]
+            if history_turns and "conversationHistory" not in body and "conversationId" not in body:
+                body["conversationHistory"] = make_history(history_turns)
+            bodies.append(body)
+    if not bodies:
+        raise ValueError(f"No requests found in {path}")
+    return bodies
+
+
+def make_event(body, user):
+    """API Gateway (Cognito オーソライザー付き) のプロキシ統合イベントを作ります。"""
+    return {
+        "resource": "/chat",
+        "path": "/chat",
+        "httpMethod": "POST",
+        "headers": {"Content-Type": "application/json", "Authorization": "Bearer loadtest"},
+        "requestContext": {"authorizer": {"claims": {"sub": f"sub-{user}", "cognito:username": f"user{user}",
+                                                     "email": f"user{user}@example.com"}}},
+        "body": json.dumps(body, ensure_ascii=False),
+    }
+
+
+def classify(response):
+    """レスポンスを "ok" / "upstream_error" / "http_<ステータス>" に分類します。"""
+    status = response.get("statusCode")
+    if status != 200:
+        return f"http_{status}"
+    body = response.get("body") or ""
+    if response.get("headers", {}).get("Content-Type", "").startswith("text/event-stream"):
+        # 最後の done イベントの中身で判定する
+        body = body.rstrip().rpartition("data: ")[2]
+    try:
+        result = json.loads(body)
+    except ValueError:
+        return "invalid_body"
+    if not result.get("success"):
+        return "handler_error"
+    text = result.get("response") or ""
+    return "upstream_error" if text.startswith(("Error:", "An unexpected error")) else "ok"
+
+
+def worker(worker_id, lambda_dir, env, jobs, results, timeout_ms, show_logs):
+    """1 つの Lambda コンテナとして、jobs から取り出したリクエストを 1 件ずつ処理します。"""
+    os.environ.update(env)
+    if not show_logs:
+        devnull = os.open(os.devnull, os.O_WRONLY)
+        os.dup2(devnull, sys.stdout.fileno())
+    rss_before_kb = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+    sys.path.insert(0, lambda_dir)
+    started = time.perf_counter()
+    import index
+    init_ms = (time.perf_counter() - started) * 1000
+    rss_init_kb = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+
+    while True:
+        job = jobs.get()
+        if job is None:
+            break
+        i, scheduled_at, event = job
+        picked_at = time.monotonic()
+        if scheduled_at is None:
+            scheduled_at = picked_at
+        try:
+            response = index.lambda_handler(event, FakeContext(f"req-{i}", timeout_ms))
+            outcome = classify(response)
+            size = len(response.get("body") or "")
+        except Exception as e:
+            outcome, size = f"exception_{type(e).__name__}", 0
+        done_at = time.monotonic()
+        results.put(("request", i, worker_id, outcome, (picked_at - scheduled_at) * 1000,
+                     (done_at - picked_at) * 1000, (done_at - scheduled_at) * 1000, size))
+
+    results.put(("worker", worker_id, init_ms, rss_before_kb, rss_init_kb,
+                 resource.getrusage(resource.RUSAGE_SELF).ru_maxrss))
+
+
+def schedule(jobs, events, rate, arrival, seed):
+    """events を rate 件/秒で jobs に投入します (rate が 0 なら一度に投入する)。"""
+    rng = random.Random(seed)
+    start = time.monotonic()
+    at = start
+    for i, event in enumerate(events):
+        if rate:
+            delay = at - time.monotonic()
+            if delay > 0:
+                time.sleep(delay)
+            jobs.put((i, at, event))
+            at += rng.expovariate(rate) if arrival == "poisson" else 1 / rate
+        else:
+            jobs.put((i, None, event))
+
+
+def percentile(values, q):
+    if not values:
+        return None
+    ordered = sorted(values)
+    return ordered[min(len(ordered) - 1, int(q * len(ordered)))]
+
+
+def summarize(values):
+    return {
+        "mean": round(statistics.fmean(values), 3) if values else None,
+        "p50": percentile(values, 0.5),
+        "p95": percentile(values, 0.95),
+        "p99": percentile(values, 0.99),
+        "max": max(values) if values else None,
+    }
+
+
+def git_revision():
+    try:
+        revision = subprocess.run(["git", "-C", ROOT, "rev-parse", "--short", "HEAD"],
+                                  capture_output=True, text=True, check=True).stdout.strip()
+        dirty = subprocess.run(["git", "-C", ROOT, "status", "--porcelain", "--", "lambda"],
+                               capture_output=True, text=True, check=True).stdout.strip()
+        return revision + ("-dirty" if dirty else "")
+    except (OSError, subprocess.CalledProcessError):
+        return None
+
+
+def run(args, bodies, backend_url):
+    env = {
+        "NGROK_URL": backend_url,
+        # 計測のコストは含めるが、EMF の出力 (ワーカーの標準出力は捨てる) は試験中に行わない
+        "METRICS_FLUSH_SECONDS": "3600",
+        **dict(item.split("=", 1) for item in args.env),
+    }
+    events = [make_event(bodies[i % len(bodies)], i % args.users) for i in range(args.requests)]
+
+    mp = multiprocessing.get_context("spawn")
+    jobs = mp.Queue()
+    results = mp.Queue()
+    workers = [mp.Process(target=worker, args=(w, args.lambda_dir, env, jobs, results, args.timeout_ms, args.show_logs))
+               for w in range(args.concurrency)]
+    for p in workers:
+        p.start()
+
+    # 全ワーカーの初期化 (コールドスタート) が済んでから計測を始める
+    warm = [make_event(bodies[0], 0)]
+    for _ in workers:
+        jobs.put((-1, None, warm[0]))
+    pending = len(workers)
+    while pending:
+        if results.get()[1] == -1:
+            pending -= 1
+
+    started = time.monotonic()
+    feeder = threading.Thread(target=schedule, args=(jobs, events, args.rate, args.arrival, args.seed), daemon=True)
+    feeder.start()
+
+    requests, worker_stats = [], []
+    while len(requests) < len(events):
+        try:
+            item = results.get(timeout=args.timeout_ms / 1000 * 2)
+        except queue.Empty:
+            break
+        requests.append(item)
+    elapsed = time.monotonic() - started
+    feeder.join()
+    for _ in workers:
+        jobs.put(None)
+    while len(worker_stats) < len(workers):
+        item = results.get()
+        if item[0] == "worker":
+            worker_stats.append(item)
+    for p in workers:
+        p.join()
+
+    outcomes = {}
+    for item in requests:
+        outcomes[item[3]] = outcomes.get(item[3], 0) + 1
+    ok = outcomes.get("ok", 0)
+    return {
+        "revision": git_revision(),
+        "config": {
+            "corpus": os.path.relpath(args.corpus, ROOT), "requests": args.requests, "concurrency": args.concurrency,
+            "rate": args.rate, "arrival": args.arrival, "users": args.users, "history_turns": args.history,
+            "backend": {"ttft_ms": args.ttft_ms, "ttft_sigma": args.ttft_sigma,
+                        "tokens_per_second": args.tokens_per_second, "output_tokens": args.output_tokens,
+                        "error_rate": args.error_rate},
+            "env": env | {"NGROK_URL": "stub"},
+        },
+        "completed": len(requests),
+        "lost": len(events) - len(requests),
+        "elapsed_s": round(elapsed, 3),
+        "throughput_rps": round(len(requests) / elapsed, 2) if elapsed else None,
+        "goodput_rps": round(ok / elapsed, 2) if elapsed else None,
+        "error_rate": round(1 - ok / len(events), 4),
+        "outcomes": outcomes,
+        "latency_ms": summarize([item[6] for item in requests]),
+        "service_ms": summarize([item[5] for item in requests]),
+        "queue_ms": summarize([item[4] for item in requests]),
+        "response_kb": summarize([item[7] / 1024 for item in requests]),
+        "workers": {
+            "init_ms": summarize([w[2] for w in worker_stats]),
+            # ru_maxrss は Linux では KB 単位
+            "rss_after_import_mb": round(max(w[4] for w in worker_stats) / 1024, 1),
+            "rss_high_water_mb": round(max(w[5] for w in worker_stats) / 1024, 1),
+        },
+    }
+
+
+def format_ms(value):
+    return "-" if value is None else f"{value:.1f}"
+
+
+def report(result, baseline=None):
+    print(f"revision {result['revision']}  completed {result['completed']} (lost {result['lost']}) "
+          f"in {result['elapsed_s']}s  throughput {result['throughput_rps']} rps  goodput {result['goodput_rps']} rps")
+    print(f"error rate {result['error_rate']:.2%}  outcomes {result['outcomes']}")
+    print(f"{'':<12} {'mean':>9} {'p50':>9} {'p95':>9} {'p99':>9} {'max':>9}")
+    for key in ("latency_ms", "service_ms", "queue_ms"):
+        row = result[key]
+        print(f"{key:<12} " + " ".join(f"{format_ms(row[q]):>9}" for q in ("mean", "p50", "p95", "p99", "max")))
+    workers = result["workers"]
+    print(f"workers: init p50 {format_ms(workers['init_ms']['p50'])}ms  "
+          f"rss after import {workers['rss_after_import_mb']}MB  high-water {workers['rss_high_water_mb']}MB")
+
+    if baseline is not None:
+        print(f"\nvs baseline {baseline.get('revision')}:")
+        pairs = [
+            ("throughput_rps", result["throughput_rps"], baseline["throughput_rps"]),
+            ("error_rate", result["error_rate"], baseline["error_rate"]),
+            ("rss_high_water_mb", workers["rss_high_water_mb"], baseline["workers"]["rss_high_water_mb"]),
+        ]
+        for q in ("p50", "p95", "p99"):
+            pairs.append((f"latency_{q}_ms", result["latency_ms"][q], baseline["latency_ms"][q]))
+        for name, now, before in pairs:
+            if now is None or before is None:
+                continue
+            change = f" ({(now - before) / before:+.1%})" if before else ""
+            print(f"    {name:<20} {before:>10.3f} -> {now:>10.3f}{change}")
+
+
+def main():
+    parser = argparse.ArgumentParser(description="lambda_handler の負荷試験")
+    parser.add_argument("--corpus", default=os.path.join(ROOT, "requests.jsonl"), help="リクエストの JSONL ファイル")
+    parser.add_argument("--requests", type=int, default=200, help="送信するリクエスト数 (コーパスを繰り返して使う)")
+    parser.add_argument("--concurrency", type=int, default=4, help="ワーカープロセス (Lambda コンテナ) の数")
+    parser.add_argument("--rate", type=float, default=0.0, help="毎秒の投入件数 (0 ならクローズドループ)")
+    parser.add_argument("--arrival", choices=("uniform", "poisson"), default="poisson", help="オープンループの到着間隔")
+    parser.add_argument("--users", type=int, default=16, help="リクエストを割り振るユーザー数")
+    parser.add_argument("--history", type=int, default=0, help="会話履歴のない行に付ける合成の会話履歴のターン数")
+    parser.add_argument("--timeout-ms", type=int, default=30000, help="Lambda のタイムアウト (context の残り時間)")
+    parser.add_argument("--env", action="append", default=[], metavar="KEY=VALUE", help="ワーカーに渡す環境変数")
+    parser.add_argument("--lambda-dir", default=LAMBDA_DIR, help="計測する lambda/ のディレクトリ")
+    parser.add_argument("--ref", help="lambda/ の代わりに計測する git リビジョン (例: HEAD~1)")
+    parser.add_argument("--output", help="結果を書き出す JSON ファイル")
+    parser.add_argument("--baseline", help="比較する以前の結果 (JSON)")
+    parser.add_argument("--show-logs", action="store_true", help="ワーカーのログを表示する")
+    stub_backend.add_model_arguments(parser)
+    parser.set_defaults(ttft_ms=300.0, seed=0)
+    args = parser.parse_args()
+
+    bodies = load_corpus(args.corpus, args.history)
+    server, _, url = stub_backend.start(model=stub_backend.model_from_args(args))
+    try:
+        if args.ref:
+            from bench_coldstart import checkout_lambda
+            with tempfile.TemporaryDirectory() as tmp:
+                args.lambda_dir = checkout_lambda(args.ref, tmp)
+                result = run(args, bodies, url)
+            result["revision"] = args.ref
+        else:
+            result = run(args, bodies, url)
+    finally:
+        server.shutdown()
+
+    baseline = None
+    if args.baseline:
+        with open(args.baseline) as f:
+            baseline = json.load(f)
+    report(result, baseline)
+    if args.output:
+        with open(args.output, "w") as f:
+            json.dump(result, f, indent=2, ensure_ascii=False)
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,355 @@
+# benchmarks/stub_backend.py
+# ベンチマーク用の推論サーバーのスタブ (GPU のバッチ処理コストを模擬する)
+#
+# 使い方: python benchmarks/stub_backend.py [--port 8501] [--base-ms 50] [--per-item-ms 5]
+#         python benchmarks/stub_backend.py --ttft-ms 300 --tokens-per-second 40 [--error-rate 0.01]
+#
+# 既定では 1 回の forward は base_ms + per_item_ms × バッチ件数 かかり、GPU は 1 つなので forward は直列に実行されます。
+# つまり 1 件ずつ送ると base_ms を毎回払い、まとめて送ると base_ms を件数で割り勘できます。
+# --ttft-ms を指定すると代わりに GenerationModel を使い、最初のトークンまでの時間とトークン生成速度を模擬します
+# (リクエストは並行に処理され、"stream": true のリクエストには SSE でトークンを 1 つずつ返します)。
+# さらに --prefill-ms-per-token を指定すると、プロンプトのうちプレフィックスキャッシュに載っていない部分の
+# 処理 (prefill) の時間を TTFT に加えます。
+#
+# Bedrock Runtime 互換のエンドポイント (/model/{modelId}/converse, converse-stream, invoke,
+# invoke-with-response-stream) もあり、boto3 の endpoint_url をこのサーバーに向けると BedrockProvider を
+# 実際の botocore (署名・接続プール・イベントストリームのパース) ごと試せます。
+import argparse
+import base64
+import collections
+import json
+import math
+import random
+import struct
+import threading
+import time
+import zlib
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+
+
+class StubGPU:
+    """
+    バッチ処理のコストモデル。
+
+    Args:
+        base_ms (float): 1 回の forward の固定コスト (ミリ秒)。
+        per_item_ms (float): バッチ 1 件あたりの追加コスト (ミリ秒)。
+    """
+
+    def __init__(self, base_ms=50.0, per_item_ms=5.0):
+        self.base_ms = base_ms
+        self.per_item_ms = per_item_ms
+        self._lock = threading.Lock()
+        self.forwards = 0
+        self.items = 0
+
+    def run(self, n):
+        with self._lock:
+            self.forwards += 1
+            self.items += n
+            time.sleep((self.base_ms + self.per_item_ms * n) / 1000)
+
+
+class GenerationModel:
+    """
+    1 件の生成にかかる時間のモデル。
+
+    最初のトークンまでの時間 (TTFT) は中央値 ttft_ms の対数正規分布、出力トークン数は平均 output_tokens の
+    指数分布に従い、以降は tokens_per_second の速度で 1 トークンずつ生成します。
+
+    Args:
+        ttft_ms (float): TTFT の中央値 (ミリ秒)。
+        ttft_sigma (float): TTFT の対数正規分布の σ (0 なら固定)。
+        tokens_per_second (float): トークンの生成速度。
+        output_tokens (int): 出力トークン数の平均。
+        error_rate (float): 500 を返すリクエストの割合。
+        seed (int): 乱数のシード。
+    """
+
+    def __init__(self, ttft_ms=300.0, ttft_sigma=0.5, tokens_per_second=40.0, output_tokens=64,
+                 error_rate=0.0, seed=None):
+        self.ttft_ms = ttft_ms
+        self.ttft_sigma = ttft_sigma
+        self.tokens_per_second = tokens_per_second
+        self.output_tokens = output_tokens
+        self.error_rate = error_rate
+        self._random = random.Random(seed)
+        self._lock = threading.Lock()
+        self.requests = 0
+        self.errors = 0
+
+    def sample(self):
+        """(TTFT 秒, 出力トークン数, エラーにするか) を返します。"""
+        with self._lock:
+            self.requests += 1
+            ttft = self.ttft_ms * math.exp(self._random.gauss(0, self.ttft_sigma)) if self.ttft_sigma else self.ttft_ms
+            tokens = max(1, round(self._random.expovariate(1 / self.output_tokens)))
+            error = self._random.random() < self.error_rate
+            if error:
+                self.errors += 1
+        return ttft / 1000, tokens, error
+
+
+class PrefixCache:
+    """
+    推論サーバーのプレフィックス (KV) キャッシュのモデル。
+
+    プロンプトを block_chars 文字ごとのブロックに区切り、先頭からのブロック列が以前のプロンプトと一致する
+    部分はキャッシュ済み (prefill 不要) とします。ブロックは LRU で capacity_tokens 分まで保持します。
+    prefill は GPU の計算で律速されるので、1 台の中では直列に実行します。
+
+    Args:
+        prefill_ms_per_token (float): キャッシュに載っていない 1 トークンの prefill 時間 (ミリ秒)。
+        capacity_tokens (int): キャッシュできるトークン数。
+        block_chars (int): キャッシュのブロックの文字数。
+        chars_per_token (float): 文字数からトークン数を概算する係数。
+    """
+
+    def __init__(self, prefill_ms_per_token=0.2, capacity_tokens=50000, block_chars=64, chars_per_token=4.0):
+        self.prefill_ms_per_token = prefill_ms_per_token
+        self.block_chars = block_chars
+        self.chars_per_token = chars_per_token
+        self.capacity_blocks = max(1, int(capacity_tokens * chars_per_token / block_chars))
+        self._blocks = collections.OrderedDict()
+        self._lock = threading.Lock()
+        self._gpu = threading.Lock()
+        self.prompt_tokens = 0
+        self.cached_tokens = 0
+
+    def lookup(self, prompt):
+        """キャッシュ済みの文字数を返し、プロンプトのブロックをキャッシュに載せます。"""
+        cached = 0
+        key = None
+        with self._lock:
+            for end in range(self.block_chars, len(prompt) + 1, self.block_chars):
+                # 前のブロックまでのキーとつなげるので、途中が異なるプロンプトの同じブロックとは一致しない
+                key = hash((key, prompt[end - self.block_chars:end]))
+                if key in self._blocks:
+                    self._blocks.move_to_end(key)
+                    if cached == end - self.block_chars:
+                        cached = end
+                else:
+                    self._blocks[key] = True
+                    if len(self._blocks) > self.capacity_blocks:
+                        self._blocks.popitem(last=False)
+            self.prompt_tokens += round(len(prompt) / self.chars_per_token)
+            self.cached_tokens += round(cached / self.chars_per_token)
+        return cached
+
+    def prefill(self, prompt):
+        """キャッシュに載っていない部分の prefill 時間だけ待ちます (他のリクエストの prefill とは直列)。"""
+        missed_tokens = (len(prompt) - self.lookup(prompt)) / self.chars_per_token
+        with self._gpu:
+            time.sleep(missed_tokens * self.prefill_ms_per_token / 1000)
+
+    def hit_ratio(self):
+        return self.cached_tokens / self.prompt_tokens if self.prompt_tokens else 0.0
+
+
+def reply(prompt):
+    return f"stub reply to: {prompt[-40:]}"
+
+
+def reply_tokens(prompt, n):
+    return [f"tok{i} " for i in range(n - 1)] + [f"(re: {prompt[-20:]})"]
+
+
+def _event_header(name, value):
+    name, value = name.encode('utf-8'), value.encode('utf-8')
+    # 値の型 7 は文字列
+    return bytes([len(name)]) + name + b"\x07" + struct.pack(">H", len(value)) + value
+
+
+def event_message(event_type, obj):
+    """AWS のイベントストリーム (application/vnd.amazon.eventstream) の 1 メッセージを組み立てます。"""
+    headers = b"".join(_event_header(name, value) for name, value in (
+        (":event-type", event_type), (":content-type", "application/json"), (":message-type", "event")))
+    payload = json.dumps(obj).encode('utf-8')
+    prelude = struct.pack(">II", 16 + len(headers) + len(payload), len(headers))
+    message = prelude + struct.pack(">I", zlib.crc32(prelude)) + headers + payload
+    return message + struct.pack(">I", zlib.crc32(message))
+
+
+def make_handler(gpu, model=None, prefix_cache=None):
+    class Handler(BaseHTTPRequestHandler):
+        protocol_version = "HTTP/1.1"
+        # ヘッダーとボディを 1 回で送り、Nagle と遅延 ACK による 40ms の待ちを計測に混ぜない
+        wbufsize = -1
+        disable_nagle_algorithm = True
+
+        def _send(self, status, obj):
+            data = json.dumps(obj).encode('utf-8')
+            self.send_response(status)
+            self.send_header("Content-Type", "application/json")
+            self.send_header("Content-Length", str(len(data)))
+            self.end_headers()
+            self.wfile.write(data)
+
+        def do_GET(self):
+            if self.path == "/health":
+                health = {"status": "ok", "model": "stub", "forwards": gpu.forwards, "items": gpu.items}
+                if prefix_cache is not None:
+                    health["prefix_cache_hit_ratio"] = round(prefix_cache.hit_ratio(), 3)
+                self._send(200, health)
+            else:
+                self._send(404, {"detail": "Not Found"})
+
+        def _generate(self, payload):
+            ttft, n, error = model.sample()
+            # max_new_tokens を超えては生成しない
+            n = min(n, int(payload.get("max_new_tokens") or n))
+            if prefix_cache is not None:
+                prefix_cache.prefill(payload.get("prompt", ""))
+            time.sleep(ttft)
+            if error:
+                self._send(500, {"detail": "stub error"})
+                return
+            tokens = reply_tokens(payload.get("prompt", ""), n)
+            if not payload.get("stream"):
+                time.sleep(n / model.tokens_per_second)
+                self._send(200, {"generated_text": "".join(tokens), "generated_tokens": n})
+                return
+            self.send_response(200)
+            self.send_header("Content-Type", "text/event-stream")
+            self.send_header("Transfer-Encoding", "chunked")
+            self.end_headers()
+            for i, token in enumerate(tokens):
+                if i:
+                    time.sleep(1 / model.tokens_per_second)
+                self._chunk(f"data: {json.dumps({'token': token})}\n\n".encode('utf-8'))
+            self._chunk(b"data: [DONE]\n\n")
+            self.wfile.write(b"0\r\n\r\n")
+            self.wfile.flush()
+
+        def _bedrock(self, action, payload):
+            # Converse と Amazon Nova の InvokeModel はどちらも messages / inferenceConfig 形式
+            prompt = "".join(block.get("text", "") for message in payload.get("messages", [])
+                             for block in message.get("content", []))
+            max_tokens = (payload.get("inferenceConfig") or {}).get("maxTokens")
+            if model is None:
+                gpu.run(1)
+                delay, tokens = 0.0, [reply(prompt)]
+            else:
+                ttft, n, error = model.sample()
+                time.sleep(ttft)
+                if error:
+                    data = json.dumps({"message": "stub error"}).encode('utf-8')
+                    self.send_response(500)
+                    self.send_header("Content-Type", "application/json")
+                    self.send_header("x-amzn-ErrorType", "InternalServerException")
+                    self.send_header("Content-Length", str(len(data)))
+                    self.end_headers()
+                    self.wfile.write(data)
+                    return
+                delay, tokens = 1 / model.tokens_per_second, reply_tokens(prompt, min(n, max_tokens or n))
+            usage = {"inputTokens": len(prompt) // 4, "outputTokens": len(tokens),
+                     "totalTokens": len(prompt) // 4 + len(tokens)}
+            if action in ("converse", "invoke"):
+                time.sleep(delay * len(tokens))
+                self._send(200, {"output": {"message": {"role": "assistant", "content": [{"text": "".join(tokens)}]}},
+                                 "stopReason": "end_turn", "usage": usage, "metrics": {"latencyMs": 0}})
+                return
+            self.send_response(200)
+            self.send_header("Content-Type", "application/vnd.amazon.eventstream")
+            self.send_header("Transfer-Encoding", "chunked")
+            self.end_headers()
+            events = [("messageStart", {"role": "assistant"})]
+            events += [("contentBlockDelta", {"contentBlockIndex": 0, "delta": {"text": token}}) for token in tokens]
+            events += [("contentBlockStop", {"contentBlockIndex": 0}), ("messageStop", {"stopReason": "end_turn"}),
+                       ("metadata", {"usage": usage, "metrics": {"latencyMs": 0}})]
+            for i, (event_type, body) in enumerate(events):
+                if event_type == "contentBlockDelta" and i > 1:
+                    time.sleep(delay)
+                if action == "invoke-with-response-stream":
+                    # InvokeModelWithResponseStream はモデルの JSON を chunk イベントの bytes (base64) に入れる
+                    chunk = json.dumps({event_type: body}).encode('utf-8')
+                    event_type, body = "chunk", {"bytes": base64.b64encode(chunk).decode('ascii')}
+                self._chunk(event_message(event_type, body))
+            self.wfile.write(b"0\r\n\r\n")
+            self.wfile.flush()
+
+        def _chunk(self, data):
+            self.wfile.write(f"{len(data):x}\r\n".encode('latin-1') + data + b"\r\n")
+            self.wfile.flush()
+
+        def do_POST(self):
+            payload = json.loads(self.rfile.read(int(self.headers.get("Content-Length", "0"))) or b"{}")
+            if self.path.startswith("/model/"):
+                self._bedrock(self.path.rpartition("/")[2], payload)
+            elif self.path == "/generate" and model is not None:
+                self._generate(payload)
+            elif self.path == "/generate":
+                gpu.run(1)
+                self._send(200, {"generated_text": reply(payload.get("prompt", ""))})
+            elif self.path == "/generate_batch":
+                prompts = payload.get("prompts", [])
+                gpu.run(len(prompts))
+                self._send(200, {"generated_texts": [reply(p) for p in prompts]})
+            else:
+                self._send(404, {"detail": "Not Found"})
+
+        def log_message(self, format, *args):
+            pass
+
+    return Handler
+
+
+def start(host="127.0.0.1", port=0, base_ms=50.0, per_item_ms=5.0, model=None, prefix_cache=None):
+    """
+    スタブサーバーをバックグラウンドスレッドで起動します。
+
+    model (GenerationModel) を指定すると、/generate はそのモデルに従って並行に応答します。
+    prefix_cache (PrefixCache) も指定すると、キャッシュに載っていないプロンプトの prefill 時間を加えます。
+
+    Returns:
+        tuple: (サーバー, StubGPU, ベースURL)。
+    """
+    gpu = StubGPU(base_ms, per_item_ms)
+    server = ThreadingHTTPServer((host, port), make_handler(gpu, model, prefix_cache))
+    server.daemon_threads = True
+    threading.Thread(target=server.serve_forever, daemon=True).start()
+    return server, gpu, f"http://{host}:{server.server_address[1]}"
+
+
+def add_model_arguments(parser):
+    """GenerationModel の設定をコマンドライン引数に追加します (他のベンチマークからも使う)。"""
+    parser.add_argument("--ttft-ms", type=float, help="最初のトークンまでの時間の中央値 (ミリ秒)。指定すると GenerationModel を使う")
+    parser.add_argument("--ttft-sigma", type=float, default=0.5, help="最初のトークンまでの時間の対数正規分布の σ")
+    parser.add_argument("--tokens-per-second", type=float, default=40.0, help="トークンの生成速度")
+    parser.add_argument("--output-tokens", type=int, default=64, help="出力トークン数の平均")
+    parser.add_argument("--error-rate", type=float, default=0.0, help="500 を返すリクエストの割合")
+    parser.add_argument("--seed", type=int, help="乱数のシード")
+
+
+def model_from_args(args):
+    if args.ttft_ms is None:
+        return None
+    return GenerationModel(args.ttft_ms, args.ttft_sigma, args.tokens_per_second, args.output_tokens,
+                           args.error_rate, args.seed)
+
+
+def main():
+    parser = argparse.ArgumentParser(description="推論サーバーのスタブ")
+    parser.add_argument("--host", default="127.0.0.1")
+    parser.add_argument("--port", type=int, default=8501)
+    parser.add_argument("--base-ms", type=float, default=50.0, help="1 回の forward の固定コスト (ミリ秒)")
+    parser.add_argument("--per-item-ms", type=float, default=5.0, help="バッチ 1 件あたりの追加コスト (ミリ秒)")
+    add_model_arguments(parser)
+    parser.add_argument("--prefill-ms-per-token", type=float,
+                        help="キャッシュに載っていないプロンプト 1 トークンの prefill 時間 (ミリ秒)。--ttft-ms と合わせて指定する")
+    parser.add_argument("--prefix-cache-tokens", type=int, default=50000, help="プレフィックスキャッシュの容量 (トークン数)")
+    args = parser.parse_args()
+
+    prefix_cache = None
+    if args.prefill_ms_per_token is not None:
+        prefix_cache = PrefixCache(args.prefill_ms_per_token, args.prefix_cache_tokens)
+    server, _, url = start(args.host, args.port, args.base_ms, args.per_item_ms, model_from_args(args), prefix_cache)
+    print(f"Stub backend listening on {url}")
+    try:
+        threading.Event().wait()
+    except KeyboardInterrupt:
+        server.shutdown()
+
+
+if __name__ == "__main__":
+    main()
@@ -8,6 +8,8 @@ new BedrockChatbotStack(app, 'BedrockChatbotStack', {
   // モデルIDをオプションで指定可能
   modelId: 'us.amazon.nova-lite-v1:0',
   //modelId: 'us.amazon.nova-micro-v1:0',
+  // 推論サーバー (NGROK_URL) の代わりに Bedrock で生成する場合
+  //modelProvider: 'bedrock',
   
   // 環境変数から取得したリージョンを使用、またはデフォルトとしてus-east-1を使用
   env: { 
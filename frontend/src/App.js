@@ -15,6 +15,9 @@ const loadConfig = () => {
       userPoolId: window.REACT_APP_CONFIG.userPoolId,
       userPoolClientId: window.REACT_APP_CONFIG.userPoolClientId,
       region: window.REACT_APP_CONFIG.region,
+      // API Gateway (REST) 経由の "stream": true は SSE 形式の応答をまとめて返す (バッファリング) だけなので、
+      // 既定では使わない。トークンごとに届けるにはレスポンスストリーミング対応の経路が必要
+      streaming: window.REACT_APP_CONFIG.streaming === true,
     };
   }
   
@@ -24,6 +27,7 @@ const loadConfig = () => {
     userPoolId: process.env.REACT_APP_USER_POOL_ID || 'YOUR_USER_POOL_ID',
     userPoolClientId: process.env.REACT_APP_USER_POOL_CLIENT_ID || 'YOUR_USER_POOL_CLIENT_ID',
     region: process.env.REACT_APP_REGION || 'us-east-1',
+    streaming: process.env.REACT_APP_STREAMING === 'true',
   };
 };
 
@@ -39,9 +43,47 @@ Amplify.configure({
   },
 });
 
+// SSE形式のレスポンスを読み取り、イベントごとにコールバックを呼ぶ関数
+const readEventStream = async (response, onEvent) => {
+  const reader = response.body.getReader();
+  const decoder = new TextDecoder();
+  let buffer = '';
+
+  const dispatch = (block) => {
+    let event = 'message';
+    const dataLines = [];
+    block.split('\n').forEach((line) => {
+      if (line.startsWith('event:')) {
+        event = line.slice(6).trim();
+      } else if (line.startsWith('data:')) {
+        dataLines.push(line.slice(5).replace(/^ /, ''));
+      }
+    });
+    if (dataLines.length > 0) {
+      onEvent(event, JSON.parse(dataLines.join('\n')));
+    }
+  };
+
+  while (true) {
+    const { done, value } = await reader.read();
+    if (done) break;
+    buffer += decoder.decode(value, { stream: true });
+    let boundary;
+    while ((boundary = buffer.indexOf('\n\n')) !== -1) {
+      dispatch(buffer.slice(0, boundary));
+      buffer = buffer.slice(boundary + 2);
+    }
+  }
+  if (buffer.trim()) {
+    dispatch(buffer);
+  }
+};
+
 // ChatInterfaceコンポーネントの定義
 function ChatInterface({ signOut, user }) {
   const [messages, setMessages] = useState([]);
+  // サーバー側の会話ID (最初の送信時に発行される)
+  const [conversationId, setConversationId] = useState(null);
   const [input, setInput] = useState('');
   const [loading, setLoading] = useState(false);
   const [error, setError] = useState(null);
@@ -72,24 +114,75 @@ function ChatInterface({ signOut, user }) {
       const session = await Auth.currentSession();
       const idToken = session.getIdToken().getJwtToken();
 
-      const response = await axios.post(config.apiEndpoint, {
-        message: userMessage,
-        conversationHistory: messages
-      }, {
-        headers: {
-          'Authorization': idToken,
-          'Content-Type': 'application/json'
+      if (config.streaming) {
+        // SSE 形式の応答: イベントを読み、トークンごとにアシスタントのメッセージを更新
+        // (API Gateway 経由では応答はまとめて届くので、表示が早くなるわけではない)
+        const response = await fetch(config.apiEndpoint, {
+          method: 'POST',
+          headers: {
+            'Authorization': idToken,
+            'Content-Type': 'application/json',
+            'Accept': 'text/event-stream'
+          },
+          body: JSON.stringify({
+            message: userMessage,
+            conversationId,
+            stream: true
+          })
+        });
+        if (!response.ok) {
+          const data = await response.json().catch(() => ({}));
+          throw new Error(data.error || `HTTP ${response.status}`);
         }
-      });
 
-      if (response.data.success) {
-        setMessages(prev => [...prev, { role: 'assistant', content: response.data.response }]);
+        let started = false;
+        let streamed = '';
+        const updateAssistant = (content) => {
+          // 更新関数は後でまとめて実行されるため、追加か置換かは呼び出し時点で決めておく
+          const isFirst = !started;
+          started = true;
+          setMessages(prev => isFirst
+            ? [...prev, { role: 'assistant', content }]
+            : [...prev.slice(0, -1), { role: 'assistant', content }]);
+        };
+
+        await readEventStream(response, (event, data) => {
+          if (event === 'done') {
+            if (data.success) {
+              setConversationId(data.conversationId);
+              updateAssistant(data.response);
+            } else {
+              setError('応答の取得に失敗しました');
+            }
+          } else if (data.token) {
+            streamed += data.token;
+            setLoading(false);
+            updateAssistant(streamed);
+          }
+        });
       } else {
-        setError('応答の取得に失敗しました');
+        // 履歴はサーバー側に保存されているので、新しいメッセージと会話IDだけを送る
+        const response = await axios.post(config.apiEndpoint, {
+          message: userMessage,
+          conversationId
+        }, {
+          headers: {
+            'Authorization': idToken,
+            'Content-Type': 'application/json'
+          }
+        });
+
+        if (response.data.success) {
+          setConversationId(response.data.conversationId);
+          setMessages(prev => [...prev, { role: 'assistant', content: response.data.response }]);
+        } else {
+          setError('応答の取得に失敗しました');
+        }
       }
     } catch (err) {
       console.error("API Error:", err);
-      setError(`エラーが発生しました: ${err.message}`);
+      // サーバーが返したエラー内容 (503 のバックエンド停止など) があればそれを表示する
+      setError(`エラーが発生しました: ${err.response?.data?.error || err.message}`);
     } finally {
       setLoading(false);
     }
@@ -98,6 +191,7 @@ function ChatInterface({ signOut, user }) {
   // 会話をクリア
   const clearConversation = () => {
     setMessages([]);
+    setConversationId(null);
   };
 
   return (
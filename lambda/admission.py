@@ -0,0 +1,492 @@
+# lambda/admission.py
+# ユーザー (cognito:username) ごとのレート制限・同時実行数の上限と、推論サーバーが飽和したときの公平な受け入れ制御
+#
+# Lambda のコンテナは 1 度に 1 件しか処理しないので、ユーザーごとの状態はコンテナ間で共有するストアに置きます
+# (本番は DynamoDB、ローカルはメモリ / SQLite)。
+import os
+import threading
+import time
+
+from structured_log import log
+
+# 判定結果の理由
+ADMITTED = "admitted"
+RATE_LIMITED = "rate_limited"            # トークンバケットが空
+CONCURRENCY_LIMITED = "concurrency_limited"  # ユーザーの同時実行数が上限
+OVER_FAIR_SHARE = "over_fair_share"      # 飽和中に公平な取り分以上を使っている
+SATURATED = "saturated"                  # 飽和中 (取り分の範囲内なので空きを待てる)
+
+
+class AdmissionRejected(Exception):
+    """
+    リクエストを受け入れられないことを表します (429 を返す)。
+
+    Args:
+        reason (str): 理由 (RATE_LIMITED など)。
+        retry_after (float): 再試行までの目安 (秒)。
+    """
+
+    def __init__(self, reason, retry_after):
+        super().__init__(f"Request rejected ({reason}); retry after {retry_after:.1f}s")
+        self.reason = reason
+        self.retry_after = retry_after
+
+
+class Decision:
+    __slots__ = ("admitted", "reason", "retry_after", "tokens", "inflight")
+
+    def __init__(self, admitted, reason, retry_after, tokens, inflight=0):
+        self.admitted = admitted
+        self.reason = reason
+        self.retry_after = retry_after
+        self.tokens = tokens
+        # 判定時点のユーザーの同時実行数 (空きを待つ間の再判定の間隔に使う)
+        self.inflight = inflight
+
+
+class AdmissionPolicy:
+    """
+    受け入れの判定ルール。ストアはこの判定を 1 回の (アトミックな) 読み書きの中で呼び出します。
+
+    Args:
+        rate_per_second (float): ユーザーごとのトークンの毎秒補充量 (0 ならレート制限しない)。
+        burst (float): トークンバケットの容量。
+        max_concurrency (int): ユーザーごとの同時実行数の上限 (0 なら制限しない)。
+        global_capacity (int): 推論サーバー全体の同時実行数 (0 なら飽和を判定しない)。
+            これに達すると、同時実行中のユーザー数で割った取り分以上を使っているユーザーは即座に拒否し、
+            取り分に満たないユーザーは空きを待ちます。
+        lease_seconds (float): 受け入れたリクエストの枠を、解放されなくても失効させるまでの時間 (秒)。
+        busy_retry_after (float): 同時実行数による拒否で返す Retry-After (秒)。
+    """
+
+    def __init__(self, rate_per_second=1.0, burst=5.0, max_concurrency=2, global_capacity=0,
+                 lease_seconds=60.0, busy_retry_after=1.0):
+        self.rate_per_second = rate_per_second
+        self.burst = burst
+        self.max_concurrency = max_concurrency
+        self.global_capacity = global_capacity
+        self.lease_seconds = lease_seconds
+        self.busy_retry_after = busy_retry_after
+
+    def decide(self, tokens, updated_at, inflight_by_user, user, now):
+        """
+        Args:
+            tokens (float): 保存されているトークン数 (初回は None)。
+            updated_at (float): tokens を保存した時刻 (time.time())。
+            inflight_by_user (dict): ユーザーごとの同時実行数 (0 のユーザーは含まない)。
+            user (str): 判定するユーザー。
+            now (float): 現在時刻 (time.time())。
+
+        Returns:
+            Decision: 判定結果と、保存するトークン数。
+        """
+        user_inflight = inflight_by_user.get(user, 0)
+        return self.decide_counts(tokens, updated_at, user_inflight, sum(inflight_by_user.values()),
+                                  len(inflight_by_user) + (0 if user_inflight else 1), now)
+
+    def decide_counts(self, tokens, updated_at, user_inflight, total_inflight, active_users, now):
+        """
+        全ユーザーの一覧の代わりに集計値で判定します (ユーザーごとの項目と全体のカウンターを持つストア用)。
+
+        Args:
+            tokens (float): 保存されているトークン数 (初回は None)。
+            updated_at (float): tokens を保存した時刻 (time.time())。
+            user_inflight (int): 判定するユーザーの同時実行数。
+            total_inflight (int): 全体の同時実行数。
+            active_users (int): 同時実行中のユーザー数 (判定するユーザーを含む)。
+            now (float): 現在時刻 (time.time())。
+
+        Returns:
+            Decision: 判定結果と、保存するトークン数。
+        """
+        if tokens is None:
+            tokens = self.burst
+        elif self.rate_per_second:
+            tokens = min(self.burst, tokens + max(0.0, now - updated_at) * self.rate_per_second)
+        if self.rate_per_second and tokens < 1:
+            return Decision(False, RATE_LIMITED, (1 - tokens) / self.rate_per_second, tokens, user_inflight)
+
+        if self.max_concurrency and user_inflight >= self.max_concurrency:
+            return Decision(False, CONCURRENCY_LIMITED, self.busy_retry_after, tokens, user_inflight)
+
+        if self.global_capacity and total_inflight >= self.global_capacity:
+            fair_share = max(1, self.global_capacity // max(1, active_users))
+            if user_inflight >= fair_share:
+                return Decision(False, OVER_FAIR_SHARE, self.busy_retry_after, tokens, user_inflight)
+            return Decision(False, SATURATED, self.busy_retry_after, tokens, user_inflight)
+
+        return Decision(True, ADMITTED, 0.0, tokens - 1 if self.rate_per_second else tokens, user_inflight)
+
+
+class MemoryAdmissionStore:
+    """プロセス内に保持するストア (ローカル開発・ベンチマーク用。コンテナ間では共有されない)。"""
+
+    def __init__(self):
+        self._buckets = {}  # ユーザー -> (トークン数, 更新時刻)
+        self._leases = {}  # リース ID -> (ユーザー, 失効時刻)
+        self._inflight = {}  # ユーザー -> 同時実行数
+        self._next_expiry = float("inf")
+        self._lock = threading.Lock()
+
+    def _expire(self, now):
+        # 失効するリースがあり得るときだけ走査する
+        if now < self._next_expiry:
+            return
+        self._next_expiry = float("inf")
+        for lease_id, (user, expires_at) in list(self._leases.items()):
+            if expires_at <= now:
+                self._remove(lease_id)
+            else:
+                self._next_expiry = min(self._next_expiry, expires_at)
+
+    def _remove(self, lease_id):
+        user, _ = self._leases.pop(lease_id)
+        count = self._inflight[user] - 1
+        if count:
+            self._inflight[user] = count
+        else:
+            del self._inflight[user]
+
+    def acquire(self, user, lease_id, policy, now):
+        with self._lock:
+            self._expire(now)
+            tokens, updated_at = self._buckets.get(user, (None, None))
+            decision = policy.decide(tokens, updated_at, self._inflight, user, now)
+            self._buckets[user] = (decision.tokens, now)
+            if decision.admitted:
+                expires_at = now + policy.lease_seconds
+                self._leases[lease_id] = (user, expires_at)
+                self._inflight[user] = self._inflight.get(user, 0) + 1
+                self._next_expiry = min(self._next_expiry, expires_at)
+            return decision
+
+    def release(self, user, lease_id):
+        with self._lock:
+            if lease_id in self._leases:
+                self._remove(lease_id)
+
+
+class SQLiteAdmissionStore:
+    """
+    ローカル SQLite に保持するストア (テスト・単一ホストで複数プロセスが共有する場合用)。
+
+    Args:
+        path (str): SQLite ファイルのパス。
+    """
+
+    def __init__(self, path):
+        import sqlite3  # 使う場合のみ読み込む (コールドスタート短縮)
+        self._conn = sqlite3.connect(path, check_same_thread=False, isolation_level=None, timeout=5.0)
+        self._conn.execute("PRAGMA journal_mode=WAL")
+        self._conn.execute(
+            "CREATE TABLE IF NOT EXISTS admission_buckets ("
+            "user TEXT PRIMARY KEY, tokens REAL NOT NULL, updated_at REAL NOT NULL)"
+        )
+        self._conn.execute(
+            "CREATE TABLE IF NOT EXISTS admission_leases ("
+            "lease_id TEXT PRIMARY KEY, user TEXT NOT NULL, expires_at REAL NOT NULL)"
+        )
+        self._conn.execute("CREATE INDEX IF NOT EXISTS admission_leases_expires ON admission_leases (expires_at)")
+        self._lock = threading.Lock()
+
+    def acquire(self, user, lease_id, policy, now):
+        with self._lock:
+            self._conn.execute("BEGIN IMMEDIATE")
+            try:
+                self._conn.execute("DELETE FROM admission_leases WHERE expires_at <= ?", (now,))
+                row = self._conn.execute(
+                    "SELECT tokens, updated_at FROM admission_buckets WHERE user = ?", (user,)
+                ).fetchone()
+                inflight = dict(self._conn.execute(
+                    "SELECT user, COUNT(*) FROM admission_leases GROUP BY user"
+                ).fetchall())
+                decision = policy.decide(row[0] if row else None, row[1] if row else None, inflight, user, now)
+                self._conn.execute(
+                    "INSERT OR REPLACE INTO admission_buckets (user, tokens, updated_at) VALUES (?, ?, ?)",
+                    (user, decision.tokens, now),
+                )
+                if decision.admitted:
+                    self._conn.execute(
+                        "INSERT INTO admission_leases (lease_id, user, expires_at) VALUES (?, ?, ?)",
+                        (lease_id, user, now + policy.lease_seconds),
+                    )
+                self._conn.execute("COMMIT")
+            except BaseException:
+                self._conn.execute("ROLLBACK")
+                raise
+        return decision
+
+    def release(self, user, lease_id):
+        with self._lock:
+            self._conn.execute("DELETE FROM admission_leases WHERE lease_id = ?", (lease_id,))
+
+
+class DynamoDBAdmissionStore:
+    """
+    DynamoDB に保持するストア (本番用)。
+
+    パーティションキー pk (S) のテーブルに、ユーザーごとの項目 (pk = "user#<ユーザー>") と全体のカウンター
+    (pk = "global#<期間番号>") を保存します。
+
+    - ユーザーの項目はトークンバケットとそのユーザーのリース (leases、map 属性) を持ち、version 属性による
+      条件付き書き込みで更新します。競合するのは同じユーザーの同時リクエストどうしだけです。
+    - 全体の同時実行数 (inflight) と同時実行中のユーザー数 (users) は、lease_seconds ごとの期間の項目に
+      アトミックな ADD で加減します。リースは受け入れた期間の項目に数え、全体の値は直近 2 期間の合計を使います
+      (リースは lease_seconds で失効するので、解放されずに残った分も 2 期間後には数えなくなる)。
+    - 全体の容量は ADD の条件式 (今の期間の inflight < 容量 - 前の期間の inflight) で確認するので、
+      複数のコンテナが同時に判定しても容量を超えて受け入れません。
+
+    Args:
+        table_name (str): テーブル名。
+        bucket_ttl_seconds (int): 項目を失効させるまでの時間 (expiresAt 属性)。
+        region_name (str): リージョン。
+        endpoint_url (str): エンドポイント (DynamoDB Local など。省略時は AWS のエンドポイント)。
+        client: dynamodb クライアント (省略時は作成する)。
+        retries (int): 同じユーザーの別のリクエストと書き込みが競合したときに読み直す回数。
+    """
+
+    def __init__(self, table_name, bucket_ttl_seconds=86400, region_name=None, endpoint_url=None, client=None,
+                 retries=5):
+        from boto3.dynamodb.types import TypeDeserializer, TypeSerializer  # 使う場合のみ読み込む
+        from botocore.exceptions import ClientError
+        if client is None:
+            import boto3
+            client = boto3.client('dynamodb', region_name=region_name, endpoint_url=endpoint_url)
+        self._client = client
+        self._table_name = table_name
+        self._serializer = TypeSerializer()
+        self._deserializer = TypeDeserializer()
+        self._client_error = ClientError
+        self.bucket_ttl_seconds = bucket_ttl_seconds
+        self.retries = retries
+
+    def _conflict(self, error):
+        return error.response["Error"]["Code"] == "ConditionalCheckFailedException"
+
+    def _get_user(self, user):
+        item = self._client.get_item(TableName=self._table_name, Key={"pk": {"S": f"user#{user}"}},
+                                     ConsistentRead=True).get("Item", {})
+        return {k: self._deserializer.deserialize(v) for k, v in item.items()}
+
+    def _put_user(self, user, item, version):
+        # version が読み取ったときのままなら書き込む (同じユーザーの別のリクエストと競合したら False)
+        item = {**item, "pk": f"user#{user}", "version": version + 1}
+        condition = {"ConditionExpression": "attribute_not_exists(pk)"}
+        if version:
+            condition = {"ConditionExpression": "version = :v", "ExpressionAttributeValues": {":v": {"N": str(version)}}}
+        try:
+            self._client.put_item(TableName=self._table_name,
+                                  Item={k: self._serializer.serialize(v) for k, v in item.items()}, **condition)
+            return True
+        except self._client_error as e:
+            if not self._conflict(e):
+                raise
+            return False
+
+    def _global_counts(self, epoch):
+        """直近 2 期間のカウンターを {期間番号: (inflight, users)} で返します。"""
+        keys = [{"pk": {"S": f"global#{e}"}} for e in (epoch - 1, epoch)]
+        counts = {epoch - 1: (0, 0), epoch: (0, 0)}
+        while keys:
+            result = self._client.batch_get_item(RequestItems={self._table_name: {"Keys": keys, "ConsistentRead": True}})
+            for item in result["Responses"].get(self._table_name, []):
+                e = int(item["pk"]["S"].split("#", 1)[1])
+                counts[e] = (int(item.get("inflight", {"N": "0"})["N"]), int(item.get("users", {"N": "0"})["N"]))
+            keys = result.get("UnprocessedKeys", {}).get(self._table_name, {}).get("Keys", [])
+        return counts
+
+    def _add(self, epoch, inflight, users, limit=None):
+        """期間のカウンターに加減します。limit を指定すると inflight が limit 未満のときだけ加え、超える場合は False。"""
+        values = {":i": {"N": str(inflight)}, ":n": {"N": str(users)},
+                  ":x": {"N": str(int(time.time()) + self.bucket_ttl_seconds)}}
+        condition = {}
+        if limit is not None:
+            condition["ConditionExpression"] = "attribute_not_exists(inflight) OR inflight < :limit"
+            values[":limit"] = {"N": str(limit)}
+        try:
+            self._client.update_item(
+                TableName=self._table_name, Key={"pk": {"S": f"global#{epoch}"}},
+                UpdateExpression="ADD inflight :i, #u :n SET expiresAt = if_not_exists(expiresAt, :x)",
+                ExpressionAttributeNames={"#u": "users"}, ExpressionAttributeValues=values, **condition)
+            return True
+        except self._client_error as e:
+            if limit is None or not self._conflict(e):
+                raise
+            return False
+
+    def _forget(self, leases, active_epoch, window_start):
+        # 外したリースと、同時実行中でなくなったユーザーを全体のカウンターから引く (窓の外の期間はもう数えていない)
+        by_epoch = {}
+        for lease in leases:
+            if lease.get("p") is not None and int(lease["p"]) >= window_start:
+                by_epoch[int(lease["p"])] = by_epoch.get(int(lease["p"]), 0) + 1
+        if active_epoch is not None and active_epoch >= window_start:
+            by_epoch.setdefault(active_epoch, 0)
+        for e, count in by_epoch.items():
+            self._add(e, -count, -1 if e == active_epoch else 0)
+
+    def acquire(self, user, lease_id, policy, now):
+        epoch = int(now // policy.lease_seconds)
+        counted = bool(policy.global_capacity)
+        for _ in range(self.retries):
+            item = self._get_user(user)
+            version = int(item.get("version", 0))
+            leases = item.get("leases", {})
+            live = {k: v for k, v in leases.items() if float(v["e"]) > now}
+            expired = [v for k, v in leases.items() if k not in live]
+            active_epoch = int(item["activeEpoch"]) if "activeEpoch" in item else None
+            tokens = float(item["tokens"]) if "tokens" in item else None
+            updated_at = float(item["updatedAt"]) if "updatedAt" in item else None
+
+            total, active_users, limit = 0, 1, None
+            if counted:
+                counts = self._global_counts(epoch)
+                # まだカウンターから引いていない失効済みのリースは数えない
+                pending = sum(1 for v in expired if v.get("p") is not None and int(v["p"]) == epoch - 1)
+                previous = max(0, counts[epoch - 1][0] - pending)
+                total = previous + max(0, counts[epoch][0])
+                # このユーザーの分は数え直す (同時実行中として今の期間に数える)
+                user_counted = active_epoch is not None and active_epoch >= epoch - 1
+                active_users = max(0, counts[epoch - 1][1] + counts[epoch][1] - user_counted) + 1
+                limit = policy.global_capacity - previous
+            decision = policy.decide_counts(tokens, updated_at, len(live), total, active_users, now)
+            if not decision.admitted:
+                # トークンは保存した値と時刻から毎回計算し直せるので、拒否では書き込まない
+                return decision
+
+            moved = counted and active_epoch != epoch
+            if counted and (limit <= 0 or not self._add(epoch, 1, 1 if moved else 0, limit=limit)):
+                # 他のコンテナが先に空きを使った
+                return policy.decide_counts(tokens, updated_at, len(live), policy.global_capacity, active_users, now)
+
+            live[lease_id] = {"e": _decimal(now + policy.lease_seconds), "p": epoch if counted else None}
+            new_item = {
+                "tokens": _decimal(decision.tokens),
+                "updatedAt": _decimal(now),
+                "expiresAt": int(now) + self.bucket_ttl_seconds,
+                "leases": live,
+            }
+            if counted:
+                new_item["activeEpoch"] = epoch
+            if self._put_user(user, new_item, version):
+                if counted:
+                    self._forget(expired, active_epoch if moved else None, epoch - 1)
+                return decision
+            if counted:
+                self._add(epoch, -1, -1 if moved else 0)
+        raise RuntimeError(f"Could not update admission state for {user}: concurrent writers")
+
+    def release(self, user, lease_id):
+        for _ in range(self.retries):
+            item = self._get_user(user)
+            leases = dict(item.get("leases", {}))
+            if lease_id not in leases:
+                return
+            released = leases.pop(lease_id)
+            now = time.time()
+            live = {k: v for k, v in leases.items() if float(v["e"]) > now}
+            removed = [released] + [v for k, v in leases.items() if k not in live]
+            active_epoch = int(item["activeEpoch"]) if "activeEpoch" in item else None
+            new_item = {k: v for k, v in item.items() if k not in ("pk", "version", "activeEpoch")}
+            new_item["leases"] = live
+            if live and active_epoch is not None:
+                new_item["activeEpoch"] = active_epoch
+            if self._put_user(user, new_item, int(item.get("version", 0))):
+                # 窓の外の期間のカウンターに加減しても読まれないので、下限は設けない
+                self._forget(removed, None if live else active_epoch, float("-inf"))
+                return
+        raise RuntimeError(f"Could not update admission state for {user}: concurrent writers")
+
+
+def _decimal(value):
+    from decimal import Decimal  # boto3 は float を受け付けない
+    return Decimal(str(round(value, 6)))
+
+
+def create_admission_store(kind, **options):
+    """
+    環境変数の値からストアを作ります。
+
+    Args:
+        kind (str): "memory" / "sqlite" / "dynamodb"。
+        options: sqlite の path、dynamodb の table_name など。
+    """
+    if kind == "memory":
+        return MemoryAdmissionStore()
+    if kind == "sqlite":
+        return SQLiteAdmissionStore(options["path"])
+    if kind == "dynamodb":
+        return DynamoDBAdmissionStore(options["table_name"])
+    raise ValueError(f"Unknown admission store: {kind}")
+
+
+class AdmissionController:
+    """
+    ストアと判定ルールを使って、上流を呼び出す前にリクエストを受け入れるかを決めます。
+
+    飽和中で取り分の範囲内のリクエストは最大 queue_timeout 秒まで空きを待ちます。
+    再判定の間隔は poll_interval × (1 + そのユーザーの同時実行数) で、同時実行数が少ないユーザーほど
+    短い間隔で再判定するので、空いた枠は軽いユーザーに先に渡ります。
+    ストアの障害時はリクエストを止めないよう、受け入れます (fail-open)。
+
+    Args:
+        store: MemoryAdmissionStore / SQLiteAdmissionStore / DynamoDBAdmissionStore。
+        policy (AdmissionPolicy): 判定ルール。
+        queue_timeout (float): 飽和中に空きを待つ最大時間 (秒)。
+        poll_interval (float): 空きを待つ間の再判定の基本の間隔 (秒)。
+    """
+
+    def __init__(self, store, policy, queue_timeout=2.0, poll_interval=0.05):
+        self.store = store
+        self.policy = policy
+        self.queue_timeout = queue_timeout
+        self.poll_interval = poll_interval
+        self.counts = {}
+        self.store_errors = 0
+
+    def acquire(self, user, max_wait=None):
+        """
+        受け入れる場合はリース ID を返します (終わったら release() に渡す)。ストア障害時は None を返します。
+
+        Args:
+            user (str): ユーザー名。
+            max_wait (float): 待つ時間の上限 (秒)。Lambda の残り時間に合わせて短くする場合に指定する。
+
+        Raises:
+            AdmissionRejected: 受け入れられない場合。
+        """
+        lease_id = os.urandom(8).hex()
+        wait = self.queue_timeout if max_wait is None else min(self.queue_timeout, max_wait)
+        give_up_at = time.monotonic() + wait
+        attempt = 0
+        while True:
+            try:
+                decision = self.store.acquire(user, lease_id, self.policy, time.time())
+            except Exception as e:
+                self.store_errors += 1
+                log.warning("Admission store failed; admitting the request", error=str(e))
+                return None
+            if decision.admitted or decision.reason != SATURATED or time.monotonic() >= give_up_at:
+                break
+            attempt += 1
+            time.sleep(min(self.poll_interval * (1 + decision.inflight), max(0.0, give_up_at - time.monotonic())))
+        self.counts[decision.reason] = self.counts.get(decision.reason, 0) + 1
+        if attempt:
+            # 空きを待ったリクエスト (最終的に受け入れたか、待ちきれずに拒否したか)
+            self.counts["queued"] = self.counts.get("queued", 0) + 1
+        if not decision.admitted:
+            raise AdmissionRejected(decision.reason, decision.retry_after)
+        return lease_id
+
+    def release(self, user, lease_id):
+        if lease_id is None:
+            return
+        try:
+            self.store.release(user, lease_id)
+        except Exception as e:
+            # 解放できなかった枠は lease_seconds 後に失効する
+            self.store_errors += 1
+            log.warning("Admission store failed to release a lease", error=str(e))
+
+    def stats(self):
+        return {**self.counts, "store_errors": self.store_errors}
@@ -0,0 +1,308 @@
+# lambda/batching.py
+# 同時に届いたプロンプトをまとめて /generate_batch に送るマイクロバッチング
+#
+# Lambda のコンテナは 1 度に 1 件のイベントしか処理しないため、バッチは推論サーバーの手前で作ります。
+# 使い方: python lambda/batching.py --listen 0.0.0.0:8080 --backend http://localhost:8501
+#         (Lambda の NGROK_URL をこのゲートウェイに向ける)
+import argparse
+import asyncio
+import collections
+import json
+import os
+import time
+
+from history import estimate_tokens
+from latency import LatencyHistogram
+from structured_log import log
+from upstream import Backend
+
+# 1 つのバッチ内で共通でなければならない生成パラメータ
+BATCH_PARAM_KEYS = ("max_new_tokens", "temperature", "top_p", "do_sample", "stop")
+
+JSON_HEADERS = {"Content-Type": "application/json", "Accept": "application/json"}
+
+
+def batch_params(payload):
+    """ペイロードからバッチのグループ分けに使う生成パラメータを取り出します。"""
+    return {k: payload[k] for k in BATCH_PARAM_KEYS if k in payload}
+
+
+class BatchError(Exception):
+    """バッチ呼び出しが失敗したことを表します (バッチ内の全リクエストに伝わります)。"""
+
+
+class _Group:
+    def __init__(self, params):
+        self.params = params
+        self.items = []  # (プロンプト, Future, 到着時刻)
+        self.tokens = 0
+        self.timer = None
+        self.ready = False
+
+
+class MicroBatcher:
+    """
+    生成パラメータが同じリクエストを最大 max_wait_ms の間ためて、1 回の send_batch にまとめます。
+
+    フラッシュ条件:
+        - max_batch_size 件たまった
+        - プロンプトの推定トークン数の合計が max_batch_tokens に達した
+        - 最初の 1 件から max_wait_ms 経過した
+        - flush_when_idle が有効で、送信中のバッチがない (低負荷時は待たずに送る)
+    max_in_flight を指定すると同時に送るバッチ数を制限し、空きを待つ間に次のバッチを大きくします。
+
+    Args:
+        send_batch (callable): (生成パラメータ, プロンプトのリスト) を受け取り、生成テキストのリストを返すコルーチン関数。
+        max_batch_size (int): 1 バッチの最大件数。
+        max_wait_ms (float): 最初のリクエストを待たせる最大時間 (ミリ秒)。
+        max_batch_tokens (int): 1 バッチのプロンプトトークン数の上限。None なら制限しない。
+        flush_when_idle (bool): 送信中のバッチがなければ即座に送るか。
+        max_in_flight (int): 同時に送信するバッチ数の上限。None なら制限しない。
+    """
+
+    def __init__(self, send_batch, max_batch_size=8, max_wait_ms=10.0, max_batch_tokens=None,
+                 flush_when_idle=False, max_in_flight=None, tokenizer=estimate_tokens):
+        self.send_batch = send_batch
+        self.max_batch_size = max_batch_size
+        self.max_wait = max_wait_ms / 1000
+        self.max_batch_tokens = max_batch_tokens
+        self.flush_when_idle = flush_when_idle
+        self.max_in_flight = max_in_flight
+        self.tokenizer = tokenizer
+        self._groups = collections.OrderedDict()
+        self._in_flight = 0
+        self._tasks = set()
+        self.batches = 0
+        self.items = 0
+        self.flush_reasons = collections.Counter()
+        self.batch_sizes = collections.Counter()
+        self.queue_wait = LatencyHistogram()
+
+    async def submit(self, payload):
+        """
+        1 件のリクエストをバッチに追加し、そのリクエストの生成テキストを返します。
+
+        Args:
+            payload (dict): /generate と同じ形式のペイロード (prompt と生成パラメータ)。
+        """
+        params = batch_params(payload)
+        key = json.dumps(params, sort_keys=True)
+        group = self._groups.get(key)
+        if group is None:
+            group = self._groups[key] = _Group(params)
+        future = asyncio.get_running_loop().create_future()
+        group.items.append((payload["prompt"], future, time.perf_counter()))
+        group.tokens += self.tokenizer(payload["prompt"])
+
+        if len(group.items) >= self.max_batch_size:
+            self._flush(key, "size")
+        elif self.max_batch_tokens and group.tokens >= self.max_batch_tokens:
+            self._flush(key, "tokens")
+        elif self.flush_when_idle and self._in_flight == 0:
+            self._flush(key, "idle")
+        elif group.timer is None and not group.ready:
+            group.timer = asyncio.get_running_loop().call_later(self.max_wait, self._flush, key, "timer")
+        return await future
+
+    def _flush(self, key, reason):
+        group = self._groups.get(key)
+        if group is None:
+            return
+        if group.timer is not None:
+            group.timer.cancel()
+            group.timer = None
+        if self.max_in_flight and self._in_flight >= self.max_in_flight:
+            # 送信枠が空いたら _drain_ready から送る (その間に届いたリクエストも同じバッチに入る)
+            group.ready = True
+            return
+
+        items = group.items[:self.max_batch_size]
+        group.items = group.items[self.max_batch_size:]
+        if group.items:
+            group.tokens = sum(self.tokenizer(prompt) for prompt, _, _ in group.items)
+            group.ready = True
+        else:
+            del self._groups[key]
+
+        now = time.perf_counter()
+        for _, _, arrived in items:
+            self.queue_wait.observe((now - arrived) * 1000)
+        self.batches += 1
+        self.items += len(items)
+        self.flush_reasons[reason] += 1
+        self.batch_sizes[len(items)] += 1
+        self._in_flight += 1
+        task = asyncio.ensure_future(self._dispatch(group.params, items))
+        self._tasks.add(task)
+        task.add_done_callback(self._tasks.discard)
+
+    async def _dispatch(self, params, items):
+        try:
+            results = await self.send_batch(params, [prompt for prompt, _, _ in items])
+            if len(results) != len(items):
+                raise BatchError(f"Expected {len(items)} results from the batch, got {len(results)}")
+        except Exception as e:
+            for _, future, _ in items:
+                if not future.done():
+                    future.set_exception(e)
+        else:
+            # 呼び出し元がキャンセル済みのリクエストには結果を返さない
+            for (_, future, _), result in zip(items, results):
+                if not future.done():
+                    future.set_result(result)
+        finally:
+            self._in_flight -= 1
+            self._drain_ready()
+
+    def _drain_ready(self):
+        # 送信枠が空いたら、待たされていたグループを古い順に送る
+        for key in [k for k, g in self._groups.items() if g.ready]:
+            if self.max_in_flight and self._in_flight >= self.max_in_flight:
+                return
+            self._groups[key].ready = False
+            self._flush(key, "drain")
+
+    def stats(self):
+        return {
+            "batches": self.batches,
+            "items": self.items,
+            "mean_batch_size": round(self.items / self.batches, 2) if self.batches else None,
+            "batch_sizes": dict(sorted(self.batch_sizes.items())),
+            "flush_reasons": dict(self.flush_reasons),
+            "in_flight": self._in_flight,
+            "queued": sum(len(g.items) for g in self._groups.values()),
+            "queue_wait_ms": self.queue_wait.snapshot(),
+        }
+
+
+class HttpBatchSender:
+    """
+    推論サーバーの /generate_batch にまとめて送る send_batch の実装。
+
+    リクエストは {"prompts": [...], 生成パラメータ}、レスポンスは {"generated_texts": [...]} を想定します。
+    /generate_batch が 404 / 405 を返すサーバーには、以後 /generate を並行に呼び出します。
+
+    Args:
+        url (str): 推論サーバーのベースURL。
+    """
+
+    def __init__(self, url, path="/generate_batch"):
+        self.backend = Backend(url, max_idle=16)
+        self.path = path
+        self.batch_supported = True
+
+    async def __call__(self, params, prompts):
+        if self.batch_supported:
+            body = json.dumps({**params, "prompts": prompts}).encode('utf-8')
+            status, data = await self.backend.post(self.path, body, JSON_HEADERS)
+            if status == 200:
+                return json.loads(data)["generated_texts"]
+            if status not in (404, 405):
+                raise BatchError(f"{self.path} returned status {status}: {data[:200]!r}")
+            log.warning("Batch endpoint is not supported by the backend; falling back to concurrent /generate calls",
+                        path=self.path, status=status)
+            self.batch_supported = False
+        return await asyncio.gather(*(self._generate_one(params, prompt) for prompt in prompts))
+
+    async def _generate_one(self, params, prompt):
+        body = json.dumps({**params, "prompt": prompt}).encode('utf-8')
+        status, data = await self.backend.post("/generate", body, JSON_HEADERS)
+        if status != 200:
+            raise BatchError(f"/generate returned status {status}: {data[:200]!r}")
+        return json.loads(data)["generated_text"]
+
+
+class BatchingGateway:
+    """
+    /generate を受け付けて MicroBatcher に渡す HTTP/1.1 (keep-alive) ゲートウェイ。
+
+    GET /health は推論サーバーにそのまま中継し、GET /stats でバッチの統計を返します。
+    """
+
+    def __init__(self, batcher, sender):
+        self.batcher = batcher
+        self.sender = sender
+
+    async def handle(self, reader, writer):
+        try:
+            while True:
+                request_line = await reader.readline()
+                if not request_line:
+                    return
+                method, path, _ = request_line.decode('latin-1').split(" ", 2)
+                headers = {}
+                while True:
+                    line = await reader.readline()
+                    if line in (b"\r\n", b"\n", b""):
+                        break
+                    name, _, value = line.decode('latin-1').partition(':')
+                    headers[name.strip().lower()] = value.strip()
+                body = await reader.readexactly(int(headers.get("content-length", "0")))
+                status, response = await self.route(method, path, body)
+                data = json.dumps(response).encode('utf-8') if not isinstance(response, bytes) else response
+                writer.write(
+                    f"HTTP/1.1 {status} {'OK' if status == 200 else 'Error'}\r\n"
+                    f"Content-Type: application/json\r\nContent-Length: {len(data)}\r\n\r\n".encode('latin-1') + data
+                )
+                await writer.drain()
+                if headers.get("connection", "").lower() == "close":
+                    return
+        except (ConnectionError, asyncio.IncompleteReadError, ValueError):
+            return
+        finally:
+            writer.close()
+
+    async def route(self, method, path, body):
+        if method == "POST" and path == "/generate":
+            try:
+                payload = json.loads(body)
+                text = await self.batcher.submit(payload)
+            except (ValueError, KeyError) as e:
+                return 400, {"detail": f"Invalid request: {e}"}
+            except Exception as e:
+                return 502, {"detail": str(e)}
+            return 200, {"generated_text": text}
+        if method == "GET" and path == "/health":
+            try:
+                return await self.sender.backend.request("GET", "/health")
+            except (OSError, asyncio.IncompleteReadError) as e:
+                return 503, {"status": "error", "detail": str(e)}
+        if method == "GET" and path == "/stats":
+            return 200, self.batcher.stats()
+        return 404, {"detail": "Not Found"}
+
+
+async def serve(host, port, backend_url, **batcher_options):
+    sender = HttpBatchSender(backend_url)
+    gateway = BatchingGateway(MicroBatcher(sender, **batcher_options), sender)
+    server = await asyncio.start_server(gateway.handle, host, port)
+    log.info("Batching gateway listening", host=host, port=port, backend=backend_url, **batcher_options)
+    async with server:
+        await server.serve_forever()
+
+
+def main():
+    parser = argparse.ArgumentParser(description="/generate をマイクロバッチにまとめるゲートウェイ")
+    parser.add_argument("--listen", default=os.environ.get("BATCH_LISTEN", "127.0.0.1:8080"), help="待ち受けアドレス (host:port)")
+    parser.add_argument("--backend", default=os.environ.get("NGROK_URL", "http://127.0.0.1:8501"), help="推論サーバーのベースURL")
+    parser.add_argument("--max-batch-size", type=int, default=int(os.environ.get("BATCH_MAX_SIZE", "8")))
+    parser.add_argument("--max-wait-ms", type=float, default=float(os.environ.get("BATCH_MAX_WAIT_MS", "10")))
+    parser.add_argument("--max-batch-tokens", type=int, default=int(os.environ.get("BATCH_MAX_TOKENS", "0")) or None)
+    parser.add_argument("--flush-when-idle", action="store_true",
+                        default=os.environ.get("BATCH_FLUSH_WHEN_IDLE", "false").lower() == "true")
+    parser.add_argument("--max-in-flight", type=int, default=int(os.environ.get("BATCH_MAX_IN_FLIGHT", "0")) or None)
+    args = parser.parse_args()
+
+    host, _, port = args.listen.rpartition(":")
+    asyncio.run(serve(
+        host, int(port), args.backend,
+        max_batch_size=args.max_batch_size,
+        max_wait_ms=args.max_wait_ms,
+        max_batch_tokens=args.max_batch_tokens,
+        flush_when_idle=args.flush_when_idle,
+        max_in_flight=args.max_in_flight,
+    ))
+
+
+if __name__ == "__main__":
+    main()
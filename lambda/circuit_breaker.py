@@ -0,0 +1,164 @@
+# lambda/circuit_breaker.py
+# /generate 呼び出しのサーキットブレーカー (closed / open / half_open)
+import collections
+import threading
+import time
+
+CLOSED = "closed"
+OPEN = "open"
+HALF_OPEN = "half_open"
+
+# メトリクスとして出力する状態の数値表現
+STATE_CODES = {CLOSED: 0, HALF_OPEN: 1, OPEN: 2}
+
+
+class CircuitOpenError(Exception):
+    """サーキットが開いているため、上流を呼ばずに失敗させたことを表します。"""
+
+    def __init__(self, retry_after):
+        super().__init__(f"Circuit is open; retry after {retry_after:.0f}s")
+        self.retry_after = retry_after
+
+
+class CircuitBreaker:
+    """
+    直近の失敗率に基づいて上流呼び出しを遮断するサーキットブレーカー。
+
+    closed: 通常どおり呼び出し、ローリングウィンドウ内の失敗率を記録します。
+    open: 呼び出しを即座に拒否します。open_seconds 経過後、最初の allow() で /health を
+          遅延プローブし、正常なら half_open に移ります (異常なら open を延長)。
+    half_open: 試行リクエストを 1 件だけ通し、成功すれば closed、失敗すれば open に戻ります。
+
+    Args:
+        failure_rate_threshold (float): open にする失敗率。
+        window_seconds (float): 失敗率を計算するローリングウィンドウの長さ (秒)。
+        min_requests (int): 失敗率を判定するのに必要なウィンドウ内のリクエスト数。
+        open_seconds (float): open を維持する時間 (秒)。
+        health_check (callable): 引数なしで呼び出し、バックエンドが正常なら True を返す関数。
+        on_state_change (callable): (旧状態, 新状態) を受け取るコールバック。
+    """
+
+    def __init__(self, failure_rate_threshold=0.5, window_seconds=30.0, min_requests=5,
+                 open_seconds=15.0, health_check=None, on_state_change=None):
+        self.failure_rate_threshold = failure_rate_threshold
+        self.window_seconds = window_seconds
+        self.min_requests = min_requests
+        self.open_seconds = open_seconds
+        self.health_check = health_check
+        self.on_state_change = on_state_change
+        self.state = CLOSED
+        self._outcomes = collections.deque()  # (時刻, 成功したか)
+        self._open_until = 0.0
+        self._trial_started_at = None
+        self._lock = threading.Lock()
+        self.opened = 0
+        self.rejected = 0
+        self.probes = 0
+        self.probe_failures = 0
+
+    def _transition(self, state):
+        old, self.state = self.state, state
+        if state == OPEN:
+            self.opened += 1
+            self._open_until = time.monotonic() + self.open_seconds
+        if state != HALF_OPEN:
+            self._trial_started_at = None
+        if state == CLOSED:
+            self._outcomes.clear()
+        if self.on_state_change is not None and old != state:
+            self.on_state_change(old, state)
+
+    def _prune(self, now):
+        cutoff = now - self.window_seconds
+        while self._outcomes and self._outcomes[0][0] < cutoff:
+            self._outcomes.popleft()
+
+    def failure_rate(self):
+        with self._lock:
+            self._prune(time.monotonic())
+            return self._failure_rate()
+
+    def _failure_rate(self):
+        if not self._outcomes:
+            return 0.0
+        return sum(1 for _, ok in self._outcomes if not ok) / len(self._outcomes)
+
+    def retry_after(self):
+        return max(0.0, self._open_until - time.monotonic())
+
+    def allow(self):
+        """
+        上流を呼び出してよいかを判定します。False の場合は呼び出さずに即座に失敗させてください。
+        """
+        probe = False
+        with self._lock:
+            now = time.monotonic()
+            if self.state == CLOSED:
+                return True
+            if self.state == OPEN:
+                if now < self._open_until:
+                    self.rejected += 1
+                    return False
+                probe = self.health_check is not None
+                if not probe:
+                    self._transition(HALF_OPEN)
+            if self.state == HALF_OPEN:
+                # 結果が記録されないまま試行が放置された場合は、次の試行を許可する
+                if self._trial_started_at is not None and now - self._trial_started_at < self.open_seconds:
+                    self.rejected += 1
+                    return False
+                self._trial_started_at = now
+                return True
+
+        # ロックの外で /health をプローブする (他の呼び出しはその間 open のまま拒否される)
+        with self._lock:
+            self._open_until = time.monotonic() + self.open_seconds
+            self.probes += 1
+        try:
+            healthy = bool(self.health_check())
+        except Exception:
+            healthy = False
+        with self._lock:
+            if not healthy:
+                self.probe_failures += 1
+                self.rejected += 1
+                return False
+            self._transition(HALF_OPEN)
+            self._trial_started_at = time.monotonic()
+            return True
+
+    def record_success(self):
+        with self._lock:
+            if self.state == HALF_OPEN:
+                self._transition(CLOSED)
+                return
+            now = time.monotonic()
+            self._outcomes.append((now, True))
+            self._prune(now)
+
+    def record_failure(self):
+        with self._lock:
+            if self.state == HALF_OPEN:
+                self._transition(OPEN)
+                return
+            if self.state == OPEN:
+                return
+            now = time.monotonic()
+            self._outcomes.append((now, False))
+            self._prune(now)
+            if len(self._outcomes) >= self.min_requests and self._failure_rate() >= self.failure_rate_threshold:
+                self._transition(OPEN)
+
+    def metrics(self):
+        with self._lock:
+            self._prune(time.monotonic())
+            return {
+                "state": self.state,
+                "state_code": STATE_CODES[self.state],
+                "failure_rate": round(self._failure_rate(), 3),
+                "window_requests": len(self._outcomes),
+                "opened": self.opened,
+                "rejected": self.rejected,
+                "probes": self.probes,
+                "probe_failures": self.probe_failures,
+            }
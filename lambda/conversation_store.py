@@ -0,0 +1,267 @@
+# lambda/conversation_store.py
+# 会話IDごとの追記専用ログ。クライアントは新しいメッセージだけを送ればよくなる
+#
+# 各ストアは履歴の要約の状態 (HistoryBuilder の summary_state。upto は会話の先頭からのメッセージ数) も
+# ターンと一緒に保存し、次のターンで前回の要約に差分だけを追加できるようにします。
+import threading
+import time
+from collections import OrderedDict
+
+
+class MemoryConversationStore:
+    """
+    プロセス内の辞書に保持するストア (ローカル開発・単一コンテナ用)。
+
+    ウォームコンテナでは辞書が残り続けるので、会話数の上限 (超えたら最も長く使われていない会話から追い出す) と、
+    最後に使われてからの有効期間を設けます。
+
+    Args:
+        max_conversations (int): 保持する会話数の上限。
+        ttl (float): 最後に読み書きされてから会話を破棄するまでの時間 (秒)。
+    """
+
+    def __init__(self, max_conversations=1000, ttl=3600.0):
+        self.max_conversations = max_conversations
+        self.ttl = ttl
+        self._conversations = OrderedDict()  # キー -> [メッセージのリスト, 要約の状態, 最終使用時刻]
+        self._lock = threading.Lock()
+        self.evictions = 0
+        self.expirations = 0
+
+    def _entry(self, key, create=False):
+        # ロックを取った状態で呼び出す
+        now = time.monotonic()
+        entry = self._conversations.get(key)
+        if entry is not None and entry[2] + self.ttl < now:
+            del self._conversations[key]
+            self.expirations += 1
+            entry = None
+        if entry is None:
+            if not create:
+                return None
+            entry = self._conversations[key] = [[], None, now]
+            while len(self._conversations) > self.max_conversations:
+                self._conversations.popitem(last=False)
+                self.evictions += 1
+        entry[2] = now
+        self._conversations.move_to_end(key)
+        return entry
+
+    def load(self, key, limit=None):
+        with self._lock:
+            entry = self._entry(key)
+            log = entry[0] if entry else []
+            return list(log[-limit:] if limit else log)
+
+    def count(self, key):
+        """会話のメッセージ数を返します。"""
+        with self._lock:
+            entry = self._entry(key)
+            return len(entry[0]) if entry else 0
+
+    def load_summary(self, key):
+        """保存した要約の状態 ({"upto": 要約済みメッセージ数, "text": 要約}) を返します。なければ None。"""
+        with self._lock:
+            entry = self._entry(key)
+            return entry[1] if entry else None
+
+    def append(self, key, messages, summary=None):
+        """
+        メッセージを追記し、追記後のメッセージ数を返します。summary を渡すと要約の状態も置き換えます。
+        """
+        with self._lock:
+            entry = self._entry(key, create=True)
+            entry[0].extend({"role": m["role"], "content": m["content"]} for m in messages)
+            if summary is not None:
+                entry[1] = dict(summary)
+            return len(entry[0])
+
+    def __len__(self):
+        return len(self._conversations)
+
+
+class SQLiteConversationStore:
+    """
+    ローカル SQLite に保持するストア (テスト・単一ホスト用)。
+
+    Args:
+        path (str): SQLite ファイルのパス。
+    """
+
+    def __init__(self, path):
+        import sqlite3  # 使う場合のみ読み込む (コールドスタート短縮)
+        self._conn = sqlite3.connect(path, check_same_thread=False, isolation_level=None, timeout=5.0)
+        self._conn.execute("PRAGMA journal_mode=WAL")
+        self._conn.execute(
+            "CREATE TABLE IF NOT EXISTS conversation_log ("
+            "conversation_key TEXT NOT NULL, seq INTEGER NOT NULL, role TEXT NOT NULL, "
+            "content TEXT NOT NULL, created_at REAL NOT NULL, "
+            "PRIMARY KEY (conversation_key, seq))"
+        )
+        self._conn.execute(
+            "CREATE TABLE IF NOT EXISTS conversation_summary ("
+            "conversation_key TEXT PRIMARY KEY, upto INTEGER NOT NULL, text TEXT NOT NULL)"
+        )
+        self._lock = threading.Lock()
+
+    def load(self, key, limit=None):
+        with self._lock:
+            if limit:
+                rows = self._conn.execute(
+                    "SELECT role, content FROM conversation_log WHERE conversation_key = ? "
+                    "ORDER BY seq DESC LIMIT ?", (key, limit),
+                ).fetchall()
+                rows.reverse()
+            else:
+                rows = self._conn.execute(
+                    "SELECT role, content FROM conversation_log WHERE conversation_key = ? ORDER BY seq",
+                    (key,),
+                ).fetchall()
+        return [{"role": role, "content": content} for role, content in rows]
+
+    def count(self, key):
+        with self._lock:
+            (last,) = self._conn.execute(
+                "SELECT COALESCE(MAX(seq), 0) FROM conversation_log WHERE conversation_key = ?", (key,)
+            ).fetchone()
+        return last
+
+    def load_summary(self, key):
+        with self._lock:
+            row = self._conn.execute(
+                "SELECT upto, text FROM conversation_summary WHERE conversation_key = ?", (key,)
+            ).fetchone()
+        return {"upto": row[0], "text": row[1]} if row else None
+
+    def append(self, key, messages, summary=None):
+        now = time.time()
+        with self._lock:
+            self._conn.execute("BEGIN IMMEDIATE")
+            try:
+                (last,) = self._conn.execute(
+                    "SELECT COALESCE(MAX(seq), 0) FROM conversation_log WHERE conversation_key = ?", (key,)
+                ).fetchone()
+                self._conn.executemany(
+                    "INSERT INTO conversation_log (conversation_key, seq, role, content, created_at) "
+                    "VALUES (?, ?, ?, ?, ?)",
+                    [(key, last + i + 1, m["role"], m["content"], now) for i, m in enumerate(messages)],
+                )
+                if summary is not None:
+                    self._conn.execute(
+                        "INSERT OR REPLACE INTO conversation_summary (conversation_key, upto, text) VALUES (?, ?, ?)",
+                        (key, summary["upto"], summary["text"]),
+                    )
+                self._conn.execute("COMMIT")
+            except BaseException:
+                self._conn.execute("ROLLBACK")
+                raise
+        return last + len(messages)
+
+
+class DynamoDBConversationStore:
+    """
+    DynamoDB に保持するストア (本番用)。
+
+    パーティションキー conversationId (S)、ソートキー seq (N) のテーブルを想定します。
+    seq の重複は条件付き書き込みで防ぐので、同じ会話への同時追記でもログは壊れません。
+    要約の状態は "<会話ID>#summary" の seq 0 の項目に、ターンと同じトランザクションで書き込みます。
+
+    Args:
+        table_name (str): テーブル名。
+        ttl_days (int): 0 より大きい場合、expiresAt 属性に失効時刻を書き込む。
+    """
+
+    def __init__(self, table_name, ttl_days=0, region_name=None):
+        import boto3  # 使う場合のみ読み込む
+        from botocore.exceptions import ClientError
+        self._table = boto3.resource('dynamodb', region_name=region_name).Table(table_name)
+        self._client_error = ClientError
+        self.ttl_days = ttl_days
+
+    def _last_seq(self, key):
+        result = self._table.query(
+            KeyConditionExpression="conversationId = :k",
+            ExpressionAttributeValues={":k": key},
+            ProjectionExpression="seq",
+            ScanIndexForward=False,
+            Limit=1,
+        )
+        items = result.get("Items", [])
+        return int(items[0]["seq"]) if items else 0
+
+    def load(self, key, limit=None):
+        items = []
+        kwargs = {
+            "KeyConditionExpression": "conversationId = :k",
+            "ExpressionAttributeValues": {":k": key},
+            "ProjectionExpression": "#r, content",
+            "ExpressionAttributeNames": {"#r": "role"},
+            "ScanIndexForward": not limit,
+        }
+        while True:
+            if limit:
+                kwargs["Limit"] = limit - len(items)
+            result = self._table.query(**kwargs)
+            items.extend(result.get("Items", []))
+            if "LastEvaluatedKey" not in result or (limit and len(items) >= limit):
+                break
+            kwargs["ExclusiveStartKey"] = result["LastEvaluatedKey"]
+        if limit:
+            items.reverse()
+        return [{"role": item["role"], "content": item["content"]} for item in items]
+
+    def count(self, key):
+        return self._last_seq(key)
+
+    def load_summary(self, key):
+        item = self._table.get_item(Key={"conversationId": f"{key}#summary", "seq": 0}).get("Item")
+        return {"upto": int(item["upto"]), "text": item["text"]} if item else None
+
+    def append(self, key, messages, retries=3, summary=None):
+        expires_at = int(time.time()) + self.ttl_days * 86400 if self.ttl_days > 0 else None
+        for _ in range(retries):
+            last = self._last_seq(key)
+            puts = []
+            for i, m in enumerate(messages):
+                item = {"conversationId": key, "seq": last + i + 1, "role": m["role"], "content": m["content"]}
+                if expires_at:
+                    item["expiresAt"] = expires_at
+                puts.append({"Put": {
+                    "TableName": self._table.name,
+                    # resource のクライアントは Python の値を自動で DynamoDB の型に変換する
+                    "Item": item,
+                    "ConditionExpression": "attribute_not_exists(seq)",
+                }})
+            if summary is not None:
+                item = {"conversationId": f"{key}#summary", "seq": 0, "upto": summary["upto"], "text": summary["text"]}
+                if expires_at:
+                    item["expiresAt"] = expires_at
+                puts.append({"Put": {
+                    "TableName": self._table.name,
+                    "Item": item,
+                }})
+            try:
+                # 1 ターン分 (ユーザー + アシスタント) はまとめて書き込み、途中までの追記を残さない
+                self._table.meta.client.transact_write_items(TransactItems=puts)
+                return last + len(messages)
+            except self._client_error as e:
+                if e.response["Error"]["Code"] != "TransactionCanceledException":
+                    raise
+        raise RuntimeError(f"Could not append to conversation {key}: concurrent writers")
+
+
+def create_store(kind, **options):
+    """
+    環境変数の値からストアを作ります。
+
+    Args:
+        kind (str): "memory" / "sqlite" / "dynamodb"。
+        options: memory の max_conversations / ttl、sqlite の path、dynamodb の table_name / ttl_days など。
+    """
+    if kind == "memory":
+        return MemoryConversationStore(options.get("max_conversations", 1000), ttl=options.get("ttl", 3600.0))
+    if kind == "sqlite":
+        return SQLiteConversationStore(options["path"])
+    if kind == "dynamodb":
+        return DynamoDBConversationStore(options["table_name"], ttl_days=options.get("ttl_days", 0))
+    raise ValueError(f"Unknown conversation store: {kind}")
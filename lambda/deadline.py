@@ -0,0 +1,178 @@
+# lambda/deadline.py
+# Lambda の残り時間から上流呼び出しのタイムアウトを決め、リトライを予算内に抑える
+import os
+import threading
+import time
+
+from latency import LatencyHistogram
+
+
+class DeadlineExceeded(Exception):
+    """Lambda の期限までに上流の応答が得られなかったことを表します。"""
+
+
+class Deadline:
+    """
+    リクエスト全体の期限。
+
+    Args:
+        seconds (float): 現在から期限までの秒数。
+    """
+
+    def __init__(self, seconds):
+        self.expires_at = time.monotonic() + seconds
+
+    @classmethod
+    def from_context(cls, context, margin_ms=1000, default_ms=60000, cap_ms=None):
+        """
+        Lambda の残り時間から、エラー応答を返すための余裕 (margin_ms) を引いた期限を作ります。
+
+        context が None (ローカル実行など) の場合は default_ms を残り時間とみなします。
+        cap_ms を指定すると、残り時間がそれより長くても cap_ms を残り時間とみなします
+        (API Gateway の統合タイムアウトが Lambda のタイムアウトより先に来る場合)。
+        """
+        remaining_ms = context.get_remaining_time_in_millis() if context is not None else default_ms
+        if cap_ms is not None:
+            remaining_ms = min(remaining_ms, cap_ms)
+        return cls(max(0, remaining_ms - margin_ms) / 1000)
+
+    def remaining(self):
+        return max(0.0, self.expires_at - time.monotonic())
+
+    def expired(self):
+        return self.remaining() <= 0
+
+
+def backoff_delay(attempt, base=0.1, cap=2.0):
+    """
+    attempt 回目のリトライ前に待つ時間 (秒) を返します (指数バックオフ + full jitter)。
+
+    random モジュールの読み込みを避けるため、ゆらぎには os.urandom を使います。
+    """
+    jitter = int.from_bytes(os.urandom(2), 'big') / 0xFFFF
+    return min(cap, base * 2 ** (attempt - 1)) * jitter
+
+
+class RetryBudget:
+    """
+    トークンバケットによるリトライ予算。
+
+    リクエストごとに ratio 個のトークンを積み、リトライ 1 回につき 1 個消費します。
+    バックエンド障害時にリトライが負荷を何倍にも増幅するのを防ぎます。
+
+    Args:
+        ratio (float): 1 リクエストあたりに許すリトライの割合 (0.1 なら 10%)。
+        min_per_second (float): 流量が少ないときにも許すリトライの毎秒補充量。
+        capacity (float): 貯められるトークンの上限。
+    """
+
+    def __init__(self, ratio=0.1, min_per_second=0.2, capacity=10.0):
+        self.ratio = ratio
+        self.min_per_second = min_per_second
+        self.capacity = capacity
+        self.tokens = capacity
+        self._updated = time.monotonic()
+        self._lock = threading.Lock()
+        self.retries = 0
+        self.denied = 0
+
+    def _refill(self):
+        now = time.monotonic()
+        self.tokens = min(self.capacity, self.tokens + (now - self._updated) * self.min_per_second)
+        self._updated = now
+
+    def deposit(self):
+        """リクエストを 1 件送るたびに呼び出します。"""
+        with self._lock:
+            self._refill()
+            self.tokens = min(self.capacity, self.tokens + self.ratio)
+
+    def try_withdraw(self):
+        """リトライしてよければトークンを 1 個消費して True を返します。"""
+        with self._lock:
+            self._refill()
+            if self.tokens >= 1:
+                self.tokens -= 1
+                self.retries += 1
+                return True
+            self.denied += 1
+            return False
+
+    def stats(self):
+        with self._lock:
+            self._refill()
+            return {"tokens": round(self.tokens, 2), "retries": self.retries, "denied": self.denied}
+
+
+class AdaptiveTimeout:
+    """
+    観測したレイテンシの分位点から 1 回の試行のタイムアウトを決めます。
+
+    p99 × multiplier を超えても応答しない試行は詰まっているとみなして打ち切り、
+    残り時間でリトライできるようにします。生成時間は max_new_tokens にほぼ比例するので、レイテンシは
+    リクエストの大きさ (size) を 2 のべき乗で区切ったクラスごとに分けて記録し、同じクラスの分位点を使います。
+    そのクラスのサンプルが少ない間は残り時間をすべて使います。
+
+    打ち切った試行もタイムアウトの時間を観測値として記録します (記録しないと上流が遅くなった後も
+    短いタイムアウトのまま打ち切りを続けてしまう。記録すれば分位点が上がり、タイムアウトが伸びる)。
+
+    Args:
+        quantile (float): 基準にする分位点。
+        multiplier (float): 分位点に掛ける倍率。
+        min_timeout (float): 1 回の試行に与える最短のタイムアウト (秒)。これ未満しか残っていなければ試行しない。
+        min_samples (int): 分位点を使い始めるサンプル数。
+    """
+
+    def __init__(self, quantile=0.99, multiplier=1.5, min_timeout=1.0, min_samples=20):
+        self.quantile = quantile
+        self.multiplier = multiplier
+        self.min_timeout = min_timeout
+        self.min_samples = min_samples
+        self.histograms = {}
+        self._lock = threading.Lock()
+
+    @staticmethod
+    def size_class(size):
+        """size (max_new_tokens など) のクラス。1, 2-3, 4-7, ... と 2 のべき乗で区切り、None は 0 にします。"""
+        return int(size).bit_length() if size else 0
+
+    def observe(self, seconds, size=None):
+        """
+        試行の所要時間を記録します。
+
+        Args:
+            seconds (float): 応答までの時間。打ち切った試行ではタイムアウトの時間。
+            size (int): リクエストの大きさ (max_new_tokens)。
+        """
+        key = self.size_class(size)
+        with self._lock:
+            histogram = self.histograms.get(key)
+            if histogram is None:
+                histogram = self.histograms[key] = LatencyHistogram()
+            histogram.observe(seconds * 1000)
+
+    def attempt_timeout(self, deadline, size=None):
+        """
+        次の試行のタイムアウト (秒) を返します。
+
+        Args:
+            deadline (Deadline): リクエスト全体の期限。
+            size (int): リクエストの大きさ (max_new_tokens)。
+
+        Raises:
+            DeadlineExceeded: 残り時間が min_timeout に満たない場合。
+        """
+        remaining = deadline.remaining()
+        if remaining < self.min_timeout:
+            raise DeadlineExceeded(f"Only {remaining:.2f}s left before the Lambda deadline")
+        with self._lock:
+            histogram = self.histograms.get(self.size_class(size))
+            if histogram is None or len(histogram.recent) < self.min_samples:
+                return remaining
+            limit = histogram.quantile(self.quantile) / 1000 * self.multiplier
+        return min(remaining, max(self.min_timeout, limit))
+
+    def snapshot(self):
+        """size のクラスごとのヒストグラム (キーはクラスの上限、例: "le_511")。"""
+        with self._lock:
+            return {f"le_{(1 << key) - 1}": histogram.snapshot() for key, histogram in sorted(self.histograms.items())}
@@ -0,0 +1,211 @@
+# lambda/encoding.py
+# クライアントの Accept-Encoding に応じて応答ボディを圧縮し、API Gateway が
+# バイナリとして返せるよう base64 にする (長い会話履歴を含む応答の転送量と、Lambda のペイロード上限対策)
+import base64
+import zlib
+
+
+def header(event, name):
+    """イベントのリクエストヘッダーを大文字小文字を区別せずに返します (なければ None)。"""
+    headers = event.get('headers') or {}
+    value = headers.get(name)
+    if value is None:
+        lowered = name.lower()
+        for key, candidate in headers.items():
+            if key.lower() == lowered:
+                return candidate
+    return value
+
+
+def request_text(event):
+    """
+    リクエストボディを文字列で返します。
+
+    API Gateway にバイナリメディアタイプを設定すると、JSON のボディも base64 で届くのでデコードします。
+    """
+    body = event.get('body')
+    if body is None:
+        return None
+    if event.get('isBase64Encoded'):
+        return base64.b64decode(body).decode('utf-8')
+    return body
+
+
+def parse_accept_encoding(value):
+    """
+    Accept-Encoding の値を {コーディング: q 値} にします。
+
+    例: "gzip, br;q=0.9, *;q=0" -> {"gzip": 1.0, "br": 0.9, "*": 0.0}
+    """
+    accepted = {}
+    for part in (value or "").split(","):
+        coding, _, params = part.strip().partition(";")
+        coding = coding.strip().lower()
+        if not coding:
+            continue
+        q = 1.0
+        for param in params.split(";"):
+            key, _, number = param.strip().partition("=")
+            if key.strip().lower() == "q":
+                try:
+                    q = float(number)
+                except ValueError:
+                    q = 0.0
+        accepted[coding] = q
+    return accepted
+
+
+def accepts_binary(accept, media_types):
+    """
+    API Gateway がこのリクエストへの base64 の応答をバイナリに戻して返すかを返します。
+
+    API Gateway は Accept ヘッダーの最初のメディアタイプがバイナリメディアタイプのいずれかに一致する場合だけ
+    base64 をデコードするので (一致しなければ base64 の文字列のままクライアントに届く)、同じ規則で判定します。
+
+    Args:
+        accept (str): リクエストの Accept ヘッダー。
+        media_types (iterable[str]): API Gateway に設定したバイナリメディアタイプ ("*/*" や "text/*" も可)。
+    """
+    first = (accept or "").split(",", 1)[0].split(";", 1)[0].strip().lower()
+    for media_type in media_types:
+        media_type = media_type.strip().lower()
+        if media_type == "*/*" or media_type == first:
+            return True
+        if media_type.endswith("/*") and first.startswith(media_type[:-1]):
+            return True
+    return False
+
+
+def _gzip(data, level):
+    # gzip モジュールはヘッダーに時刻を書き込むので、zlib で直接 gzip 形式にする
+    compressor = zlib.compressobj(level, zlib.DEFLATED, 31)
+    return compressor.compress(data) + compressor.flush()
+
+
+class ResponseEncoder:
+    """
+    応答ボディの圧縮。クライアントが受け付けるコーディングのうち、サーバーが優先するものを使います。
+
+    brotli パッケージがあれば br を gzip より優先します (なければ gzip のみ)。
+    min_bytes 未満のボディや、圧縮しても小さくならないボディはそのまま返します。
+    圧縮を有効にしている場合は、圧縮しなかった応答にも Vary: Accept-Encoding を付けます
+    (キャッシュが圧縮していない応答を gzip を受け付けるクライアントに返したり、その逆をしたりしないように)。
+
+    Args:
+        min_bytes (int): 圧縮するボディの最小バイト数 (UTF-8)。
+        gzip_level (int): gzip の圧縮レベル (1-9)。
+        brotli_quality (int): brotli の品質 (0-11)。
+        codings (list[str]): 使うコーディング (優先順)。
+        binary_media_types (list[str]): API Gateway に設定したバイナリメディアタイプ。リクエストの Accept が
+            これに一致しない場合は圧縮しない (accepts_binary)。None なら Accept を確認しない。
+    """
+
+    def __init__(self, min_bytes=1024, gzip_level=6, brotli_quality=5, codings=("br", "gzip"),
+                 binary_media_types=None):
+        self.min_bytes = min_bytes
+        self.gzip_level = gzip_level
+        self.brotli_quality = brotli_quality
+        self.binary_media_types = None if binary_media_types is None else list(binary_media_types)
+        self.codings = []
+        self._brotli = None
+        for coding in codings:
+            if coding == "br":
+                try:
+                    import brotli  # 使う場合のみ読み込む
+                except ImportError:
+                    continue
+                self._brotli = brotli
+            elif coding != "gzip":
+                raise ValueError(f"Unknown content coding: {coding}")
+            self.codings.append(coding)
+        # 圧縮した応答のヘッダーは (元のヘッダー, コーディング) ごとに一度だけ組み立てる
+        self._headers = {}
+        self.compressed = 0
+        self.skipped = 0
+        self.bytes_in = 0
+        self.bytes_out = 0
+
+    def negotiate(self, accept_encoding):
+        """使うコーディングを返します。受け付けられるものがなければ None (identity)。"""
+        accepted = parse_accept_encoding(accept_encoding)
+        best, best_q = None, 0.0
+        for coding in self.codings:
+            q = accepted.get(coding, accepted.get("*", 0.0))
+            # q 値が同じならサーバーの優先順 (codings の順) で選ぶ
+            if q > best_q:
+                best, best_q = coding, q
+        return best
+
+    def compress(self, data, coding):
+        if coding == "br":
+            return self._brotli.compress(data, quality=self.brotli_quality)
+        return _gzip(data, self.gzip_level)
+
+    def _encoded_headers(self, headers, coding):
+        key = (id(headers), coding)
+        cached = self._headers.get(key)
+        if cached is None or cached[0] is not headers:
+            if len(self._headers) >= 32:
+                # 応答ごとに作ったヘッダー (Retry-After 付きなど) で増え続けないようにする
+                self._headers.clear()
+            encoded = {**headers, "Vary": "Accept-Encoding"}
+            if coding is not None:
+                encoded["Content-Encoding"] = coding
+            cached = (headers, encoded)
+            self._headers[key] = cached
+        return cached[1]
+
+    def _identity(self, response):
+        # 圧縮しなかった応答にも Vary を付ける (ヘッダーは元のヘッダーごとに一度だけ組み立てる)
+        return {**response, "headers": self._encoded_headers(response.get("headers") or {}, None)}
+
+    def encode(self, response, accept_encoding, accept=None):
+        """
+        Lambda プロキシ統合の応答を、必要なら圧縮して base64 にした応答にします。
+
+        Args:
+            response (dict): statusCode / headers / body (str) を持つ応答。headers はモジュールレベルの定数を想定する。
+            accept_encoding (str): リクエストの Accept-Encoding ヘッダー。
+            accept (str): リクエストの Accept ヘッダー (binary_media_types を指定した場合に確認する)。
+
+        Returns:
+            dict: 圧縮した場合は isBase64Encoded=True の新しい応答、しなかった場合は Vary を付けた応答
+                (圧縮を使わない設定なら response そのもの)。
+        """
+        if not self.codings:
+            return response
+        body = response.get("body")
+        if not body:
+            return self._identity(response)
+        coding = self.negotiate(accept_encoding)
+        if coding is None:
+            return self._identity(response)
+        if self.binary_media_types is not None and not accepts_binary(accept, self.binary_media_types):
+            # API Gateway が base64 をデコードしないので、圧縮すると base64 の文字列のまま届いてしまう
+            self.skipped += 1
+            return self._identity(response)
+        data = body.encode('utf-8')
+        if len(data) < self.min_bytes:
+            self.skipped += 1
+            return self._identity(response)
+        compressed = self.compress(data, coding)
+        if len(compressed) >= len(data):
+            self.skipped += 1
+            return self._identity(response)
+        self.compressed += 1
+        self.bytes_in += len(data)
+        self.bytes_out += len(compressed)
+        return {
+            "statusCode": response["statusCode"],
+            "headers": self._encoded_headers(response["headers"], coding),
+            "isBase64Encoded": True,
+            "body": base64.b64encode(compressed).decode('ascii'),
+        }
+
+    def stats(self):
+        return {
+            "codings": list(self.codings),
+            "compressed": self.compressed,
+            "skipped": self.skipped,
+            "ratio": round(self.bytes_out / self.bytes_in, 3) if self.bytes_in else None,
+        }
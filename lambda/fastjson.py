@@ -0,0 +1,156 @@
+# lambda/fastjson.py
+# JSON のエンコード / デコード。orjson がインストールされていれば使い、なければ標準ライブラリの json を使う
+#
+# どちらの場合も出力は区切りの空白なし・非 ASCII 文字をエスケープしない UTF-8 にそろえる
+# (日本語の会話履歴はエスケープすると 1 文字 6 バイトになる)。
+import json
+import os
+from json.decoder import WHITESPACE, JSONDecodeError, scanstring
+
+orjson = None
+if os.environ.get("JSON_BACKEND", "auto") != "json":
+    try:
+        import orjson
+    except ImportError:
+        pass
+
+# 使用中の実装 ("orjson" / "json")
+BACKEND = "orjson" if orjson is not None else "json"
+
+_encoder = json.JSONEncoder(ensure_ascii=False, separators=(",", ":"))
+# 孤立したサロゲートを含む文字列は UTF-8 にできないので、その場合だけエスケープする
+_ascii_encoder = json.JSONEncoder(separators=(",", ":"))
+_decoder = json.JSONDecoder()
+
+
+class RawJSON:
+    """
+    エンコード済みの JSON テキスト。
+
+    dumps() に渡すオブジェクトのトップレベルのメンバーの値に使うと、デコード・再エンコードせずにそのまま埋め込みます。
+    """
+
+    __slots__ = ("text",)
+
+    def __init__(self, text):
+        self.text = text
+
+
+def _encode(obj):
+    if orjson is not None:
+        try:
+            return orjson.dumps(obj).decode('utf-8')
+        except TypeError:
+            # orjson が扱えない値 (孤立したサロゲート、64 ビットを超える整数など) は標準ライブラリに任せる
+            pass
+    text = _encoder.encode(obj)
+    try:
+        text.encode('utf-8')
+    except UnicodeEncodeError:
+        return _ascii_encoder.encode(obj)
+    return text
+
+
+def dumps(obj):
+    """
+    obj を JSON 文字列にします。
+
+    obj が dict で値に RawJSON を含む場合、そのメンバーはテキストのまま末尾に埋め込みます。
+    """
+    if type(obj) is dict:
+        raw = [(key, value) for key, value in obj.items() if type(value) is RawJSON]
+        if raw:
+            text = _encode({key: value for key, value in obj.items() if type(value) is not RawJSON})
+            members = ",".join(f"{_encode(key)}:{value.text}" for key, value in raw)
+            return f"{text[:-1]}{',' if len(text) > 2 else ''}{members}}}"
+    return _encode(obj)
+
+
+def dumpb(obj):
+    """obj を UTF-8 の JSON バイト列にします (HTTP で送信する用)。"""
+    if orjson is not None:
+        try:
+            return orjson.dumps(obj)
+        except TypeError:
+            pass
+    return _encode(obj).encode('utf-8')
+
+
+def loads(data):
+    """JSON の文字列またはバイト列をデコードします。"""
+    if orjson is not None:
+        return orjson.loads(data)
+    return json.loads(data)
+
+
+def _skip(text, idx):
+    return WHITESPACE.match(text, idx).end()
+
+
+def loads_with_raw(text, keys):
+    """
+    トップレベルがオブジェクトの JSON 文字列をデコードし、keys のメンバーについては元の JSON テキストも返します。
+
+    応答にそのまま含めるメンバー (会話履歴など) を、デコードしたオブジェクトから再エンコードせずに済ませるために使います。
+    日本語を多く含む大きな会話履歴では orjson でデコードしても速くならず、再エンコードの方が高くつくため、
+    orjson がある場合もこの関数は標準ライブラリのデコーダーを使います。
+
+    Args:
+        text (str): JSON 文字列。
+        keys (iterable): 元のテキストを取り出すメンバー名。
+
+    Returns:
+        tuple: (デコードしたオブジェクト, {メンバー名: RawJSON})。
+
+    Raises:
+        json.JSONDecodeError: text が JSON として不正な場合。
+    """
+    keys = frozenset(keys)
+    idx = _skip(text, 0)
+    if text[idx:idx + 1] != "{":
+        return json.loads(text), {}
+
+    # json.decoder の JSONObject と同じ手順でメンバーを読み、値の位置を記録する
+    obj = {}
+    raw = {}
+    idx = _skip(text, idx + 1)
+    if text[idx:idx + 1] != "}":
+        while True:
+            if text[idx:idx + 1] != '"':
+                raise JSONDecodeError("Expecting property name enclosed in double quotes", text, idx)
+            key, idx = scanstring(text, idx + 1)
+            idx = _skip(text, idx)
+            if text[idx:idx + 1] != ":":
+                raise JSONDecodeError("Expecting ':' delimiter", text, idx)
+            start = _skip(text, idx + 1)
+            obj[key], idx = _decoder.raw_decode(text, start)
+            if key in keys:
+                raw[key] = RawJSON(text[start:idx])
+            idx = _skip(text, idx)
+            delimiter = text[idx:idx + 1]
+            if delimiter == "}":
+                break
+            if delimiter != ",":
+                raise JSONDecodeError("Expecting ',' delimiter", text, idx)
+            idx = _skip(text, idx + 1)
+    end = _skip(text, idx + 1)
+    if end != len(text):
+        raise JSONDecodeError("Extra data", text, end)
+    return obj, raw
+
+
+def extend_array(raw, items):
+    """
+    エンコード済みの JSON 配列 raw の末尾に items を追加した RawJSON を返します。
+
+    Args:
+        raw (RawJSON): JSON 配列のテキスト。
+        items (list): 追加する要素。
+    """
+    inner = dumps(items)[1:-1]
+    if not inner:
+        return raw
+    text = raw.text
+    if _skip(text, 1) == len(text) - 1:
+        return RawJSON(f"[{inner}]")
+    return RawJSON(f"{text[:-1]},{inner}]")
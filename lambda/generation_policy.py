@@ -0,0 +1,279 @@
+# lambda/generation_policy.py
+# /generate に送る生成パラメータ (max_new_tokens など) をメッセージの種類と長さから決め、
+# クライアントが指定したオプションをサーバー側の上限内に収める
+import json
+import re
+import threading
+
+from history import estimate_tokens
+
+# メッセージの種類ごとのルール (上から順に判定し、最初に当てはまったものを使う)
+#   pattern: メッセージ (小文字にしたもの) に含まれる正規表現
+#   max_prompt_tokens / min_prompt_tokens: メッセージの推定トークン数の範囲
+#   max_new_tokens: 生成トークン数の予算。per_prompt_token を指定するとメッセージのトークン数に比例して増やす
+#     (max_budget を指定するとそれを超えない)。既定のルールは従来の固定値 512 を超えない
+#   temperature / top_p: 既定値を上書きする場合に指定する
+DEFAULT_RULES = [
+    {"name": "greeting", "max_prompt_tokens": 16, "max_new_tokens": 64,
+     # メッセージ全体が挨拶・あいづちの場合だけ (「Hi, can you explain ...」や「okinawa ...」は当てはまらない)
+     "pattern": r"^\W*(?:hi|hello|hey|thanks|thank you|ok|okay|good (?:morning|evening)|"
+                r"こんにちは|こんばんは|おはよう(?:ございます)?|ありがとう(?:ございます)?|よろしく(?:お願いします)?|"
+                r"了解(?:です)?|はじめまして)\b\W*$"},
+    {"name": "code", "max_new_tokens": 512,
+     "pattern": r"```|\b(code|function|python|javascript|typescript|sql|bash|regex)\b|コード|プログラム|関数|実装|スクリプト"},
+    {"name": "long_form", "max_new_tokens": 512,
+     "pattern": r"\b(explain|describe|in detail|write|summari[sz]e|essay|compare)\b|詳しく|詳細|説明|解説|まとめ|要約|書いて|作成|比較"},
+    {"name": "short_question", "max_prompt_tokens": 24, "max_new_tokens": 256},
+    {"name": "default", "max_new_tokens": 320, "per_prompt_token": 1, "max_budget": 512},
+]
+
+# 既定の生成パラメータ (従来は常にこの値と max_new_tokens=512 を送っていた)
+DEFAULT_PARAMS = {"temperature": 0.7, "top_p": 0.9, "do_sample": True}
+
+
+class GenerationOptionsError(ValueError):
+    """リクエストボディの generationOptions が不正なことを表します (400 を返す)。"""
+
+
+class GenerationLimits:
+    """
+    クライアントが指定できる生成パラメータの上限。範囲外の数値は上限・下限に丸めます。
+
+    Args:
+        max_new_tokens (int): max_new_tokens の上限 (ルールの予算もこれを超えない)。
+        max_temperature (float): temperature の上限。
+        max_stop (int): 停止シーケンスの最大個数。
+        max_stop_chars (int): 1 つの停止シーケンスの最大文字数。
+    """
+
+    def __init__(self, max_new_tokens=1024, max_temperature=1.5, max_stop=4, max_stop_chars=32):
+        self.max_new_tokens = max_new_tokens
+        self.max_temperature = max_temperature
+        self.max_stop = max_stop
+        self.max_stop_chars = max_stop_chars
+
+
+def _number(options, key, kind):
+    value = options[key]
+    # bool は int のサブクラスなので明示的に除く
+    if isinstance(value, bool) or not isinstance(value, kind):
+        raise GenerationOptionsError(f"generationOptions.{key} must be a number")
+    return value
+
+
+def _clamp(value, low, high):
+    return min(max(value, low), high)
+
+
+class GenerationPolicy:
+    """
+    メッセージからルールを選び、/generate に送る生成パラメータを組み立てます。
+
+    Args:
+        rules (list[dict]): ルール (DEFAULT_RULES と同じ形式)。
+        limits (GenerationLimits): クライアントが指定できる値の上限。
+        defaults (dict): temperature / top_p / do_sample の既定値。
+        stop (list[str]): 常に付ける停止シーケンス。
+        tokenizer (callable): メッセージのトークン数を数える関数。
+    """
+
+    def __init__(self, rules=None, limits=None, defaults=None, stop=None, tokenizer=estimate_tokens):
+        self.rules = [{**rule, "_re": re.compile(rule["pattern"], re.IGNORECASE) if rule.get("pattern") else None}
+                      for rule in (DEFAULT_RULES if rules is None else rules)]
+        self.limits = limits or GenerationLimits()
+        self.defaults = {**DEFAULT_PARAMS, **(defaults or {})}
+        self.stop = list(stop or [])
+        self.tokenizer = tokenizer
+
+    def classify(self, message, prompt_tokens):
+        """メッセージに当てはまる最初のルールを返します (どれにも当てはまらなければ最後のルール)。"""
+        text = message.strip().lower()
+        for rule in self.rules:
+            if prompt_tokens > rule.get("max_prompt_tokens", prompt_tokens):
+                continue
+            if prompt_tokens < rule.get("min_prompt_tokens", 0):
+                continue
+            if rule["_re"] is not None and not rule["_re"].search(text):
+                continue
+            return rule
+        return self.rules[-1]
+
+    def build(self, message, options=None):
+        """
+        生成パラメータを組み立てます。
+
+        Args:
+            message (str): ユーザーのメッセージ。
+            options (dict): リクエストボディの generationOptions (max_new_tokens / temperature / top_p /
+                do_sample / stop)。指定された値はルールより優先しますが、上限を超える値は丸めます。
+
+        Returns:
+            tuple: (生成パラメータ, 選んだルール名, 丸めたオプション名のリスト)。
+
+        Raises:
+            GenerationOptionsError: options の形式が不正な場合。
+        """
+        prompt_tokens = self.tokenizer(message)
+        rule = self.classify(message, prompt_tokens)
+        budget = rule["max_new_tokens"] + round(rule.get("per_prompt_token", 0) * prompt_tokens)
+        budget = min(budget, rule.get("max_budget", budget))
+        params = {
+            "max_new_tokens": _clamp(budget, 1, self.limits.max_new_tokens),
+            "temperature": rule.get("temperature", self.defaults["temperature"]),
+            "top_p": rule.get("top_p", self.defaults["top_p"]),
+            "do_sample": self.defaults["do_sample"],
+        }
+        stop = list(self.stop)
+        adjusted = []
+        if options:
+            if not isinstance(options, dict):
+                raise GenerationOptionsError("generationOptions must be an object")
+            unknown = set(options) - {"max_new_tokens", "temperature", "top_p", "do_sample", "stop"}
+            if unknown:
+                raise GenerationOptionsError(f"Unsupported generationOptions: {', '.join(sorted(unknown))}")
+            limits = (
+                ("max_new_tokens", int, 1, self.limits.max_new_tokens),
+                ("temperature", (int, float), 0.0, self.limits.max_temperature),
+                ("top_p", (int, float), 0.01, 1.0),
+            )
+            for key, kind, low, high in limits:
+                if key in options:
+                    value = _number(options, key, kind)
+                    params[key] = _clamp(value, low, high)
+                    if params[key] != value:
+                        adjusted.append(key)
+            if "do_sample" in options:
+                if not isinstance(options["do_sample"], bool):
+                    raise GenerationOptionsError("generationOptions.do_sample must be a boolean")
+                params["do_sample"] = options["do_sample"]
+            if "stop" in options:
+                requested = options["stop"]
+                if isinstance(requested, str):
+                    requested = [requested]
+                if (not isinstance(requested, list) or len(requested) > self.limits.max_stop
+                        or not all(isinstance(s, str) and 0 < len(s) <= self.limits.max_stop_chars for s in requested)):
+                    raise GenerationOptionsError(
+                        f"generationOptions.stop must be up to {self.limits.max_stop} strings of "
+                        f"1-{self.limits.max_stop_chars} characters"
+                    )
+                stop.extend(s for s in requested if s not in stop)
+        if stop:
+            params["stop"] = stop
+        return params, rule["name"], adjusted
+
+
+def truncate_at_stop(text, stop):
+    """
+    最初に現れた停止シーケンスの手前でテキストを切ります (推論サーバーが stop を無視する場合に備える)。
+
+    Returns:
+        tuple: (切った後のテキスト, 停止シーケンスで切ったかどうか)。
+    """
+    if not stop:
+        return text, False
+    positions = [i for i in (text.find(s) for s in stop) if i >= 0]
+    if not positions:
+        return text, False
+    return text[:min(positions)], True
+
+
+class StopFilter:
+    """
+    トークンストリームから停止シーケンス以降を取り除きます。
+
+    停止シーケンスの先頭になり得る末尾の文字は、次のトークンで停止シーケンスかどうか分かるまで送らずに保持します。
+
+    Args:
+        tokens (iterable[str]): トークンのイテレーター。
+        stop (list[str]): 停止シーケンス。
+    """
+
+    def __init__(self, tokens, stop):
+        self._tokens = tokens
+        self._stop = list(stop)
+        self.stopped = False
+
+    def _holdback(self, text):
+        # 末尾がいずれかの停止シーケンスの先頭と一致する最長の長さ
+        longest = 0
+        for s in self._stop:
+            for n in range(min(len(s) - 1, len(text)), longest, -1):
+                if text.endswith(s[:n]):
+                    longest = n
+                    break
+        return longest
+
+    def __iter__(self):
+        if not self._stop:
+            yield from self._tokens
+            return
+        pending = ""
+        for token in self._tokens:
+            pending += token
+            text, stopped = truncate_at_stop(pending, self._stop)
+            if stopped:
+                self.stopped = True
+                if text:
+                    yield text
+                return
+            keep = self._holdback(pending)
+            if len(pending) > keep:
+                yield pending[:len(pending) - keep]
+                pending = pending[len(pending) - keep:]
+        if pending:
+            yield pending
+
+
+class TokenLedger:
+    """予算 (max_new_tokens) に対して実際に生成されたトークン数を、ルールごとに累計します。"""
+
+    def __init__(self):
+        self._lock = threading.Lock()
+        self.rules = {}
+
+    def record(self, rule, budgeted, produced):
+        with self._lock:
+            entry = self.rules.setdefault(rule, {"requests": 0, "budgeted": 0, "produced": 0, "exhausted": 0})
+            entry["requests"] += 1
+            entry["budgeted"] += budgeted
+            entry["produced"] += produced
+            # 予算を使い切った応答 (途中で切られている可能性がある)
+            entry["exhausted"] += produced >= budgeted
+
+    def stats(self):
+        with self._lock:
+            budgeted = sum(e["budgeted"] for e in self.rules.values())
+            produced = sum(e["produced"] for e in self.rules.values())
+            return {
+                "budgeted_tokens": budgeted,
+                "produced_tokens": produced,
+                "utilization": round(produced / budgeted, 3) if budgeted else None,
+                "rules": {name: dict(entry) for name, entry in self.rules.items()},
+            }
+
+
+def produced_tokens(response_data, text):
+    """
+    推論サーバーの応答から生成トークン数を取り出します。含まれていなければテキストから概算します。
+
+    Args:
+        response_data (dict): /generate の応答 (ストリーミングの場合は None)。
+        text (str): 生成されたテキスト。
+    """
+    if isinstance(response_data, dict):
+        for value in (response_data.get("generated_tokens"),
+                      (response_data.get("details") or {}).get("generated_tokens"),
+                      (response_data.get("usage") or {}).get("completion_tokens")):
+            if isinstance(value, int) and not isinstance(value, bool):
+                return value
+    return estimate_tokens(text)
+
+
+def load_rules(value):
+    """環境変数 GENERATION_RULES の JSON (ルールのリスト) を読み込みます。空なら None (既定のルール)。"""
+    if not value:
+        return None
+    rules = json.loads(value)
+    if not isinstance(rules, list) or not rules or not all(isinstance(r, dict) and "name" in r and "max_new_tokens" in r for r in rules):
+        raise ValueError("GENERATION_RULES must be a non-empty JSON list of rules with name and max_new_tokens")
+    return rules
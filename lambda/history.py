@@ -0,0 +1,153 @@
+# lambda/history.py
+# 会話履歴をトークン予算内に収めてプロンプトを組み立てる
+import math
+import re
+
+# CJK 文字 (ひらがな・カタカナ・漢字・全角記号など) はおおよそ 1 文字 1 トークンとして数える
+_CJK_RE = re.compile(r'[\u3000-\u30ff\u3400-\u4dbf\u4e00-\u9fff\uf900-\ufaff\uff00-\uffef]')
+_SENTENCE_END_RE = re.compile(r'(?<=[。．！？!?\.])\s*')
+
+ROLE_LABELS = {"user": "User", "assistant": "Assistant"}
+
+
+def estimate_tokens(text):
+    """
+    トークナイザーを使わずにトークン数を概算します。
+
+    CJK 文字は 1 文字 1 トークン、それ以外は 4 文字 1 トークンとして数えます。
+    正確な数が必要な場合は、同じシグネチャの関数を HistoryBuilder に渡してください。
+    """
+    if not text:
+        return 0
+    cjk = len(_CJK_RE.findall(text))
+    return cjk + math.ceil((len(text) - cjk) / 4)
+
+
+def first_sentence(text, limit=80):
+    """テキストの最初の 1 文を返します (長すぎる場合は limit 文字で切ります)。"""
+    sentence = _SENTENCE_END_RE.split(text.strip(), maxsplit=1)[0]
+    return sentence if len(sentence) <= limit else sentence[:limit] + "…"
+
+
+def extractive_summary(previous, messages):
+    """
+    古いターンの要約を更新します (既定の要約関数)。
+
+    LLM を呼ばずに、ユーザー発話の最初の 1 文を箇条書きで積み上げます。
+
+    Args:
+        previous (str): これまでの要約 ("" なら初回)。
+        messages (list): 新たに要約対象になったメッセージ。
+
+    Returns:
+        str: 更新後の要約。
+    """
+    lines = [previous] if previous else []
+    for msg in messages:
+        if msg.get("role") == "user" and msg.get("content"):
+            lines.append(f"- {first_sentence(msg['content'])}")
+    return "\n".join(lines)
+
+
+def _format_message(msg):
+    return f"{ROLE_LABELS.get(msg.get('role'), msg.get('role'))}: {msg.get('content', '')}"
+
+
+class HistoryBuilder:
+    """
+    直近のターンをスライディングウィンドウで残し、トークン予算内のプロンプトを作ります。
+
+    Args:
+        budget (int): プロンプト全体のトークン予算。
+        tokenizer (callable): テキストからトークン数を返す関数。
+        summarizer (callable): (前回の要約, 新たに外れたメッセージ) から要約を返す関数。None なら要約しない。
+        summary_budget (int): 要約に割り当てるトークン数の上限 (予算の 1/4 を超えない)。
+    """
+
+    def __init__(self, budget, tokenizer=estimate_tokens, summarizer=extractive_summary, summary_budget=256):
+        self.budget = budget
+        self.tokenizer = tokenizer
+        self.summarizer = summarizer
+        self.summary_budget = summary_budget
+
+    def _trim_summary(self, summary, budget):
+        # 要約が予算を超えたら古い行から落とす (新しい行から数えて予算に収まる分だけ残す)
+        lines = summary.split("\n")
+        kept = []
+        used = 0
+        for line in reversed(lines):
+            cost = self.tokenizer(line) + 1
+            if kept and used + cost > budget:
+                break
+            kept.append(line)
+            used += cost
+        kept.reverse()
+        return "\n".join(kept)
+
+    def build(self, history, message, summary_state=None):
+        """
+        会話履歴と新しいメッセージからプロンプトを組み立てます。
+
+        ウィンドウは新しい方から予算に達するまで広げるので、履歴全体を走査しません。
+        summary_state を渡すと、前回要約した位置から差分だけを要約に追加します (rolling summary)。
+
+        Args:
+            history (list): 今回のメッセージより前の会話履歴。
+            message (str): 今回のユーザーメッセージ。
+            summary_state (dict): 前回の {"upto": 要約済みメッセージ数, "text": 要約}。
+
+        Returns:
+            tuple: (プロンプト文字列, 統計情報と新しい summary_state を含む dict)。
+        """
+        tail = f"{ROLE_LABELS['user']}: {message}\n{ROLE_LABELS['assistant']}:"
+        used = self.tokenizer(tail)
+        summary_state = summary_state or {"upto": 0, "text": ""}
+
+        window = []
+        costs = []
+        start = len(history)
+        for msg in reversed(history):
+            line = _format_message(msg)
+            cost = self.tokenizer(line) + 1
+            if used + cost > self.budget:
+                break
+            window.append(line)
+            costs.append(cost)
+            used += cost
+            start -= 1
+
+        # 収まらないターンがあり要約する場合は、要約の分だけウィンドウの古い側を詰める
+        summary_budget = min(self.summary_budget, self.budget // 4)
+        if self.summarizer is not None and start > 0:
+            while window and used > self.budget - summary_budget:
+                window.pop()
+                used -= costs.pop()
+                start += 1
+        window.reverse()
+
+        summary = ""
+        if self.summarizer is not None and start > 0:
+            upto = min(summary_state.get("upto", 0), start)
+            summary = summary_state.get("text", "") if upto else ""
+            # 要約に残り得るのは直近の数行だけなので、それより古いメッセージは読まない
+            if start - upto > summary_budget:
+                upto, summary = start - summary_budget, ""
+            if upto < start:
+                summary = self._trim_summary(self.summarizer(summary, history[upto:start]), summary_budget)
+            summary_state = {"upto": start, "text": summary}
+
+        parts = []
+        if summary:
+            parts.append(f"[これまでの会話の要約]\n{summary}\n")
+        parts.extend(window)
+        parts.append(tail)
+        prompt = "\n".join(parts)
+
+        stats = {
+            "history_messages": len(history),
+            "window_messages": len(window),
+            "dropped_messages": start,
+            "estimated_tokens": used + (self.tokenizer(summary) if summary else 0),
+            "summary_state": summary_state,
+        }
+        return prompt, stats
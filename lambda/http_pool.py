@@ -0,0 +1,314 @@
+# lambda/http_pool.py
+# ウォームスタート間で再利用する HTTP/1.1 keep-alive コネクションプール
+import http.client
+import select
+import threading
+import time
+import urllib.parse
+
+# 再利用したソケットがサーバー側で既に閉じられていた場合に発生し得る例外
+_STALE_ERRORS = (
+    http.client.RemoteDisconnected,
+    http.client.BadStatusLine,
+    ConnectionResetError,
+    BrokenPipeError,
+    ConnectionAbortedError,
+)
+
+
+class PoolTimeout(TimeoutError):
+    """すべてのコネクションが使用中で、タイムアウトまでに空きができなかったことを表します。"""
+
+
+def _nothing_received(error):
+    """
+    切断による例外が、レスポンスを 1 バイトも受け取る前に起きたものかを返します。
+
+    RemoteDisconnected はステータス行を読む前に切断された場合に送出されますが、それ以外の BadStatusLine は
+    何かを受け取った (サーバーがリクエストを処理した可能性がある) ことを意味するので、再送しません。
+    """
+    if isinstance(error, http.client.RemoteDisconnected):
+        return True
+    return not isinstance(error, http.client.BadStatusLine)
+
+
+class PooledResponse:
+    """
+    プールから取得したコネクション上のレスポンス。
+
+    ボディを最後まで読み切った時点でコネクションをプールへ返却します。
+    途中で close() された場合はコネクションを破棄します。
+    """
+
+    def __init__(self, pool, conn, response, timings):
+        self._pool = pool
+        self._conn = conn
+        self._response = response
+        self.status = response.status
+        self.reason = response.reason
+        self.headers = response.headers
+        self.timings = timings
+
+    def read(self, amt=None):
+        try:
+            data = self._response.read(amt)
+        except Exception:
+            self._discard()
+            raise
+        if amt is None or not data:
+            self._release()
+        return data
+
+    def read1(self, amt=-1):
+        # チャンク転送でも届いている分だけを返す (ストリーミング用)
+        try:
+            data = self._response.read1(amt)
+        except Exception:
+            self._discard()
+            raise
+        if not data:
+            self._release()
+        return data
+
+    def readline(self):
+        try:
+            line = self._response.readline()
+        except Exception:
+            self._discard()
+            raise
+        if not line:
+            self._release()
+        return line
+
+    def __iter__(self):
+        while True:
+            line = self.readline()
+            if not line:
+                return
+            yield line
+
+    def settimeout(self, timeout):
+        # 以降の読み取り 1 回あたりのタイムアウトを変更する (期限に合わせて短くする場合など)
+        if self._conn is not None and self._conn.sock is not None:
+            self._conn.sock.settimeout(timeout)
+
+    def close(self):
+        # 読み切っていないレスポンスが残ったソケットは再利用できない
+        if self._conn is not None:
+            if self._response.isclosed():
+                self._release()
+            else:
+                self._discard()
+
+    def _release(self):
+        if self._conn is not None:
+            conn, self._conn = self._conn, None
+            self._pool._put(conn, reusable=not self._response.will_close)
+
+    def _discard(self):
+        if self._conn is not None:
+            conn, self._conn = self._conn, None
+            self._pool._put(conn, reusable=False)
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc, tb):
+        self.close()
+        return False
+
+
+class ConnectionPool:
+    """
+    単一オリジン向けの HTTP/1.1 keep-alive コネクションプール。
+
+    Args:
+        base_url (str): 接続先のベースURL (例: https://example.ngrok-free.app)。
+        maxsize (int): プールに保持するアイドルコネクションの上限。
+        idle_timeout (float): これより長くアイドルだったコネクションは再利用しない (秒)。
+        timeout (float): デフォルトのソケットタイムアウト (秒)。
+        max_connections (int): 同時に開くコネクション (使用中 + アイドル) の上限。上限に達している間の
+            リクエストは、コネクションが返却されるかタイムアウトまで待つ (PoolTimeout)。
+    """
+
+    def __init__(self, base_url, maxsize=4, idle_timeout=60.0, timeout=60.0, max_connections=16):
+        parsed = urllib.parse.urlsplit(base_url)
+        self.scheme = parsed.scheme or "http"
+        self.host = parsed.hostname
+        self.port = parsed.port
+        self.base_path = parsed.path.rstrip('/')
+        self.maxsize = maxsize
+        self.idle_timeout = idle_timeout
+        self.timeout = timeout
+        self.max_connections = max_connections
+        self._idle = []  # (conn, 返却時刻) の LIFO スタック
+        self._lock = threading.Lock()
+        # コネクションが返却されたり閉じられたりしたときに、空きを待っているリクエストを起こす
+        self._available = threading.Condition(self._lock)
+        self.open_connections = 0  # 使用中 + アイドルのコネクション数
+        self.stats = {
+            "requests": 0,
+            "connections_created": 0,
+            "connections_reused": 0,
+            "stale_reconnects": 0,
+            "discarded": 0,
+            "pool_timeouts": 0,
+        }
+
+    def _new_conn(self, timeout):
+        if self.scheme == "https":
+            return http.client.HTTPSConnection(self.host, self.port, timeout=timeout)
+        return http.client.HTTPConnection(self.host, self.port, timeout=timeout)
+
+    def _close(self, conn):
+        conn.close()
+        with self._available:
+            self.open_connections -= 1
+            self._available.notify_all()
+
+    @staticmethod
+    def _is_dropped(conn):
+        # アイドル中のソケットが読み込み可能 = サーバーが FIN を送った (もしくは不正なデータ)
+        sock = conn.sock
+        if sock is None:
+            return True
+        try:
+            readable, _, _ = select.select([sock], [], [], 0)
+        except (OSError, ValueError):
+            return True
+        return bool(readable)
+
+    def _get(self, timeout):
+        """
+        アイドルのコネクションを取り出すか、新しいコネクションを開く枠を確保します。
+
+        どちらもできない場合は、コネクションが返却されるか閉じられるまで最大 timeout 秒待ちます。
+
+        Returns:
+            tuple: (再利用するコネクション (新しく開く場合は None), 再利用かどうか)。
+
+        Raises:
+            PoolTimeout: timeout までに空きができなかった場合。
+        """
+        deadline = time.monotonic() + timeout
+        with self._available:
+            while True:
+                now = time.monotonic()
+                while self._idle:
+                    conn, released_at = self._idle.pop()
+                    if now - released_at <= self.idle_timeout and not self._is_dropped(conn):
+                        self.stats["connections_reused"] += 1
+                        return conn, True
+                    self.stats["discarded"] += 1
+                    self.open_connections -= 1
+                    conn.close()
+                if self.open_connections < self.max_connections:
+                    self.open_connections += 1
+                    return None, False
+                if now >= deadline:
+                    self.stats["pool_timeouts"] += 1
+                    raise PoolTimeout(f"All {self.max_connections} connections are in use")
+                self._available.wait(deadline - now)
+
+    def _put(self, conn, reusable=True):
+        with self._available:
+            if reusable and conn.sock is not None and len(self._idle) < self.maxsize:
+                self._idle.append((conn, time.monotonic()))
+                self._available.notify_all()
+                return
+            self.stats["discarded"] += 1
+        self._close(conn)
+
+    def request(self, method, path, body=None, headers=None, timeout=None):
+        """
+        リクエストを送信し、ステータスとヘッダーを受信した時点で PooledResponse を返します。
+
+        再利用したコネクションが切断済みだった場合は、新しいコネクションで一度だけ再送します
+        (レスポンスを 1 バイトも受け取っていない場合だけ。受け取った後の切断はサーバーが処理した可能性があるので再送しない)。
+        開いているコネクションが max_connections に達している場合は、空きができるまで最大 timeout 秒待ちます。
+
+        Args:
+            method (str): HTTPメソッド。
+            path (str): ベースURLからの相対パス (例: /generate)。
+            body (bytes): リクエストボディ。
+            headers (dict): リクエストヘッダー。
+            timeout (float): このリクエストのソケットタイムアウト (秒)。
+
+        Returns:
+            PooledResponse: timings に connect_ms / ttfb_ms / reused を含むレスポンス。
+
+        Raises:
+            PoolTimeout: timeout までにコネクションの空きができなかった場合。
+        """
+        timeout = self.timeout if timeout is None else timeout
+        url = self.base_path + path
+        headers = dict(headers or {})
+        headers.setdefault("Connection", "keep-alive")
+        with self._lock:
+            self.stats["requests"] += 1
+
+        conn, reused = self._get(timeout)
+        retried = False
+        while True:
+            start = time.perf_counter()
+            connect_ms = 0.0
+            fresh = conn is None
+            if fresh:
+                conn = self._new_conn(timeout)
+            try:
+                if fresh:
+                    conn.connect()
+                    connect_ms = (time.perf_counter() - start) * 1000
+                    with self._lock:
+                        self.stats["connections_created"] += 1
+                else:
+                    conn.timeout = timeout
+                    conn.sock.settimeout(timeout)
+                sent_at = time.perf_counter()
+                conn.request(method, url, body=body, headers=headers)
+                response = conn.getresponse()
+            except _STALE_ERRORS as e:
+                # 再利用ソケットの切断は想定内なので、レスポンスを受け取る前なら一度だけ新規接続で再送する
+                # (閉じた接続の枠をそのまま新しい接続に使う)
+                if reused and not retried and _nothing_received(e):
+                    conn.close()
+                    with self._lock:
+                        self.stats["stale_reconnects"] += 1
+                    conn, reused, retried = None, False, True
+                    continue
+                self._close(conn)
+                raise
+            except BaseException:
+                self._close(conn)
+                raise
+
+            timings = {
+                "reused": reused,
+                "stale_retry": retried,
+                "connect_ms": connect_ms,
+                "ttfb_ms": (time.perf_counter() - sent_at) * 1000,
+            }
+            return PooledResponse(self, conn, response, timings)
+
+    def prewarm(self, timeout=None):
+        """アイドルコネクションを一本確立してプールに入れます (初期化フェーズ用)。上限に達している場合は何もしません。"""
+        timeout = self.timeout if timeout is None else timeout
+        with self._lock:
+            if self.open_connections >= self.max_connections:
+                return
+            self.open_connections += 1
+        conn = self._new_conn(timeout)
+        try:
+            conn.connect()
+        except BaseException:
+            self._close(conn)
+            raise
+        with self._lock:
+            self.stats["connections_created"] += 1
+        self._put(conn)
+
+    def close(self):
+        with self._lock:
+            idle, self._idle = self._idle, []
+        for conn, _ in idle:
+            self._close(conn)
@@ -1,157 +1,1180 @@
 import os
 import re
 # import requests # requests ライブラリは使用しない
-import urllib.request # urllib.request をインポート
+import http.client # 接続エラーの判定用にインポート
 import json # json ライブラリをインポート (必須)
+import math
 import socket # タイムアウト用にインポート
-
-NGROK_URL = "https://8f76-34-16-206-248.ngrok-free.app"
+import threading
+import time # ストリーミングの計測用にインポート
+
+import fastjson
+import response_cache
+import singleflight
+from admission import AdmissionController, AdmissionPolicy, AdmissionRejected, create_admission_store
+from circuit_breaker import STATE_CODES, CircuitBreaker, CircuitOpenError
+from conversation_store import create_store
+from generation_policy import (GenerationLimits, GenerationOptionsError, GenerationPolicy, StopFilter, TokenLedger,
+                               load_rules, produced_tokens, truncate_at_stop)
+from encoding import ResponseEncoder, header, request_text
+from deadline import AdaptiveTimeout, Deadline, DeadlineExceeded, RetryBudget, backoff_delay
+from http_pool import ConnectionPool, PoolTimeout
+from jobs import FAILED, FINISHED, QUEUED, SUCCEEDED, PartialWriter, create_job_queue, create_job_store, run_worker
+from metrics import create_instrumentation
+from providers import BedrockProvider, ProviderError, bedrock_client, select_provider
+from streaming import TimedStream, format_sse, iter_tokens
+from structured_log import log
+
+NGROK_URL = os.environ.get("NGROK_URL", "https://8f76-34-16-206-248.ngrok-free.app")
+
+# レスポンスヘッダーはモジュール読み込み時に一度だけ組み立てる
+CORS_HEADERS = {
+    "Access-Control-Allow-Origin": "*",
+    "Access-Control-Allow-Headers": "Content-Type,X-Amz-Date,Authorization,X-Api-Key,X-Amz-Security-Token",
+    "Access-Control-Allow-Methods": "OPTIONS,GET,POST"
+}
+JSON_HEADERS = {"Content-Type": "application/json", **CORS_HEADERS}
+EVENT_STREAM_HEADERS = {"Content-Type": "text/event-stream; charset=utf-8", "Cache-Control": "no-cache", **CORS_HEADERS}
+
+ARN_REGION_RE = re.compile('arn:aws:lambda:([^:]+):')
 
 # session = requests.Session() # requests.Session は使用しない
+# ウォームスタート間で TCP/TLS 接続を使い回すためのプール (モジュールレベルで保持)
+http_pool = ConnectionPool(
+    NGROK_URL,
+    maxsize=int(os.environ.get("HTTP_POOL_MAXSIZE", "4")),
+    idle_timeout=float(os.environ.get("HTTP_POOL_IDLE_TIMEOUT", "60")),
+    max_connections=int(os.environ.get("HTTP_POOL_MAX_CONNECTIONS", "16")),
+)
+
+# サーキットブレーカーの設定 (バックエンド停止時にタイムアウトまで待たずに即座に失敗させる)
+CIRCUIT_BREAKER_ENABLED = os.environ.get("CIRCUIT_BREAKER_ENABLED", "true").lower() == "true"
+HEALTH_CHECK_TIMEOUT = float(os.environ.get("HEALTH_CHECK_TIMEOUT", "2"))
+BREAKER_OPTIONS = {
+    "failure_rate_threshold": float(os.environ.get("CIRCUIT_FAILURE_RATE", "0.5")),
+    "window_seconds": float(os.environ.get("CIRCUIT_WINDOW_SECONDS", "30")),
+    "min_requests": int(os.environ.get("CIRCUIT_MIN_REQUESTS", "5")),
+    "open_seconds": float(os.environ.get("CIRCUIT_OPEN_SECONDS", "15")),
+}
+
+# 複数の推論サーバーを使う場合の負荷分散・ヘッジリクエストエンジン (カンマ区切りで指定)
+BACKEND_URLS = [url.strip() for url in os.environ.get("BACKEND_URLS", "").split(",") if url.strip()]
+upstream_engine = None
+if BACKEND_URLS:
+    # asyncio の読み込みは重いので、エンジンを使う場合のみ読み込む
+    from upstream import UpstreamEngine
+    upstream_engine = UpstreamEngine(
+        BACKEND_URLS,
+        policy=os.environ.get("BACKEND_POLICY", "least_outstanding"),
+        hedge_quantile=float(os.environ.get("HEDGE_QUANTILE", "0.95")),
+        default_hedge_delay_ms=float(os.environ.get("HEDGE_DEFAULT_DELAY_MS", "2000")),
+        # バックエンドごとのブレーカーで、落ちているバックエンドを選択から外す
+        breaker_options=BREAKER_OPTIONS if CIRCUIT_BREAKER_ENABLED else None,
+        # BACKEND_POLICY=affinity で 1 台に許す未完了数 (平均の何倍か)
+        affinity_load_factor=float(os.environ.get("AFFINITY_LOAD_FACTOR", "1.25")),
+        on_breaker_change=lambda url, old, new: on_breaker_change(url, old, new),
+    )
+
+# 生成を行うモデルプロバイダー (MODEL_PROVIDER=auto では、推論サーバーの URL がなく MODEL_ID があれば Bedrock)
+MODEL_ID = os.environ.get("MODEL_ID")
+MODEL_PROVIDER = select_provider(os.environ.get("MODEL_PROVIDER", "http"), MODEL_ID,
+                                 http_configured="NGROK_URL" in os.environ or bool(BACKEND_URLS))
+bedrock_provider = None
+if MODEL_PROVIDER == "bedrock":
+    bedrock_provider = BedrockProvider(
+        MODEL_ID or "us.amazon.nova-lite-v1:0",
+        api=os.environ.get("BEDROCK_API", "converse"),
+        # クライアントは初期化フェーズで作っておき、ウォームスタートで使い回す
+        client=bedrock_client(
+            region_name=os.environ.get("BEDROCK_REGION"),
+            endpoint_url=os.environ.get("BEDROCK_ENDPOINT_URL"),
+            max_pool_connections=int(os.environ.get("BEDROCK_MAX_POOL_CONNECTIONS", "10")),
+            read_timeout=float(os.environ.get("BEDROCK_READ_TIMEOUT", "20")),
+        ),
+        max_temperature=float(os.environ.get("BEDROCK_MAX_TEMPERATURE", "1")),
+    )
+
+# 同一プロンプトの応答キャッシュ (モジュールレベルで保持し、ウォームスタート間で再利用)
+generate_cache = None
+if os.environ.get("RESPONSE_CACHE_ENABLED", "true").lower() == "true":
+    _cache_store_path = os.environ.get("RESPONSE_CACHE_SQLITE_PATH")
+    generate_cache = response_cache.ResponseCache(
+        response_cache.LRUCache(
+            max_entries=int(os.environ.get("RESPONSE_CACHE_MAX_ENTRIES", "256")),
+            ttl=float(os.environ.get("RESPONSE_CACHE_TTL", "300")),
+        ),
+        store=response_cache.SQLiteStore(_cache_store_path) if _cache_store_path else None,
+        cache_sampled=os.environ.get("RESPONSE_CACHE_SAMPLED", "false").lower() == "true",
+    )
+
+# 言い換えられたプロンプトにも以前の応答を返す意味キャッシュ (NumPy が必要)
+semantic_cache = None
+if os.environ.get("SEMANTIC_CACHE_ENABLED", "false").lower() == "true":
+    try:
+        from semantic_cache import SemanticCache, create_embedder  # NumPy の読み込みが重いので、使う場合のみ読み込む
+        _semantic_dim = int(os.environ.get("SEMANTIC_CACHE_DIM", "256"))
+        semantic_cache = SemanticCache(
+            create_embedder(os.environ.get("SEMANTIC_CACHE_EMBEDDER", "hashing"), _semantic_dim),
+            dim=_semantic_dim,
+            threshold=float(os.environ.get("SEMANTIC_CACHE_THRESHOLD", "0.85")),
+            max_bytes=int(os.environ.get("SEMANTIC_CACHE_MAX_BYTES", str(16 * 1024 * 1024))),
+            max_answer_bytes=int(os.environ.get("SEMANTIC_CACHE_MAX_ANSWER_BYTES", "8192")),
+            ttl=float(os.environ.get("SEMANTIC_CACHE_TTL", "3600")),
+            path=os.environ.get("SEMANTIC_CACHE_PATH", "/tmp/semantic_cache") or None,
+            cache_sampled=os.environ.get("SEMANTIC_CACHE_SAMPLED", "false").lower() == "true",
+        )
+    except ImportError as e:
+        log.warning("Semantic cache disabled", error=str(e))
+
+# 同一ペイロードの同時リクエストを 1 回の /generate 呼び出しにまとめる
+generate_flight = None
+if os.environ.get("SINGLEFLIGHT_ENABLED", "true").lower() == "true":
+    _flight_store_path = os.environ.get("SINGLEFLIGHT_SQLITE_PATH")
+    generate_flight = singleflight.SingleFlight(
+        store=singleflight.SQLiteFlightStore(_flight_store_path) if _flight_store_path else None,
+    )
+
+# 会話履歴をトークン予算内でプロンプトに含める (0 の場合は従来どおりメッセージのみ送信)
+HISTORY_TOKEN_BUDGET = int(os.environ.get("HISTORY_TOKEN_BUDGET", "0"))
+history_builder = None
+if HISTORY_TOKEN_BUDGET > 0:
+    from history import HistoryBuilder  # 正規表現のコンパイルを伴うので、使う場合のみ読み込む
+    history_builder = HistoryBuilder(
+        HISTORY_TOKEN_BUDGET,
+        summary_budget=int(os.environ.get("HISTORY_SUMMARY_BUDGET", "256")),
+    )
+    if os.environ.get("HISTORY_SUMMARY_ENABLED", "true").lower() != "true":
+        history_builder.summarizer = None
+
+# メッセージの種類と長さから max_new_tokens などを決める (GENERATION_POLICY_ENABLED=false で従来の固定値)
+FIXED_GENERATION_PARAMS = {"max_new_tokens": 512, "temperature": 0.7, "top_p": 0.9, "do_sample": True}
+generation_policy = None
+if os.environ.get("GENERATION_POLICY_ENABLED", "true").lower() == "true":
+    generation_policy = GenerationPolicy(
+        rules=load_rules(os.environ.get("GENERATION_RULES")),
+        limits=GenerationLimits(
+            max_new_tokens=int(os.environ.get("GENERATION_MAX_NEW_TOKENS", "1024")),
+            max_temperature=float(os.environ.get("GENERATION_MAX_TEMPERATURE", "1.5")),
+        ),
+        # 履歴から組み立てたプロンプトは "User:" / "Assistant:" 形式なので、次のユーザーのターンを作り始めたら止める
+        stop=json.loads(os.environ.get("GENERATION_STOP", '["\\nUser:"]')),
+    )
+# 予算 (max_new_tokens) に対して実際に生成されたトークン数
+generation_ledger = TokenLedger()
+
+# 会話IDごとの履歴ストア (クライアントは新しいメッセージと会話IDだけを送る)
+HISTORY_MAX_MESSAGES = int(os.environ.get("HISTORY_MAX_MESSAGES", "200"))
+conversation_store = None
+if os.environ.get("CONVERSATION_STORE", "memory") != "none":
+    conversation_store = create_store(
+        os.environ.get("CONVERSATION_STORE", "memory"),
+        path=os.environ.get("CONVERSATION_SQLITE_PATH", "/tmp/conversations.db"),
+        table_name=os.environ.get("CONVERSATION_TABLE"),
+        ttl_days=int(os.environ.get("CONVERSATION_TTL_DAYS", "0")),
+        max_conversations=int(os.environ.get("CONVERSATION_MEMORY_MAX", "1000")),
+        ttl=float(os.environ.get("CONVERSATION_MEMORY_TTL", "3600")),
+    )
+
+# ユーザーごとのレート制限と、推論サーバー飽和時の公平な受け入れ制御 (ADMISSION_STORE=none で無効化)
+admission = None
+if os.environ.get("ADMISSION_STORE", "none") != "none":
+    admission = AdmissionController(
+        create_admission_store(
+            os.environ["ADMISSION_STORE"],
+            path=os.environ.get("ADMISSION_SQLITE_PATH", "/tmp/admission.db"),
+            table_name=os.environ.get("ADMISSION_TABLE"),
+        ),
+        AdmissionPolicy(
+            rate_per_second=float(os.environ.get("ADMISSION_RATE_PER_SECOND", "1")),
+            burst=float(os.environ.get("ADMISSION_BURST", "5")),
+            max_concurrency=int(os.environ.get("ADMISSION_MAX_CONCURRENCY", "2")),
+            global_capacity=int(os.environ.get("ADMISSION_GLOBAL_CAPACITY", "0")),
+            lease_seconds=float(os.environ.get("ADMISSION_LEASE_SECONDS", "60")),
+        ),
+        queue_timeout=float(os.environ.get("ADMISSION_QUEUE_TIMEOUT", "2")),
+    )
+
+# 応答ボディの圧縮 (クライアントの Accept-Encoding が gzip / br を受け付け、ボディがしきい値以上の場合)
+response_encoder = None
+if os.environ.get("RESPONSE_COMPRESSION_ENABLED", "true").lower() == "true":
+    response_encoder = ResponseEncoder(
+        min_bytes=int(os.environ.get("RESPONSE_COMPRESS_MIN_BYTES", "1024")),
+        gzip_level=int(os.environ.get("RESPONSE_GZIP_LEVEL", "6")),
+        brotli_quality=int(os.environ.get("RESPONSE_BROTLI_QUALITY", "5")),
+        # API Gateway のバイナリメディアタイプ (Accept がこれに一致するリクエストにだけ圧縮した応答を返す)
+        binary_media_types=[t for t in os.environ.get(
+            "BINARY_MEDIA_TYPES", "application/json,text/event-stream").split(",") if t.strip()],
+    )
+# 応答に会話履歴を含めるか (リクエストボディの includeHistory で上書きできる)
+RESPONSE_INCLUDE_HISTORY = os.environ.get("RESPONSE_INCLUDE_HISTORY", "true").lower() == "true"
+
+# 非同期ジョブモード ("async": true のリクエストを 202 で受け付け、ワーカーで生成する。JOB_QUEUE=none で無効)
+JOB_QUEUE = os.environ.get("JOB_QUEUE", "none")
+JOB_PARTIAL_INTERVAL = float(os.environ.get("JOB_PARTIAL_INTERVAL", "1"))
+JOB_POLL_MAX_WAIT = float(os.environ.get("JOB_POLL_MAX_WAIT", "10"))
+JOB_LOCAL_WORKERS = int(os.environ.get("JOB_LOCAL_WORKERS", "1"))
+job_queue = None
+job_store = None
+if JOB_QUEUE != "none":
+    job_queue = create_job_queue(
+        JOB_QUEUE,
+        path=os.environ.get("JOB_QUEUE_SQLITE_PATH", "/tmp/jobs.db"),
+        visibility_timeout=float(os.environ.get("JOB_VISIBILITY_TIMEOUT", "300")),
+        queue_url=os.environ.get("JOB_QUEUE_URL"),
+    )
+# ワーカー関数 (worker_handler) はキューに送信しないので、JOB_STORE だけを設定する
+if JOB_QUEUE != "none" or os.environ.get("JOB_STORE"):
+    job_store = create_job_store(
+        os.environ.get("JOB_STORE", "memory"),
+        path=os.environ.get("JOB_STORE_SQLITE_PATH", "/tmp/jobs.db"),
+        table_name=os.environ.get("JOB_TABLE"),
+        result_bucket=os.environ.get("JOB_RESULT_BUCKET") or None,
+        ttl=float(os.environ.get("JOB_TTL_SECONDS", "86400")),
+    )
+# memory / sqlite のキューのジョブを実行するこのプロセス内のワーカースレッド (最初のジョブを受け付けたときに起動)
+local_job_workers = []
+
+def health_check():
+    """
+    NGROK_URL の /health を確認し、モデルが利用可能なら True を返します。
+
+    サーキットが open の間に遅延プローブとして呼び出されます。
+    """
+    try:
+        with http_pool.request('GET', '/health', timeout=HEALTH_CHECK_TIMEOUT) as response:
+            if response.status != 200:
+                log.warning("Health check failed", status=response.status)
+                return False
+            health = json.loads(response.read().decode('utf-8') or '{}')
+            return health.get("status", "ok") == "ok"
+    except Exception as e:
+        log.warning("Health check failed", error=str(e))
+        return False
+
+def on_breaker_change(name, old, new):
+    """ブレーカーの状態遷移をログと EMF のメトリクス (circuit_transitions / circuit_state) に出力します。"""
+    log.warning("Circuit breaker state changed", backend=name, old=old, new=new)
+    metrics.count("circuit_transitions", {"Backend": name, "Transition": f"{old}->{new}"})
+    metrics.gauge("circuit_state", STATE_CODES[new], {"Backend": name})
+
+# 単一バックエンド (NGROK_URL または Bedrock) 用のブレーカー (複数バックエンド時はエンジン側のブレーカーを使う)
+# Bedrock には /health がないので、open_seconds 経過後はプローブせずに試行リクエストを通す
+upstream_breaker = None
+if CIRCUIT_BREAKER_ENABLED and upstream_engine is None:
+    upstream_breaker = CircuitBreaker(health_check=health_check if bedrock_provider is None else None,
+                                      on_state_change=lambda old, new: on_breaker_change(breaker_name(), old, new),
+                                      **BREAKER_OPTIONS)
+
+def breaker_name():
+    """単一バックエンドのブレーカーの名前 (ログとメトリクスの Backend ディメンション)。"""
+    return f"bedrock:{bedrock_provider.model_id}" if bedrock_provider is not None else NGROK_URL
+
+def breaker_metrics():
+    """
+    サーキットブレーカーの状態をメトリクスとして返し、状態と失敗率を EMF のメトリクス
+    (circuit_state / circuit_failure_rate) にも記録します (次の flush で出力する)。
+    """
+    if upstream_breaker is not None:
+        breakers = {breaker_name(): upstream_breaker.metrics()}
+    elif upstream_engine is not None:
+        breakers = {url: stats["breaker"] for url, stats in upstream_engine.snapshot()["backends"].items()}
+    else:
+        return {}
+    for name, breaker in breakers.items():
+        if breaker is None:
+            continue
+        metrics.gauge("circuit_state", breaker["state_code"], {"Backend": name})
+        metrics.gauge("circuit_failure_rate", breaker["failure_rate"], {"Backend": name})
+    return breakers
+
+def acquire_upstream():
+    """上流を呼び出す前にブレーカーを確認し、open なら CircuitOpenError を送出します。"""
+    if upstream_breaker is not None and not upstream_breaker.allow():
+        raise CircuitOpenError(upstream_breaker.retry_after())
+
+def record_upstream(ok):
+    """上流呼び出しの成否 (接続エラー・タイムアウト・5xx は失敗) をブレーカーに記録します。"""
+    if upstream_breaker is not None:
+        if ok:
+            upstream_breaker.record_success()
+        else:
+            upstream_breaker.record_failure()
+
+# Lambda の残り時間から上流呼び出しの期限を決める (期限の DEADLINE_MARGIN_MS 前にはエラー応答を返す)
+DEADLINE_MARGIN_MS = int(os.environ.get("DEADLINE_MARGIN_MS", "1000"))
+# API Gateway の統合タイムアウト (REST API は 29 秒)。API Gateway 経由のリクエストは Lambda の残り時間が長くても
+# この時間を残り時間とみなす (Lambda のタイムアウトが 30 秒だと、余裕を引いた期限が API Gateway の 29 秒と同じになり
+# クライアントには 504 より先に API Gateway のエラーが返ってしまう)
+API_GATEWAY_TIMEOUT_MS = int(os.environ.get("API_GATEWAY_TIMEOUT_MS", "29000"))
+adaptive_timeout = AdaptiveTimeout(
+    quantile=float(os.environ.get("ATTEMPT_TIMEOUT_QUANTILE", "0.99")),
+    multiplier=float(os.environ.get("ATTEMPT_TIMEOUT_MULTIPLIER", "1.5")),
+    min_timeout=float(os.environ.get("MIN_ATTEMPT_TIMEOUT", "1")),
+)
+RETRY_MAX_ATTEMPTS = int(os.environ.get("RETRY_MAX_ATTEMPTS", "3"))
+retry_budget = RetryBudget(
+    ratio=float(os.environ.get("RETRY_BUDGET_RATIO", "0.1")),
+    min_per_second=float(os.environ.get("RETRY_MIN_PER_SECOND", "0.2")),
+)
+
+# フェーズごとの所要時間をヒストグラムに集約し、CloudWatch EMF で出力する (METRICS_SINK=none で無効化)
+# 応答を返すと実行環境は凍結され、次の呼び出しがないまま破棄されることもあるので、既定では呼び出しごとに出力する
+metrics = create_instrumentation(
+    os.environ.get("METRICS_SINK", "stdout"),
+    namespace=os.environ.get("METRICS_NAMESPACE", "SimpleChat"),
+    flush_seconds=float(os.environ.get("METRICS_FLUSH_SECONDS", "0")),
+    dimensions={"FunctionName": os.environ.get("AWS_LAMBDA_FUNCTION_NAME", "local")},
+)
+
+# 初期化フェーズで推論サーバーへの接続を確立しておき、最初のリクエストで TCP/TLS ハンドシェイクを待たない
+if (os.environ.get("PREWARM_CONNECTION", "true").lower() == "true" and upstream_engine is None
+        and bedrock_provider is None):
+    try:
+        http_pool.prewarm(timeout=float(os.environ.get("PREWARM_TIMEOUT", "1")))
+    except OSError as e:
+        log.info("Connection prewarm skipped", error=str(e))
 
 # Lambda コンテキストからリージョンを抽出する関数 (変更なし)
 def extract_region_from_arn(arn):
-    match = re.search('arn:aws:lambda:([^:]+):', arn)
+    match = ARN_REGION_RE.search(arn)
     if match:
         return match.group(1)
     return "us-east-1"
 
-def lambda_handler(event, context):
+def stream_chat(payload, on_complete, deadline, on_token=None):
+    """
+    /generate のトークンストリームを受け取り、SSE イベントとして逐次 yield します。
+
+    最後に event: done として on_complete が返す最終結果を送ります。
+    エラー時も通常モードと同様にエラー内容を応答テキストとして返します。
+    期限に達した場合はそこまでのトークンで打ち切ります (1 トークンも届いていなければ DeadlineExceeded)。
+
+    Args:
+        payload (dict): /generate に送るペイロード (stream フラグはここで付与)。
+        on_complete (callable): (応答テキスト, 正常に生成できたか) を受け取り、done イベントの内容を返す関数。
+        deadline (Deadline): リクエスト全体の期限。
+        on_token (callable): 指定すると、受け取ったトークンを 1 つずつ渡す (非同期ジョブの途中経過の保存用)。
+
+    Yields:
+        str: SSE 形式のイベント文字列。
+    """
+    if bedrock_provider is not None:
+        yield from stream_bedrock(payload, on_complete, deadline, on_token)
+        return
+    with metrics.span("payload_encode"):
+        data = fastjson.dumpb({**payload, "stream": True})
+    headers = {
+        'Content-Type': 'application/json',
+        'Accept': 'text/event-stream, application/x-ndjson, application/json'
+    }
+    started_at = time.perf_counter()
+    chunks = []
+    ok = False
+
+    # open の場合や残り時間がない場合は、最初のイベントを返す前に例外を送出する
+    if deadline.remaining() < adaptive_timeout.min_timeout:
+        raise DeadlineExceeded("Not enough time left to start streaming")
+    acquire_upstream()
     try:
-        print("Received event:", json.dumps(event))
+        # ブレーカーには 1 リクエストにつき 1 回だけ記録する (ヘッダーの受信時に成功と記録すると、
+        # ストリームの途中のタイムアウトで失敗も記録され、1 リクエストが 2 件に数えられてしまう)
+        with http_pool.request('POST', '/generate', body=data, headers=headers, timeout=deadline.remaining()) as response:
+            metrics.record("upstream_connect", response.timings['connect_ms'])
+            metrics.record("upstream_ttfb", response.timings['ttfb_ms'])
+            if response.status == 200:
+                # 推論サーバーが stop を無視しても、停止シーケンス以降はクライアントに送らない
+                stream = TimedStream(StopFilter(iter_tokens(response), payload.get('stop', ())), started_at)
+                for token in stream:
+                    chunks.append(token)
+                    if on_token is not None:
+                        on_token(token)
+                    yield format_sse({"token": token})
+                    if deadline.expired():
+                        log.warning("Streaming stopped at the deadline", tokens=len(chunks))
+                        break
+                    # 次の読み取りも期限を超えて待たないようにする
+                    response.settimeout(deadline.remaining())
+                # 最初のトークンまでの時間と合計時間は別々に記録する
+                log.info("Streaming finished", ttft_ms=stream.ttft_ms, total_ms=round(stream.total_ms, 1),
+                         tokens=stream.token_count)
+                record_upstream(True)
+                assistant_response = "".join(chunks) or 'Received empty response from external API'
+                ok = bool(chunks)
+            else:
+                error_body = response.read().decode('utf-8', 'replace')
+                record_upstream(response.status < 500)
+                log.error("External API returned an error status", status=response.status, body=error_body)
+                assistant_response = f"Error: API returned status {response.status}. Body: {error_body[:200]}"
+    except PoolTimeout as e:
+        # 接続の空き待ちで期限が来ただけなので、バックエンドの失敗としては記録しない
+        raise DeadlineExceeded("No upstream connection became free before the deadline") from e
+    except socket.timeout:
+        log.error("Streaming request to external API timed out", tokens=len(chunks))
+        record_upstream(False)
+        if not chunks:
+            raise DeadlineExceeded("External API did not respond before the deadline")
+        assistant_response = "".join(chunks)
+    except (OSError, http.client.HTTPException) as e:
+        log.error("Error calling external API (connection error)", error=str(e))
+        record_upstream(False)
+        assistant_response = "".join(chunks) or f"Error: Could not connect to external API. Reason: {e}"
+    except Exception as e: # その他の予期せぬエラー
+        log.exception("An unexpected error occurred during streaming")
+        assistant_response = "".join(chunks) or f"An unexpected error occurred: {e}"
+
+    yield format_sse(on_complete(assistant_response, ok), event="done")
+
+def stream_bedrock(payload, on_complete, deadline, on_token=None):
+    """
+    stream_chat の Bedrock 版。ConverseStream / InvokeModelWithResponseStream のトークンを SSE イベントとして
+    逐次 yield し、最後に on_complete が返す最終結果を event: done として送ります。
+    """
+    started_at = time.perf_counter()
+    chunks = []
+    ok = False
+
+    # open の場合や残り時間がない場合は、最初のイベントを返す前に例外を送出する
+    if deadline.remaining() < adaptive_timeout.min_timeout:
+        raise DeadlineExceeded("Not enough time left to start streaming")
+    acquire_upstream()
+    try:
+        with metrics.span("bedrock_call"):
+            tokens = bedrock_provider.stream(payload)
+        # Bedrock が stopSequences を扱わないモデルでも、停止シーケンス以降はクライアントに送らない
+        stream = TimedStream(StopFilter(tokens, payload.get('stop', ())), started_at)
+        for token in stream:
+            chunks.append(token)
+            if on_token is not None:
+                on_token(token)
+            yield format_sse({"token": token})
+            if deadline.expired():
+                log.warning("Streaming stopped at the deadline", tokens=len(chunks))
+                tokens.close()
+                break
+        record_upstream(True)
+        log.info("Streaming finished", ttft_ms=stream.ttft_ms, total_ms=round(stream.total_ms, 1),
+                 tokens=stream.token_count)
+        assistant_response = "".join(chunks) or 'Received empty response from Bedrock'
+        ok = bool(chunks)
+    except ProviderError as e:
+        log.error("Bedrock streaming failed", code=e.code, error=str(e), tokens=len(chunks))
+        # 入力の誤り (ValidationException など) はバックエンドの障害として数えない
+        record_upstream(not e.retryable)
+        if e.timeout and not chunks:
+            raise DeadlineExceeded("Bedrock did not respond before the deadline") from e
+        assistant_response = "".join(chunks) or f"Error: Bedrock returned {e.code}. Reason: {e}"
+    except Exception as e: # その他の予期せぬエラー
+        log.exception("An unexpected error occurred during streaming")
+        assistant_response = "".join(chunks) or f"An unexpected error occurred: {e}"
+
+    yield format_sse(on_complete(assistant_response, ok), event="done")
+
+def post_generate(data, headers, timeout=60, affinity_key=None):
+    """
+    /generate に POST し、(ステータス, レスポンスボディ) を返します。
+
+    BACKEND_URLS が設定されている場合は複数バックエンドのエンジン経由で、
+    それ以外は NGROK_URL への keep-alive 接続で送信します。
+    サーキットが open の場合は送信せずに CircuitOpenError を送出します。
+    affinity_key はエンジンの affinity ポリシーでバックエンドを決めるキーです (単一バックエンドでは使わない)。
+    """
+    if upstream_engine is not None:
+        status, body, backend_url, hedged = upstream_engine.post_sync('/generate', data, headers, timeout, affinity_key)
+        log.info("Upstream backend", backend=backend_url, hedged=hedged,
+                 affinity_hits=upstream_engine.affinity_hits, affinity_spills=upstream_engine.affinity_spills)
+        return status, body
+    acquire_upstream()
+    try:
+        # ウォーム時は既存の接続を再利用する
+        with http_pool.request('POST', '/generate', body=data, headers=headers, timeout=timeout) as response:
+            timings = response.timings
+            log.info("Upstream connection", reused=timings['reused'], connect_ms=round(timings['connect_ms'], 1),
+                     ttfb_ms=round(timings['ttfb_ms'], 1))
+            metrics.record("upstream_connect", timings['connect_ms'])
+            metrics.record("upstream_ttfb", timings['ttfb_ms'])
+            with metrics.span("body_read"):
+                status, response_bytes = response.status, response.read()
+    except PoolTimeout:
+        # 接続の空き待ちのタイムアウトはバックエンドの失敗ではない
+        raise
+    except (OSError, http.client.HTTPException):
+        record_upstream(False)
+        raise
+    record_upstream(status < 500)
+    return status, response_bytes
+
+def post_generate_with_retry(data, headers, deadline, affinity_key=None, size=None):
+    """
+    期限内で /generate を呼び出し、(ステータス, レスポンスボディ, デコードした JSON (200 以外は None)) を返します。
+
+    1 回の試行のタイムアウトは同じ大きさ (size = max_new_tokens) のリクエストで観測したレイテンシの分位点から決め、
+    接続エラー・タイムアウト・途中で切れた応答・5xx・JSON としてデコードできない 200 の応答は
+    期限とリトライ予算が残っている間だけ、指数バックオフを挟んで再試行します。最後の試行がタイムアウトした場合は
+    DeadlineExceeded を送出します。
+    """
+    retry_budget.deposit()
+    attempt = 1
+    while True:
+        timeout = adaptive_timeout.attempt_timeout(deadline, size)
+        started = time.perf_counter()
+        error = None
+        try:
+            status, response_bytes = post_generate(data, headers, timeout=timeout, affinity_key=affinity_key)
+        except PoolTimeout as e:
+            # 接続の空き待ちの時間は上流のレイテンシとして観測しない
+            raise DeadlineExceeded(f"No upstream connection became free within {timeout:.1f}s") from e
+        except (OSError, http.client.HTTPException) as e:
+            error = e
+            if isinstance(e, socket.timeout):
+                # 打ち切った試行も記録し、上流が遅くなったらタイムアウトが伸びるようにする
+                adaptive_timeout.observe(timeout, size)
+        else:
+            if status == 200:
+                try:
+                    with metrics.span("json_decode"):
+                        response_data = fastjson.loads(response_bytes)
+                except ValueError as e:
+                    # 途中で切れたボディなど。接続エラーと同じく再試行する
+                    error = e
+                else:
+                    adaptive_timeout.observe(time.perf_counter() - started, size)
+                    return status, response_bytes, response_data
+            elif status < 500:
+                adaptive_timeout.observe(time.perf_counter() - started, size)
+                return status, response_bytes, None
+
+        # 失敗直後に同じバックエンドへ再送しても失敗しやすいので、少し待ってからリトライする
+        delay = backoff_delay(attempt)
+        if (attempt >= RETRY_MAX_ATTEMPTS or deadline.remaining() - delay < adaptive_timeout.min_timeout
+                or not retry_budget.try_withdraw()):
+            if error is None:
+                return status, response_bytes, None
+            if isinstance(error, socket.timeout):
+                raise DeadlineExceeded(f"External API did not respond within {timeout:.1f}s") from error
+            raise error
+        attempt += 1
+        log.warning("Retrying /generate", attempt=attempt, delay_ms=round(delay * 1000),
+                    error=str(error) if error else f"status {status}", retry_budget=retry_budget.stats())
+        time.sleep(delay)
+
+def call_generate(data, deadline, affinity_key=None, size=None):
+    """
+    /generate を呼び出し、アシスタントの応答テキストを返します。
+
+    エラー時も例外は送出せず、エラー内容を応答テキストとして返します。
+    ただしサーキットが open の場合と期限までに応答が得られない場合は、呼び出し元で 503 / 504 を
+    返せるよう CircuitOpenError / DeadlineExceeded を送出します。
+
+    Args:
+        data (bytes): /generate に送るエンコード済みのペイロード。
+        deadline (Deadline): リクエスト全体の期限。
+        affinity_key (str): 同じ会話を同じバックエンドに送るためのキー (conversation_affinity_key の結果)。
+        size (int): ペイロードの max_new_tokens (試行のタイムアウトを同じ大きさのリクエストのレイテンシから決める)。
+
+    Returns:
+        tuple: (応答テキスト, 正常な生成結果かどうか, 生成トークン数 (正常な場合のみ、それ以外は 0))。
+    """
+    external_api_url = f"{NGROK_URL.rstrip('/')}/generate"
+    headers = {
+        'Content-Type': 'application/json',
+        'Accept': 'application/json'
+    }
+
+    assistant_response = 'Error: Could not get response from external API.' # デフォルトのエラーメッセージ
+    ok = False
+    tokens = 0
 
+    try:
+        # リクエストを送信 (タイムアウトは Lambda の残り時間とレイテンシ分布から決める)
+        status, response_bytes, response_data = post_generate_with_retry(data, headers, deadline, affinity_key, size)
+        if status == 200:
+            # 応答全体はサンプリング対象のリクエストでだけ、受信したバイト列のまま記録する
+            log.body("External API response", "response", response_bytes, response_bytes=len(response_bytes))
+            assistant_response = response_data.get('generated_text')
+            ok = bool(assistant_response)
+            if ok:
+                tokens = produced_tokens(response_data, assistant_response)
+            if 'generated_text' not in response_data:
+                assistant_response = 'No response text found in API result'
+            elif not assistant_response:
+                assistant_response = 'Received empty response from external API'
+        else:
+            error_body = response_bytes.decode('utf-8', 'replace')
+            log.error("External API returned an error status", status=status, body=error_body)
+            assistant_response = f"Error: API returned status {status}. Body: {error_body[:200]}" # エラー内容を一部含める
+
+    except (CircuitOpenError, DeadlineExceeded):
+        raise
+    except socket.timeout:
+        log.error("Request to external API timed out", url=external_api_url)
+        assistant_response = "Error: External API request timed out."
+        # タイムアウトの場合もエラーとして処理を続けるか、例外を再発生させるか選択
+        # raise Exception("External API request timed out.") # ここで処理を中断する場合
+    except json.JSONDecodeError as e:
+        log.error("Error decoding JSON response from external API", error=str(e))
+        assistant_response = "Error: Could not decode the response from the external API."
+        # raise Exception("Failed to decode external API response.") # ここで処理を中断する場合
+    except (OSError, http.client.HTTPException) as e:
+        # 接続関連のエラー (接続不可、切断など)
+        log.error("Error calling external API (connection error)", error=str(e))
+        assistant_response = f"Error: Could not connect to external API. Reason: {e}"
+        # raise Exception(f"Failed to call external API: {e}") # ここで処理を中断する場合
+    except Exception as e: # その他の予期せぬエラー
+         log.exception("An unexpected error occurred during API call")
+         assistant_response = f"An unexpected error occurred: {e}"
+         # raise # 予期せぬエラーは再発生させるのが良い場合も
+
+    return assistant_response, ok, tokens
+
+def call_bedrock(payload, deadline):
+    """
+    Bedrock で生成し、call_generate と同じ (応答テキスト, 正常な生成結果かどうか, 生成トークン数) を返します。
+
+    スロットリング・サーバー側のエラー・接続エラーは、期限とリトライ予算が残っている間だけ
+    指数バックオフを挟んで再試行します。サーキットが open の場合と、期限までに応答が得られない場合は
+    CircuitOpenError / DeadlineExceeded を送出します。
+    """
+    retry_budget.deposit()
+    size = payload.get('max_new_tokens')
+    attempt = 1
+    while True:
+        # 1 回の試行のタイムアウトはクライアントの read_timeout で決まるので、ここでは残り時間だけを確認する
+        adaptive_timeout.attempt_timeout(deadline, size)
+        acquire_upstream()
+        started = time.perf_counter()
+        try:
+            with metrics.span("bedrock_call"):
+                assistant_response, tokens = bedrock_provider.generate(payload)
+        except ProviderError as e:
+            # 入力の誤り (ValidationException など) はバックエンドの障害として数えない
+            record_upstream(not e.retryable)
+            error = e
+            if e.timeout:
+                adaptive_timeout.observe(time.perf_counter() - started, size)
+        else:
+            record_upstream(True)
+            adaptive_timeout.observe(time.perf_counter() - started, size)
+            if not assistant_response:
+                return 'Received empty response from Bedrock', False, 0
+            return assistant_response, True, tokens or produced_tokens(None, assistant_response)
+
+        delay = backoff_delay(attempt)
+        if (not error.retryable or attempt >= RETRY_MAX_ATTEMPTS
+                or deadline.remaining() - delay < adaptive_timeout.min_timeout or not retry_budget.try_withdraw()):
+            log.error("Bedrock call failed", code=error.code, error=str(error), attempts=attempt)
+            if error.timeout:
+                raise DeadlineExceeded("Bedrock did not respond in time") from error
+            return f"Error: Bedrock returned {error.code}. Reason: {error}", False, 0
+        attempt += 1
+        log.warning("Retrying Bedrock", attempt=attempt, delay_ms=round(delay * 1000), code=error.code,
+                    retry_budget=retry_budget.stats())
+        time.sleep(delay)
+
+def load_summary_state(store_key, history):
+    """
+    会話ストアに保存した要約の状態を、読み込んだ履歴 (直近 HISTORY_MAX_MESSAGES 件) の位置に合わせて返します。
+
+    Returns:
+        tuple: (HistoryBuilder に渡す summary_state、使えなければ None, 履歴の先頭が会話の何件目か)。
+    """
+    saved = conversation_store.load_summary(store_key)
+    if saved is None:
+        return None, 0
+    offset = conversation_store.count(store_key) - len(history) if len(history) >= HISTORY_MAX_MESSAGES else 0
+    # 要約済みの位置が読み込んだ範囲より前なら、間のメッセージが読めないので要約し直す
+    if saved["upto"] <= offset:
+        return None, offset
+    return {"upto": saved["upto"] - offset, "text": saved["text"]}, offset
+
+def generate_text(payload, payload_bytes, deadline, affinity_key=None, on_token=None):
+    """
+    モデルプロバイダー (MODEL_PROVIDER) で生成し、(応答テキスト, 正常な生成結果かどうか, 生成トークン数) を返します。
+
+    on_token を指定すると (非同期ジョブの途中経過の保存用)、Bedrock と単一バックエンドではストリーミングで生成して
+    トークンを 1 つずつ渡します。BACKEND_URLS の複数バックエンドでは同期リクエストと同じくエンジン経由
+    (バックエンドの選択・ブレーカー・ヘッジ) で応答全体を生成し、最後にまとめて渡します。
+    """
+    if on_token is not None and upstream_engine is None:
+        assistant_response, ok = generate_streaming(payload, deadline, on_token)
+        return assistant_response, ok, produced_tokens(None, assistant_response) if ok else 0
+    if bedrock_provider is not None:
+        result = call_bedrock(payload, deadline)
+    else:
+        result = call_generate(payload_bytes, deadline, affinity_key, payload.get('max_new_tokens'))
+    if on_token is not None and result[1]:
+        on_token(result[0])
+    return result
+
+def admit(user, deadline):
+    """
+    上流を呼び出す前にユーザーの受け入れを判定し、リース ID を返します (受け入れ制御が無効なら None)。
+
+    Raises:
+        AdmissionRejected: レート制限・同時実行数の上限などで受け入れられない場合。
+    """
+    if admission is None:
+        return None
+    with metrics.span("admission"):
+        # 飽和中に空きを待つ場合も、上流を呼び出す時間は残しておく
+        return admission.acquire(user, max_wait=deadline.remaining() - adaptive_timeout.min_timeout)
+
+def conversation_affinity_key(username, conversation_history, message, conversation_id=None):
+    """
+    同じ会話のリクエストを同じバックエンドに送るためのキーを返します。
+
+    差分モードでは会話 ID を、それ以外は会話の最初のメッセージを使います。最初のターンの
+    メッセージは次のターン以降の履歴の先頭になるので、どのターンでも同じキーになり、
+    前のターンでプレフィックス (KV) キャッシュが温まったバックエンドに送られます。
+    """
+    if conversation_id is not None:
+        return f"{username}/{conversation_id}"
+    first = conversation_history[0] if conversation_history else None
+    if isinstance(first, dict) and isinstance(first.get('content'), str):
+        return f"{username}/{first['content']}"
+    return f"{username}/{message}"
+
+def generate_streaming(payload, deadline, on_token):
+    """
+    stream_chat でトークンを on_token に渡しながら生成し、(応答テキスト, 正常に生成できたか) を返します。
+    """
+    outcome = []
+    for _ in stream_chat(payload, lambda text, ok: outcome.append((text, ok)), deadline, on_token):
+        pass
+    return outcome[0]
+
+def record_generation(rule, budget, produced):
+    """上流で生成したトークン数を予算と合わせて記録します。"""
+    generation_ledger.record(rule, budget, produced)
+    stats = generation_ledger.stats()
+    log.info("Generation budget", rule=rule, budgeted=budget, produced=produced,
+             utilization=stats["utilization"], produced_tokens=stats["produced_tokens"])
+
+def encode_response(response, event):
+    """クライアントが受け付ける場合は応答ボディを圧縮します (RESPONSE_COMPRESSION_ENABLED=false なら何もしない)。"""
+    if response_encoder is None:
+        return response
+    with metrics.span("response_compress"):
+        return response_encoder.encode(response, header(event, 'Accept-Encoding'), header(event, 'Accept'))
+
+def enqueue_job(request_body, user_info, username, deadline):
+    """
+    リクエストを非同期ジョブとしてキューに入れ、202 とジョブ ID を返します。
+
+    レート制限は受け付け時に判定して枠はすぐに返し、同時に生成する数はワーカーの並列度で制限します。
+
+    Raises:
+        AdmissionRejected: レート制限を超えている場合。
+    """
+    lease = admit(username, deadline)
+    if lease is not None:
+        admission.release(username, lease)
+    # uuid モジュールは読み込まずに、同じ形式 (32 桁の 16 進数) のランダムな ID を発行する
+    job_id = os.urandom(16).hex()
+    with metrics.span("job_enqueue"):
+        job_store.create(job_id, username)
+        # ワーカーには認可済みのクレームのうち、ユーザーの識別に使うものだけを渡す
+        claims = {key: value for key, value in (user_info or {}).items() if key in ('sub', 'cognito:username')}
+        job_queue.send({
+            "jobId": job_id,
+            "event": {"body": request_body, "requestContext": {"authorizer": {"claims": claims}}},
+        })
+    start_local_workers()
+    log.info("Job enqueued", job_id=job_id, queue=JOB_QUEUE)
+    return {
+        "statusCode": 202,
+        "headers": JSON_HEADERS,
+        "body": json.dumps({"success": True, "jobId": job_id, "status": QUEUED})
+    }
+
+def poll_job(job_id, username, query, deadline):
+    """
+    ジョブの状態・途中経過・結果を返します (GET /chat/jobs/{jobId})。
+
+    クエリパラメータ after にクライアントが受け取り済みの途中経過の文字数を指定すると、それ以降だけを返します。
+    wait (秒) を指定すると、途中経過が増えるかジョブが終わるまで最大 JOB_POLL_MAX_WAIT 秒待ちます (ロングポーリング)。
+    他のユーザーのジョブは存在しないものとして 404 を返します。
+    """
+    try:
+        after = max(0, int(query.get('after') or 0))
+        wait = min(max(0.0, float(query.get('wait') or 0)), JOB_POLL_MAX_WAIT, deadline.remaining())
+    except ValueError:
+        return {
+            "statusCode": 400,
+            "headers": JSON_HEADERS,
+            "body": json.dumps({"success": False, "error": "after and wait must be numbers"})
+        }
+    wait_until = time.monotonic() + wait
+    while True:
+        job = job_store.get(job_id) if job_store is not None else None
+        if job is None or job["owner"] != username:
+            return {
+                "statusCode": 404,
+                "headers": JSON_HEADERS,
+                "body": json.dumps({"success": False, "error": "Job not found"})
+            }
+        if job["status"] in FINISHED or len(job["partial"]) > after or time.monotonic() >= wait_until:
+            break
+        time.sleep(min(0.25, max(0.0, wait_until - time.monotonic())))
+    result = {
+        "success": True,
+        "jobId": job_id,
+        "status": job["status"],
+        "partial": job["partial"][after:],
+        "partialLength": len(job["partial"]),
+    }
+    if job["status"] in FINISHED:
+        # 同期モードで返すはずだったステータスとボディ (会話履歴などを含む)
+        result["statusCode"] = job["statusCode"]
+        result["result"] = fastjson.loads(job["result"])
+    return {
+        "statusCode": 200,
+        "headers": JSON_HEADERS,
+        "body": fastjson.dumps(result)
+    }
+
+def run_job(message, context):
+    """キューから受け取ったジョブを 1 件実行し、途中経過と結果をジョブストアに保存します。"""
+    job_id = message['jobId']
+    # キューは同じメッセージを複数回届けることがあるので、終了済みのジョブは実行しない
+    if not job_store.start(job_id):
+        log.info("Job already finished", job_id=job_id)
+        return
+    writer = PartialWriter(lambda text: job_store.update_partial(job_id, text), JOB_PARTIAL_INTERVAL)
+    response = lambda_handler(message['event'], context, on_token=writer.add)
+    status = SUCCEEDED if response['statusCode'] == 200 else FAILED
+    try:
+        job_store.finish(job_id, status, response['statusCode'], response['body'])
+    except Exception as error:
+        # 結果を保存できないジョブは失敗として終わらせる (running のまま再送され、同じ生成を繰り返さないように)
+        log.exception("Could not store the job result", job_id=job_id, error=str(error),
+                      result_bytes=len(response['body']))
+        status = FAILED
+        job_store.finish(job_id, FAILED, 500, json.dumps({"success": False, "error": "Could not store the job result"}))
+    log.info("Job finished", job_id=job_id, status=status, status_code=response['statusCode'],
+             partial_writes=writer.writes)
+
+def start_local_workers():
+    """
+    memory / sqlite のキューのジョブを、このプロセスのスレッドで実行します (ローカル開発・テスト用)。
+
+    Lambda ではプロセスが応答後に凍結されるので、JOB_QUEUE=sqs とワーカー関数 (worker_handler) を使います。
+    """
+    if JOB_QUEUE not in ("memory", "sqlite") or local_job_workers:
+        return
+    for _ in range(JOB_LOCAL_WORKERS):
+        worker = threading.Thread(target=run_worker, args=(job_queue, lambda message: run_job(message, None),
+                                                           threading.Event()), daemon=True)
+        worker.start()
+        local_job_workers.append(worker)
+
+def worker_handler(event, context):
+    """
+    SQS から非同期ジョブを受け取って実行するワーカー関数のハンドラ。
+
+    失敗したレコードは batchItemFailures で返し、SQS の再送に任せます (同じジョブの再実行は run_job が防ぐ)。
+    """
+    failures = []
+    for record in event.get('Records', []):
+        try:
+            run_job(json.loads(record['body']), context)
+        except Exception as error:
+            log.exception("Job failed", error=str(error), message_id=record.get('messageId'))
+            failures.append({"itemIdentifier": record['messageId']})
+    log.flush()
+    return {"batchItemFailures": failures}
+
+def lambda_handler(event, context, on_token=None):
+    """
+    /chat のハンドラ。on_token は非同期ジョブのワーカー (run_job) が指定し、
+    生成中のトークンを受け取ります (応答は同期モードと同じ JSON)。
+    """
+    handler_started = time.perf_counter()
+    metrics.begin()
+    username = None
+    admission_lease = None
+    try:
+        # Lambda のタイムアウトより前に必ず応答を返せるよう、残り時間から期限を決める
+        # 非同期ジョブのイベント (run_job) は API Gateway を通らないので、Lambda の残り時間だけで決める
+        from_api_gateway = 'httpMethod' in event or 'routeKey' in event
+        deadline = Deadline.from_context(context, margin_ms=DEADLINE_MARGIN_MS,
+                                         cap_ms=API_GATEWAY_TIMEOUT_MS if from_api_gateway else None)
         user_info = None
         if 'requestContext' in event and 'authorizer' in event['requestContext']:
             user_info = event['requestContext']['authorizer']['claims']
-            print(f"Authenticated user: {user_info.get('email') or user_info.get('cognito:username')}")
 
-        body = json.loads(event['body'])
+        # 以降のログにはリクエスト ID と、メールアドレスの代わりに不透明な sub を付ける
+        log.begin_request(request_id=getattr(context, "aws_request_id", None),
+                          user_sub=(user_info or {}).get('sub'))
+        username = (user_info or {}).get('cognito:username', 'anonymous')
+
+        # GET /chat/jobs/{jobId} は非同期ジョブのポーリング
+        job_id = (event.get('pathParameters') or {}).get('jobId')
+        if job_id is not None:
+            return encode_response(poll_job(job_id, username, event.get('queryStringParameters') or {}, deadline), event)
+        # イベント全体 (会話履歴を含む) はサンプリング対象のリクエストでだけ記録する
+        log.body("Received event", "event", event, path=event.get('path'), method=event.get('httpMethod'),
+                 body_chars=len(event.get('body') or ''))
+
+        with metrics.span("body_parse"):
+            request_body = request_text(event)
+            # 会話履歴は応答にそのまま返すので、受け取った JSON テキストも取っておく
+            body, raw_members = fastjson.loads_with_raw(request_body, ('conversationHistory',))
         message = body['message']
-        conversation_history = body.get('conversationHistory', [])
-
-        print("Processing message:", message)
 
-        messages = conversation_history.copy()
-        messages.append({
-            "role": "user",
-            "content": message
-        })
-
-        # --- 外部API呼び出し (urllib.request を使用) ---
+        # "async": true のリクエストはキューに入れてすぐに 202 を返し、生成はワーカーで行う
+        if body.get('async') and job_queue is not None and on_token is None:
+            if generation_policy is not None:
+                # 不正な generationOptions はワーカーに渡す前に 400 で返す
+                generation_policy.build(message, body.get('generationOptions'))
+            return enqueue_job(request_body, user_info, username, deadline)
+
+        # conversationId を含むリクエストはサーバー側の会話ストアを使う (差分モード)
+        # 含まない場合は従来どおりクライアントが送った会話履歴を使う
+        delta_mode = 'conversationId' in body and conversation_store is not None
+        if delta_mode:
+            # uuid モジュールは読み込まずに、同じ形式 (32 桁の 16 進数) のランダムな ID を発行する
+            conversation_id = body.get('conversationId') or os.urandom(16).hex()
+            store_key = f"{username}/{conversation_id}"
+            # 履歴をプロンプトに含めない設定ならストアを読む必要はない (Bedrock には messages として渡す)
+            conversation_history = (conversation_store.load(store_key, limit=HISTORY_MAX_MESSAGES)
+                                    if history_builder or bedrock_provider is not None else [])
+        else:
+            conversation_history = body.get('conversationHistory', [])
+
+        log.body("Processing message", "message", message, message_chars=len(message),
+                 history_messages=len(conversation_history), delta_mode=delta_mode)
+
+        user_message = {"role": "user", "content": message}
+        # includeHistory=false なら応答に会話履歴を含めない (クライアントが自分で履歴に追加する)
+        include_history = bool(body.get('includeHistory', RESPONSE_INCLUDE_HISTORY))
+        # 履歴を受け取ったテキストのまま返せる場合は、デコードしたリストのコピーも再エンコードもしない
+        raw_history = None
+        if not delta_mode and isinstance(conversation_history, list):
+            raw_history = raw_members.get('conversationHistory')
+        if raw_history is None and include_history:
+            with metrics.span("history_copy"):
+                messages = conversation_history.copy()
+                messages.append(user_message)
+
+        # --- 外部API呼び出し (keep-alive コネクションプールを使用) ---
         external_api_url = f"{NGROK_URL.rstrip('/')}/generate"
-        payload = {
-            "prompt": message,
-            "max_new_tokens": 512,
-            "temperature": 0.7,
-            "top_p": 0.9,
-            "do_sample": True
-        }
+        prompt = message
+        new_summary = None
+        if history_builder is not None and conversation_history:
+            # 差分モードでは前回のターンで保存した要約に、新たにウィンドウから外れたメッセージだけを追加する
+            summary_state, history_offset = None, 0
+            if delta_mode and history_builder.summarizer is not None:
+                summary_state, history_offset = load_summary_state(store_key, conversation_history)
+            with metrics.span("history_build"):
+                prompt, history_stats = history_builder.build(conversation_history, message, summary_state)
+            state = history_stats.pop("summary_state")
+            if delta_mode and state["upto"] and state != summary_state:
+                new_summary = {"upto": state["upto"] + history_offset, "text": state["text"]}
+            log.info("History compaction", reused_summary=summary_state is not None, **history_stats)
+        # 生成パラメータはメッセージの種類と長さから決め、クライアントの generationOptions は上限内で反映する
+        if generation_policy is not None:
+            generation_params, generation_rule, adjusted = generation_policy.build(message, body.get('generationOptions'))
+            log.info("Generation policy", rule=generation_rule, adjusted=adjusted, **generation_params)
+        else:
+            generation_params, generation_rule = FIXED_GENERATION_PARAMS, "fixed"
+        payload = {"prompt": prompt, **generation_params}
+        if bedrock_provider is not None and history_builder is None and isinstance(conversation_history, list):
+            # Bedrock には会話履歴を messages としてそのまま渡す (HISTORY_TOKEN_BUDGET 指定時は組み立てたプロンプトを使う)
+            payload["messages"] = [*conversation_history, user_message]
+
+        # ペイロードは 1 回だけエンコードし、同じバイト列を送信・single-flight のキー・ログに使う
+        with metrics.span("payload_encode"):
+            payload_bytes = fastjson.dumpb(payload)
+        log.body("Calling external API", "payload", payload_bytes, provider=MODEL_PROVIDER, url=external_api_url,
+                 prompt_chars=len(prompt))
+
+        # 決定的なリクエスト (またはオプトイン時のサンプリング) は応答キャッシュを参照する
+        cache_key = None
+        assistant_response = None
+        if generate_cache is not None and generate_cache.is_cacheable(payload):
+            cache_key = response_cache.make_key(message, conversation_history, payload)
+            assistant_response = generate_cache.get(cache_key)
+            log.info("Response cache", hit=assistant_response is not None, **generate_cache.stats())
+
+        # 完全一致しなかった場合は、意味の近い過去のプロンプトの応答を探す
+        semantic_vector = None
+        semantic_hit = False
+        if assistant_response is None and semantic_cache is not None and semantic_cache.is_cacheable(payload):
+            with metrics.span("semantic_lookup"):
+                semantic_namespace = semantic_cache.namespace(conversation_history, payload)
+                semantic_vector = semantic_cache.vectorize(message)
+                assistant_response, similarity = semantic_cache.get(semantic_vector, semantic_namespace)
+            semantic_hit = assistant_response is not None
+            log.info("Semantic cache", hit=semantic_hit, similarity=round(similarity, 3), **semantic_cache.stats())
+
+        def finish(assistant_response, ok):
+            # 生成結果をキャッシュ・会話ストアに反映し、クライアントに返す内容を組み立てる
+            if ok and cache_key is not None:
+                generate_cache.set(cache_key, assistant_response)
+            if ok and semantic_vector is not None and not semantic_hit:
+                semantic_cache.set(semantic_vector, semantic_namespace, assistant_response)
+            if delta_mode:
+                result = {"success": True, "response": assistant_response, "conversationId": conversation_id}
+                # 失敗した応答は履歴に残さない (クライアントは同じメッセージを再送できる)
+                if ok:
+                    result["turn"] = conversation_store.append(store_key, [
+                        {"role": "user", "content": message},
+                        {"role": "assistant", "content": assistant_response},
+                    ], summary=new_summary)
+                return result
+            if not include_history:
+                return {"success": True, "response": assistant_response}
+            assistant_message = {"role": "assistant", "content": assistant_response}
+            if raw_history is not None:
+                history = fastjson.extend_array(raw_history, [user_message, assistant_message])
+            else:
+                messages.append(assistant_message)
+                history = messages
+            return {
+                "success": True, # Lambda関数自体の実行は成功したとみなす
+                "response": assistant_response,
+                "conversationHistory": history
+            }
+
+        if body.get('stream'):
+            # SSE 形式の応答: トークンを SSE イベントとして返す (フレーミングのみ)
+            # Python ランタイムはレスポンスストリーミング非対応なので、イベント列は生成し終えてからまとめて返す
+            # (クライアントが最初のトークンを受け取る時間は非ストリーミングと変わらない)
+            if assistant_response is not None:
+                events = [
+                    format_sse({"token": assistant_response}),
+                    format_sse(finish(assistant_response, True), event="done"),
+                ]
+            else:
+                admission_lease = admit(username, deadline)
+
+                def finish_stream(assistant_response, ok):
+                    if ok:
+                        record_generation(generation_rule, payload['max_new_tokens'], produced_tokens(None, assistant_response))
+                    return finish(assistant_response, ok)
+
+                events = stream_chat(payload, finish_stream, deadline)
+            return encode_response({
+                "statusCode": 200,
+                "headers": EVENT_STREAM_HEADERS,
+                "body": "".join(events)
+            }, event)
+
+        ok = True
+        if assistant_response is None:
+            # キャッシュで返せるリクエストは上流を使わないので、受け入れ判定はキャッシュミス時だけ行う
+            # (非同期ジョブは受け付け時に判定済み)
+            if on_token is None:
+                admission_lease = admit(username, deadline)
+            # 同じ会話のターンは同じバックエンドに送り、前のターンのプレフィックスキャッシュを再利用させる
+            affinity_key = None
+            if upstream_engine is not None:
+                affinity_key = conversation_affinity_key(username, conversation_history, message,
+                                                         conversation_id if delta_mode else None)
+            shared = False
+            if on_token is not None:
+                # 非同期ジョブ: 同期リクエストと同じ経路で生成し、途中経過は on_token で受け取る
+                assistant_response, ok, tokens = generate_text(payload, payload_bytes, deadline, affinity_key, on_token)
+            elif generate_flight is not None:
+                flight_key = singleflight.payload_key(payload_bytes)
+                # 他の呼び出しの結果はこのリクエストの期限までしか待たない
+                (assistant_response, ok, tokens), shared = generate_flight.do(
+                    flight_key, lambda: generate_text(payload, payload_bytes, deadline, affinity_key),
+                    wait_timeout=deadline.remaining())
+                log.info("Single-flight", shared=shared, **generate_flight.stats())
+            else:
+                assistant_response, ok, tokens = generate_text(payload, payload_bytes, deadline, affinity_key)
+            log.info("Circuit breaker metrics", breakers=breaker_metrics())
+            if ok:
+                assistant_response, _ = truncate_at_stop(assistant_response, payload.get('stop'))
+                # 共有した結果のトークンは、呼び出した側で記録済み
+                if not shared:
+                    record_generation(generation_rule, payload['max_new_tokens'], tokens)
 
-        print(f"Calling external API: {external_api_url}")
-        print(f"Payload: {json.dumps(payload)}")
+        # --- 外部API呼び出しここまで ---
 
-        # ペイロードをJSON文字列に変換し、UTF-8でエンコード
-        data = json.dumps(payload).encode('utf-8')
-        headers = {
-            'Content-Type': 'application/json',
-            'Accept': 'application/json'
+        result = finish(assistant_response, ok)
+        with metrics.span("response_encode"):
+            response_body = fastjson.dumps(result)
+        return encode_response({
+            "statusCode": 200, # エラーが発生してもAPI Gatewayには200を返し、エラー内容はbodyに含める
+            "headers": JSON_HEADERS,
+            "body": response_body
+        }, event)
+
+    except AdmissionRejected as error:
+        # 同じユーザーのリクエストが多すぎる場合や、飽和中に取り分を超える場合は上流を呼ばずに 429 を返す
+        log.warning("Request rejected by admission control", reason=error.reason,
+                    retry_after=round(error.retry_after, 2), admission=admission.stats())
+        retry_after = max(1, math.ceil(error.retry_after))
+        return {
+            "statusCode": 429,
+            "headers": {**JSON_HEADERS, "Retry-After": str(retry_after)},
+            "body": json.dumps({
+                "success": False,
+                "error": "Too many requests. Please retry later.",
+                "reason": error.reason,
+                "retryAfter": retry_after
+            })
         }
 
-        # POSTリクエストを作成
-        req = urllib.request.Request(external_api_url, data=data, headers=headers, method='POST')
-
-        assistant_response = 'Error: Could not get response from external API.' # デフォルトのエラーメッセージ
-
-        try:
-            # リクエストを送信 (タイムアウトを60秒に設定)
-            with urllib.request.urlopen(req, timeout=60) as response:
-                if response.status == 200:
-                    response_body = response.read().decode('utf-8')
-                    response_data = json.loads(response_body)
-                    print("External API response:", json.dumps(response_data))
-                    assistant_response = response_data.get('generated_text', 'No response text found in API result')
-                    if not assistant_response:
-                        assistant_response = 'Received empty response from external API'
-                else:
-                    print(f"Error: External API returned status code {response.status}")
-                    # エラーレスポンスのボディを読み取る試み
-                    try:
-                        error_body = response.read().decode('utf-8')
-                        print(f"Error body: {error_body}")
-                        assistant_response = f"Error: API returned status {response.status}. Body: {error_body[:200]}" # エラー内容を一部含める
-                    except Exception as read_err:
-                        print(f"Could not read error body: {read_err}")
-                        assistant_response = f"Error: API returned status {response.status}"
-
-        except socket.timeout:
-            print(f"Error: Request to {external_api_url} timed out.")
-            assistant_response = "Error: External API request timed out."
-            # タイムアウトの場合もエラーとして処理を続けるか、例外を再発生させるか選択
-            # raise Exception("External API request timed out.") # ここで処理を中断する場合
-        except urllib.error.HTTPError as e:
-            # HTTPエラー (4xx, 5xx)
-            print(f"Error calling external API (HTTPError): {e.code} {e.reason}")
-            try:
-                error_body = e.read().decode('utf-8')
-                print(f"Error body: {error_body}")
-                assistant_response = f"Error: API returned status {e.code}. Body: {error_body[:200]}"
-            except Exception as read_err:
-                print(f"Could not read error body: {read_err}")
-                assistant_response = f"Error: API returned status {e.code} {e.reason}"
-            # raise Exception(f"Failed to call external API: {e}") # ここで処理を中断する場合
-        except urllib.error.URLError as e:
-            # URL関連のエラー (接続不可など)
-            print(f"Error calling external API (URLError): {e.reason}")
-            assistant_response = f"Error: Could not connect to external API. Reason: {e.reason}"
-            # raise Exception(f"Failed to call external API: {e}") # ここで処理を中断する場合
-        except json.JSONDecodeError as e:
-            print(f"Error decoding JSON response from external API: {e}")
-            assistant_response = "Error: Could not decode the response from the external API."
-            # raise Exception("Failed to decode external API response.") # ここで処理を中断する場合
-        except Exception as e: # その他の予期せぬエラー
-             print(f"An unexpected error occurred during API call: {e}")
-             assistant_response = f"An unexpected error occurred: {e}"
-             # raise # 予期せぬエラーは再発生させるのが良い場合も
-
-        # --- 外部API呼び出しここまで ---
+    except GenerationOptionsError as error:
+        log.warning("Invalid generation options", error=str(error))
+        return {
+            "statusCode": 400,
+            "headers": JSON_HEADERS,
+            "body": json.dumps({
+                "success": False,
+                "error": str(error)
+            })
+        }
 
-        messages.append({
-            "role": "assistant",
-            "content": assistant_response
-        })
+    except CircuitOpenError as error:
+        # バックエンド停止中はタイムアウトまで待たずに即座に 503 を返す
+        log.warning("Circuit open, failing fast", error=str(error), breakers=breaker_metrics())
+        retry_after = max(1, round(error.retry_after))
+        return {
+            "statusCode": 503,
+            "headers": {**JSON_HEADERS, "Retry-After": str(retry_after)},
+            "body": json.dumps({
+                "success": False,
+                "error": "The model backend is currently unavailable. Please retry later.",
+                "retryAfter": retry_after
+            })
+        }
 
+    except DeadlineExceeded as error:
+        # Lambda に強制終了される前に、タイムアウトしたことをクライアントに返す
+        log.error("Deadline exceeded", error=str(error), retry_budget=retry_budget.stats())
         return {
-            "statusCode": 200, # エラーが発生してもAPI Gatewayには200を返し、エラー内容はbodyに含める
-            "headers": {
-                "Content-Type": "application/json",
-                "Access-Control-Allow-Origin": "*",
-                "Access-Control-Allow-Headers": "Content-Type,X-Amz-Date,Authorization,X-Api-Key,X-Amz-Security-Token",
-                "Access-Control-Allow-Methods": "OPTIONS,POST"
-            },
+            "statusCode": 504,
+            "headers": JSON_HEADERS,
             "body": json.dumps({
-                "success": True, # Lambda関数自体の実行は成功したとみなす
-                "response": assistant_response,
-                "conversationHistory": messages
+                "success": False,
+                "error": "The model did not respond in time. Please retry."
             })
         }
 
     except Exception as error:
         # Lambdaハンドラ自体の大きなエラー (ボディのパース失敗など)
-        print("Lambda Handler Error:", str(error))
+        log.exception("Lambda Handler Error", error=str(error))
         return {
             "statusCode": 500,
-            "headers": {
-                "Content-Type": "application/json",
-                "Access-Control-Allow-Origin": "*",
-                "Access-Control-Allow-Headers": "Content-Type,X-Amz-Date,Authorization,X-Api-Key,X-Amz-Security-Token",
-                "Access-Control-Allow-Methods": "OPTIONS,POST"
-            },
+            "headers": JSON_HEADERS,
             "body": json.dumps({
                 "success": False,
                 "error": f"Lambda handler failed: {str(error)}"
             })
         }
 
+    finally:
+        if admission_lease is not None:
+            admission.release(username, admission_lease)
+        metrics.record("total", (time.perf_counter() - handler_started) * 1000)
+        metrics.end()
+        # 応答を返すとプロセスが凍結されるので、このリクエストのログを書き出しておく
+        log.flush()
+
         
 # import requests # urllib.request の代わりに requests をインポート
 # import json
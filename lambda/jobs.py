@@ -0,0 +1,413 @@
+# lambda/jobs.py
+# 非同期ジョブモード: /chat はリクエストをキューに入れて 202 とジョブ ID をすぐに返し、
+# ワーカーが生成した途中経過と結果をジョブストアに保存する (クライアントはジョブ ID でポーリングする)
+import json
+import queue
+import threading
+import time
+
+QUEUED = "queued"
+RUNNING = "running"
+SUCCEEDED = "succeeded"
+FAILED = "failed"
+FINISHED = (SUCCEEDED, FAILED)
+
+
+class JobResultTooLarge(ValueError):
+    """ジョブの結果がジョブストアに保存できる大きさを超えていることを表します。"""
+
+
+def _new_job(job_id, owner, now, ttl):
+    return {
+        "jobId": job_id, "owner": owner, "status": QUEUED, "partial": "", "statusCode": None, "result": None,
+        "attempts": 0, "createdAt": now, "updatedAt": now, "expiresAt": now + ttl,
+    }
+
+
+class MemoryJobQueue:
+    """プロセス内のキュー (ローカル開発・テスト用。ワーカーは同じプロセスのスレッドで動かす)。"""
+
+    def __init__(self):
+        self._queue = queue.Queue()
+
+    def send(self, message):
+        self._queue.put(json.dumps(message))
+
+    def receive(self, max_messages=1, wait_seconds=1.0):
+        """(受信ハンドル, メッセージ) のリストを返します。メモリ上のキューは受信した時点で取り除きます。"""
+        try:
+            messages = [self._queue.get(timeout=wait_seconds)]
+        except queue.Empty:
+            return []
+        while len(messages) < max_messages:
+            try:
+                messages.append(self._queue.get_nowait())
+            except queue.Empty:
+                break
+        return [(None, json.loads(m)) for m in messages]
+
+    def delete(self, handle):
+        pass
+
+
+class SQLiteJobQueue:
+    """
+    ローカル SQLite のキュー (テスト・単一ホスト用)。複数のワーカープロセスから受信できます。
+
+    受信したメッセージは visibility_timeout 秒の間ほかのワーカーから見えなくなり、
+    その間に delete() されなければ (ワーカーが落ちた場合など) 再び受信されます。
+
+    Args:
+        path (str): SQLite ファイルのパス。
+        visibility_timeout (float): 受信したメッセージを隠しておく時間 (秒)。
+    """
+
+    def __init__(self, path, visibility_timeout=300.0):
+        import sqlite3  # 使う場合のみ読み込む (コールドスタート短縮)
+        self._conn = sqlite3.connect(path, check_same_thread=False, isolation_level=None, timeout=5.0)
+        self._conn.execute("PRAGMA journal_mode=WAL")
+        self._conn.execute(
+            "CREATE TABLE IF NOT EXISTS job_queue ("
+            "id INTEGER PRIMARY KEY AUTOINCREMENT, body TEXT NOT NULL, visible_at REAL NOT NULL)"
+        )
+        self._lock = threading.Lock()
+        self.visibility_timeout = visibility_timeout
+
+    def send(self, message):
+        with self._lock:
+            self._conn.execute("INSERT INTO job_queue (body, visible_at) VALUES (?, ?)",
+                               (json.dumps(message), time.time()))
+
+    def _claim(self, max_messages):
+        now = time.time()
+        with self._lock:
+            self._conn.execute("BEGIN IMMEDIATE")
+            try:
+                rows = self._conn.execute(
+                    "SELECT id, body FROM job_queue WHERE visible_at <= ? ORDER BY id LIMIT ?", (now, max_messages)
+                ).fetchall()
+                self._conn.executemany("UPDATE job_queue SET visible_at = ? WHERE id = ?",
+                                       [(now + self.visibility_timeout, row_id) for row_id, _ in rows])
+                self._conn.execute("COMMIT")
+            except BaseException:
+                self._conn.execute("ROLLBACK")
+                raise
+        return [(row_id, json.loads(body)) for row_id, body in rows]
+
+    def receive(self, max_messages=1, wait_seconds=1.0, poll_interval=0.05):
+        deadline = time.monotonic() + wait_seconds
+        while True:
+            messages = self._claim(max_messages)
+            if messages or time.monotonic() >= deadline:
+                return messages
+            time.sleep(poll_interval)
+
+    def delete(self, handle):
+        with self._lock:
+            self._conn.execute("DELETE FROM job_queue WHERE id = ?", (handle,))
+
+
+class SQSJobQueue:
+    """
+    Amazon SQS のキュー (本番用)。Lambda ではイベントソースマッピングがワーカーを起動するので、
+    ここでは主に send() を使います (receive() はローカルのワーカーから SQS を読む場合用)。
+
+    Args:
+        queue_url (str): キューの URL。
+    """
+
+    def __init__(self, queue_url, region_name=None):
+        import boto3  # 使う場合のみ読み込む
+        self._client = boto3.client('sqs', region_name=region_name)
+        self.queue_url = queue_url
+
+    def send(self, message):
+        self._client.send_message(QueueUrl=self.queue_url, MessageBody=json.dumps(message))
+
+    def receive(self, max_messages=1, wait_seconds=1.0):
+        result = self._client.receive_message(QueueUrl=self.queue_url, MaxNumberOfMessages=min(10, max_messages),
+                                              WaitTimeSeconds=int(wait_seconds))
+        return [(m["ReceiptHandle"], json.loads(m["Body"])) for m in result.get("Messages", [])]
+
+    def delete(self, handle):
+        self._client.delete_message(QueueUrl=self.queue_url, ReceiptHandle=handle)
+
+
+class MemoryJobStore:
+    """プロセス内の辞書に保持するジョブストア (ローカル開発・テスト用)。"""
+
+    def __init__(self, ttl=86400.0):
+        self.ttl = ttl
+        self._jobs = {}
+        self._lock = threading.Lock()
+
+    def create(self, job_id, owner):
+        now = time.time()
+        with self._lock:
+            # 期限切れのジョブは作成時にまとめて消す
+            for key in [k for k, job in self._jobs.items() if job["expiresAt"] <= now]:
+                del self._jobs[key]
+            self._jobs[job_id] = _new_job(job_id, owner, now, self.ttl)
+
+    def get(self, job_id):
+        with self._lock:
+            job = self._jobs.get(job_id)
+            return dict(job) if job is not None and job["expiresAt"] > time.time() else None
+
+    def start(self, job_id):
+        """
+        ジョブを実行中にします。キューは同じメッセージを複数回届けることがあるので、
+        終了済み (または存在しない) ジョブなら False を返し、呼び出し側は実行しません。
+        """
+        with self._lock:
+            job = self._jobs.get(job_id)
+            if job is None or job["status"] in FINISHED:
+                return False
+            job.update(status=RUNNING, attempts=job["attempts"] + 1, updatedAt=time.time())
+            return True
+
+    def update_partial(self, job_id, text):
+        with self._lock:
+            job = self._jobs.get(job_id)
+            if job is not None and job["status"] == RUNNING:
+                job.update(partial=text, updatedAt=time.time())
+
+    def finish(self, job_id, status, status_code, result):
+        with self._lock:
+            job = self._jobs.get(job_id)
+            if job is not None:
+                job.update(status=status, statusCode=status_code, result=result, updatedAt=time.time())
+
+
+class SQLiteJobStore:
+    """
+    ローカル SQLite に保持するジョブストア (テスト・単一ホスト用)。
+
+    Args:
+        path (str): SQLite ファイルのパス。
+        ttl (float): ジョブを保持する期間 (秒)。
+    """
+
+    _COLUMNS = ("jobId", "owner", "status", "partial", "statusCode", "result", "attempts",
+                "createdAt", "updatedAt", "expiresAt")
+
+    def __init__(self, path, ttl=86400.0):
+        import sqlite3  # 使う場合のみ読み込む (コールドスタート短縮)
+        self._conn = sqlite3.connect(path, check_same_thread=False, isolation_level=None, timeout=5.0)
+        self._conn.execute("PRAGMA journal_mode=WAL")
+        self._conn.execute(
+            "CREATE TABLE IF NOT EXISTS jobs ("
+            "jobId TEXT PRIMARY KEY, owner TEXT NOT NULL, status TEXT NOT NULL, partial TEXT NOT NULL, "
+            "statusCode INTEGER, result TEXT, attempts INTEGER NOT NULL, "
+            "createdAt REAL NOT NULL, updatedAt REAL NOT NULL, expiresAt REAL NOT NULL)"
+        )
+        self._lock = threading.Lock()
+        self.ttl = ttl
+
+    def create(self, job_id, owner):
+        job = _new_job(job_id, owner, time.time(), self.ttl)
+        with self._lock:
+            self._conn.execute("DELETE FROM jobs WHERE expiresAt <= ?", (job["createdAt"],))
+            self._conn.execute(f"INSERT INTO jobs VALUES ({', '.join('?' * len(self._COLUMNS))})",
+                               tuple(job[c] for c in self._COLUMNS))
+
+    def get(self, job_id):
+        with self._lock:
+            row = self._conn.execute(f"SELECT {', '.join(self._COLUMNS)} FROM jobs WHERE jobId = ? AND expiresAt > ?",
+                                     (job_id, time.time())).fetchone()
+        return dict(zip(self._COLUMNS, row)) if row else None
+
+    def start(self, job_id):
+        with self._lock:
+            cursor = self._conn.execute(
+                "UPDATE jobs SET status = ?, attempts = attempts + 1, updatedAt = ? "
+                "WHERE jobId = ? AND status NOT IN (?, ?)", (RUNNING, time.time(), job_id, *FINISHED))
+        return cursor.rowcount == 1
+
+    def update_partial(self, job_id, text):
+        with self._lock:
+            self._conn.execute("UPDATE jobs SET partial = ?, updatedAt = ? WHERE jobId = ? AND status = ?",
+                               (text, time.time(), job_id, RUNNING))
+
+    def finish(self, job_id, status, status_code, result):
+        with self._lock:
+            self._conn.execute("UPDATE jobs SET status = ?, statusCode = ?, result = ?, updatedAt = ? WHERE jobId = ?",
+                               (status, status_code, result, time.time(), job_id))
+
+
+def _truncate_utf8(text, max_bytes):
+    # UTF-8 で max_bytes 以下になるよう末尾を切る (文字の途中では切らない)
+    data = text.encode('utf-8')
+    return text if len(data) <= max_bytes else data[:max_bytes].decode('utf-8', 'ignore')
+
+
+class DynamoDBJobStore:
+    """
+    DynamoDB に保持するジョブストア (本番用)。
+
+    パーティションキー jobId (S) のテーブルを想定し、expiresAt 属性を TTL に使います。
+    DynamoDB の項目は 400KB までなので、途中経過は max_partial_bytes で切り、max_result_bytes を超える結果は
+    S3 の result_bucket (jobs/<ジョブ ID>.json) に保存して項目にはキー (resultKey) だけを置きます。
+
+    Args:
+        table_name (str): テーブル名。
+        ttl (float): ジョブを保持する期間 (秒)。
+        result_bucket (str): 大きな結果を保存する S3 バケット (None なら大きな結果は JobResultTooLarge)。
+        max_result_bytes (int): 項目に直接保存する結果の最大バイト数。
+        max_partial_bytes (int): 項目に保存する途中経過の最大バイト数。
+    """
+
+    def __init__(self, table_name, ttl=86400.0, region_name=None, result_bucket=None, max_result_bytes=256 * 1024,
+                 max_partial_bytes=96 * 1024):
+        import boto3  # 使う場合のみ読み込む
+        from botocore.exceptions import ClientError
+        self._table = boto3.resource('dynamodb', region_name=region_name).Table(table_name)
+        self._s3 = boto3.client('s3', region_name=region_name) if result_bucket else None
+        self._client_error = ClientError
+        self.ttl = ttl
+        self.result_bucket = result_bucket
+        self.max_result_bytes = max_result_bytes
+        self.max_partial_bytes = max_partial_bytes
+
+    def create(self, job_id, owner):
+        job = _new_job(job_id, owner, time.time(), self.ttl)
+        # DynamoDB の数値は Decimal で返るので、時刻は整数 (TTL も秒単位の整数が必要) で保存する
+        job.update(createdAt=int(job["createdAt"]), updatedAt=int(job["updatedAt"]), expiresAt=int(job["expiresAt"]))
+        self._table.put_item(Item={k: v for k, v in job.items() if v is not None})
+
+    def get(self, job_id):
+        item = self._table.get_item(Key={"jobId": job_id}, ConsistentRead=True).get("Item")
+        if item is None or int(item["expiresAt"]) <= time.time():
+            return None
+        job = {key: None for key in ("statusCode", "result")}
+        job.update(item)
+        for key in ("statusCode", "attempts", "createdAt", "updatedAt", "expiresAt"):
+            if job[key] is not None:
+                job[key] = int(job[key])
+        result_key = job.pop("resultKey", None)
+        if result_key is not None:
+            job["result"] = self._s3.get_object(Bucket=self.result_bucket, Key=result_key)["Body"].read().decode('utf-8')
+        return job
+
+    def _update(self, job_id, expression, values, condition, names=None):
+        try:
+            self._table.update_item(
+                Key={"jobId": job_id},
+                UpdateExpression=expression,
+                ConditionExpression=condition,
+                ExpressionAttributeNames={"#s": "status", **(names or {})},
+                ExpressionAttributeValues={":now": int(time.time()), **values},
+            )
+            return True
+        except self._client_error as e:
+            if e.response["Error"]["Code"] != "ConditionalCheckFailedException":
+                raise
+            return False
+
+    def start(self, job_id):
+        return self._update(job_id, "SET #s = :running, attempts = attempts + :one, updatedAt = :now",
+                            {":running": RUNNING, ":one": 1, ":succeeded": SUCCEEDED, ":failed": FAILED},
+                            "attribute_exists(jobId) AND NOT #s IN (:succeeded, :failed)")
+
+    def update_partial(self, job_id, text):
+        # 上限を超えた途中経過は書き足さない (完了後の結果には全体が入る)。"partial" も予約語なのでプレースホルダを使う
+        self._update(job_id, "SET #p = :partial, updatedAt = :now",
+                     {":partial": _truncate_utf8(text, self.max_partial_bytes), ":running": RUNNING}, "#s = :running",
+                     names={"#p": "partial"})
+
+    def finish(self, job_id, status, status_code, result):
+        """
+        Raises:
+            JobResultTooLarge: 結果が max_result_bytes を超え、result_bucket が設定されていない場合。
+        """
+        size = len(result.encode('utf-8'))
+        if size <= self.max_result_bytes:
+            self._update(job_id, "SET #s = :status, statusCode = :code, #r = :result, updatedAt = :now",
+                         {":status": status, ":code": status_code, ":result": result}, "attribute_exists(jobId)",
+                         # "result" は DynamoDB の予約語なので名前のプレースホルダを使う
+                         names={"#r": "result"})
+            return
+        if self.result_bucket is None:
+            raise JobResultTooLarge(f"Job result is {size} bytes (limit {self.max_result_bytes}); set JOB_RESULT_BUCKET")
+        result_key = f"jobs/{job_id}.json"
+        self._s3.put_object(Bucket=self.result_bucket, Key=result_key, Body=result.encode('utf-8'),
+                            ContentType="application/json")
+        self._update(job_id, "SET #s = :status, statusCode = :code, resultKey = :key, updatedAt = :now",
+                     {":status": status, ":code": status_code, ":key": result_key}, "attribute_exists(jobId)")
+
+
+class PartialWriter:
+    """
+    生成中のトークンを受け取り、interval 秒ごとにそれまでのテキスト全体を sink に書き出します
+    (トークンごとにストアへ書き込まない)。
+
+    Args:
+        sink (callable): それまでに生成されたテキストを受け取る関数。
+        interval (float): 書き出す間隔 (秒)。
+    """
+
+    def __init__(self, sink, interval=1.0):
+        self._sink = sink
+        self.interval = interval
+        self._chunks = []
+        self._last = time.monotonic()
+        self.writes = 0
+
+    def add(self, token):
+        self._chunks.append(token)
+        now = time.monotonic()
+        if now - self._last >= self.interval:
+            self._last = now
+            self.writes += 1
+            self._sink("".join(self._chunks))
+
+
+def run_worker(job_queue, process, stop_event, batch_size=1, wait_seconds=1.0):
+    """
+    stop_event がセットされるまでキューからジョブを受信して process(message) を呼び出します
+    (ローカルのワーカースレッド用。Lambda では worker_handler が SQS のレコードを受け取る)。
+
+    process が例外を送出したメッセージは削除しないので、キューの再送に任せます。
+    """
+    while not stop_event.is_set():
+        for handle, message in job_queue.receive(batch_size, wait_seconds):
+            try:
+                process(message)
+            except Exception:
+                continue
+            job_queue.delete(handle)
+
+
+def create_job_queue(kind, **options):
+    """
+    環境変数の値からキューを作ります。
+
+    Args:
+        kind (str): "memory" / "sqlite" / "sqs"。
+        options: sqlite の path / visibility_timeout、sqs の queue_url。
+    """
+    if kind == "memory":
+        return MemoryJobQueue()
+    if kind == "sqlite":
+        return SQLiteJobQueue(options["path"], visibility_timeout=options.get("visibility_timeout", 300.0))
+    if kind == "sqs":
+        return SQSJobQueue(options["queue_url"])
+    raise ValueError(f"Unknown job queue: {kind}")
+
+
+def create_job_store(kind, **options):
+    """
+    環境変数の値からジョブストアを作ります。
+
+    Args:
+        kind (str): "memory" / "sqlite" / "dynamodb"。
+        options: ttl、sqlite の path、dynamodb の table_name / result_bucket。
+    """
+    ttl = options.get("ttl", 86400.0)
+    if kind == "memory":
+        return MemoryJobStore(ttl)
+    if kind == "sqlite":
+        return SQLiteJobStore(options["path"], ttl)
+    if kind == "dynamodb":
+        return DynamoDBJobStore(options["table_name"], ttl, result_bucket=options.get("result_bucket"))
+    raise ValueError(f"Unknown job store: {kind}")
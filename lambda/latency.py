@@ -0,0 +1,36 @@
+# lambda/latency.py
+# レイテンシのヒストグラム (asyncio などを読み込まずに使えるよう独立させている)
+import bisect
+import collections
+
+# レイテンシヒストグラムのバケット境界 (ミリ秒)
+BUCKETS_MS = (5, 10, 25, 50, 100, 250, 500, 1000, 2500, 5000, 10000, 30000, 60000)
+
+
+class LatencyHistogram:
+    """固定バケットのヒストグラムと、分位点計算用の直近サンプルを保持します。"""
+
+    def __init__(self, window=256):
+        self.counts = [0] * (len(BUCKETS_MS) + 1)
+        self.recent = collections.deque(maxlen=window)
+        self.total = 0
+
+    def observe(self, ms):
+        self.counts[bisect.bisect_left(BUCKETS_MS, ms)] += 1
+        self.recent.append(ms)
+        self.total += 1
+
+    def quantile(self, q):
+        if not self.recent:
+            return None
+        ordered = sorted(self.recent)
+        return ordered[min(len(ordered) - 1, int(q * len(ordered)))]
+
+    def snapshot(self):
+        labels = [f"le_{b}" for b in BUCKETS_MS] + ["le_inf"]
+        return {
+            "count": self.total,
+            "buckets": dict(zip(labels, self.counts)),
+            "p50_ms": self.quantile(0.5),
+            "p95_ms": self.quantile(0.95),
+        }
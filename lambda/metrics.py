@@ -0,0 +1,276 @@
+# lambda/metrics.py
+# リクエストの処理段階 (フェーズ) ごとの所要時間を計測し、CloudWatch Embedded Metric Format (EMF) で出力する
+import contextvars
+import json
+import math
+import sys
+import threading
+import time
+
+# 計測するフェーズ (index.py の lambda_handler で計測する順)
+PHASES = (
+    "body_parse",        # リクエストボディの JSON デコード
+    "history_copy",      # 会話履歴のコピーと新しいメッセージの追加
+    "history_build",     # 会話履歴のコンパクションとプロンプトの組み立て (HISTORY_TOKEN_BUDGET 指定時)
+    "semantic_lookup",   # 意味キャッシュの埋め込みと近傍検索 (SEMANTIC_CACHE_ENABLED 時)
+    "admission",         # ユーザーごとのレート制限・受け入れ判定 (飽和中の待ち時間を含む)
+    "job_enqueue",       # 非同期ジョブの作成とキューへの送信 ("async": true のリクエスト)
+    "payload_encode",    # /generate に送るペイロードの JSON エンコード
+    "upstream_connect",  # 推論サーバーへの接続 (再利用時は 0)
+    "upstream_ttfb",     # リクエスト送信からステータス行の受信まで
+    "body_read",         # レスポンスボディの読み取り
+    "json_decode",       # レスポンスボディの JSON デコード
+    "bedrock_call",      # Bedrock の呼び出し (MODEL_PROVIDER=bedrock。ストリーミングでは最初のイベントを受け取るまで)
+    "response_encode",   # クライアントに返すボディの JSON エンコード
+    "response_compress", # 応答ボディの圧縮と base64 エンコード (Accept-Encoding で gzip / br を受け付ける場合)
+    "total",             # ハンドラー全体
+)
+
+# 集約ヒストグラムの対数バケット (0.01ms〜約 100 秒を 1.2 倍刻みで、EMF の上限 100 値に収まる 89 バケット)
+_MIN_MS = 0.01
+_RATIO = 1.2
+_LOG_RATIO = math.log(_RATIO)
+_MAX_BUCKET = 88
+
+
+class _NullSpan:
+    # 計測が無効な場合に返す、何もしないコンテキストマネージャー (毎回生成しない)
+    __slots__ = ()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc, tb):
+        return False
+
+
+NULL_SPAN = _NullSpan()
+
+
+class _Span:
+    __slots__ = ("_metrics", "_name", "_start")
+
+    def __init__(self, metrics, name):
+        self._metrics = metrics
+        self._name = name
+
+    def __enter__(self):
+        self._start = time.perf_counter()
+        return self
+
+    def __exit__(self, exc_type, exc, tb):
+        self._metrics.record(self._name, (time.perf_counter() - self._start) * 1000)
+        return False
+
+
+class PhaseHistogram:
+    """
+    EMF の Values / Counts 形式で出力するための集約ヒストグラム。
+
+    値は対数バケットの代表値 (幾何平均) に丸めて数えるので、相対誤差は約 ±10% です。
+    Min / Max / Sum は丸める前の値で保持します。
+    """
+
+    def __init__(self):
+        self.counts = {}
+        self.count = 0
+        self.sum = 0.0
+        self.min = math.inf
+        self.max = 0.0
+
+    def observe(self, ms):
+        bucket = 0 if ms <= _MIN_MS else min(_MAX_BUCKET, int(math.log(ms / _MIN_MS) / _LOG_RATIO))
+        self.counts[bucket] = self.counts.get(bucket, 0) + 1
+        self.count += 1
+        self.sum += ms
+        if ms < self.min:
+            self.min = ms
+        if ms > self.max:
+            self.max = ms
+
+    def to_emf(self):
+        buckets = sorted(self.counts)
+        return {
+            "Values": [round(_MIN_MS * _RATIO ** (b + 0.5), 3) for b in buckets],
+            "Counts": [self.counts[b] for b in buckets],
+            "Min": round(self.min, 3),
+            "Max": round(self.max, 3),
+            "Count": self.count,
+            "Sum": round(self.sum, 3),
+        }
+
+
+class StdoutSink:
+    """EMF のレコードを 1 行の JSON として標準出力に書き出します (CloudWatch Logs がメトリクスに変換する)。"""
+
+    def __init__(self, stream=None):
+        self.stream = stream or sys.stdout
+
+    def emit(self, record):
+        self.stream.write(json.dumps(record, separators=(",", ":")) + "\n")
+        self.stream.flush()
+
+
+class MemorySink:
+    """出力した EMF のレコードをメモリに保持します (ローカルでの確認やベンチマーク用)。"""
+
+    def __init__(self):
+        self.records = []
+
+    def emit(self, record):
+        self.records.append(record)
+
+
+class Instrumentation:
+    """
+    フェーズごとの所要時間をリクエスト単位で記録し、ヒストグラムに集約して定期的に EMF で出力します。
+
+    無効な場合、span() は共有の何もしないコンテキストマネージャーを返し、record() / end() もすぐに戻ります。
+    処理中のリクエストの記録はスレッド (contextvars のコンテキスト) ごとに持つので、非同期ジョブのローカルワーカーが
+    並行してリクエストを処理しても混ざりません。
+    count() / gauge() で記録した回数と最新値 (サーキットブレーカーの状態遷移と状態など) も、同じ間隔で
+    ディメンションの組ごとに 1 件の EMF レコードとして出力します。
+
+    Args:
+        namespace (str): CloudWatch メトリクスの名前空間。
+        sink: emit(record) を持つ出力先 (StdoutSink / MemorySink)。
+        enabled (bool): 計測するか。
+        flush_seconds (float): 集約したヒストグラムを出力する間隔 (秒)。0 ならリクエストごとに出力する。
+        dimensions (dict): すべてのメトリクスに付けるディメンション (例: {"FunctionName": ...})。
+    """
+
+    def __init__(self, namespace="SimpleChat", sink=None, enabled=True, flush_seconds=10.0, dimensions=None):
+        self.namespace = namespace
+        self.sink = sink if sink is not None else StdoutSink()
+        self.enabled = enabled
+        self.flush_seconds = flush_seconds
+        self.dimensions = dict(dimensions or {})
+        self._current = contextvars.ContextVar(f"metrics_current_{id(self)}", default=None)
+        self._lock = threading.Lock()
+        self._histograms = {}
+        self._series = {}  # 追加のディメンションの組 -> {メトリクス名: (値, 単位)}
+        self._last_flush = time.monotonic()
+
+    @property
+    def current(self):
+        """このスレッドで処理中のリクエストのフェーズごとの所要時間 (ミリ秒)。"""
+        current = self._current.get()
+        if current is None:
+            current = {}
+            self._current.set(current)
+        return current
+
+    def begin(self):
+        """リクエストの開始時に呼び出し、このスレッドの前のリクエストの記録を捨てます。"""
+        if self.enabled:
+            self._current.set({})
+
+    def span(self, name):
+        """with 文で囲んだ区間の所要時間を name のフェーズとして記録します。"""
+        if not self.enabled:
+            return NULL_SPAN
+        return _Span(self, name)
+
+    def record(self, name, ms):
+        """計測済みの所要時間 (ミリ秒) を記録します。同じリクエストで同じフェーズを複数回記録した場合は合計します。"""
+        if self.enabled:
+            current = self.current
+            current[name] = current.get(name, 0.0) + ms
+
+    def _series_for(self, dimensions):
+        key = tuple(sorted((dimensions or {}).items()))
+        series = self._series.get(key)
+        if series is None:
+            series = self._series[key] = {}
+        return series
+
+    def count(self, name, dimensions=None, value=1):
+        """
+        回数を加算します (次の flush() で出力するまで、同じディメンションの組ごとに合計する)。
+
+        Args:
+            name (str): メトリクス名。
+            dimensions (dict): このメトリクスに追加で付けるディメンション (例: {"Backend": ...})。
+            value (int): 加算する値。
+        """
+        if self.enabled:
+            with self._lock:
+                series = self._series_for(dimensions)
+                series[name] = (series.get(name, (0, None))[0] + value, "Count")
+
+    def gauge(self, name, value, dimensions=None):
+        """最新の値だけを出力するメトリクス (サーキットブレーカーの状態など) を記録します。"""
+        if self.enabled:
+            with self._lock:
+                self._series_for(dimensions)[name] = (value, "None")
+
+    def end(self):
+        """
+        リクエストの終了時に呼び出し、記録をヒストグラムに加えます。
+
+        Returns:
+            dict: このリクエストのフェーズごとの所要時間 (ミリ秒)。
+        """
+        if not self.enabled:
+            return {}
+        current = self.current
+        self._current.set({})
+        with self._lock:
+            for name, ms in current.items():
+                histogram = self._histograms.get(name)
+                if histogram is None:
+                    histogram = self._histograms[name] = PhaseHistogram()
+                histogram.observe(ms)
+            due = time.monotonic() - self._last_flush >= self.flush_seconds
+        if due:
+            self.flush()
+        return current
+
+    def flush(self):
+        """
+        集約したヒストグラムを 1 件の EMF レコードとして、count() / gauge() の値をディメンションの組ごとに
+        1 件ずつ出力し、集約をリセットします。
+        """
+        with self._lock:
+            self._last_flush = time.monotonic()
+            histograms, self._histograms = self._histograms, {}
+            series, self._series = self._series, {}
+        if histograms:
+            self.sink.emit(self._record(self.dimensions, {
+                f"{name}_ms": (histogram.to_emf(), "Milliseconds") for name, histogram in histograms.items()
+            }))
+        for key, values in series.items():
+            self.sink.emit(self._record({**self.dimensions, **dict(key)}, values))
+
+    def _record(self, dimensions, values):
+        # values: {メトリクス名: (値, 単位)}
+        record = {
+            "_aws": {
+                "Timestamp": int(time.time() * 1000),
+                "CloudWatchMetrics": [{
+                    "Namespace": self.namespace,
+                    "Dimensions": [sorted(dimensions)],
+                    "Metrics": [{"Name": name, "Unit": unit} for name, (_, unit) in values.items()],
+                }],
+            },
+            **dimensions,
+        }
+        for name, (value, _) in values.items():
+            record[name] = value
+        return record
+
+
+def create_instrumentation(sink_name="stdout", **options):
+    """
+    名前から出力先を選んで Instrumentation を作ります。
+
+    Args:
+        sink_name (str): "stdout" / "memory" / "none" ("none" の場合は計測しない)。
+    """
+    if sink_name == "none":
+        return Instrumentation(sink=MemorySink(), enabled=False, **options)
+    if sink_name == "memory":
+        return Instrumentation(sink=MemorySink(), **options)
+    if sink_name == "stdout":
+        return Instrumentation(sink=StdoutSink(), **options)
+    raise ValueError(f"Unknown metrics sink: {sink_name}")
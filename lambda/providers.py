@@ -0,0 +1,228 @@
+# lambda/providers.py
+# モデルプロバイダー: /chat の生成を HTTP の推論サーバー (/generate) と Amazon Bedrock のどちらで行うか
+#
+# HTTP の推論サーバーは index.py の call_generate / stream_chat (コネクションプール・複数バックエンド) が扱い、
+# Bedrock はこのモジュールの BedrockProvider が扱います。どちらも /generate 形式のペイロード
+# ({"prompt", "max_new_tokens", "temperature", "top_p", "do_sample", "stop"}) を受け取ります。
+import json
+import threading
+
+HTTP = "http"
+BEDROCK = "bedrock"
+
+# 時間をおいて再試行すれば成功しうる Bedrock のエラー (イベントストリーム中のエラーは先頭が小文字で届く)
+RETRYABLE_ERRORS = frozenset(code.lower() for code in (
+    "ThrottlingException", "ServiceUnavailableException", "InternalServerException",
+    "ModelNotReadyException", "ModelTimeoutException", "ModelStreamErrorException",
+))
+
+
+class ProviderError(Exception):
+    """
+    モデルプロバイダーの呼び出しの失敗を表します。
+
+    Args:
+        message (str): エラーの内容。
+        code (str): プロバイダーのエラーコード (例: "ThrottlingException")。
+        retryable (bool): 時間をおいて再試行してよいか (スロットリング・サーバー側のエラー・接続エラー)。
+        timeout (bool): タイムアウトによる失敗か。
+    """
+
+    def __init__(self, message, code=None, retryable=False, timeout=False):
+        super().__init__(message)
+        self.code = code
+        self.retryable = retryable
+        self.timeout = timeout
+
+
+def select_provider(kind, model_id=None, http_configured=False):
+    """
+    使うモデルプロバイダーを決めます。
+
+    Args:
+        kind (str): "http" / "bedrock" / "auto"。
+        model_id (str): MODEL_ID 環境変数の値。
+        http_configured (bool): NGROK_URL または BACKEND_URLS が設定されているか。
+
+    Returns:
+        str: "http" または "bedrock"。auto の場合、推論サーバーの URL が設定されていれば http、
+            そうでなく MODEL_ID が設定されていれば bedrock、どちらもなければ http。
+    """
+    if kind == "auto":
+        return BEDROCK if model_id and not http_configured else HTTP
+    if kind in (HTTP, BEDROCK):
+        return kind
+    raise ValueError(f"Unknown model provider: {kind}")
+
+
+# bedrock-runtime クライアントは作成 (エンドポイント解決・サービスモデルの読み込み) が重いので、
+# 設定ごとに 1 つだけ作り、ウォームスタートとスレッド (非同期ジョブのワーカー) の間で使い回す
+_clients = {}
+_clients_lock = threading.Lock()
+
+
+def bedrock_client(region_name=None, endpoint_url=None, max_pool_connections=10, connect_timeout=2.0,
+                   read_timeout=20.0, max_attempts=1):
+    """
+    モジュールレベルに保持した bedrock-runtime クライアントを返します (なければ作ります)。
+
+    Args:
+        region_name (str): リージョン (省略時は AWS_REGION)。
+        endpoint_url (str): エンドポイント (ローカルのスタブなど。省略時は AWS のエンドポイント)。
+        max_pool_connections (int): 接続プールの最大接続数 (同時に呼び出すスレッド数以上にする)。
+        connect_timeout (float): 接続のタイムアウト (秒)。
+        read_timeout (float): 読み取りのタイムアウト (秒)。非ストリーミングでは生成全体を待つ時間になる。
+        max_attempts (int): botocore 自身の試行回数 (再試行は呼び出し元の期限とリトライ予算で行うので既定は 1)。
+    """
+    key = (region_name, endpoint_url, max_pool_connections, connect_timeout, read_timeout, max_attempts)
+    with _clients_lock:
+        client = _clients.get(key)
+        if client is None:
+            import boto3  # 使う場合のみ読み込む
+            from botocore.config import Config
+            client = boto3.client('bedrock-runtime', region_name=region_name, endpoint_url=endpoint_url, config=Config(
+                max_pool_connections=max_pool_connections,
+                connect_timeout=connect_timeout,
+                read_timeout=read_timeout,
+                retries={"total_max_attempts": max_attempts, "mode": "standard"},
+                tcp_keepalive=True,
+            ))
+            _clients[key] = client
+    return client
+
+
+def bedrock_messages(payload):
+    """
+    ペイロードを Bedrock の messages 形式にします。
+
+    ペイロードに messages (会話履歴と新しいメッセージ) があればそれを、なければ prompt を 1 つのユーザーの
+    メッセージとして使います。Bedrock は user から始まり user / assistant が交互に並ぶことを求めるので、
+    先頭の assistant は除き、同じロールが続くメッセージは 1 つにまとめます。
+    """
+    source = payload.get("messages") or [{"role": "user", "content": payload.get("prompt", "")}]
+    messages = []
+    for message in source:
+        if not isinstance(message, dict):
+            continue
+        role, content = message.get("role"), message.get("content")
+        if role not in ("user", "assistant") or not isinstance(content, str) or not content:
+            continue
+        if not messages and role != "user":
+            continue
+        if messages and messages[-1]["role"] == role:
+            messages[-1]["content"][0]["text"] += "\n" + content
+        else:
+            messages.append({"role": role, "content": [{"text": content}]})
+    return messages
+
+
+class BedrockProvider:
+    """
+    Amazon Bedrock のモデルプロバイダー。
+
+    api="converse" は Converse / ConverseStream API を、api="invoke" は InvokeModel /
+    InvokeModelWithResponseStream API (Amazon Nova の messages 形式のボディ) を使います。
+
+    Args:
+        model_id (str): モデル ID (推論プロファイル ID も可)。
+        api (str): "converse" / "invoke"。
+        client: bedrock-runtime クライアント (省略時は bedrock_client() が保持するもの)。
+        max_temperature (float): temperature の上限 (Bedrock のモデルの多くは 0-1)。
+    """
+
+    name = BEDROCK
+
+    def __init__(self, model_id, api="converse", client=None, max_temperature=1.0):
+        if api not in ("converse", "invoke"):
+            raise ValueError(f"Unknown Bedrock API: {api}")
+        self.model_id = model_id
+        self.api = api
+        self.client = client if client is not None else bedrock_client()
+        self.max_temperature = max_temperature
+        from botocore.exceptions import BotoCoreError, ClientError, ConnectTimeoutError, ReadTimeoutError
+        self._client_error = ClientError
+        self._botocore_error = BotoCoreError
+        self._timeout_errors = (ConnectTimeoutError, ReadTimeoutError)
+
+    def inference_config(self, payload):
+        """生成パラメータを Bedrock の inferenceConfig にします (do_sample=false は temperature 0)。"""
+        config = {"maxTokens": int(payload.get("max_new_tokens", 512))}
+        if payload.get("do_sample", True):
+            config["temperature"] = min(float(payload.get("temperature", 0.7)), self.max_temperature)
+            config["topP"] = float(payload.get("top_p", 0.9))
+        else:
+            config["temperature"] = 0.0
+        if payload.get("stop"):
+            config["stopSequences"] = list(payload["stop"])
+        return config
+
+    def _error(self, error):
+        """botocore の例外を ProviderError にします。"""
+        if isinstance(error, self._client_error):
+            code = error.response.get("Error", {}).get("Code", "")
+            return ProviderError(str(error), code=code, retryable=code.lower() in RETRYABLE_ERRORS)
+        return ProviderError(str(error), code=type(error).__name__, retryable=True,
+                             timeout=isinstance(error, self._timeout_errors))
+
+    def _invoke_body(self, payload):
+        return json.dumps({"messages": bedrock_messages(payload), "inferenceConfig": self.inference_config(payload)})
+
+    def generate(self, payload):
+        """
+        応答全体を生成します。
+
+        Returns:
+            tuple: (応答テキスト, 生成トークン数)。
+
+        Raises:
+            ProviderError: Bedrock の呼び出しが失敗した場合。
+        """
+        try:
+            if self.api == "converse":
+                result = self.client.converse(modelId=self.model_id, messages=bedrock_messages(payload),
+                                              inferenceConfig=self.inference_config(payload))
+            else:
+                response = self.client.invoke_model(modelId=self.model_id, body=self._invoke_body(payload),
+                                                    contentType="application/json", accept="application/json")
+                result = json.loads(response["body"].read())
+        except (self._client_error, self._botocore_error) as e:
+            raise self._error(e) from e
+        content = ((result.get("output") or {}).get("message") or {}).get("content") or []
+        text = "".join(block.get("text", "") for block in content)
+        return text, (result.get("usage") or {}).get("outputTokens", 0)
+
+    def stream(self, payload):
+        """
+        トークン (テキスト断片) を生成順に返すイテレーターを返します。
+
+        Raises:
+            ProviderError: 呼び出し、またはストリームの途中で Bedrock がエラーを返した場合。
+        """
+        try:
+            if self.api == "converse":
+                response = self.client.converse_stream(modelId=self.model_id, messages=bedrock_messages(payload),
+                                                       inferenceConfig=self.inference_config(payload))
+                events = response["stream"]
+            else:
+                response = self.client.invoke_model_with_response_stream(
+                    modelId=self.model_id, body=self._invoke_body(payload),
+                    contentType="application/json", accept="application/json")
+                events = response["body"]
+        except (self._client_error, self._botocore_error) as e:
+            raise self._error(e) from e
+        return self._iter_text(events)
+
+    def _iter_text(self, events):
+        try:
+            for event in events:
+                if "chunk" in event:
+                    # InvokeModelWithResponseStream はモデル固有の JSON をチャンクのバイト列で返す
+                    event = json.loads(event["chunk"]["bytes"])
+                text = ((event.get("contentBlockDelta") or {}).get("delta") or {}).get("text")
+                if text:
+                    yield text
+        except (self._client_error, self._botocore_error) as e:
+            raise self._error(e) from e
+        finally:
+            # 期限で途中で打ち切った場合も、レスポンスを閉じて接続をプールに返す
+            events.close()
@@ -0,0 +1,185 @@
+# lambda/response_cache.py
+# 同一プロンプトに対する /generate の応答キャッシュ (プロセス内 LRU + 任意の共有ストア)
+import hashlib
+import json
+import threading
+import time
+import unicodedata
+from collections import OrderedDict
+
+from structured_log import log
+
+# キャッシュキーに含めるサンプリングパラメータ
+SAMPLING_KEYS = ("temperature", "top_p", "max_new_tokens", "do_sample", "stop")
+
+
+def normalize_prompt(text):
+    """全角/半角の揺れと前後・連続する空白を正規化します。"""
+    return " ".join(unicodedata.normalize('NFKC', text).split())
+
+
+def history_digest(history):
+    """会話履歴の内容から決定的なダイジェストを計算します。"""
+    canonical = json.dumps(history or [], sort_keys=True, ensure_ascii=False, separators=(',', ':'))
+    return hashlib.sha256(canonical.encode('utf-8')).hexdigest()
+
+
+def make_key(prompt, history, payload):
+    """
+    正規化したプロンプト、会話履歴のダイジェスト、サンプリングパラメータからキャッシュキーを作ります。
+
+    Args:
+        prompt (str): ユーザーのメッセージ。
+        history (list): 今回のメッセージより前の会話履歴。
+        payload (dict): /generate に送るペイロード。
+
+    Returns:
+        str: キャッシュキー (sha256 の16進文字列)。
+    """
+    params = {key: payload.get(key) for key in SAMPLING_KEYS}
+    material = json.dumps(
+        [normalize_prompt(prompt), history_digest(history), params],
+        sort_keys=True, ensure_ascii=False, separators=(',', ':'),
+    )
+    return hashlib.sha256(material.encode('utf-8')).hexdigest()
+
+
+class LRUCache:
+    """
+    TTL 付きのサイズ上限ありLRU。モジュールレベルで保持すればウォームスタート間で生き残ります。
+
+    Args:
+        max_entries (int): 保持するエントリ数の上限。
+        ttl (float): エントリの有効期間 (秒)。
+    """
+
+    def __init__(self, max_entries=256, ttl=300.0):
+        self.max_entries = max_entries
+        self.ttl = ttl
+        self._data = OrderedDict()
+        self._lock = threading.Lock()
+        self.evictions = 0
+        self.expirations = 0
+
+    def get(self, key):
+        with self._lock:
+            entry = self._data.get(key)
+            if entry is None:
+                return None
+            expires_at, value = entry
+            if expires_at < time.monotonic():
+                del self._data[key]
+                self.expirations += 1
+                return None
+            self._data.move_to_end(key)
+            return value
+
+    def set(self, key, value, ttl=None):
+        expires_at = time.monotonic() + (self.ttl if ttl is None else ttl)
+        with self._lock:
+            self._data[key] = (expires_at, value)
+            self._data.move_to_end(key)
+            while len(self._data) > self.max_entries:
+                self._data.popitem(last=False)
+                self.evictions += 1
+
+    def __len__(self):
+        return len(self._data)
+
+
+class SQLiteStore:
+    """
+    2段目の共有ストア (ローカル SQLite)。get/set を実装すれば DynamoDB などに差し替えられます。
+
+    Args:
+        path (str): SQLite ファイルのパス (Lambda では /tmp 配下)。
+    """
+
+    def __init__(self, path):
+        import sqlite3  # 使う場合のみ読み込む (コールドスタート短縮)
+        self._conn = sqlite3.connect(path, check_same_thread=False, isolation_level=None)
+        self._conn.execute("PRAGMA journal_mode=WAL")
+        self._conn.execute(
+            "CREATE TABLE IF NOT EXISTS response_cache ("
+            "key TEXT PRIMARY KEY, value TEXT NOT NULL, expires_at REAL NOT NULL)"
+        )
+        self._lock = threading.Lock()
+
+    def get(self, key):
+        with self._lock:
+            row = self._conn.execute(
+                "SELECT value, expires_at FROM response_cache WHERE key = ?", (key,)
+            ).fetchone()
+        if row is None or row[1] < time.time():
+            return None
+        return row[0]
+
+    def set(self, key, value, ttl):
+        now = time.time()
+        with self._lock:
+            self._conn.execute(
+                "INSERT OR REPLACE INTO response_cache (key, value, expires_at) VALUES (?, ?, ?)",
+                (key, value, now + ttl),
+            )
+            self._conn.execute("DELETE FROM response_cache WHERE expires_at < ?", (now,))
+
+
+class ResponseCache:
+    """
+    LRU (1段目) と任意の共有ストア (2段目) を組み合わせた応答キャッシュ。
+
+    do_sample=False の決定的なリクエストは常にキャッシュ対象です。
+    サンプリングするリクエストは cache_sampled=True の場合のみキャッシュします。
+
+    Args:
+        lru (LRUCache): プロセス内キャッシュ。
+        store: get(key) / set(key, value, ttl) を持つ共有ストア。None なら1段のみ。
+        cache_sampled (bool): do_sample=True のリクエストもキャッシュするか。
+    """
+
+    def __init__(self, lru, store=None, cache_sampled=False):
+        self.lru = lru
+        self.store = store
+        self.cache_sampled = cache_sampled
+        self.hits = 0
+        self.store_hits = 0
+        self.misses = 0
+
+    def is_cacheable(self, payload):
+        return not payload.get("do_sample", True) or self.cache_sampled
+
+    def get(self, key):
+        value = self.lru.get(key)
+        if value is not None:
+            self.hits += 1
+            return value
+        if self.store is not None:
+            try:
+                value = self.store.get(key)
+            except Exception as e:
+                log.warning("Response cache store read failed", error=str(e))
+                value = None
+            if value is not None:
+                self.store_hits += 1
+                self.lru.set(key, value)
+                return value
+        self.misses += 1
+        return None
+
+    def set(self, key, value):
+        self.lru.set(key, value)
+        if self.store is not None:
+            try:
+                self.store.set(key, value, self.lru.ttl)
+            except Exception as e:
+                log.warning("Response cache store write failed", error=str(e))
+
+    def stats(self):
+        return {
+            "hits": self.hits,
+            "store_hits": self.store_hits,
+            "misses": self.misses,
+            "evictions": self.lru.evictions,
+            "expirations": self.lru.expirations,
+            "size": len(self.lru),
+        }
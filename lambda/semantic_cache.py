@@ -0,0 +1,380 @@
+# lambda/semantic_cache.py
+# 言い換えられた質問 (「パスワードをリセットする方法」と「パスワードのリセット方法は?」など) にも以前の応答を返す意味キャッシュ
+#
+# プロンプトを埋め込みベクトルに変換し、NumPy の行列に保持した過去のプロンプトとのコサイン類似度が
+# しきい値以上なら、その応答を返します。行列はメモリマップしたファイルに置くので、
+# プロセスを起動し直してもファイルを読み込み直す (パースする) ことなく、そのまま検索できます。
+import hashlib
+import importlib
+import json
+import math
+import os
+import re
+import threading
+import time
+import zlib
+
+from response_cache import SAMPLING_KEYS, history_digest, normalize_prompt
+
+# 英語の機能語 (疑問詞は意味を変えるので含めない)
+_STOPWORDS = frozenset(
+    "a an the i me my we our you your it its is are am was were be been do does did to of in on at for with "
+    "and or can could would should will please this that there".split()
+)
+# 日本語の依頼・疑問の定型表現 (「〜する方法」「〜するには」など、言い換えで付いたり付かなかったりする)
+_FILLER_RE = re.compile(r"教えて(ください|下さい)?|ください|お願いします|(する)?方法|するには|どう|でしょうか|ですか")
+# 英数字の単語 / カタカナ / 漢字 / ひらがなの連続ごとに区切る
+_RUN_RE = re.compile(r"[a-z0-9]+|[\u30a0-\u30ff]+|[\u3400-\u4dbf\u4e00-\u9fff\uf900-\ufaff\u3005]+|[\u3040-\u309f]+")
+# conflict_terms() 用 (英字の大文字・小文字を区別して区切る)
+_TERM_RE = re.compile(r"[A-Za-z0-9]+|[\u30a0-\u30ff]+|[\u3400-\u4dbf\u4e00-\u9fff\uf900-\ufaff\u3005]+|[\u3040-\u309f]+")
+# 否定 ("don't" などは "don" と "t" に分かれるので、"t" を否定として扱う)
+_NEGATIONS = frozenset("not no never nor cannot without t".split())
+_JA_NEGATION_RE = re.compile(r"ない|なかっ|ません")
+# 片方をもう片方に置き換えると意味が逆になる語 (語幹で比較する)
+_ANTONYMS = frozenset(
+    "ascend descend increas decreas enabl disabl add remov min max minimum maximum encrypt decrypt upload download "
+    "import export start stop upper lower left right buy sell true false allow deny accept reject "
+    "install uninstall older newer oldest newest first last".split()
+)
+_JA_ANTONYMS = ("昇順", "降順", "最大", "最小", "有効", "無効", "追加", "削除", "増加", "減少", "暗号化", "復号",
+                "許可", "拒否", "開始", "停止", "最新", "最古", "以上", "以下", "以前", "以降")
+# 後ろ (日本語では前) の語との組み合わせで向きが決まる語 ("TCP より UDP" と "UDP より TCP" など)
+_DIRECTIONS = frozenset("than from into before after vs versus".split())
+_JA_DIRECTIONS = ("から", "より", "まで", "へ")
+# 文頭の語は大文字で始まっても固有名詞とはみなさない
+_SENTENCE_START_RE = re.compile(r"(^|[.?!。?!]\s*)$")
+
+
+def _features(text):
+    # (特徴, 重み) を返す。短いひらがなの連続 (助詞など) は言い換えで変わりやすいので使わない
+    for run in _RUN_RE.findall(_FILLER_RE.sub(" ", normalize_prompt(text).lower())):
+        first = run[0]
+        if first.isascii():
+            if run in _STOPWORDS:
+                continue
+            yield "w:" + run, 1.0
+            if len(run) > 4:
+                # 語形の変化 (reset / resetting など) も近くなるよう、文字 3-gram も少し加える
+                for i in range(len(run) - 2):
+                    yield "c:" + run[i:i + 3], 0.25
+        elif "\u3040" <= first <= "\u309f":
+            if len(run) <= 2:
+                continue
+            for i in range(len(run) - 1):
+                yield "b:" + run[i:i + 2], 0.5
+        elif "\u30a0" <= first <= "\u30ff":
+            yield "w:" + run, 1.0
+            for i in range(len(run) - 1):
+                yield "b:" + run[i:i + 2], 0.5
+        else:
+            # 漢字は熟語の区切り方 (「返品手続き」と「返品の手続き」) に左右されないよう、2-gram だけを使う
+            if len(run) == 1:
+                yield "w:" + run, 1.0
+            for i in range(len(run) - 1):
+                yield "b:" + run[i:i + 2], 1.0
+
+
+def _stem(word):
+    # 語形の変化 (sorts / sorting など) を揃える簡易的な語幹
+    for suffix in ("ing", "ed", "es", "s"):
+        if len(word) > 4 and word.endswith(suffix):
+            return word[:-len(suffix)]
+    return word
+
+
+def conflict_terms(text):
+    """
+    埋め込みの類似度が高くても別の質問とみなすための、意味を変える語の組を返します。
+
+    埋め込みのコサイン類似度は、1 語だけ違う質問 (ascending と descending、safe と not safe) や、
+    語を入れ替えた質問 (TCP と UDP) でも高くなります。そこで、否定の有無、反対の意味を持つ語 (_ANTONYMS)、
+    than / from / から などの向きを決める語と相手の語、固有名詞・略語・数字の並びを取り出し、
+    これが食い違うエントリは類似度に関係なく返しません。それ以外の言い換え (語の追加・省略・入れ替え) は類似度だけで判定します。
+
+    Returns:
+        str: 比較用の文字列 (食い違う語がなければ同じ値)。
+    """
+    text = _FILLER_RE.sub(" ", normalize_prompt(text))
+    terms = set()
+    entities = []  # 固有名詞・略語・数字 (Python, TCP, HTTP2, 3 ...) の並び順
+    pending = None  # 英語の向きを決める語 (次の内容語と組にする)
+    previous = None  # 直前の内容語 (日本語の「から」などと組にする)
+    for match in _TERM_RE.finditer(text):
+        run = match.group()
+        first = run[0]
+        if first.isascii():
+            word = run.lower()
+            if word in _NEGATIONS:
+                terms.add("not")
+                continue
+            if word in _DIRECTIONS:
+                pending = word
+                continue
+            if word in _STOPWORDS:
+                continue
+            stem = _stem(word)
+            if stem in _ANTONYMS or word in _ANTONYMS:
+                terms.add(stem)
+            capitalized = first.isupper() and not _SENTENCE_START_RE.search(text[:match.start()])
+            # 略語 (TCP)、途中に大文字を含む語 (MySQL)、文中で大文字で始まる語 (Python)、数字を含む語
+            if (len(run) > 1 and (capitalized or any(c.isupper() for c in run[1:]))) or any(c.isdigit() for c in run):
+                entities.append(word)
+            if pending:
+                terms.add(f"{pending} {stem}")
+                pending = None
+            previous = stem
+        elif "\u3040" <= first <= "\u309f":
+            if _JA_NEGATION_RE.search(run):
+                terms.add("not")
+            direction = next((d for d in _JA_DIRECTIONS if run.startswith(d)), None)
+            if direction and previous:
+                terms.add(f"{previous} {direction}")
+        else:
+            terms.update(a for a in _JA_ANTONYMS if a in run)
+            if first >= "\u3400" or len(run) > 1:
+                previous = run
+    return " ".join(sorted(terms)) + "|" + " ".join(entities)
+
+
+def conflict_digest(text):
+    """conflict_terms() を 64 ビットの値にします (インデックスの行に保存する)。"""
+    digest = hashlib.blake2b(conflict_terms(text).encode('utf-8'), digest_size=8).digest()
+    return int.from_bytes(digest, "little")
+
+
+class HashingEmbedder:
+    """
+    外部のモデルを使わない埋め込み (特徴ハッシング)。単語と文字 n-gram を dim 次元にハッシュし、L2 正規化します。
+
+    ハッシュには zlib.crc32 を使うので、プロセスが変わっても同じテキストは同じベクトルになります
+    (Python の hash() はプロセスごとに変わるため、永続化したインデックスと組み合わせられない)。
+
+    Args:
+        dim (int): ベクトルの次元数。
+    """
+
+    def __init__(self, dim=256):
+        self.dim = dim
+
+    def __call__(self, text):
+        vector = [0.0] * self.dim
+        for feature, weight in _features(text):
+            h = zlib.crc32(feature.encode('utf-8'))
+            vector[h % self.dim] += weight if h & 0x80000000 else -weight
+        norm = math.sqrt(sum(v * v for v in vector))
+        return [v / norm for v in vector] if norm else vector
+
+
+def create_embedder(spec, dim):
+    """
+    環境変数の値から埋め込み関数を作ります。
+
+    Args:
+        spec (str): "hashing"、または "モジュール名:関数名" (テキストを受け取り dim 次元の数値列を返す関数)。
+        dim (int): ベクトルの次元数。
+    """
+    if spec == "hashing":
+        return HashingEmbedder(dim)
+    module_name, _, attr = spec.partition(":")
+    if not attr:
+        raise ValueError(f"Unknown embedder: {spec}")
+    return getattr(importlib.import_module(module_name), attr)
+
+
+class VectorIndex:
+    """
+    正規化済みベクトルと応答を固定サイズの行に保持するインデックス。満杯になると最も長く使われていない行を上書きします。
+
+    path を指定すると、ベクトル・応答・メタデータを NumPy の .npy ファイルにメモリマップします
+    (書き込みはページキャッシュ経由でファイルに反映される)。同じファイルを複数のプロセスから同時に書き込むことはできません。
+
+    Args:
+        dim (int): ベクトルの次元数。
+        capacity (int): 行数。
+        slot_bytes (int): 1 行に保存できる応答の最大バイト数 (UTF-8)。
+        path (str): 保存先のディレクトリ。None ならメモリ上のみ。
+    """
+
+    def __init__(self, dim, capacity, slot_bytes, path=None):
+        import numpy as np  # 使う場合のみ読み込む (コールドスタート短縮)
+        self._np = np
+        self.dim = dim
+        self.capacity = capacity
+        self.slot_bytes = slot_bytes
+        self.meta_dtype = np.dtype([
+            ("namespace", "<u8"), ("conflicts", "<u8"), ("last_used", "<f8"), ("expires_at", "<f8"), ("length", "<u4"),
+        ])
+        shapes = {
+            "vectors": ((capacity, dim), np.dtype("<f4")),
+            "answers": ((capacity, slot_bytes), np.dtype("u1")),
+            "meta": ((capacity,), self.meta_dtype),
+        }
+        self.loaded = False
+        if path is None:
+            arrays = {name: np.zeros(shape, dtype) for name, (shape, dtype) in shapes.items()}
+        else:
+            arrays = self._open(path, shapes)
+        self.vectors = arrays["vectors"]
+        self.answers = arrays["answers"]
+        self.meta = arrays["meta"]
+
+    def _open(self, path, shapes):
+        from numpy.lib.format import open_memmap
+        os.makedirs(path, exist_ok=True)
+        files = {name: os.path.join(path, f"{name}.npy") for name in shapes}
+        try:
+            arrays = {name: self._np.load(files[name], mmap_mode="r+") for name in shapes}
+            if all(arrays[name].shape == shape and arrays[name].dtype == dtype
+                   for name, (shape, dtype) in shapes.items()):
+                self.loaded = True
+                return arrays
+        except (OSError, ValueError):
+            pass
+        # ファイルがない・壊れている・設定 (次元数や行数) が変わった場合は作り直す
+        return {name: open_memmap(files[name], mode="w+", dtype=dtype, shape=shape)
+                for name, (shape, dtype) in shapes.items()}
+
+    def search(self, vector, namespace, conflicts, now):
+        """
+        namespace が同じで有効期限内の行から、最も類似度の高い行を返します。
+        意味を変える語 (conflict_digest() の値) が食い違う行は除きます。
+
+        Returns:
+            tuple: (行番号, コサイン類似度)。該当する行がなければ (-1, 0.0)。
+        """
+        np = self._np
+        live = ((self.meta["namespace"] == namespace) & (self.meta["conflicts"] == conflicts)
+                & (self.meta["expires_at"] > now))
+        if not live.any():
+            return -1, 0.0
+        similarities = np.where(live, self.vectors @ vector, -np.inf)
+        row = int(similarities.argmax())
+        return row, float(similarities[row])
+
+    def answer(self, row, now):
+        """行の応答を返し、最終使用時刻を更新します。"""
+        self.meta["last_used"][row] = now
+        return bytes(self.answers[row, :self.meta["length"][row]]).decode('utf-8')
+
+    def add(self, vector, namespace, conflicts, answer, expires_at, now):
+        """
+        行を追加します。期限切れ (または未使用) の行がなければ、最も長く使われていない行を上書きします。
+
+        Returns:
+            bool: 有効な行を追い出した場合は True。
+        """
+        free = self.meta["expires_at"] <= now
+        if free.any():
+            row, evicted = int(free.argmax()), False
+        else:
+            row, evicted = int(self.meta["last_used"].argmin()), True
+        # 書き込み途中で中断しても壊れた行が見つからないよう、先に無効にしてから書き、最後に有効にする
+        self.meta["expires_at"][row] = 0
+        self.vectors[row] = vector
+        self.answers[row, :len(answer)] = self._np.frombuffer(answer, dtype="u1")
+        self.meta[row] = (namespace, conflicts, now, expires_at, len(answer))
+        return evicted
+
+    def __len__(self):
+        return int((self.meta["expires_at"] > time.time()).sum())
+
+    def flush(self):
+        for array in (self.vectors, self.answers, self.meta):
+            if hasattr(array, "flush"):
+                array.flush()
+
+
+class SemanticCache:
+    """
+    埋め込みの近傍検索で、意味の近いプロンプトに以前の応答を返すキャッシュ。
+
+    会話履歴とサンプリングパラメータが一致するエントリ (同じ namespace) をコサイン類似度で検索します。
+    ただし、否定・反対の意味の語・向き・固有名詞や数字 (conflict_terms()) が食い違うエントリは返しません。
+    キャッシュ対象は ResponseCache と同じく、do_sample=False のリクエスト (cache_sampled=True ならすべて) です。
+
+    Args:
+        embed (callable): テキストを dim 次元の数値列に変換する関数。
+        dim (int): ベクトルの次元数。
+        threshold (float): 応答を返すコサイン類似度の下限。
+        max_bytes (int): インデックスのメモリ上限 (行数はこれと dim、max_answer_bytes から決める)。
+        max_answer_bytes (int): キャッシュする応答の最大バイト数 (UTF-8)。超える応答はキャッシュしない。
+        ttl (float): エントリの有効期間 (秒)。
+        path (str): インデックスを保存するディレクトリ。None ならメモリ上のみ。
+        cache_sampled (bool): do_sample=True のリクエストもキャッシュするか。
+    """
+
+    def __init__(self, embed, dim=256, threshold=0.85, max_bytes=16 * 1024 * 1024, max_answer_bytes=8192,
+                 ttl=3600.0, path=None, cache_sampled=False):
+        self.embed = embed
+        self.threshold = threshold
+        self.max_answer_bytes = max_answer_bytes
+        self.ttl = ttl
+        self.cache_sampled = cache_sampled
+        row_bytes = dim * 4 + max_answer_bytes + 36
+        self.index = VectorIndex(dim, max(1, max_bytes // row_bytes), max_answer_bytes, path)
+        self._lock = threading.Lock()
+        self.hits = 0
+        self.misses = 0
+        self.evictions = 0
+        self.too_large = 0
+
+    def is_cacheable(self, payload):
+        return not payload.get("do_sample", True) or self.cache_sampled
+
+    def namespace(self, history, payload):
+        """会話履歴とサンプリングパラメータから、検索対象を絞り込む 64 ビットの値を計算します。"""
+        params = json.dumps({key: payload.get(key) for key in SAMPLING_KEYS}, sort_keys=True)
+        digest = hashlib.blake2b(f"{history_digest(history)}|{params}".encode('utf-8'), digest_size=8).digest()
+        return int.from_bytes(digest, "little")
+
+    def vectorize(self, prompt):
+        """
+        プロンプトを検索キーにします (get() と set() で同じ値を使い回す)。
+
+        Returns:
+            tuple: (正規化した埋め込みベクトル, conflict_digest())。
+        """
+        vector = self.index._np.asarray(self.embed(prompt), dtype="<f4")
+        if vector.shape != (self.index.dim,):
+            raise ValueError(f"Embedding has shape {vector.shape}, expected ({self.index.dim},)")
+        norm = float(self.index._np.linalg.norm(vector))
+        return (vector / norm if norm else vector), conflict_digest(prompt)
+
+    def get(self, key, namespace):
+        """
+        Args:
+            key: vectorize() の結果。
+            namespace (int): namespace() の結果。
+
+        Returns:
+            tuple: (応答、見つからなければ None, 最も近いエントリの類似度)。
+        """
+        vector, conflicts = key
+        now = time.time()
+        with self._lock:
+            row, similarity = self.index.search(vector, namespace, conflicts, now)
+            if row >= 0 and similarity >= self.threshold:
+                self.hits += 1
+                return self.index.answer(row, now), similarity
+        self.misses += 1
+        return None, similarity
+
+    def set(self, key, namespace, answer):
+        vector, conflicts = key
+        data = answer.encode('utf-8')
+        if len(data) > self.max_answer_bytes:
+            self.too_large += 1
+            return
+        now = time.time()
+        with self._lock:
+            if self.index.add(vector, namespace, conflicts, data, now + self.ttl, now):
+                self.evictions += 1
+
+    def stats(self):
+        return {
+            "hits": self.hits,
+            "misses": self.misses,
+            "evictions": self.evictions,
+            "too_large": self.too_large,
+            "capacity": self.index.capacity,
+        }
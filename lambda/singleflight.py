@@ -0,0 +1,291 @@
+# lambda/singleflight.py
+# 同一ペイロードの同時リクエストを 1 回の上流呼び出しにまとめる (single-flight)
+import hashlib
+import json
+import os
+import threading
+import time
+
+
+def payload_key(data):
+    """送信するペイロードのバイト列からキーを作ります。"""
+    return hashlib.sha256(data).hexdigest()
+
+
+class _Call:
+    def __init__(self):
+        self.done = threading.Event()
+        self.result = None
+        self.error = None
+        self.waiters = 0
+
+
+class SingleFlight:
+    """
+    スレッド間で同一キーの呼び出しをまとめます。
+
+    先に到着した呼び出しだけが fn を実行し、同じキーで待っている呼び出しはその結果を共有します。
+
+    Args:
+        store: プロセス間でまとめる場合の共有ストア (FlightStore)。None ならプロセス内のみ。
+        wait_timeout (float): 他の呼び出しの結果を待つ最大時間 (秒)。do() の wait_timeout で呼び出しごとに指定できる。
+    """
+
+    def __init__(self, store=None, wait_timeout=60.0):
+        self.store = store
+        self.wait_timeout = wait_timeout
+        self._calls = {}
+        self._lock = threading.Lock()
+        self.calls = 0
+        self.upstream_calls = 0
+        self.shared = 0
+
+    def do(self, key, fn, wait_timeout=None):
+        """
+        key に対して fn() を高々 1 回だけ実行し、その結果を返します。
+
+        Args:
+            key (str): リクエストを識別するキー。
+            fn (callable): 上流呼び出し。戻り値は JSON 化できる値であること (プロセス間共有のため)。
+            wait_timeout (float): 他の呼び出しの結果を待つ最大時間 (秒)。省略時はコンストラクターの値。
+                呼び出し元の残り時間を渡すと、それを過ぎてからは待たずに自分で fn() を呼び出す。
+
+        Returns:
+            tuple: (fn の戻り値, 他の呼び出しの結果を共有したかどうか)。
+        """
+        with self._lock:
+            self.calls += 1
+            call = self._calls.get(key)
+            if call is not None:
+                call.waiters += 1
+                leader = False
+            else:
+                call = self._calls[key] = _Call()
+                leader = True
+
+        if wait_timeout is None:
+            wait_timeout = self.wait_timeout
+        if not leader:
+            if not call.done.wait(wait_timeout):
+                # 待ちきれない場合は自分で呼び出す (結果の共有よりも応答を優先)
+                with self._lock:
+                    call.waiters -= 1
+                    self.upstream_calls += 1
+                return fn(), False
+            with self._lock:
+                self.shared += 1
+            if call.error is not None:
+                raise call.error
+            return call.result, True
+
+        try:
+            call.result, shared = self._do_leader(key, fn, wait_timeout)
+        except BaseException as e:
+            call.error = e
+            raise
+        finally:
+            with self._lock:
+                del self._calls[key]
+            call.done.set()
+        return call.result, shared
+
+    def _do_leader(self, key, fn, wait_timeout):
+        if self.store is None:
+            with self._lock:
+                self.upstream_calls += 1
+            return fn(), False
+
+        # プロセス間: ロックを取れたプロセスだけが上流を呼び、他は結果が公開されるのを待つ
+        # (ロックを取ったプロセスも自分の残り時間より長くは呼び出さないので、ロックの期限も同じにする)
+        deadline = time.monotonic() + wait_timeout
+        while True:
+            if self.store.try_acquire(key, ttl=max(wait_timeout, 1.0)):
+                try:
+                    with self._lock:
+                        self.upstream_calls += 1
+                    result = fn()
+                    self.store.publish(key, result)
+                    return result, False
+                finally:
+                    self.store.release(key)
+            found, result = self.store.wait(key, deadline)
+            if found:
+                with self._lock:
+                    self.shared += 1
+                return result, True
+            if time.monotonic() >= deadline:
+                # 待ちきれない場合は自分で呼び出す (結果の共有よりも応答を優先)
+                with self._lock:
+                    self.upstream_calls += 1
+                return fn(), False
+
+    def stats(self):
+        return {
+            "calls": self.calls,
+            "upstream_calls": self.upstream_calls,
+            "saved_upstream_calls": self.shared,
+            "in_flight": len(self._calls),
+        }
+
+
+class AsyncSingleFlight:
+    """
+    asyncio のタスク間で同一キーのコルーチン呼び出しをまとめます。
+
+    先行の呼び出し (リーダー) が例外で終わった場合は、待っていたタスクにも同じ例外を送出します。
+    リーダーがキャンセルされた場合 (クライアントの切断など) は、待っていたタスクのうち 1 つが代わりに呼び出します。
+    """
+
+    def __init__(self):
+        self._futures = {}
+        self.calls = 0
+        self.upstream_calls = 0
+        self.shared = 0
+
+    async def do(self, key, coro_fn):
+        """
+        Returns:
+            tuple: (結果, 他のタスクの呼び出し結果を共有したか)。
+        """
+        import asyncio  # asyncio は読み込みが重いので、使う場合のみ読み込む
+        self.calls += 1
+        while True:
+            future = self._futures.get(key)
+            if future is None:
+                break
+            try:
+                # 待っている側がキャンセルされても共有中の呼び出しは止めない
+                result = await asyncio.shield(future)
+            except asyncio.CancelledError:
+                if future.cancelled():
+                    # キャンセルされたのはリーダーなので、自分がリーダーになって呼び出し直す
+                    continue
+                raise
+            self.shared += 1
+            return result, True
+
+        future = asyncio.get_running_loop().create_future()
+        self._futures[key] = future
+        self.upstream_calls += 1
+        try:
+            result = await coro_fn()
+        except asyncio.CancelledError:
+            future.cancel()
+            raise
+        except BaseException as e:
+            future.set_exception(e)
+            # 誰も待っていない場合の "exception was never retrieved" 警告を避ける
+            future.exception()
+            raise
+        else:
+            future.set_result(result)
+            return result, False
+        finally:
+            del self._futures[key]
+
+    def stats(self):
+        return {
+            "calls": self.calls,
+            "upstream_calls": self.upstream_calls,
+            "saved_upstream_calls": self.shared,
+            "in_flight": len(self._futures),
+        }
+
+
+class SQLiteFlightStore:
+    """
+    プロセス間でロックと結果を共有するストア (ローカル SQLite)。
+
+    try_acquire / release / publish / wait を実装すれば DynamoDB などに差し替えられます。
+
+    Args:
+        path (str): SQLite ファイルのパス。
+        result_ttl (float): 公開した結果を後続の待機者のために残しておく時間 (秒)。
+        poll_interval (float): 結果待ちのポーリング間隔 (秒)。
+    """
+
+    def __init__(self, path, result_ttl=5.0, poll_interval=0.02):
+        self.path = path
+        self.result_ttl = result_ttl
+        self.poll_interval = poll_interval
+        self._local = threading.local()
+        self._pid = None
+        conn = self._conn()
+        conn.execute(
+            "CREATE TABLE IF NOT EXISTS flights ("
+            "key TEXT PRIMARY KEY, owner TEXT, lock_expires REAL, "
+            "result TEXT, result_expires REAL)"
+        )
+
+    def _conn(self):
+        conn = getattr(self._local, "conn", None)
+        if conn is None or self._pid != os.getpid():
+            import sqlite3  # 使う場合のみ読み込む (コールドスタート短縮)
+            conn = sqlite3.connect(self.path, timeout=5.0, isolation_level=None)
+            conn.execute("PRAGMA journal_mode=WAL")
+            self._local.conn = conn
+            self._pid = os.getpid()
+        return conn
+
+    def _owner(self):
+        return f"{os.getpid()}:{threading.get_ident()}"
+
+    def try_acquire(self, key, ttl):
+        now = time.time()
+        conn = self._conn()
+        conn.execute("BEGIN IMMEDIATE")
+        try:
+            row = conn.execute(
+                "SELECT owner, lock_expires FROM flights WHERE key = ?", (key,)
+            ).fetchone()
+            if row is not None and row[0] is not None and row[1] > now:
+                conn.execute("COMMIT")
+                return False
+            conn.execute(
+                "INSERT INTO flights (key, owner, lock_expires) VALUES (?, ?, ?) "
+                "ON CONFLICT(key) DO UPDATE SET owner = excluded.owner, "
+                "lock_expires = excluded.lock_expires, result = NULL, result_expires = NULL",
+                (key, self._owner(), now + ttl),
+            )
+            conn.execute("COMMIT")
+            return True
+        except BaseException:
+            conn.execute("ROLLBACK")
+            raise
+
+    def publish(self, key, result):
+        self._conn().execute(
+            "UPDATE flights SET result = ?, result_expires = ? WHERE key = ?",
+            (json.dumps(result), time.time() + self.result_ttl, key),
+        )
+
+    def release(self, key):
+        now = time.time()
+        conn = self._conn()
+        conn.execute(
+            "UPDATE flights SET owner = NULL, lock_expires = NULL WHERE key = ? AND owner = ?",
+            (key, self._owner()),
+        )
+        conn.execute("DELETE FROM flights WHERE owner IS NULL AND (result_expires IS NULL OR result_expires < ?)", (now,))
+
+    def wait(self, key, deadline):
+        """
+        他プロセスが結果を公開するか、ロックが解放されるまで待ちます。
+
+        Returns:
+            tuple: (結果が見つかったか, 結果)。ロックが解放されただけなら (False, None)。
+        """
+        conn = self._conn()
+        while True:
+            now = time.time()
+            row = conn.execute(
+                "SELECT owner, lock_expires, result, result_expires FROM flights WHERE key = ?", (key,)
+            ).fetchone()
+            if row is None:
+                return False, None
+            owner, lock_expires, result, result_expires = row
+            if result is not None and result_expires > now:
+                return True, json.loads(result)
+            if owner is None or lock_expires <= now or time.monotonic() >= deadline:
+                return False, None
+            time.sleep(self.poll_interval)
@@ -0,0 +1,149 @@
+# lambda/streaming.py
+# /generate のトークンストリームを逐次中継するためのジェネレーターパイプライン
+import codecs
+import json
+import time
+
+import fastjson
+
+# ストリームの 1 イベントから取り出すテキストのキー (推論サーバーの実装差を吸収する)
+_TOKEN_KEYS = ("token", "text", "delta", "generated_text")
+
+
+def _extract_token(data):
+    """SSE/NDJSON の data 部分からトークン文字列を取り出します。終端なら None を返します。"""
+    if data == "[DONE]":
+        return None
+    try:
+        obj = json.loads(data)
+    except json.JSONDecodeError:
+        return data
+    if isinstance(obj, dict):
+        if obj.get("done") or obj.get("finished"):
+            return obj.get("token") or ""
+        for key in _TOKEN_KEYS:
+            value = obj.get(key)
+            if isinstance(value, dict):
+                value = value.get("text")
+            if isinstance(value, str):
+                return value
+        return ""
+    return obj if isinstance(obj, str) else ""
+
+
+def _drain(response):
+    # 終端イベント以降の残り (チャンク終端など) を読み切り、接続を再利用可能にする
+    while response.read1(1024):
+        pass
+
+
+def iter_sse_data(lines):
+    """
+    SSE の行ストリームを data フィールドごとのイベントにまとめます。
+
+    Args:
+        lines (iterable[bytes]): レスポンスの行イテレーター。
+
+    Yields:
+        str: 1 イベント分の data (複数行の data は改行で連結)。
+    """
+    decoder = codecs.getincrementaldecoder('utf-8')()
+    data_lines = []
+    for raw in lines:
+        line = decoder.decode(raw).rstrip('\r\n')
+        if not line:
+            if data_lines:
+                yield "\n".join(data_lines)
+                data_lines = []
+            continue
+        if line.startswith(':'):
+            continue  # コメント (keep-alive ping)
+        field, _, value = line.partition(':')
+        if field == 'data':
+            data_lines.append(value[1:] if value.startswith(' ') else value)
+    if data_lines:
+        yield "\n".join(data_lines)
+
+
+def iter_tokens(response):
+    """
+    推論サーバーのレスポンスを Content-Type に応じてトークン列に変換します。
+
+    text/event-stream と NDJSON は 1 イベントずつ、それ以外のチャンク転送はチャンクごとに、
+    通常の JSON レスポンスは generated_text 全体を 1 トークンとして返します。
+
+    Args:
+        response: http_pool.PooledResponse。
+
+    Yields:
+        str: トークン (テキスト断片)。
+    """
+    content_type = (response.headers.get('Content-Type') or '').split(';')[0].strip().lower()
+    if content_type == 'text/event-stream':
+        for data in iter_sse_data(response):
+            token = _extract_token(data)
+            if token is None:
+                _drain(response)
+                return
+            if token:
+                yield token
+    elif content_type in ('application/x-ndjson', 'application/jsonl'):
+        for raw in response:
+            line = raw.decode('utf-8').strip()
+            if not line:
+                continue
+            token = _extract_token(line)
+            if token is None:
+                _drain(response)
+                return
+            if token:
+                yield token
+    elif content_type == 'application/json':
+        # ストリーミング非対応のサーバーは通常の JSON を返すので、全体を 1 トークンとして扱う
+        data = json.loads(response.read().decode('utf-8'))
+        text = data.get('generated_text', '')
+        if text:
+            yield text
+    else:
+        decoder = codecs.getincrementaldecoder('utf-8')()
+        while True:
+            chunk = response.read1(1024)
+            if not chunk:
+                break
+            text = decoder.decode(chunk)
+            if text:
+                yield text
+        tail = decoder.decode(b'', final=True)
+        if tail:
+            yield tail
+
+
+class TimedStream:
+    """
+    トークンストリームをラップし、最初のトークンまでの時間 (TTFT) と合計時間を計測します。
+
+    Args:
+        tokens (iterable[str]): トークンのイテレーター。
+        started_at (float): リクエスト送信時刻 (time.perf_counter の値)。
+    """
+
+    def __init__(self, tokens, started_at=None):
+        self._tokens = tokens
+        self.started_at = time.perf_counter() if started_at is None else started_at
+        self.ttft_ms = None
+        self.total_ms = None
+        self.token_count = 0
+
+    def __iter__(self):
+        for token in self._tokens:
+            if self.ttft_ms is None:
+                self.ttft_ms = (time.perf_counter() - self.started_at) * 1000
+            self.token_count += 1
+            yield token
+        self.total_ms = (time.perf_counter() - self.started_at) * 1000
+
+
+def format_sse(data, event=None):
+    """オブジェクトを SSE の 1 イベント分の文字列に変換します。"""
+    prefix = f"event: {event}\n" if event else ""
+    return f"{prefix}data: {fastjson.dumps(data)}\n\n"
@@ -0,0 +1,247 @@
+# lambda/structured_log.py
+# 構造化ログ (1 行 1 JSON)。整形・マスク・書き出しはバックグラウンドスレッドで行い、リクエストの処理を待たせない
+import contextvars
+import json
+import logging
+import logging.handlers
+import os
+import queue
+import sys
+import time
+
+REDACTED = "[REDACTED]"
+
+# 既定でマスクするフィールド名 (大文字小文字は区別しない)
+DEFAULT_REDACT_FIELDS = (
+    "authorization", "idtoken", "id_token", "accesstoken", "access_token", "refreshtoken",
+    "password", "email", "cognito:username", "phone_number", "x-api-key",
+)
+
+_SCALAR_TYPES = frozenset((int, float, bool, type(None)))
+
+# リクエスト単位の状態 (ログに付けるフィールドとボディを記録するか)。非同期ジョブのローカルワーカーのように
+# 1 つのプロセスで複数のリクエストを並行して処理しても混ざらないよう、スレッド (コンテキスト) ごとに持つ
+_context = contextvars.ContextVar("log_context", default={})
+_sample_bodies = contextvars.ContextVar("log_sample_bodies", default=False)
+
+
+class RedactingJsonFormatter(logging.Formatter):
+    """
+    ログレコードを 1 行の JSON にします。
+
+    redact_fields に一致するキーの値はネストした dict の中でもマスクし、
+    長い文字列は max_field_chars 文字、長いリストは max_items 件で切り詰めます。
+    """
+
+    def __init__(self, redact_fields=DEFAULT_REDACT_FIELDS, max_field_chars=2048, max_items=50):
+        super().__init__()
+        self.redact_fields = frozenset(f.lower() for f in redact_fields)
+        self.max_field_chars = max_field_chars
+        self.max_items = max_items
+
+    def _clean(self, value):
+        # ほとんどのフィールドは数値などのスカラー値なので、isinstance の連鎖を通さずに返す
+        if type(value) in _SCALAR_TYPES:
+            return value
+        if isinstance(value, dict):
+            return {k: REDACTED if str(k).lower() in self.redact_fields else self._clean(v) for k, v in value.items()}
+        if isinstance(value, (list, tuple)):
+            cleaned = [self._clean(v) for v in value[:self.max_items]]
+            if len(value) > self.max_items:
+                cleaned.append(f"…(+{len(value) - self.max_items} items)")
+            return cleaned
+        if isinstance(value, (bytes, bytearray)):
+            value = value.decode('utf-8', 'replace')
+        if isinstance(value, str) and len(value) > self.max_field_chars:
+            return f"{value[:self.max_field_chars]}…(+{len(value) - self.max_field_chars} chars)"
+        return value
+
+    def format(self, record):
+        entry = {"ts": round(record.created, 3), "level": record.levelname, "msg": record.getMessage()}
+        entry.update(getattr(record, "fields", {}))
+        if record.exc_info:
+            entry["exc"] = self.formatException(record.exc_info)
+        return json.dumps(self._clean(entry), ensure_ascii=False, default=str)
+
+
+class _DeferredQueueHandler(logging.handlers.QueueHandler):
+    # 既定の QueueHandler は呼び出し元のスレッドで整形してしまうので、レコードをそのままキューに入れる
+    # (ログに渡した dict などは、その後書き換えないこと)
+    def prepare(self, record):
+        return record
+
+
+class _BufferedStreamHandler(logging.StreamHandler):
+    # 1 レコードごとではなく、キューが空になった時点でまとめて flush する
+    def __init__(self, stream, pending):
+        super().__init__(stream)
+        self.pending = pending
+
+    def emit(self, record):
+        try:
+            self.stream.write(self.format(record) + self.terminator)
+            if self.pending.empty():
+                self.stream.flush()
+        except Exception:
+            self.handleError(record)
+
+
+class StructuredLogger:
+    """
+    リクエスト単位のコンテキストとボディのサンプリングを持つロガー。
+
+    コンテキストとサンプリングの判定はスレッド (contextvars のコンテキスト) ごとに保持します。
+
+    Args:
+        name (str): 標準 logging のロガー名。
+    """
+
+    def __init__(self, name="simplechat"):
+        self._logger = logging.getLogger(name)
+        # Lambda ランタイムがルートロガーに付けるハンドラーで二重に出力しない
+        self._logger.propagate = False
+        self._queue = None
+        self._listener = None
+        self.body_sample_rate = 0.0
+        self.flush_timeout = 0.05
+
+    @property
+    def context(self):
+        """このスレッドで処理中のリクエストのフィールド。"""
+        return _context.get()
+
+    @property
+    def sample_bodies(self):
+        """このスレッドで処理中のリクエストのボディを記録するか。"""
+        return _sample_bodies.get()
+
+    def configure(self, level="INFO", redact_fields=DEFAULT_REDACT_FIELDS, max_field_chars=2048, max_items=50,
+                  body_sample_rate=0.0, asynchronous=True, flush_timeout=0.05, stream=None):
+        """
+        出力先と設定を (再) 構成します。
+
+        Args:
+            level (str): ログレベル。
+            redact_fields (iterable): 値をマスクするフィールド名。
+            max_field_chars (int): 1 つの文字列フィールドの最大文字数。
+            max_items (int): 1 つのリストフィールドの最大件数。
+            body_sample_rate (float): リクエストやレスポンスのボディを記録するリクエストの割合 (ヘッドサンプリング)。
+            asynchronous (bool): キューとバックグラウンドスレッド経由で書き出すか。
+            flush_timeout (float): flush() で書き出しを待つ最大時間 (秒)。
+            stream: 出力先 (既定は標準出力)。
+        """
+        self.close()
+        for handler in list(self._logger.handlers):
+            self._logger.removeHandler(handler)
+        self._logger.setLevel(level.upper() if isinstance(level, str) else level)
+        self.body_sample_rate = body_sample_rate
+        self.flush_timeout = flush_timeout
+
+        formatter = RedactingJsonFormatter(redact_fields, max_field_chars, max_items)
+        stream = stream or sys.stdout
+        if asynchronous:
+            self._queue = queue.Queue()
+            output = _BufferedStreamHandler(stream, self._queue)
+            output.setFormatter(formatter)
+            self._listener = logging.handlers.QueueListener(self._queue, output)
+            self._listener.start()
+            self._logger.addHandler(_DeferredQueueHandler(self._queue))
+        else:
+            output = logging.StreamHandler(stream)
+            output.setFormatter(formatter)
+            self._logger.addHandler(output)
+
+    def configure_from_env(self):
+        redact = os.environ.get("LOG_REDACT_FIELDS")
+        self.configure(
+            level=os.environ.get("LOG_LEVEL", "INFO"),
+            redact_fields=[f.strip() for f in redact.split(",") if f.strip()] if redact else DEFAULT_REDACT_FIELDS,
+            max_field_chars=int(os.environ.get("LOG_MAX_FIELD_CHARS", "2048")),
+            max_items=int(os.environ.get("LOG_MAX_ITEMS", "50")),
+            body_sample_rate=float(os.environ.get("LOG_BODY_SAMPLE_RATE", "0")),
+            asynchronous=os.environ.get("LOG_ASYNC", "true").lower() == "true",
+            flush_timeout=float(os.environ.get("LOG_FLUSH_TIMEOUT_MS", "50")) / 1000,
+        )
+
+    def begin_request(self, **context):
+        """
+        リクエストの開始時に呼び出し、以降のレコードに付けるフィールドとボディを記録するかを決めます。
+
+        Returns:
+            bool: このリクエストのボディを記録するか。
+        """
+        _context.set(context)
+        if self._logger.isEnabledFor(logging.DEBUG):
+            sample = True
+        elif self.body_sample_rate > 0:
+            # random モジュールを読み込まずに一様乱数を作る
+            sample = int.from_bytes(os.urandom(2), 'big') / 0xFFFF < self.body_sample_rate
+        else:
+            sample = False
+        _sample_bodies.set(sample)
+        return sample
+
+    def enabled(self, level):
+        return self._logger.isEnabledFor(level)
+
+    def log(self, level, msg, exc_info=None, **fields):
+        if not self._logger.isEnabledFor(level):
+            return
+        if exc_info is True:
+            exc_info = sys.exc_info()
+        # Logger.log はスタックをさかのぼって呼び出し元を探すので、使わない情報は求めずにレコードを作る
+        record = self._logger.makeRecord(self._logger.name, level, "", 0, msg, (), exc_info,
+                                         extra={"fields": {**_context.get(), **fields}})
+        self._logger.handle(record)
+
+    def debug(self, msg, **fields):
+        self.log(logging.DEBUG, msg, **fields)
+
+    def info(self, msg, **fields):
+        self.log(logging.INFO, msg, **fields)
+
+    def warning(self, msg, **fields):
+        self.log(logging.WARNING, msg, **fields)
+
+    def error(self, msg, **fields):
+        self.log(logging.ERROR, msg, **fields)
+
+    def exception(self, msg, **fields):
+        self.log(logging.ERROR, msg, exc_info=True, **fields)
+
+    def body(self, msg, name, value, **fields):
+        """
+        大きなボディを含むレコード。サンプリング対象のリクエストでだけ value を記録し、
+        それ以外は fields (サイズなどの要約) だけを記録します。
+        """
+        if _sample_bodies.get():
+            fields[name] = value
+        self.info(msg, **fields)
+
+    def flush(self, timeout=None):
+        """
+        キューに残ったレコードの書き出しを最大 timeout 秒 (既定は flush_timeout) 待ちます。
+
+        Lambda は応答を返すとプロセスを凍結するので、ハンドラーの最後で呼び出して
+        そのリクエストのログがそのリクエストの間に出力されるようにします。
+        """
+        if self._queue is None:
+            return True
+        deadline = time.monotonic() + (self.flush_timeout if timeout is None else timeout)
+        with self._queue.all_tasks_done:
+            while self._queue.unfinished_tasks:
+                remaining = deadline - time.monotonic()
+                if remaining <= 0:
+                    return False
+                self._queue.all_tasks_done.wait(remaining)
+        return True
+
+    def close(self):
+        if self._listener is not None:
+            self._listener.stop()
+            self._listener = None
+            self._queue = None
+
+
+log = StructuredLogger()
+log.configure_from_env()
@@ -0,0 +1,408 @@
+# lambda/upstream.py
+# 複数の推論サーバーへの負荷分散とヘッジリクエストを行う asyncio ベースのエンジン
+import asyncio
+import bisect
+import hashlib
+import math
+import ssl
+import threading
+import time
+import urllib.parse
+
+from circuit_breaker import CircuitBreaker, CircuitOpenError
+from latency import LatencyHistogram
+
+
+class UpstreamProtocolError(ConnectionError):
+    """
+    バックエンドの応答が途中で切れた、または HTTP として壊れていたことを表します。
+
+    ConnectionError (OSError) のサブクラスなので、呼び出し元は接続エラーと同じく再試行できる失敗として扱えます。
+    """
+
+
+class _NothingReceived(ConnectionError):
+    """接続が応答を 1 バイトも返さずに閉じられたことを表します (リクエストは処理されていない)。"""
+
+
+class Backend:
+    """
+    1 台の推論サーバー。未完了リクエスト数、EWMA レイテンシ、アイドル接続を保持します。
+
+    Args:
+        url (str): ベースURL。
+        ewma_alpha (float): EWMA の平滑化係数。
+        breaker (CircuitBreaker): このバックエンド用のサーキットブレーカー。None なら常に選択対象。
+    """
+
+    def __init__(self, url, ewma_alpha=0.3, max_idle=4, breaker=None):
+        parsed = urllib.parse.urlsplit(url)
+        self.url = url
+        self.https = parsed.scheme == "https"
+        self.host = parsed.hostname
+        self.port = parsed.port or (443 if self.https else 80)
+        self.base_path = parsed.path.rstrip('/')
+        self.ewma_alpha = ewma_alpha
+        self.ewma_ms = None
+        self.outstanding = 0
+        self.errors = 0
+        self.histogram = LatencyHistogram()
+        self.max_idle = max_idle
+        self.breaker = breaker
+        self._idle = []
+
+    def observe(self, ms, ok=True):
+        # ok=None はキャンセルされた試行 (成否不明) で、レイテンシだけを記録する
+        self.histogram.observe(ms)
+        if ok is False:
+            self.errors += 1
+        self.ewma_ms = ms if self.ewma_ms is None else self.ewma_alpha * ms + (1 - self.ewma_alpha) * self.ewma_ms
+        if self.breaker is not None and ok is not None:
+            if ok:
+                self.breaker.record_success()
+            else:
+                self.breaker.record_failure()
+
+    async def _connect(self):
+        while self._idle:
+            reader, writer = self._idle.pop()
+            # アイドル中にサーバーが閉じた接続は使わない
+            if not reader.at_eof() and not writer.is_closing():
+                return reader, writer, True
+            writer.close()
+        ctx = ssl.create_default_context() if self.https else None
+        reader, writer = await asyncio.open_connection(self.host, self.port, ssl=ctx)
+        return reader, writer, False
+
+    def _release(self, reader, writer, reusable):
+        if reusable and len(self._idle) < self.max_idle:
+            self._idle.append((reader, writer))
+        else:
+            writer.close()
+
+    async def post(self, path, body, headers):
+        """
+        HTTP/1.1 の POST を送信し、(ステータス, ボディ) を返します。キャンセルされた接続は破棄します。
+        """
+        return await self.request("POST", path, body, headers)
+
+    async def request(self, method, path, body=b"", headers=None):
+        """任意のメソッドでリクエストを送信し、(ステータス, ボディ) を返します。"""
+        headers = headers or {}
+        reader, writer, reused = await self._connect()
+        try:
+            try:
+                status, response_headers, data = await self._exchange(reader, writer, method, path, body, headers)
+            except _NothingReceived:
+                if not reused:
+                    raise
+                # 再利用した接続が切れていた場合は新しい接続で一度だけ再送する。応答を一部でも受け取った後の切断は
+                # バックエンドが生成を始めた可能性があるので、再送せずにエラーにする (同じ生成を 2 回させない)
+                writer.close()
+                reader, writer, _ = None, None, None
+                ctx = ssl.create_default_context() if self.https else None
+                reader, writer = await asyncio.open_connection(self.host, self.port, ssl=ctx)
+                status, response_headers, data = await self._exchange(reader, writer, method, path, body, headers)
+        except (asyncio.IncompleteReadError, asyncio.LimitOverrunError, ValueError) as e:
+            # 途中で切れた応答や、ステータス行・チャンクサイズを解釈できない応答
+            if writer is not None:
+                writer.close()
+            raise UpstreamProtocolError(f"Malformed response from {self.url}: {e!r}") from e
+        except BaseException:
+            if writer is not None:
+                writer.close()
+            raise
+        keep_alive = response_headers.get("connection", "").lower() != "close"
+        self._release(reader, writer, keep_alive)
+        return status, data
+
+    async def _exchange(self, reader, writer, method, path, body, headers):
+        lines = [f"{method} {self.base_path}{path} HTTP/1.1", f"Host: {self.host}",
+                 f"Content-Length: {len(body)}", "Connection: keep-alive"]
+        lines.extend(f"{k}: {v}" for k, v in headers.items())
+        try:
+            writer.write(("\r\n".join(lines) + "\r\n\r\n").encode('latin-1') + body)
+            await writer.drain()
+            # 最初の 1 バイトを別に読み、何も受け取らずに切れたのか、応答の途中で切れたのかを区別する
+            first = await reader.read(1)
+        except ConnectionError as e:
+            raise _NothingReceived(f"{self.url} closed the connection before responding") from e
+        if not first:
+            raise _NothingReceived(f"{self.url} closed the connection before responding")
+
+        status_line = first + await reader.readuntil(b"\r\n")
+        parts = status_line.split()
+        if len(parts) < 2 or not parts[0].startswith(b"HTTP/"):
+            raise ValueError(f"Bad status line: {status_line[:64]!r}")
+        status = int(parts[1])
+        response_headers = {}
+        while True:
+            line = await reader.readuntil(b"\r\n")
+            if line == b"\r\n":
+                break
+            name, _, value = line.decode('latin-1').partition(':')
+            response_headers[name.strip().lower()] = value.strip()
+
+        if response_headers.get("transfer-encoding", "").lower() == "chunked":
+            chunks = []
+            while True:
+                size = int((await reader.readuntil(b"\r\n")).split(b";")[0], 16)
+                if size == 0:
+                    # トレーラーを読み飛ばす
+                    while await reader.readuntil(b"\r\n") != b"\r\n":
+                        pass
+                    break
+                chunks.append(await reader.readexactly(size))
+                await reader.readexactly(2)
+            data = b"".join(chunks)
+        elif "content-length" in response_headers:
+            data = await reader.readexactly(int(response_headers["content-length"]))
+        else:
+            data = await reader.read()
+            response_headers["connection"] = "close"
+        return status, response_headers, data
+
+
+def _ring_hash(key):
+    # プロセスが変わっても同じ位置になるよう、hash() ではなく blake2b を使う
+    return int.from_bytes(hashlib.blake2b(key.encode('utf-8'), digest_size=8).digest(), "big")
+
+
+class HashRing:
+    """
+    コンシステントハッシュのリング。バックエンドを増減しても、大半のキーは同じバックエンドに割り当てられたままになります。
+
+    Args:
+        backends (list[Backend]): リングに載せるバックエンド。
+        vnodes (int): 1 台あたりの仮想ノード数 (多いほどキーが均等に分散する)。
+    """
+
+    def __init__(self, backends, vnodes=64):
+        points = sorted((_ring_hash(f"{backend.url}#{i}"), index)
+                        for index, backend in enumerate(backends) for i in range(vnodes))
+        self._hashes = [h for h, _ in points]
+        self._owners = [index for _, index in points]
+        self.backends = backends
+
+    def walk(self, key):
+        """キーの位置から時計回りに、各バックエンドを 1 回ずつ (優先順に) 返します。"""
+        start = bisect.bisect(self._hashes, _ring_hash(key))
+        seen = set()
+        for i in range(len(self._owners)):
+            index = self._owners[(start + i) % len(self._owners)]
+            if index not in seen:
+                seen.add(index)
+                yield self.backends[index]
+                if len(seen) == len(self.backends):
+                    return
+
+
+class UpstreamEngine:
+    """
+    複数バックエンドへの負荷分散とヘッジリクエストを行うエンジン。
+
+    最初に選んだバックエンドが p95 相当の時間内に応答しなければ、別のバックエンドに
+    同じリクエストを送り、先に返ってきた方を採用して遅い方はキャンセルします。
+
+    Args:
+        urls (list): バックエンドのベースURL。
+        policy (str): "least_outstanding" (未完了数が最少)、"ewma" (EWMA レイテンシ × 負荷が最小)、
+            または "affinity" (affinity_key ごとに決まったバックエンド。キーがなければ least_outstanding)。
+        hedge_quantile (float): ヘッジ遅延に使う分位点。
+        default_hedge_delay_ms (float): サンプルが少ない間のヘッジ遅延。
+        min_hedge_delay_ms (float): ヘッジ遅延の下限。
+        min_samples (int): 分位点を使い始めるサンプル数。
+        breaker_options (dict): 指定するとバックエンドごとに CircuitBreaker を作り、open のバックエンドを選択から外す。
+        affinity_load_factor (float): affinity で 1 台に許す未完了数の上限 (全体の平均の何倍か)。
+            超えている場合はリング上の次のバックエンドに回す (負荷の上限付きコンシステントハッシュ)。
+        affinity_vnodes (int): affinity のリングの 1 台あたりの仮想ノード数。
+        on_breaker_change (callable): (バックエンドの URL, 旧状態, 新状態) を受け取る、ブレーカーの状態遷移のコールバック。
+    """
+
+    def __init__(self, urls, policy="least_outstanding", hedge_quantile=0.95,
+                 default_hedge_delay_ms=2000.0, min_hedge_delay_ms=50.0, min_samples=20,
+                 breaker_options=None, affinity_load_factor=1.25, affinity_vnodes=64, on_breaker_change=None):
+        self.backends = [Backend(url, breaker=self._breaker(url, breaker_options, on_breaker_change)) for url in urls]
+        self.policy = policy
+        self.hedge_quantile = hedge_quantile
+        self.default_hedge_delay_ms = default_hedge_delay_ms
+        self.min_hedge_delay_ms = min_hedge_delay_ms
+        self.min_samples = min_samples
+        self.hedges_sent = 0
+        self.hedges_won = 0
+        self.affinity_load_factor = affinity_load_factor
+        self.ring = HashRing(self.backends, affinity_vnodes) if policy == "affinity" else None
+        # affinity で最初の候補 (キャッシュが温まっているはずのバックエンド) を使えた回数と、次の候補に回した回数
+        self.affinity_hits = 0
+        self.affinity_spills = 0
+        self._loop = None
+        self._loop_thread = None
+        self._loop_lock = threading.Lock()
+
+    @staticmethod
+    def _breaker(url, options, on_change):
+        if options is None:
+            return None
+        if on_change is None:
+            return CircuitBreaker(**options)
+        return CircuitBreaker(on_state_change=lambda old, new: on_change(url, old, new), **options)
+
+    def _score(self, backend):
+        if self.policy == "ewma":
+            # 未計測のバックエンドは優先的に試す
+            return (backend.ewma_ms or 0.0) * (backend.outstanding + 1)
+        return (backend.outstanding, backend.ewma_ms or 0.0)
+
+    def pick(self, exclude=(), affinity_key=None):
+        if self.ring is not None and affinity_key is not None:
+            backend = self._pick_affinity(exclude, affinity_key)
+            if backend is not None:
+                return backend
+        # スコア順に見て、サーキットが閉じている (または half_open の試行枠がある) 最初のバックエンドを使う
+        for backend in sorted((b for b in self.backends if b not in exclude), key=self._score):
+            if backend.breaker is None or backend.breaker.allow():
+                return backend
+        return None
+
+    def _pick_affinity(self, exclude, affinity_key):
+        # 1 台の未完了数は (全体 + 1) / 台数 × load_factor まで。同じキーのリクエストが集中しても
+        # 1 台だけが詰まらないよう、上限に達したバックエンドや open のバックエンドは飛ばしてリング上の次に回す
+        limit = math.ceil(self.affinity_load_factor * (sum(b.outstanding for b in self.backends) + 1)
+                          / len(self.backends))
+        for position, backend in enumerate(self.ring.walk(affinity_key)):
+            if backend in exclude or backend.outstanding >= limit:
+                continue
+            if backend.breaker is None or backend.breaker.allow():
+                if position == 0:
+                    self.affinity_hits += 1
+                elif not exclude:
+                    self.affinity_spills += 1
+                return backend
+        return None
+
+    def hedge_delay(self, backend):
+        if len(backend.histogram.recent) < self.min_samples:
+            return self.default_hedge_delay_ms / 1000
+        return max(self.min_hedge_delay_ms, backend.histogram.quantile(self.hedge_quantile)) / 1000
+
+    async def _attempt(self, backend, path, body, headers):
+        backend.outstanding += 1
+        started = time.perf_counter()
+        try:
+            status, data = await backend.post(path, body, headers)
+        except asyncio.CancelledError:
+            # キャンセルされた負け側は「少なくともこれだけ遅い」ことが分かっているので、
+            # 経過時間を記録して次回以降の選択で避けられるようにする
+            backend.observe((time.perf_counter() - started) * 1000, ok=None)
+            raise
+        except Exception:
+            backend.observe((time.perf_counter() - started) * 1000, ok=False)
+            raise
+        finally:
+            backend.outstanding -= 1
+        backend.observe((time.perf_counter() - started) * 1000, ok=status < 500)
+        return backend, status, data
+
+    async def post(self, path, body, headers, timeout=60.0, affinity_key=None):
+        """
+        リクエストを送信し、(ステータス, ボディ, 応答したバックエンドのURL, ヘッジしたか) を返します。
+
+        最初の試行が失敗 (例外または 5xx) した場合も、ヘッジ前であれば別のバックエンドに送り直します。
+        全バックエンドのサーキットが開いている場合は、接続せずに CircuitOpenError を送出します。
+        affinity_key (会話 ID など) を指定すると、policy="affinity" では同じキーを同じバックエンドに送ります。
+        """
+        primary = self.pick(affinity_key=affinity_key)
+        if primary is None:
+            raise CircuitOpenError(min(b.breaker.retry_after() for b in self.backends))
+        pending = {asyncio.ensure_future(self._attempt(primary, path, body, headers))}
+        hedged = False
+        deadline = time.monotonic() + timeout
+        failure = None
+
+        def launch_secondary():
+            secondary = self.pick(exclude=(primary,), affinity_key=affinity_key)
+            if secondary is None:
+                return False
+            self.hedges_sent += 1
+            pending.add(asyncio.ensure_future(self._attempt(secondary, path, body, headers)))
+            return True
+
+        try:
+            while pending:
+                remaining = deadline - time.monotonic()
+                if remaining <= 0:
+                    raise asyncio.TimeoutError()
+                wait_for = remaining if hedged else min(self.hedge_delay(primary), remaining)
+                done, pending = await asyncio.wait(pending, timeout=wait_for, return_when=asyncio.FIRST_COMPLETED)
+                if not done:
+                    if not hedged:
+                        hedged = True
+                        launch_secondary()
+                    continue
+                for task in done:
+                    if task.exception() is None:
+                        backend, status, data = task.result()
+                        if status < 500:
+                            if backend is not primary:
+                                self.hedges_won += 1
+                            return status, data, backend.url, hedged
+                        failure = (status, data, backend.url)
+                    else:
+                        failure = task.exception()
+                if not hedged:
+                    hedged = True
+                    launch_secondary()
+            if isinstance(failure, tuple):
+                return (*failure, hedged)
+            raise failure
+        finally:
+            for task in pending:
+                task.cancel()
+            # 負け側のキャンセル処理 (接続のクローズ) をこの呼び出しの中で完了させる
+            if pending:
+                await asyncio.gather(*pending, return_exceptions=True)
+
+    def _running_loop(self):
+        # イベントループは専用のスレッドで動かし続ける (ロックはループの起動時だけ取る)
+        with self._loop_lock:
+            if self._loop is None or self._loop.is_closed() or not self._loop_thread.is_alive():
+                self._loop = asyncio.new_event_loop()
+                self._loop_thread = threading.Thread(target=self._loop.run_forever, name="upstream-engine",
+                                                     daemon=True)
+                self._loop_thread.start()
+            return self._loop
+
+    def post_sync(self, path, body, headers, timeout=60.0, affinity_key=None):
+        """
+        同期コードから呼び出すためのラッパー。
+
+        イベントループはモジュールレベルで使い回すので、ウォームスタート間で接続も再利用されます。
+        ループは専用のスレッドで動き、呼び出しは run_coroutine_threadsafe で投入するので、
+        複数のスレッド (非同期ジョブのワーカーなど) からの呼び出しは互いを待たずに並行して進みます。
+        """
+        future = asyncio.run_coroutine_threadsafe(self.post(path, body, headers, timeout, affinity_key),
+                                                  self._running_loop())
+        try:
+            return future.result()
+        except asyncio.TimeoutError as e:
+            # 同期側の呼び出し元が socket.timeout と同じように扱えるよう組み込みの TimeoutError にする
+            # (Python 3.10 では asyncio.TimeoutError は別のクラス)
+            raise TimeoutError(f"No backend responded within {timeout}s") from e
+
+    def snapshot(self):
+        return {
+            "hedges_sent": self.hedges_sent,
+            "hedges_won": self.hedges_won,
+            "affinity_hits": self.affinity_hits,
+            "affinity_spills": self.affinity_spills,
+            "backends": {
+                b.url: {
+                    "outstanding": b.outstanding,
+                    "ewma_ms": b.ewma_ms,
+                    "errors": b.errors,
+                    "breaker": b.breaker.metrics() if b.breaker is not None else None,
+                    "latency": b.histogram.snapshot(),
+                }
+                for b in self.backends
+            },
+        }
@@ -12,9 +12,14 @@ import * as cognito from 'aws-cdk-lib/aws-cognito';
 import * as path from 'path';
 import * as cr from 'aws-cdk-lib/custom-resources';
 import * as logs from 'aws-cdk-lib/aws-logs';
+import * as dynamodb from 'aws-cdk-lib/aws-dynamodb';
+import * as sqs from 'aws-cdk-lib/aws-sqs';
+import * as lambdaEventSources from 'aws-cdk-lib/aws-lambda-event-sources';
 
 export interface BedrockChatbotStackProps extends cdk.StackProps {
   modelId?: string;
+  // 生成に使うプロバイダー ('http': NGROK_URL の推論サーバー, 'bedrock': modelId の Bedrock モデル)
+  modelProvider?: string;
 }
 
 export class BedrockChatbotStack extends cdk.Stack {
@@ -22,6 +27,7 @@ export class BedrockChatbotStack extends cdk.Stack {
     super(scope, id, props);
 
     const modelId = props?.modelId || 'us.amazon.nova-lite-v1:0';
+    const modelProvider = props?.modelProvider || 'http';
 
     // Cognito User Poolの作成
     const userPool = new cognito.UserPool(this, 'ChatbotUserPool', {
@@ -148,18 +154,125 @@ export class BedrockChatbotStack extends cdk.Stack {
       resources: ['*']
     }));
 
+    // 会話履歴テーブル (会話IDごとの追記専用ログ)
+    const conversationTable = new dynamodb.Table(this, 'ConversationTable', {
+      partitionKey: { name: 'conversationId', type: dynamodb.AttributeType.STRING },
+      sortKey: { name: 'seq', type: dynamodb.AttributeType.NUMBER },
+      billingMode: dynamodb.BillingMode.PAY_PER_REQUEST,
+      timeToLiveAttribute: 'expiresAt',
+      removalPolicy: cdk.RemovalPolicy.DESTROY,
+    });
+
+    // 受け入れ制御テーブル (ユーザーごとのトークンバケットと、同時実行中のリース)
+    const admissionTable = new dynamodb.Table(this, 'AdmissionTable', {
+      partitionKey: { name: 'pk', type: dynamodb.AttributeType.STRING },
+      billingMode: dynamodb.BillingMode.PAY_PER_REQUEST,
+      timeToLiveAttribute: 'expiresAt',
+      removalPolicy: cdk.RemovalPolicy.DESTROY,
+    });
+
+    // 非同期ジョブの状態・途中経過・結果のテーブル
+    const jobTable = new dynamodb.Table(this, 'JobTable', {
+      partitionKey: { name: 'jobId', type: dynamodb.AttributeType.STRING },
+      billingMode: dynamodb.BillingMode.PAY_PER_REQUEST,
+      timeToLiveAttribute: 'expiresAt',
+      removalPolicy: cdk.RemovalPolicy.DESTROY,
+    });
+
+    // DynamoDB の項目 (400KB まで) に収まらない大きなジョブの結果 (ジョブの保持期間と同じ 1 日で削除)
+    const jobResultBucket = new s3.Bucket(this, 'JobResultBucket', {
+      blockPublicAccess: s3.BlockPublicAccess.BLOCK_ALL,
+      encryption: s3.BucketEncryption.S3_MANAGED,
+      lifecycleRules: [{ expiration: cdk.Duration.days(1) }],
+      removalPolicy: cdk.RemovalPolicy.DESTROY,
+      autoDeleteObjects: true,
+    });
+
+    // 非同期ジョブのキュー (3 回失敗したメッセージはデッドレターキューへ)
+    const jobDeadLetterQueue = new sqs.Queue(this, 'JobDeadLetterQueue', {
+      retentionPeriod: cdk.Duration.days(4),
+    });
+    const jobQueue = new sqs.Queue(this, 'JobQueue', {
+      // ワーカーのタイムアウトより長くし、実行中のメッセージが再配信されないようにする
+      visibilityTimeout: cdk.Duration.minutes(6),
+      deadLetterQueue: { queue: jobDeadLetterQueue, maxReceiveCount: 3 },
+    });
+
+    // Lambda が gzip / br で圧縮して base64 で返す応答を、API Gateway がバイナリとしてクライアントに返すメディアタイプ
+    // (API Gateway は Accept の最初のメディアタイプがこれに一致する場合だけデコードするので、Lambda にも同じ値を渡し、
+    // 一致しないリクエストには圧縮しない応答を返す)
+    const binaryMediaTypes = ['application/json', 'text/event-stream'];
+
+    // Lambda のコード。requirements.txt のパッケージ (orjson など) を Lambda と同じイメージでインストールして同梱する
+    // (ネイティブ拡張を含むので、ローカルの pip install ではなくこのイメージでビルドする。Docker が必要)
+    const lambdaCode = lambda.Code.fromAsset(path.join(__dirname, '../lambda'), {
+      bundling: {
+        image: lambda.Runtime.PYTHON_3_10.bundlingImage,
+        command: [
+          'bash', '-c',
+          'pip install --no-cache-dir -r requirements.txt -t /asset-output && cp -au . /asset-output',
+        ],
+      },
+    });
+
     // Lambda function
     const chatFunction = new lambda.Function(this, 'ChatFunction', {
       runtime: lambda.Runtime.PYTHON_3_10,
       handler: 'index.lambda_handler',
-      code: lambda.Code.fromAsset(path.join(__dirname, '../lambda')),
+      code: lambdaCode,
       timeout: cdk.Duration.seconds(30),
       memorySize: 128,
       role: lambdaRole,
       environment: {
         MODEL_ID: modelId,
+        MODEL_PROVIDER: modelProvider,
+        CONVERSATION_STORE: 'dynamodb',
+        CONVERSATION_TABLE: conversationTable.tableName,
+        CONVERSATION_TTL_DAYS: '30',
+        ADMISSION_STORE: 'dynamodb',
+        ADMISSION_TABLE: admissionTable.tableName,
+        JOB_QUEUE: 'sqs',
+        JOB_QUEUE_URL: jobQueue.queueUrl,
+        JOB_STORE: 'dynamodb',
+        JOB_TABLE: jobTable.tableName,
+        JOB_RESULT_BUCKET: jobResultBucket.bucketName,
+        BINARY_MEDIA_TYPES: binaryMediaTypes.join(','),
       },
     });
+    conversationTable.grantReadWriteData(chatFunction);
+    admissionTable.grantReadWriteData(chatFunction);
+    jobTable.grantReadWriteData(chatFunction);
+    jobResultBucket.grantRead(chatFunction);
+    jobQueue.grantSendMessages(chatFunction);
+
+    // 非同期ジョブのワーカー (API Gateway の 29 秒の制限を受けないので、長い生成もここで行う)
+    const jobWorkerFunction = new lambda.Function(this, 'JobWorkerFunction', {
+      runtime: lambda.Runtime.PYTHON_3_10,
+      handler: 'index.worker_handler',
+      code: lambdaCode,
+      timeout: cdk.Duration.minutes(5),
+      memorySize: 128,
+      role: lambdaRole,
+      environment: {
+        MODEL_ID: modelId,
+        MODEL_PROVIDER: modelProvider,
+        CONVERSATION_STORE: 'dynamodb',
+        CONVERSATION_TABLE: conversationTable.tableName,
+        CONVERSATION_TTL_DAYS: '30',
+        JOB_STORE: 'dynamodb',
+        JOB_TABLE: jobTable.tableName,
+        JOB_RESULT_BUCKET: jobResultBucket.bucketName,
+      },
+    });
+    conversationTable.grantReadWriteData(jobWorkerFunction);
+    jobTable.grantReadWriteData(jobWorkerFunction);
+    jobResultBucket.grantPut(jobWorkerFunction);
+    jobWorkerFunction.addEventSource(new lambdaEventSources.SqsEventSource(jobQueue, {
+      batchSize: 1,
+      // 同時に生成するジョブ数の上限 (推論サーバーを飽和させない)
+      maxConcurrency: 4,
+      reportBatchItemFailures: true,
+    }));
 
     // 明示的な依存関係を追加
     const cfnChatFunction = chatFunction.node.defaultChild as lambda.CfnFunction;
@@ -170,6 +283,9 @@ export class BedrockChatbotStack extends cdk.Stack {
     const api = new apigateway.RestApi(this, 'ChatbotApi', {
       restApiName: 'Bedrock Chatbot API',
       description: 'API for Bedrock Converse chatbot',
+      // Lambda が gzip / br で圧縮して base64 で返す応答を、API Gateway がバイナリとしてクライアントに返せるようにする
+      // (この型のリクエストボディも base64 で Lambda に届くので、ハンドラー側でデコードする)
+      binaryMediaTypes,
       defaultCorsPreflightOptions: {
         allowOrigins: apigateway.Cors.ALL_ORIGINS,
         allowMethods: apigateway.Cors.ALL_METHODS,
@@ -189,6 +305,13 @@ export class BedrockChatbotStack extends cdk.Stack {
       authorizationType: apigateway.AuthorizationType.COGNITO,
     });
 
+    // 非同期ジョブのポーリング (GET /chat/jobs/{jobId})
+    const jobResource = chatResource.addResource('jobs').addResource('{jobId}');
+    jobResource.addMethod('GET', new apigateway.LambdaIntegration(chatFunction), {
+      authorizer,
+      authorizationType: apigateway.AuthorizationType.COGNITO,
+    });
+
     // 設定生成用のLambdaロールを作成
     const configGeneratorRole = new iam.Role(this, 'ConfigGeneratorRole', {
       assumedBy: new iam.ServicePrincipal('lambda.amazonaws.com'),
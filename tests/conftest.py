@@ -0,0 +1,30 @@
+# tests/conftest.py
+# lambda/ のモジュールと benchmarks/ のスタブをテストから import できるようにする
+import os
+import sys
+
+ROOT = os.path.join(os.path.dirname(os.path.abspath(__file__)), '..')
+sys.path.insert(0, os.path.join(ROOT, 'lambda'))
+sys.path.insert(0, os.path.join(ROOT, 'benchmarks'))
+
+import importlib  # noqa: E402
+
+import pytest  # noqa: E402
+
+
+@pytest.fixture
+def load_index(monkeypatch):
+    """
+    環境変数を設定してから lambda/index.py を読み込み直す関数を返します
+    (index.py は設定をモジュールの初期化時に読むため)。
+    """
+    def load(**env):
+        defaults = {"METRICS_SINK": "none", "PREWARM_CONNECTION": "false", "LOG_LEVEL": "ERROR",
+                    "NGROK_URL": "http://127.0.0.1:9"}
+        for key, value in {**defaults, **env}.items():
+            monkeypatch.setenv(key, value)
+        sys.modules.pop("index", None)
+        return importlib.import_module("index")
+
+    yield load
+    sys.modules.pop("index", None)
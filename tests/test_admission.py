@@ -0,0 +1,120 @@
+# tests/test_admission.py
+import threading
+import time
+
+import pytest
+
+from admission import (ADMITTED, CONCURRENCY_LIMITED, OVER_FAIR_SHARE, SATURATED, AdmissionController,
+                       AdmissionPolicy, AdmissionRejected, MemoryAdmissionStore)
+
+
+def test_saturated_backend_rejects_only_users_over_fair_share():
+    policy = AdmissionPolicy(rate_per_second=0, max_concurrency=0, global_capacity=4)
+    inflight = {"heavy": 3, "light": 1}
+    # 取り分は 4 // 2 = 2
+    assert policy.decide(None, None, inflight, "heavy", 0).reason == OVER_FAIR_SHARE
+    assert policy.decide(None, None, inflight, "light", 0).reason == SATURATED
+    # 新しいユーザーは数に入れて取り分を計算する (4 // 3 = 1)
+    assert policy.decide(None, None, inflight, "new", 0).reason == SATURATED
+
+
+def test_per_user_concurrency_limit():
+    store = MemoryAdmissionStore()
+    policy = AdmissionPolicy(rate_per_second=0, max_concurrency=2)
+    assert [store.acquire("a", str(i), policy, 0).reason for i in range(3)] == [ADMITTED, ADMITTED, CONCURRENCY_LIMITED]
+    store.release("a", "0")
+    assert store.acquire("a", "3", policy, 0).admitted
+
+
+def test_waiting_interval_grows_with_the_users_inflight(monkeypatch):
+    store = MemoryAdmissionStore()
+    policy = AdmissionPolicy(rate_per_second=0, max_concurrency=0, global_capacity=4)
+    for i in range(3):
+        store.acquire("heavy", f"h{i}", policy, time.time())
+    store.acquire("light", "l0", policy, time.time())
+    sleeps = []
+    monkeypatch.setattr(time, "sleep", sleeps.append)
+    controller = AdmissionController(store, policy, queue_timeout=60, poll_interval=0.01)
+    # 重いユーザーは取り分 (2) を超えているので待たずに拒否される
+    with pytest.raises(AdmissionRejected) as rejected:
+        controller.acquire("heavy", max_wait=60)
+    assert rejected.value.reason == OVER_FAIR_SHARE
+    assert sleeps == []
+
+    # 軽いユーザーは poll_interval × (1 + 同時実行数) の間隔で空きを待つ
+    calls = []
+
+    def acquire(user, lease_id, policy, now):
+        calls.append(lease_id)
+        if len(calls) == 3:
+            store.release("heavy", "h0")
+        return MemoryAdmissionStore.acquire(store, user, lease_id, policy, now)
+
+    monkeypatch.setattr(store, "acquire", acquire)
+    assert controller.acquire("light", max_wait=60) is not None
+    assert sleeps == [pytest.approx(0.02), pytest.approx(0.02)]
+    assert controller.stats()["queued"] == 1
+
+
+def test_store_failure_admits_the_request():
+    class BrokenStore:
+        def acquire(self, user, lease_id, policy, now):
+            raise RuntimeError("store unavailable")
+
+        def release(self, user, lease_id):
+            raise RuntimeError("store unavailable")
+
+    controller = AdmissionController(BrokenStore(), AdmissionPolicy())
+    lease_id = controller.acquire("a")
+    assert lease_id is None
+    controller.release("a", lease_id)
+    controller.release("a", "lease")
+    assert controller.stats()["store_errors"] == 2
+
+
+@pytest.fixture
+def dynamodb_store(monkeypatch):
+    moto = pytest.importorskip("moto")
+    import boto3
+    for key, value in (("AWS_ACCESS_KEY_ID", "test"), ("AWS_SECRET_ACCESS_KEY", "test"),
+                       ("AWS_DEFAULT_REGION", "us-east-1")):
+        monkeypatch.setenv(key, value)
+    from admission import DynamoDBAdmissionStore
+    from bench_admission import SerializedClient
+    with moto.mock_aws():
+        client = SerializedClient(boto3.client("dynamodb"))
+        client.create_table(TableName="admission", KeySchema=[{"AttributeName": "pk", "KeyType": "HASH"}],
+                            AttributeDefinitions=[{"AttributeName": "pk", "AttributeType": "S"}],
+                            BillingMode="PAY_PER_REQUEST")
+        yield DynamoDBAdmissionStore("admission", client=client)
+
+
+def test_dynamodb_store_keeps_global_capacity_under_concurrency(dynamodb_store):
+    policy = AdmissionPolicy(rate_per_second=0, max_concurrency=0, global_capacity=10)
+    now = time.time()
+    results = []
+
+    def acquire(i):
+        results.append(dynamodb_store.acquire(f"user{i % 20}", f"lease{i}", policy, now).admitted)
+
+    threads = [threading.Thread(target=acquire, args=(i,)) for i in range(40)]
+    for thread in threads:
+        thread.start()
+    for thread in threads:
+        thread.join()
+    assert len(results) == 40
+    assert sum(results) == 10
+
+
+def test_dynamodb_store_releases_and_expires_leases(dynamodb_store):
+    policy = AdmissionPolicy(rate_per_second=0, max_concurrency=2, global_capacity=2, lease_seconds=60)
+    now = time.time()
+    assert dynamodb_store.acquire("a", "a1", policy, now).admitted
+    assert dynamodb_store.acquire("b", "b1", policy, now).admitted
+    assert dynamodb_store.acquire("c", "c1", policy, now).reason == SATURATED
+    dynamodb_store.release("a", "a1")
+    assert dynamodb_store.acquire("c", "c2", policy, now).admitted
+    # 解放されなかったリースは lease_seconds 後に数えなくなる
+    later = now + 2 * policy.lease_seconds + 1
+    assert dynamodb_store.acquire("d", "d1", policy, later).admitted
+    assert dynamodb_store.acquire("e", "e1", policy, later).admitted
@@ -0,0 +1,83 @@
+# tests/test_circuit_breaker.py
+import time
+
+import stub_backend
+from circuit_breaker import CLOSED, HALF_OPEN, OPEN, CircuitBreaker
+from loadtest import FakeContext, make_event
+from metrics import Instrumentation, MemorySink
+
+
+def make_breaker(healthy, transitions):
+    return CircuitBreaker(failure_rate_threshold=0.5, min_requests=2, open_seconds=0.05,
+                          health_check=lambda: healthy[0],
+                          on_state_change=lambda old, new: transitions.append((old, new)))
+
+
+def test_breaker_opens_probes_and_closes():
+    healthy, transitions = [False], []
+    breaker = make_breaker(healthy, transitions)
+    breaker.record_success()
+    breaker.record_failure()
+    assert breaker.state == OPEN
+    assert not breaker.allow()
+    # open_seconds 後も /health が異常なら open のまま
+    time.sleep(0.06)
+    assert not breaker.allow()
+    assert breaker.state == OPEN
+    # 正常になれば試行リクエストを 1 件だけ通す
+    healthy[0] = True
+    time.sleep(0.06)
+    assert breaker.allow()
+    assert breaker.state == HALF_OPEN
+    assert not breaker.allow()
+    breaker.record_success()
+    assert breaker.state == CLOSED
+    assert transitions == [(CLOSED, OPEN), (OPEN, HALF_OPEN), (HALF_OPEN, CLOSED)]
+    assert breaker.metrics()["probe_failures"] == 1
+
+
+def test_failed_trial_reopens_the_breaker():
+    healthy, transitions = [True], []
+    breaker = make_breaker(healthy, transitions)
+    breaker.record_failure()
+    breaker.record_failure()
+    time.sleep(0.06)
+    assert breaker.allow()
+    breaker.record_failure()
+    assert breaker.state == OPEN
+    assert transitions == [(CLOSED, OPEN), (OPEN, HALF_OPEN), (HALF_OPEN, OPEN)]
+    assert breaker.metrics()["opened"] == 2
+
+
+def test_counts_and_gauges_are_emitted_per_dimension():
+    metrics = Instrumentation(sink=MemorySink(), flush_seconds=3600, dimensions={"FunctionName": "chat"})
+    metrics.count("circuit_transitions", {"Backend": "a", "Transition": "closed->open"})
+    metrics.count("circuit_transitions", {"Backend": "a", "Transition": "closed->open"})
+    metrics.gauge("circuit_state", 1, {"Backend": "a"})
+    metrics.gauge("circuit_state", 2, {"Backend": "a"})
+    metrics.flush()
+    records = {tuple(r["_aws"]["CloudWatchMetrics"][0]["Dimensions"][0]): r for r in metrics.sink.records}
+    transitions = records[("Backend", "FunctionName", "Transition")]
+    assert transitions["circuit_transitions"] == 2
+    assert transitions["_aws"]["CloudWatchMetrics"][0]["Metrics"] == [{"Name": "circuit_transitions", "Unit": "Count"}]
+    assert records[("Backend", "FunctionName")]["circuit_state"] == 2
+    metrics.flush()
+    assert len(metrics.sink.records) == 2
+
+
+def test_mid_stream_timeout_is_recorded_once(load_index):
+    # 最初のトークンはすぐに、以降は 1 秒ごとに返すので、期限 (1.5 秒) はストリームの途中で来る
+    model = stub_backend.GenerationModel(ttft_ms=5, ttft_sigma=0, tokens_per_second=1, output_tokens=10, seed=0)
+    url = stub_backend.start(model=model)[2]
+    index = load_index(NGROK_URL=url, METRICS_SINK="memory", METRICS_FLUSH_SECONDS="3600",
+                       CIRCUIT_MIN_REQUESTS="1", MIN_ATTEMPT_TIMEOUT="0.2", SINGLEFLIGHT_ENABLED="false")
+    response = index.lambda_handler(make_event({"message": "hello", "stream": True}, 1), FakeContext("req", 2500))
+    assert response["statusCode"] == 200
+    assert "event: done" in response["body"]
+    breaker = index.upstream_breaker.metrics()
+    assert (breaker["window_requests"], breaker["failure_rate"], breaker["state"]) == (1, 1.0, OPEN)
+
+    index.metrics.flush()
+    transitions = [r for r in index.metrics.sink.records if "circuit_transitions" in r]
+    assert [(r["Backend"], r["Transition"], r["circuit_transitions"]) for r in transitions] == [
+        (url, "closed->open", 1)]
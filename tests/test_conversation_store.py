@@ -0,0 +1,91 @@
+# tests/test_conversation_store.py
+import json
+import time
+
+import pytest
+
+from conversation_store import MemoryConversationStore, SQLiteConversationStore
+from history import extractive_summary
+from loadtest import FakeContext, make_event
+
+
+@pytest.fixture(params=["memory", "sqlite", "dynamodb"])
+def store(request, tmp_path, monkeypatch):
+    if request.param == "memory":
+        yield MemoryConversationStore()
+    elif request.param == "sqlite":
+        yield SQLiteConversationStore(str(tmp_path / "conversations.db"))
+    else:
+        moto = pytest.importorskip("moto")
+        import boto3
+        for key, value in (("AWS_ACCESS_KEY_ID", "test"), ("AWS_SECRET_ACCESS_KEY", "test"),
+                           ("AWS_DEFAULT_REGION", "us-east-1")):
+            monkeypatch.setenv(key, value)
+        from conversation_store import DynamoDBConversationStore
+        with moto.mock_aws():
+            boto3.client("dynamodb").create_table(
+                TableName="conversations",
+                KeySchema=[{"AttributeName": "conversationId", "KeyType": "HASH"},
+                           {"AttributeName": "seq", "KeyType": "RANGE"}],
+                AttributeDefinitions=[{"AttributeName": "conversationId", "AttributeType": "S"},
+                                      {"AttributeName": "seq", "AttributeType": "N"}],
+                BillingMode="PAY_PER_REQUEST")
+            yield DynamoDBConversationStore("conversations", ttl_days=1)
+
+
+def test_summary_is_saved_with_the_turn(store):
+    assert store.load_summary("u/c") is None
+    turn = [{"role": "user", "content": "hi"}, {"role": "assistant", "content": "hello"}]
+    assert store.append("u/c", turn) == 2
+    assert store.load_summary("u/c") is None
+    assert store.append("u/c", turn, summary={"upto": 2, "text": "- hi"}) == 4
+    assert store.load_summary("u/c") == {"upto": 2, "text": "- hi"}
+    assert store.count("u/c") == 4
+    assert store.load("u/c", limit=3) == [*turn[1:], *turn]
+
+
+def test_memory_store_evicts_least_recently_used_conversations():
+    store = MemoryConversationStore(max_conversations=2)
+    for key in ("a", "b"):
+        store.append(key, [{"role": "user", "content": key}])
+    store.load("a")
+    store.append("c", [{"role": "user", "content": "c"}])
+    assert (len(store), store.evictions) == (2, 1)
+    assert store.load("b") == []
+    assert store.count("a") == 1
+
+
+def test_memory_store_drops_idle_conversations():
+    store = MemoryConversationStore(ttl=0.05)
+    store.append("a", [{"role": "user", "content": "a"}], summary={"upto": 1, "text": "- a"})
+    time.sleep(0.06)
+    assert store.load_summary("a") is None
+    assert (len(store), store.expirations) == (0, 1)
+
+
+def test_second_turn_extends_the_saved_summary(load_index, monkeypatch):
+    index = load_index(HISTORY_TOKEN_BUDGET="60", HISTORY_SUMMARY_BUDGET="15", CONVERSATION_STORE="memory",
+                       SINGLEFLIGHT_ENABLED="false", RESPONSE_CACHE_ENABLED="false")
+    summarized = []
+
+    def summarizer(previous, messages):
+        summarized.append(len(messages))
+        return extractive_summary(previous, messages)
+
+    monkeypatch.setattr(index.history_builder, "summarizer", summarizer)
+    monkeypatch.setattr(index, "generate_text", lambda *args, **kwargs: ("An answer of about ten tokens here.", True, 8))
+
+    def send(turn):
+        body = {"message": f"Question number {turn} about the same topic?", "conversationId": "c"}
+        response = index.lambda_handler(make_event(body, 1), FakeContext(f"req-{turn}", 30000))
+        assert response["statusCode"] == 200
+        return json.loads(response["body"])
+
+    for turn in range(6):
+        send(turn)
+    assert summarized, "the window never overflowed"
+    # 2 回目以降の要約では、前回の要約に新たに外れたターン (2 件) だけを追加する
+    assert all(count <= 2 for count in summarized[1:])
+    saved = index.conversation_store.load_summary("user1/c")
+    assert saved["upto"] == 2 * len(summarized)
+    assert saved["text"].splitlines()[-1] == f"- Question number {len(summarized) - 1} about the same topic?"
@@ -0,0 +1,59 @@
+# tests/test_deadline.py
+import pytest
+
+from deadline import AdaptiveTimeout, Deadline
+from loadtest import FakeContext, make_event
+
+
+def test_deadline_is_capped_before_the_margin():
+    context = FakeContext("req", 30000)
+    # 30 秒の関数でも、API Gateway の 29 秒から余裕の 1 秒を引いた 28 秒を期限にする
+    assert Deadline.from_context(context, margin_ms=1000, cap_ms=29000).remaining() == pytest.approx(28, abs=0.1)
+    assert Deadline.from_context(context, margin_ms=1000).remaining() == pytest.approx(29, abs=0.1)
+    # 残り時間が上限より短ければ残り時間から決める
+    assert Deadline.from_context(FakeContext("req", 5000), cap_ms=29000).remaining() == pytest.approx(4, abs=0.1)
+
+
+@pytest.mark.parametrize("event, expected", [
+    (make_event({"message": "hello"}, 1), 28),
+    # 非同期ジョブのイベント (API Gateway を通らない) は Lambda の残り時間だけで決める
+    ({"body": '{"message": "hello"}', "requestContext": {"authorizer": {"claims": {}}}}, 29),
+])
+def test_handler_caps_api_gateway_requests(load_index, monkeypatch, event, expected):
+    index = load_index(SINGLEFLIGHT_ENABLED="false")
+    remaining = []
+
+    def generate_text(payload, payload_bytes, deadline, affinity_key=None, on_token=None):
+        remaining.append(deadline.remaining())
+        return "hi", True, 1
+
+    monkeypatch.setattr(index, "generate_text", generate_text)
+    response = index.lambda_handler(event, FakeContext("req", 30000))
+    assert response["statusCode"] == 200
+    assert remaining == [pytest.approx(expected, abs=0.5)]
+
+
+def test_attempt_timeout_is_keyed_by_size():
+    timeouts = AdaptiveTimeout(multiplier=1.5, min_timeout=0.1, min_samples=5)
+    for _ in range(5):
+        timeouts.observe(0.2, size=64)
+        timeouts.observe(2.0, size=512)
+    deadline = Deadline(20)
+    assert timeouts.attempt_timeout(deadline, 64) == pytest.approx(0.3)
+    assert timeouts.attempt_timeout(deadline, 512) == pytest.approx(3.0)
+    # サンプルのない大きさでは残り時間をすべて使う
+    assert timeouts.attempt_timeout(deadline, 1024) == pytest.approx(20, abs=0.1)
+
+
+def test_timed_out_attempts_raise_the_timeout():
+    timeouts = AdaptiveTimeout(quantile=0.99, multiplier=1.5, min_timeout=0.1, min_samples=5)
+    for _ in range(5):
+        timeouts.observe(0.2, size=256)
+    deadline = Deadline(20)
+    timeout = timeouts.attempt_timeout(deadline, 256)
+    # 上流が遅くなり、打ち切りが続くとタイムアウトが伸びていく
+    for _ in range(3):
+        timeouts.observe(timeout, size=256)
+        longer = timeouts.attempt_timeout(deadline, 256)
+        assert longer > timeout
+        timeout = longer
@@ -0,0 +1,94 @@
+# tests/test_encoding.py
+import base64
+import gzip
+import json
+
+import pytest
+
+from encoding import ResponseEncoder, accepts_binary, request_text
+from loadtest import FakeContext, make_event
+
+HEADERS = {"Content-Type": "application/json"}
+BINARY_MEDIA_TYPES = ["application/json", "text/event-stream"]
+
+
+def large_response():
+    return {"statusCode": 200, "headers": HEADERS, "body": json.dumps({"response": "こんにちは" * 500})}
+
+
+@pytest.mark.parametrize("accept, expected", [
+    ("application/json", True),
+    ("application/json, text/plain, */*", True),
+    ("text/event-stream", True),
+    ("*/*", False),
+    ("text/html, application/json", False),
+    (None, False),
+])
+def test_accepts_binary_checks_the_first_media_type(accept, expected):
+    assert accepts_binary(accept, BINARY_MEDIA_TYPES) is expected
+    assert accepts_binary(accept, ["*/*"])
+
+
+def test_gzip_response_round_trips():
+    encoder = ResponseEncoder(codings=("gzip",), binary_media_types=BINARY_MEDIA_TYPES)
+    response = large_response()
+    encoded = encoder.encode(response, "gzip, deflate", "application/json")
+    assert encoded["isBase64Encoded"] is True
+    assert encoded["headers"] == {**HEADERS, "Content-Encoding": "gzip", "Vary": "Accept-Encoding"}
+    assert gzip.decompress(base64.b64decode(encoded["body"])).decode('utf-8') == response["body"]
+
+
+def test_brotli_response_round_trips():
+    brotli = pytest.importorskip("brotli")
+    encoder = ResponseEncoder(binary_media_types=BINARY_MEDIA_TYPES)
+    response = large_response()
+    encoded = encoder.encode(response, "gzip, br", "application/json")
+    assert encoded["headers"]["Content-Encoding"] == "br"
+    assert brotli.decompress(base64.b64decode(encoded["body"])).decode('utf-8') == response["body"]
+
+
+@pytest.mark.parametrize("accept_encoding, accept, body", [
+    # Accept-Encoding で受け付けないクライアント
+    (None, "application/json", large_response()["body"]),
+    ("gzip;q=0, identity", "application/json", large_response()["body"]),
+    # API Gateway が base64 をデコードしないクライアント (Accept: */*)
+    ("gzip", "*/*", large_response()["body"]),
+    # しきい値未満のボディ
+    ("gzip", "application/json", '{"success": true}'),
+])
+def test_uncompressed_responses_still_vary_on_accept_encoding(accept_encoding, accept, body):
+    encoder = ResponseEncoder(codings=("gzip",), binary_media_types=BINARY_MEDIA_TYPES)
+    encoded = encoder.encode({"statusCode": 200, "headers": HEADERS, "body": body}, accept_encoding, accept)
+    assert "isBase64Encoded" not in encoded
+    assert encoded["body"] == body
+    assert encoded["headers"] == {**HEADERS, "Vary": "Accept-Encoding"}
+
+
+def test_request_text_decodes_base64_bodies():
+    body = json.dumps({"message": "こんにちは"}, ensure_ascii=False)
+    event = {"body": base64.b64encode(body.encode('utf-8')).decode('ascii'), "isBase64Encoded": True}
+    assert request_text(event) == body
+    assert request_text({"body": body}) == body
+
+
+def test_handler_compresses_only_for_binary_accept(load_index, monkeypatch):
+    index = load_index(SINGLEFLIGHT_ENABLED="false", RESPONSE_COMPRESS_MIN_BYTES="256")
+    monkeypatch.setattr(index, "generate_text", lambda *args, **kwargs: ("長い応答" * 200, True, 200))
+    event = make_event({"message": "hello"}, 1)
+
+    def call(accept):
+        headers = {**event["headers"], "Accept-Encoding": "gzip"}
+        if accept is not None:
+            headers["Accept"] = accept
+        return index.lambda_handler({**event, "headers": headers}, FakeContext("req", 30000))
+
+    compressed = call("application/json, text/plain, */*")
+    assert compressed["isBase64Encoded"] is True
+    assert compressed["headers"]["Vary"] == "Accept-Encoding"
+    body = json.loads(gzip.decompress(base64.b64decode(compressed["body"])))
+    assert body["response"] == "長い応答" * 200
+    # curl などの Accept: */* には、API Gateway がそのまま返せる圧縮していない応答を返す
+    plain = call("*/*")
+    assert not plain.get("isBase64Encoded")
+    assert plain["headers"]["Vary"] == "Accept-Encoding"
+    assert json.loads(plain["body"])["response"] == body["response"]
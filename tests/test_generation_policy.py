@@ -0,0 +1,51 @@
+# tests/test_generation_policy.py
+import pytest
+
+from generation_policy import GenerationOptionsError, GenerationPolicy
+
+
+@pytest.fixture
+def policy():
+    return GenerationPolicy()
+
+
+@pytest.mark.parametrize("message", ["hi", "Hello!", "  thanks :)", "ok", "good morning", "こんにちは", "ありがとうございます"])
+def test_greeting_only_messages_use_small_budget(policy, message):
+    params, rule, _ = policy.build(message)
+    assert rule == "greeting"
+    assert params["max_new_tokens"] == 64
+
+
+@pytest.mark.parametrize("message, expected", [
+    ("history of the Roman empire", "short_question"),
+    ("okinawa travel tips", "short_question"),
+    ("Hi, can you explain how TCP congestion control works?", "long_form"),
+    ("Hey, write a python function to parse CSV", "code"),
+])
+def test_questions_starting_like_greetings_are_not_greetings(policy, message, expected):
+    params, rule, _ = policy.build(message)
+    assert rule == expected
+    assert params["max_new_tokens"] > 64
+
+
+@pytest.mark.parametrize("message", [
+    "Write a python function that parses CSV files",
+    "Explain in detail how TCP congestion control works",
+    "Some context about the system we run. " * 60,
+])
+def test_rule_budgets_do_not_exceed_the_fixed_baseline(policy, message):
+    # 従来は常に max_new_tokens=512 を送っていたので、どの種類のメッセージでもそれより遅く・高くしない
+    params, rule, _ = policy.build(message)
+    assert params["max_new_tokens"] <= 512
+
+
+def test_client_options_are_clamped(policy):
+    params, _, adjusted = policy.build("hello", {"max_new_tokens": 100000, "temperature": 9})
+    assert params["max_new_tokens"] == policy.limits.max_new_tokens
+    assert params["temperature"] == policy.limits.max_temperature
+    assert set(adjusted) == {"max_new_tokens", "temperature"}
+
+
+def test_invalid_options_raise(policy):
+    with pytest.raises(GenerationOptionsError):
+        policy.build("hello", {"temperature": "hot"})
@@ -0,0 +1,111 @@
+# tests/test_http_pool.py
+import http.client
+import socketserver
+import threading
+import time
+
+import pytest
+
+from http_pool import ConnectionPool, PoolTimeout
+
+OK = b"HTTP/1.1 200 OK\r\nContent-Length: 2\r\n\r\nok"
+
+
+def serve(replies):
+    """
+    1 つの接続で受けた n 番目のリクエストに replies[n] を返す HTTP サーバーを起動し、URL を返します。
+
+    replies[n] が None ならリクエストを読んだ後、何も返さずに接続を閉じます。
+    """
+
+    class Handler(socketserver.BaseRequestHandler):
+        def handle(self):
+            buffer = b""
+            for reply in replies:
+                while b"\r\n\r\n" not in buffer:
+                    data = self.request.recv(4096)
+                    if not data:
+                        return
+                    buffer += data
+                buffer = buffer.split(b"\r\n\r\n", 1)[1]
+                if reply is None:
+                    return
+                self.request.sendall(reply)
+
+    server = socketserver.ThreadingTCPServer(("127.0.0.1", 0), Handler)
+    server.daemon_threads = True
+    threading.Thread(target=server.serve_forever, daemon=True).start()
+    return f"http://127.0.0.1:{server.server_address[1]}"
+
+
+def test_requests_wait_for_a_free_connection():
+    pool = ConnectionPool(serve([OK] * 10), max_connections=2)
+    held = [pool.request("GET", "/", timeout=5) for _ in range(2)]
+    started = time.monotonic()
+    with pytest.raises(PoolTimeout):
+        pool.request("GET", "/", timeout=0.1)
+    assert time.monotonic() - started < 1
+    assert pool.open_connections == 2
+    # 使用中の接続が閉じられれば待っていたリクエストも送れる
+    threading.Timer(0.05, held[0].close).start()
+    with pool.request("GET", "/", timeout=5) as response:
+        assert response.read() == b"ok"
+    # 読み終えていない応答を閉じた接続は再利用せずに閉じる
+    held[1].close()
+    assert pool.open_connections == 1
+    assert pool.stats["pool_timeouts"] == 1
+    pool.close()
+    assert pool.open_connections == 0
+
+
+def test_released_idle_connection_is_handed_to_a_waiter():
+    pool = ConnectionPool(serve([OK] * 10), max_connections=1)
+    held = pool.request("GET", "/", timeout=5)
+
+    def release():
+        held.read()
+        held.close()
+
+    threading.Timer(0.05, release).start()
+    with pool.request("GET", "/", timeout=5) as response:
+        assert response.timings["reused"]
+        assert response.read() == b"ok"
+    assert pool.stats["connections_created"] == 1
+
+
+def test_request_count_is_exact_across_threads():
+    pool = ConnectionPool(serve([OK] * 50), maxsize=4, max_connections=4)
+
+    def call():
+        for _ in range(10):
+            with pool.request("GET", "/", timeout=5) as response:
+                response.read()
+
+    threads = [threading.Thread(target=call) for _ in range(4)]
+    for thread in threads:
+        thread.start()
+    for thread in threads:
+        thread.join(10)
+    assert pool.stats["requests"] == 40
+    assert pool.open_connections <= 4
+
+
+def test_stale_socket_is_retried_when_nothing_was_received():
+    pool = ConnectionPool(serve([OK, None]))
+    with pool.request("GET", "/", timeout=5) as response:
+        response.read()
+    # 再利用した接続はリクエストを読んだ後に閉じられるが、何も受け取っていないので新しい接続で再送する
+    with pool.request("GET", "/", timeout=5) as response:
+        assert (response.status, response.read()) == (200, b"ok")
+    assert (pool.stats["stale_reconnects"], pool.stats["connections_created"]) == (1, 2)
+
+
+def test_garbled_response_on_a_reused_socket_is_not_retried():
+    pool = ConnectionPool(serve([OK, b"NOT-HTTP\r\n\r\n"]))
+    with pool.request("GET", "/", timeout=5) as response:
+        response.read()
+    # サーバーが何かを返した後の失敗は、リクエストを処理した可能性があるので再送しない
+    with pytest.raises(http.client.BadStatusLine):
+        pool.request("GET", "/", timeout=5)
+    assert pool.stats["stale_reconnects"] == 0
+    assert pool.open_connections == 0
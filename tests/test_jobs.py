@@ -0,0 +1,142 @@
+# tests/test_jobs.py
+import json
+import time
+
+import pytest
+
+import stub_backend
+from jobs import FAILED, QUEUED, RUNNING, SUCCEEDED, MemoryJobStore, PartialWriter, SQLiteJobStore
+from loadtest import FakeContext, make_event
+
+
+@pytest.fixture(params=["memory", "sqlite"])
+def store(request, tmp_path):
+    if request.param == "memory":
+        return MemoryJobStore()
+    return SQLiteJobStore(str(tmp_path / "jobs.db"))
+
+
+def test_job_lifecycle(store):
+    store.create("job1", "alice")
+    assert store.get("job1")["status"] == QUEUED
+    assert store.start("job1")
+    store.update_partial("job1", "Hel")
+    job = store.get("job1")
+    assert (job["status"], job["partial"], job["attempts"]) == (RUNNING, "Hel", 1)
+    store.finish("job1", SUCCEEDED, 200, '{"success": true}')
+    job = store.get("job1")
+    assert (job["status"], job["statusCode"], job["result"]) == (SUCCEEDED, 200, '{"success": true}')
+    # キューが同じメッセージを再送しても、終了済みのジョブは実行しない
+    assert not store.start("job1")
+    assert not store.start("missing")
+
+
+def test_partial_writer_writes_at_interval():
+    writes = []
+    writer = PartialWriter(writes.append, interval=0)
+    for token in ("a", "b", "c"):
+        writer.add(token)
+    assert writes == ["a", "ab", "abc"]
+    quiet = PartialWriter(writes.append, interval=3600)
+    quiet.add("x")
+    assert quiet.writes == 0
+
+
+def wait_for_job(index, job_id, user, timeout=10):
+    deadline = time.monotonic() + timeout
+    while time.monotonic() < deadline:
+        event = {**make_event({}, user), "httpMethod": "GET", "body": None,
+                 "pathParameters": {"jobId": job_id}, "queryStringParameters": {"wait": "1"}}
+        body = json.loads(index.lambda_handler(event, FakeContext("poll", 30000))["body"])
+        if body["status"] in (SUCCEEDED, FAILED):
+            return body
+    raise AssertionError("job did not finish")
+
+
+def test_async_job_uses_the_backend_engine(load_index):
+    model = stub_backend.GenerationModel(ttft_ms=5, ttft_sigma=0, tokens_per_second=2000, output_tokens=8, seed=0)
+    urls = [stub_backend.start(model=model)[2] for _ in range(2)]
+    index = load_index(JOB_QUEUE="memory", JOB_STORE="memory", BACKEND_URLS=",".join(urls))
+    response = index.lambda_handler(make_event({"message": "hello there, how are you", "async": True}, 1),
+                                     FakeContext("req", 30000))
+    assert response["statusCode"] == 202
+    job_id = json.loads(response["body"])["jobId"]
+    body = wait_for_job(index, job_id, 1)
+    assert body["status"] == SUCCEEDED
+    assert body["result"]["success"] and body["result"]["response"]
+    # 同期リクエストと同じく、複数バックエンドのエンジン経由で生成している
+    backends = index.upstream_engine.snapshot()["backends"]
+    assert sum(stats["latency"]["count"] for stats in backends.values()) >= 1
+    # 他のユーザーからは見えない
+    other = {**make_event({}, 2), "httpMethod": "GET", "body": None, "pathParameters": {"jobId": job_id}}
+    assert index.lambda_handler(other, FakeContext("poll", 30000))["statusCode"] == 404
+
+
+def test_async_job_streams_partial_text_from_a_single_backend(load_index):
+    model = stub_backend.GenerationModel(ttft_ms=5, ttft_sigma=0, tokens_per_second=200, output_tokens=40, seed=0)
+    url = stub_backend.start(model=model)[2]
+    index = load_index(JOB_QUEUE="memory", JOB_STORE="memory", NGROK_URL=url, JOB_PARTIAL_INTERVAL="0")
+    response = index.lambda_handler(make_event({"message": "write a long story", "async": True}, 1),
+                                    FakeContext("req", 30000))
+    job_id = json.loads(response["body"])["jobId"]
+    body = wait_for_job(index, job_id, 1)
+    assert body["status"] == SUCCEEDED
+    assert index.job_store.get(job_id)["partial"]
+
+
+@pytest.fixture
+def aws(monkeypatch):
+    moto = pytest.importorskip("moto")
+    import boto3
+    for key, value in (("AWS_ACCESS_KEY_ID", "test"), ("AWS_SECRET_ACCESS_KEY", "test"),
+                       ("AWS_DEFAULT_REGION", "us-east-1")):
+        monkeypatch.setenv(key, value)
+    with moto.mock_aws():
+        boto3.client("dynamodb").create_table(
+            TableName="jobs", KeySchema=[{"AttributeName": "jobId", "KeyType": "HASH"}],
+            AttributeDefinitions=[{"AttributeName": "jobId", "AttributeType": "S"}], BillingMode="PAY_PER_REQUEST")
+        boto3.client("s3").create_bucket(Bucket="job-results")
+        yield
+
+
+def test_dynamodb_store_keeps_large_results_in_s3(aws):
+    from jobs import DynamoDBJobStore
+    store = DynamoDBJobStore("jobs", result_bucket="job-results", max_result_bytes=1024, max_partial_bytes=100)
+    store.create("job1", "alice")
+    assert store.start("job1")
+    store.update_partial("job1", "あ" * 1000)
+    assert store.get("job1")["partial"] == "あ" * 33
+    result = json.dumps({"success": True, "response": "x" * 5000})
+    store.finish("job1", SUCCEEDED, 200, result)
+    job = store.get("job1")
+    assert (job["status"], job["result"]) == (SUCCEEDED, result)
+    small = json.dumps({"success": True, "response": "ok"})
+    store.create("job2", "alice")
+    store.finish("job2", SUCCEEDED, 200, small)
+    assert store.get("job2")["result"] == small
+
+
+def test_dynamodb_store_rejects_large_results_without_a_bucket(aws):
+    from jobs import DynamoDBJobStore, JobResultTooLarge
+    store = DynamoDBJobStore("jobs", max_result_bytes=1024)
+    store.create("job1", "alice")
+    with pytest.raises(JobResultTooLarge):
+        store.finish("job1", SUCCEEDED, 200, "x" * 5000)
+
+
+def test_job_fails_when_its_result_cannot_be_stored(load_index, monkeypatch):
+    url = stub_backend.start(model=stub_backend.GenerationModel(ttft_ms=5, ttft_sigma=0, output_tokens=4, seed=0))[2]
+    index = load_index(JOB_QUEUE="memory", JOB_STORE="memory", NGROK_URL=url)
+    finish = index.job_store.finish
+
+    def finish_too_large(job_id, status, status_code, result):
+        if status == SUCCEEDED:
+            raise RuntimeError("Item size has exceeded the maximum allowed size")
+        finish(job_id, status, status_code, result)
+
+    monkeypatch.setattr(index.job_store, "finish", finish_too_large)
+    response = index.lambda_handler(make_event({"message": "hello", "async": True}, 1), FakeContext("req", 30000))
+    body = wait_for_job(index, json.loads(response["body"])["jobId"], 1)
+    assert body["status"] == FAILED
+    assert body["statusCode"] == 500
+    assert not body["result"]["success"]
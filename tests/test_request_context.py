@@ -0,0 +1,86 @@
+# tests/test_request_context.py
+# 並行して処理するリクエスト (非同期ジョブのローカルワーカー) のログのコンテキストと計測が混ざらないこと
+import io
+import json
+import threading
+
+from loadtest import FakeContext, make_event
+from metrics import Instrumentation, MemorySink
+from structured_log import StructuredLogger
+
+
+def run_interleaved(first, second):
+    # first の途中 (pause 後) で second を最後まで実行する
+    pause, resume = threading.Event(), threading.Event()
+
+    def run_first():
+        first(pause, resume)
+
+    def run_second():
+        pause.wait(5)
+        second()
+        resume.set()
+
+    threads = [threading.Thread(target=run_first), threading.Thread(target=run_second)]
+    for thread in threads:
+        thread.start()
+    for thread in threads:
+        thread.join(5)
+
+
+def test_log_context_and_body_sampling_are_per_thread():
+    stream = io.StringIO()
+    logger = StructuredLogger("test_request_context")
+    logger.configure(level="INFO", body_sample_rate=1.0, asynchronous=False, stream=stream)
+    logger.begin_request(request_id="main")
+
+    def first(pause, resume):
+        logger.begin_request(request_id="job-1")
+        pause.set()
+        resume.wait(5)
+        logger.body("Generated", "text", "first answer")
+
+    def second():
+        logger.body_sample_rate = 0.0
+        logger.begin_request(request_id="job-2")
+        logger.body("Generated", "text", "second answer")
+
+    run_interleaved(first, second)
+    records = [json.loads(line) for line in stream.getvalue().splitlines()]
+    assert [(r["request_id"], r.get("text")) for r in records] == [("job-2", None), ("job-1", "first answer")]
+    assert logger.context == {"request_id": "main"}
+
+
+def test_phase_timings_are_per_thread():
+    metrics = Instrumentation(sink=MemorySink(), flush_seconds=3600)
+    results = {}
+
+    def first(pause, resume):
+        metrics.begin()
+        metrics.record("body_parse", 1.0)
+        pause.set()
+        resume.wait(5)
+        metrics.record("total", 10.0)
+        results["first"] = metrics.end()
+
+    def second():
+        metrics.begin()
+        metrics.record("body_parse", 2.0)
+        metrics.record("total", 20.0)
+        results["second"] = metrics.end()
+
+    run_interleaved(first, second)
+    assert results == {"first": {"body_parse": 1.0, "total": 10.0}, "second": {"body_parse": 2.0, "total": 20.0}}
+    metrics.flush()
+    total = metrics.sink.records[0]["total_ms"]
+    assert (total["Count"], total["Sum"]) == (2, 30.0)
+
+
+def test_each_invocation_emits_its_metrics(load_index, monkeypatch):
+    # 実行環境は応答後に凍結・破棄され得るので、次の呼び出しを待たずに出力する
+    index = load_index(METRICS_SINK="memory", SINGLEFLIGHT_ENABLED="false")
+    monkeypatch.setattr(index, "generate_text", lambda *args, **kwargs: ("hi", True, 1))
+    response = index.lambda_handler(make_event({"message": "hello"}, 1), FakeContext("req", 30000))
+    assert response["statusCode"] == 200
+    phases = [record for record in index.metrics.sink.records if "total_ms" in record]
+    assert [record["total_ms"]["Count"] for record in phases] == [1]
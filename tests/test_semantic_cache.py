@@ -0,0 +1,75 @@
+# tests/test_semantic_cache.py
+import pytest
+
+from semantic_cache import HashingEmbedder, SemanticCache, conflict_terms
+
+NEAR_MISSES = [
+    ("How do I sort a list in Python so it sorts ascending?", "How do I sort a list in Python so it sorts descending?"),
+    ("Is it safe to run rm -rf on the build directory?", "Is it not safe to run rm -rf on the build directory?"),
+    ("Is it safe to run rm -rf on the build directory?", "Isn't it safe to run rm -rf on the build directory?"),
+    ("Is TCP faster than UDP?", "Is UDP faster than TCP?"),
+    ("Should I use TCP or UDP for video calls?", "Should I use UDP or TCP for video calls?"),
+    ("How do I migrate from MySQL to PostgreSQL?", "How do I migrate from PostgreSQL to MySQL?"),
+    ("東京から大阪への行き方", "大阪から東京への行き方"),
+    ("この薬は妊娠中に飲めますか", "この薬は妊娠中に飲めませんか"),
+]
+
+PARAPHRASES = [
+    ("How do I reset my password?", "How can I reset the password?"),
+    ("パスワードをリセットする方法を教えてください", "パスワードのリセット方法は?"),
+    ("返品の手続きを教えてください", "返品の手続きは?"),
+    ("Pythonでリストをソートする方法", "Pythonのリストのソート方法を教えてください"),
+    ("How do I reset my password?", "I forgot my password, how do I reset it?"),
+]
+
+
+@pytest.mark.parametrize("cached, question", NEAR_MISSES)
+def test_near_misses_have_conflicting_terms(cached, question):
+    assert conflict_terms(cached) != conflict_terms(question)
+
+
+@pytest.mark.parametrize("cached, question", PARAPHRASES)
+def test_paraphrases_have_no_conflicting_terms(cached, question):
+    assert conflict_terms(cached) == conflict_terms(question)
+
+
+@pytest.fixture
+def cache():
+    pytest.importorskip("numpy")
+    return SemanticCache(HashingEmbedder(256), threshold=0.85, max_bytes=256 * 1024)
+
+
+@pytest.mark.parametrize("cached, question", NEAR_MISSES)
+def test_near_misses_are_not_served_from_cache(cache, cached, question):
+    namespace = cache.namespace([], {})
+    cache.set(cache.vectorize(cached), namespace, "cached answer")
+    answer, _ = cache.get(cache.vectorize(question), namespace)
+    assert answer is None
+
+
+@pytest.mark.parametrize("cached, question", PARAPHRASES)
+def test_paraphrases_are_served_from_cache(cache, cached, question):
+    namespace = cache.namespace([], {})
+    cache.set(cache.vectorize(cached), namespace, "cached answer")
+    answer, similarity = cache.get(cache.vectorize(question), namespace)
+    assert answer == "cached answer"
+    assert similarity >= 0.85
+
+
+def test_other_conversations_are_not_searched(cache):
+    cache.set(cache.vectorize("How do I reset my password?"), cache.namespace([], {}), "cached answer")
+    history = [{"role": "user", "content": "I use the mobile app"}]
+    answer, _ = cache.get(cache.vectorize("How do I reset my password?"), cache.namespace(history, {}))
+    assert answer is None
+
+
+def test_reworded_paraphrase_hits_and_negation_misses(cache):
+    namespace = cache.namespace([], {})
+    cache.set(cache.vectorize("How do I reset my password?"), namespace, "cached answer")
+    # 内容語が違っても (forgot, it が増えている) 類似度がしきい値以上なら返す
+    answer, similarity = cache.get(cache.vectorize("I forgot my password, how do I reset it?"), namespace)
+    assert answer == "cached answer" and similarity >= 0.85
+    # 否定は類似度がしきい値以上でも返さない
+    question = cache.vectorize("How do I not reset my password?")
+    assert float(question[0] @ cache.vectorize("How do I reset my password?")[0]) >= 0.85
+    assert cache.get(question, namespace)[0] is None
@@ -0,0 +1,114 @@
+# tests/test_singleflight.py
+import asyncio
+import threading
+import time
+
+import pytest
+
+from singleflight import AsyncSingleFlight, SingleFlight, SQLiteFlightStore
+
+
+def slow_leader(flight, key, release):
+    started = threading.Event()
+
+    def fn():
+        started.set()
+        release.wait(5)
+        return "leader"
+
+    thread = threading.Thread(target=flight.do, args=(key, fn))
+    thread.start()
+    started.wait(5)
+    return thread
+
+
+def test_waiters_share_the_leaders_result():
+    flight = SingleFlight()
+    release = threading.Event()
+    leader = slow_leader(flight, "k", release)
+    threading.Timer(0.05, release.set).start()
+    assert flight.do("k", lambda: "follower", wait_timeout=5) == ("leader", True)
+    leader.join(5)
+    assert flight.stats()["upstream_calls"] == 1
+
+
+def test_waiters_stop_waiting_at_their_deadline():
+    flight = SingleFlight()
+    release = threading.Event()
+    leader = slow_leader(flight, "k", release)
+    started = time.monotonic()
+    # 残り時間を過ぎてまで先行の呼び出しを待たず、自分で呼び出す
+    assert flight.do("k", lambda: "follower", wait_timeout=0.05) == ("follower", False)
+    assert time.monotonic() - started < 1
+    release.set()
+    leader.join(5)
+    assert flight.stats()["upstream_calls"] == 2
+
+
+def test_cross_process_waiters_stop_waiting_at_their_deadline(tmp_path):
+    path = str(tmp_path / "flights.db")
+    release = threading.Event()
+    # 別プロセスの代わりに、ストアを共有する別のインスタンスがロックを持っている状態にする
+    leader = slow_leader(SingleFlight(store=SQLiteFlightStore(path)), "k", release)
+    flight = SingleFlight(store=SQLiteFlightStore(path))
+    started = time.monotonic()
+    assert flight.do("k", lambda: "follower", wait_timeout=0.1) == ("follower", False)
+    assert time.monotonic() - started < 1
+    release.set()
+    leader.join(5)
+
+
+def test_async_followers_share_the_leaders_result():
+    flight = AsyncSingleFlight()
+    calls = []
+
+    async def generate():
+        calls.append(1)
+        await asyncio.sleep(0.05)
+        return "answer"
+
+    async def run():
+        return await asyncio.gather(*(flight.do("k", generate) for _ in range(3)))
+
+    assert asyncio.run(run()) == [("answer", False), ("answer", True), ("answer", True)]
+    assert len(calls) == 1
+    assert flight.stats() == {"calls": 3, "upstream_calls": 1, "saved_upstream_calls": 2, "in_flight": 0}
+
+
+def test_async_followers_get_the_leaders_exception():
+    flight = AsyncSingleFlight()
+
+    async def fail():
+        await asyncio.sleep(0.05)
+        raise ValueError("backend error")
+
+    async def run():
+        return await asyncio.gather(*(flight.do("k", fail) for _ in range(2)), return_exceptions=True)
+
+    results = asyncio.run(run())
+    assert [type(r) for r in results] == [ValueError, ValueError]
+    assert flight.stats()["upstream_calls"] == 1
+
+
+def test_cancelled_async_leader_hands_over_to_a_follower():
+    flight = AsyncSingleFlight()
+    calls = []
+
+    async def generate():
+        calls.append(1)
+        await asyncio.sleep(0.05)
+        return "answer"
+
+    async def run():
+        leader = asyncio.create_task(flight.do("k", generate))
+        await asyncio.sleep(0)
+        followers = [asyncio.create_task(flight.do("k", generate)) for _ in range(2)]
+        await asyncio.sleep(0.01)
+        # リーダーのクライアントが切断しても、待っていたタスクの呼び出しは続ける
+        leader.cancel()
+        with pytest.raises(asyncio.CancelledError):
+            await leader
+        return await asyncio.gather(*followers)
+
+    assert asyncio.run(run()) == [("answer", False), ("answer", True)]
+    assert len(calls) == 2
@@ -0,0 +1,165 @@
+# tests/test_upstream.py
+import asyncio
+import http.server
+import json
+import socketserver
+import threading
+import time
+
+import pytest
+
+import stub_backend
+from loadtest import FakeContext, make_event
+from upstream import Backend, UpstreamEngine, UpstreamProtocolError
+
+OK = b"HTTP/1.1 200 OK\r\nContent-Length: 2\r\n\r\nok"
+
+
+def serve(handle):
+    """handle(リクエストハンドラー) で応答する HTTP サーバーを起動し、URL を返します。"""
+
+    class Handler(http.server.BaseHTTPRequestHandler):
+        protocol_version = "HTTP/1.1"
+
+        def do_POST(self):
+            self.rfile.read(int(self.headers.get("Content-Length", 0)))
+            handle(self)
+
+        def log_message(self, format, *args):
+            pass
+
+    server = socketserver.ThreadingTCPServer(("127.0.0.1", 0), Handler)
+    server.daemon_threads = True
+    threading.Thread(target=server.serve_forever, daemon=True).start()
+    return f"http://127.0.0.1:{server.server_address[1]}"
+
+
+def serve_raw(replies, received):
+    """
+    1 つの接続で受けた n 番目のリクエストに replies[n] をそのまま返して、最後の応答の後に接続を閉じるサーバーを起動します。
+
+    受け取ったリクエストの数を received に追加していきます。
+    """
+
+    class Handler(socketserver.BaseRequestHandler):
+        def handle(self):
+            buffer = b""
+            for reply in replies:
+                while b"\r\n\r\n" not in buffer:
+                    data = self.request.recv(4096)
+                    if not data:
+                        return
+                    buffer += data
+                head, buffer = buffer.split(b"\r\n\r\n", 1)
+                length = int(next(line.split(b":")[1] for line in head.split(b"\r\n")
+                                  if line.lower().startswith(b"content-length")))
+                while len(buffer) < length:
+                    buffer += self.request.recv(4096)
+                buffer = buffer[length:]
+                received.append(1)
+                self.request.sendall(reply)
+
+    server = socketserver.ThreadingTCPServer(("127.0.0.1", 0), Handler)
+    server.daemon_threads = True
+    threading.Thread(target=server.serve_forever, daemon=True).start()
+    return f"http://127.0.0.1:{server.server_address[1]}"
+
+
+def post_twice(url):
+    # 2 回目は 1 回目の接続を再利用する
+    async def run():
+        backend = Backend(url)
+        first = await backend.post("/generate", b"{}", {})
+        return first, await backend.post("/generate", b"{}", {})
+    return asyncio.run(run())
+
+
+def test_reused_connection_closed_before_responding_is_retried():
+    received = []
+    # 2 回目のリクエストには何も返さずに閉じるが、再送先の新しい接続には応答する
+    url = serve_raw([OK, b""], received)
+    assert post_twice(url) == ((200, b"ok"), (200, b"ok"))
+    assert len(received) == 3
+
+
+@pytest.mark.parametrize("partial", [b"HTTP/1.1 20", b"HTTP/1.1 200 OK\r\nContent-Length: 10\r\n\r\nok"])
+def test_reused_connection_closed_mid_response_is_not_resent(partial):
+    received = []
+    url = serve_raw([OK, partial], received)
+    with pytest.raises(UpstreamProtocolError):
+        post_twice(url)
+    # 応答を一部でも受け取った後は、同じ生成をもう一度させないよう再送しない
+    assert len(received) == 2
+
+
+def truncated(handler):
+    # Content-Length より短いボディを送って切断する
+    handler.send_response(200)
+    handler.send_header("Content-Length", "100")
+    handler.end_headers()
+    handler.wfile.write(b'{"generated_text": "')
+    handler.wfile.flush()
+    handler.close_connection = True
+
+
+def garbage(handler):
+    handler.wfile.write(b"NOT-HTTP\r\n\r\n")
+    handler.close_connection = True
+
+
+@pytest.mark.parametrize("handle", [truncated, garbage])
+def test_malformed_responses_are_retryable_connection_errors(handle):
+    engine = UpstreamEngine([serve(handle)])
+    with pytest.raises(UpstreamProtocolError) as raised:
+        engine.post_sync("/generate", b"{}", {}, timeout=5)
+    assert isinstance(raised.value, ConnectionError)
+    assert engine.snapshot()["backends"][engine.backends[0].url]["errors"] == 1
+
+
+def test_malformed_response_falls_over_to_another_backend():
+    model = stub_backend.GenerationModel(ttft_ms=5, ttft_sigma=0, tokens_per_second=2000, output_tokens=4, seed=0)
+    good = stub_backend.start(model=model)[2]
+    engine = UpstreamEngine([serve(truncated), good], default_hedge_delay_ms=5000)
+    for _ in range(4):
+        status, body, url, _ = engine.post_sync("/generate", b'{"prompt": "hi"}', {}, timeout=5)
+        assert (status, url) == (200, good)
+        assert json.loads(body)["generated_text"]
+
+
+def test_post_sync_calls_from_threads_run_concurrently():
+    model = stub_backend.GenerationModel(ttft_ms=300, ttft_sigma=0, tokens_per_second=2000, output_tokens=4, seed=0)
+    engine = UpstreamEngine([stub_backend.start(model=model)[2]], default_hedge_delay_ms=5000)
+    engine.post_sync("/generate", b'{"prompt": "warm"}', {}, timeout=5)
+    statuses = []
+
+    def call():
+        statuses.append(engine.post_sync("/generate", b'{"prompt": "hi"}', {}, timeout=5)[0])
+
+    threads = [threading.Thread(target=call) for _ in range(4)]
+    started = time.monotonic()
+    for thread in threads:
+        thread.start()
+    for thread in threads:
+        thread.join(10)
+    # 1 件ずつ順番に処理すると 1.2 秒以上かかる
+    assert time.monotonic() - started < 0.9
+    assert statuses == [200] * 4
+
+
+def test_undecodable_200_response_is_retried(load_index):
+    calls = []
+
+    def flaky(handler):
+        calls.append(1)
+        body = b'{"generated_text": "trunc' if len(calls) == 1 else b'{"generated_text": "hello"}'
+        handler.send_response(200)
+        handler.send_header("Content-Type", "application/json")
+        handler.send_header("Content-Length", str(len(body)))
+        handler.end_headers()
+        handler.wfile.write(body)
+
+    index = load_index(NGROK_URL=serve(flaky), SINGLEFLIGHT_ENABLED="false")
+    response = index.lambda_handler(make_event({"message": "hi"}, 1), FakeContext("req", 30000))
+    assert response["statusCode"] == 200
+    assert json.loads(response["body"])["response"] == "hello"
+    assert len(calls) == 2